@@ -0,0 +1,40 @@
+"""
+Add rolling summary columns to ai_conversation_contexts
+
+Revision ID: 0135
+Revises: 0134
+Create Date: 2026-10-19
+"""
+
+from alembic import op
+
+revision = "0135"
+down_revision = "0134"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.execute(
+        """
+        -- 对话滚动摘要：summary 覆盖 summary_until（含）之前的全部消息
+        ALTER TABLE ai_conversation_contexts
+        ADD COLUMN IF NOT EXISTS summary TEXT,
+        ADD COLUMN IF NOT EXISTS summary_until TIMESTAMPTZ,
+        ADD COLUMN IF NOT EXISTS summary_updated_at TIMESTAMPTZ;
+
+        COMMENT ON COLUMN ai_conversation_contexts.summary IS '对话滚动摘要（增量更新）';
+        COMMENT ON COLUMN ai_conversation_contexts.summary_until IS '摘要已覆盖的最后一条消息的 created_at';
+        """
+    )
+
+
+def downgrade() -> None:
+    op.execute(
+        """
+        ALTER TABLE ai_conversation_contexts
+        DROP COLUMN IF EXISTS summary_updated_at,
+        DROP COLUMN IF EXISTS summary_until,
+        DROP COLUMN IF EXISTS summary;
+        """
+    )
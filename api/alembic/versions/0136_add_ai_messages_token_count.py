@@ -0,0 +1,35 @@
+"""
+Add token_count column to ai_messages
+
+Revision ID: 0136
+Revises: 0135
+Create Date: 2026-10-19
+"""
+
+from alembic import op
+
+revision = "0136"
+down_revision = "0135"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.execute(
+        """
+        -- 保存消息时用模型分词器计算的 token 数（历史消息为 NULL，查询时按字符估算）
+        ALTER TABLE ai_messages
+        ADD COLUMN IF NOT EXISTS token_count INTEGER;
+
+        COMMENT ON COLUMN ai_messages.token_count IS '消息 token 数（保存时按对话模型分词器计算）';
+        """
+    )
+
+
+def downgrade() -> None:
+    op.execute(
+        """
+        ALTER TABLE ai_messages
+        DROP COLUMN IF EXISTS token_count;
+        """
+    )
@@ -0,0 +1,50 @@
+"""
+Add backfill_jobs table
+
+Revision ID: 0137
+Revises: 0136
+Create Date: 2026-10-19
+"""
+
+from alembic import op
+
+revision = "0137"
+down_revision = "0136"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.execute(
+        """
+        -- 书籍批量补处理（OCR / 向量索引）任务：游标持久化，进程中断后可从断点继续
+        CREATE TABLE IF NOT EXISTS backfill_jobs (
+            id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL CHECK (kind IN ('ocr', 'vector')),
+            scope TEXT NOT NULL DEFAULT 'missing' CHECK (scope IN ('missing', 'all')),
+            status TEXT NOT NULL DEFAULT 'running' CHECK (status IN ('running', 'paused', 'completed')),
+            cursor_created_at TIMESTAMPTZ,
+            cursor_id UUID,
+            total INTEGER NOT NULL DEFAULT 0,
+            enqueued INTEGER NOT NULL DEFAULT 0,
+            rate_started_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            rate_base INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            finished_at TIMESTAMPTZ
+        );
+
+        COMMENT ON TABLE backfill_jobs IS '书籍批量补处理任务（按 created_at, id 游标分批投递）';
+        COMMENT ON COLUMN backfill_jobs.scope IS 'missing: 仅未处理的书籍；all: 全部书籍（全量重建）';
+        COMMENT ON COLUMN backfill_jobs.rate_started_at IS '投递速率统计起点（恢复运行时重置，用于估算剩余时间）';
+        COMMENT ON COLUMN backfill_jobs.rate_base IS 'rate_started_at 时的 enqueued 值';
+        """
+    )
+
+
+def downgrade() -> None:
+    op.execute(
+        """
+        DROP TABLE IF EXISTS backfill_jobs;
+        """
+    )
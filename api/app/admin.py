@@ -7,6 +7,7 @@
 - 翻译管理：列表/新增/更新/删除
 - 计费流水：账户与流水查询
 - 区域定价：列表与新增/更新
+- GPU 队列：按用户的积压与等待时长（【2026-10-19】公平调度）
 
 说明：
 - 仅新增注释，不改动管理员验证与业务逻辑
@@ -414,3 +415,20 @@ async def upsert_regional_price(body: dict = Body(...), _=Depends(require_admin)
             {"id": pid, "p": plan_code, "c": currency, "r": period, "a": amount_minor},
         )
     return {"status": "success", "data": {"id": pid}}
+
+
+@router.get("/gpu/queues")
+async def gpu_queue_stats(_=Depends(require_admin)):
+    """GPU 队列积压：Celery 队列中的待执行数 + 每个用户子队列的积压与最长等待，以及 GPU 锁持有者与等待者"""
+    from .services.fair_queue import FAIR_QUEUES, fair_queue_stats, queue_depth
+    from .services.gpu_lock import get_gpu_lock_status
+
+    try:
+        data = {
+            queue: {"ready": queue_depth(queue), "tenants": fair_queue_stats(queue)}
+            for queue in FAIR_QUEUES
+        }
+        data["gpu_lock"] = get_gpu_lock_status()
+        return {"status": "success", "data": data}
+    except Exception as e:
+        raise HTTPException(status_code=503, detail=f"queue_stats_unavailable: {e}")
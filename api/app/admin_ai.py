@@ -21,6 +21,7 @@ from sqlalchemy import text
 from .admin import require_admin
 from .db import engine
 from .services.llm_provider import get_provider, ChatMessage
+from .services.model_registry import bump_model_config_version
 
 router = APIRouter(prefix="/api/v1/admin/ai-models", tags=["admin-ai"])
 
@@ -226,6 +227,9 @@ async def create_ai_model(
             },
         )
 
+    # 【2026-10-19】通知各进程重新加载模型配置
+    bump_model_config_version()
+
     return {
         "status": "success",
         "data": {"id": model_id},
@@ -347,6 +351,9 @@ async def update_ai_model(
             update_sql = f"UPDATE ai_models SET {', '.join(updates)} WHERE id = cast(:id as uuid)"
             await conn.execute(text(update_sql), params)
 
+    # 【2026-10-19】通知各进程重新加载模型配置
+    bump_model_config_version()
+
     return {"status": "success"}
 
 
@@ -361,6 +368,9 @@ async def delete_ai_model(id: str, _=Depends(require_admin)):
         if not result.fetchone():
             raise HTTPException(status_code=404, detail="not_found")
 
+    # 【2026-10-19】通知各进程重新加载模型配置
+    bump_model_config_version()
+
     return {"status": "success"}
 
 
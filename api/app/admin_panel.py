@@ -7,6 +7,7 @@ from sqlalchemy import text
 
 from .auth import require_user
 from .db import engine
+from .services.model_registry import bump_model_config_version
 
 router = APIRouter(prefix="/api/v1/admin", tags=["admin"])
 
@@ -284,6 +285,7 @@ async def upsert_model(body: dict = Body(...), auth=Depends(require_user)):
             },
         )
         await _audit(conn, auth[0], "upsert_model", body or {})
+    bump_model_config_version()
     return {"status": "success"}
 
 
@@ -18,11 +18,14 @@ API 端点:
 """
 
 import asyncio
+import hashlib
 import json
 import logging
 import os
+import re
 import time
 import uuid
+from datetime import datetime, timezone
 from typing import Optional
 
 logger = logging.getLogger(__name__)
@@ -45,12 +48,19 @@ from .services.llm_provider import (
     SiliconFlowProvider,
 )
 from .services.llama_rag import search_book_chunks, search_user_notes
-
-try:
-    import tiktoken
-except ImportError:
-    tiktoken = None
-    logger.warning("[AI] tiktoken not installed, falling back to character-based estimation")
+from .services.book_context import load_book_contexts
+from .services.model_registry import get_model_registry
+from .services.token_counter import count_tokens
+from .services.ai_write_behind import build_reply_payload, enqueue_ai_reply, save_reply_message
+from .services.answer_cache import ANSWER_CACHE_ENABLED, lookup_answer, schedule_store_answer
+from .services.llm_governor import GovernorRejected, get_llm_governor
+from .services.llm_hedge import HEDGE_ENABLED, HedgedStream
+from .services.sse import coalesce_deltas, sse_event
+from .services.conversation_memory import (
+    ConversationMemory,
+    load_conversation_memory,
+    schedule_summary_refresh,
+)
 
 router = APIRouter(prefix="/api/v1/ai", tags=["ai"])
 
@@ -61,6 +71,10 @@ router = APIRouter(prefix="/api/v1/ai", tags=["ai"])
 AI_CHAT_LATENCY = Histogram("ai_chat_latency_seconds", "AI chat latency", ["mode"])
 AI_CHAT_TOTAL = Counter("ai_chat_total", "Total AI chat requests", ["mode", "status"])
 AI_TOKENS_CONSUMED = Counter("ai_tokens_consumed", "Tokens consumed", ["type"])
+# 【2026-10-19】QA 检索各阶段耗时（book_info / rewrite / search_speculative / search_rewritten / notes / total）
+AI_RETRIEVAL_STAGE_LATENCY = Histogram(
+    "ai_retrieval_stage_seconds", "QA retrieval stage latency", ["stage"]
+)
 
 # ============================================================================
 # Redis Cache
@@ -130,6 +144,9 @@ CREDITS_PER_1K_OUTPUT = 2  # 输出
 RAG_MAX_BOOKS = 50  # 最大支持的书籍数量（书架可能包含很多书）
 RAG_MAX_CITATIONS = 15  # 最大引用数量（发送给 LLM 的上下文）
 
+# 【2026-10-19】查询重写缓存（按 对话 + 轮次），SSE 重连/重试不重复调用 LLM
+QUERY_REWRITE_CACHE_TTL = int(os.getenv("AI_QUERY_REWRITE_CACHE_TTL", "3600"))
+
 
 def calculate_dynamic_top_k(query: str, book_count: int) -> int:
     """
@@ -221,129 +238,21 @@ class UpdateConversationRequest(BaseModel):
 
 
 def _sse_event(event_type: str, data: dict) -> bytes:
-    """生成 SSE 事件"""
-    payload = json.dumps({"type": event_type, **data}, ensure_ascii=False)
-    return f"data: {payload}\n\n".encode("utf-8")
+    """生成 SSE 事件（【2026-10-19】orjson 快速编码，见 services/sse.py）"""
+    return sse_event(event_type, data)
 
 
 async def get_default_model_config():
-    """获取默认模型配置"""
-    async with engine.begin() as conn:
-        # 先尝试获取默认模型
-        result = await conn.execute(
-            text(
-                """
-                SELECT provider, model_id, api_key_encrypted, endpoint,
-                       input_price_per_1k, output_price_per_1k
-                FROM ai_models
-                WHERE is_default = true AND active = true
-                LIMIT 1
-                """
-            )
-        )
-        row = result.fetchone()
-
-        if not row:
-            # 回退到任意激活的模型
-            result = await conn.execute(
-                text(
-                    """
-                    SELECT provider, model_id, api_key_encrypted, endpoint,
-                           input_price_per_1k, output_price_per_1k
-                    FROM ai_models
-                    WHERE active = true
-                    ORDER BY updated_at DESC
-                    LIMIT 1
-                    """
-                )
-            )
-            row = result.fetchone()
-
-        if not row:
-            # 使用环境变量配置
-            api_key = os.getenv("SILICONFLOW_API_KEY", "")
-            if not api_key:
-                raise HTTPException(status_code=503, detail="no_ai_model_configured")
-            return {
-                "provider": "siliconflow",
-                "model_id": DEFAULT_MODEL,
-                "api_key": api_key,
-                "endpoint": None,
-                "input_price": CREDITS_PER_1K_INPUT,
-                "output_price": CREDITS_PER_1K_OUTPUT,
-            }
-
-        # 解密 API Key
-        from .admin_ai import decrypt_api_key
-
-        api_key = decrypt_api_key(row[2]) if row[2] else os.getenv("SILICONFLOW_API_KEY", "")
-
-        return {
-            "provider": row[0],
-            "model_id": row[1],
-            "api_key": api_key,
-            "endpoint": row[3],
-            "input_price": float(row[4]) if row[4] else CREDITS_PER_1K_INPUT,
-            "output_price": float(row[5]) if row[5] else CREDITS_PER_1K_OUTPUT,
-        }
-
+    """
+    获取默认模型配置
 
-async def get_book_info(book_id: str, user_id: str) -> Optional[dict]:
-    """获取书籍信息（包括 content_sha256 用于向量搜索）"""
-    async with engine.begin() as conn:
-        result = await conn.execute(
-            text(
-                """
-                SELECT title, author, content_sha256
-                FROM books
-                WHERE id = cast(:id as uuid) AND user_id = cast(:uid as uuid)
-                """
-            ),
-            {"id": book_id, "uid": user_id},
-        )
-        row = result.fetchone()
-        if row:
-            return {
-                "id": book_id,
-                "title": row[0] or "未知书名", 
-                "author": row[1] or "未知作者",
-                "content_sha256": row[2]  # 用于向量搜索匹配
-            }
-        return None
-
-
-async def get_books_info_by_sha256(content_sha256_list: list[str], user_id: str) -> dict[str, dict]:
-    """根据content_sha256获取书籍信息映射"""
-    if not content_sha256_list:
-        return {}
-    
-    async with engine.begin() as conn:
-        # 构建IN子句
-        placeholders = ", ".join([f":sha_{i}" for i in range(len(content_sha256_list))])
-        params = {f"sha_{i}": sha for i, sha in enumerate(content_sha256_list)}
-        params["uid"] = user_id
-        
-        result = await conn.execute(
-            text(
-                f"""
-                SELECT id, title, author, content_sha256
-                FROM books
-                WHERE content_sha256 IN ({placeholders}) AND user_id = cast(:uid as uuid)
-                """
-            ),
-            params,
-        )
-        rows = result.fetchall()
-        
-        # 构建 sha256 -> book_info 映射
-        return {
-            row[3]: {
-                "id": str(row[0]),
-                "title": row[1] or "未知书名",
-                "author": row[2] or "未知作者",
-            }
-            for row in rows
-        }
+    【2026-10-19】改为读取进程内模型配置注册表：
+    配置与解密后的 API Key 只在首次或 admin 修改模型后加载，聊天请求不再查询数据库
+    """
+    model_config = await get_model_registry().get_default()
+    if model_config is None:
+        raise HTTPException(status_code=503, detail="no_ai_model_configured")
+    return model_config
 
 
 async def get_books_from_shelves(shelf_ids: list[str], user_id: str) -> list[str]:
@@ -411,82 +320,37 @@ async def check_credits(user_id: str, estimated_tokens: int = 1000) -> bool:
         return total_credits >= estimated_cost * 0.8
 
 
-async def deduct_credits(user_id: str, usage: LLMUsage, model_config: dict) -> int:
-    """扣除 Credits"""
+def calculate_credits(usage: LLMUsage, model_config: dict) -> int:
+    """按模型单价计算本次调用的 Credits"""
     input_cost = (usage.prompt_tokens / 1000) * model_config["input_price"]
     output_cost = (usage.completion_tokens / 1000) * model_config["output_price"]
-    total_cost = int(input_cost + output_cost)
-
-    if total_cost <= 0:
-        return 0
-
-    async with engine.begin() as conn:
-        # 扣除 Credits
-        await conn.execute(
-            text(
-                """
-                UPDATE credit_accounts
-                SET balance = GREATEST(0, balance - :cost),
-                    updated_at = now()
-                WHERE owner_id = cast(:uid as uuid)
-                """
-            ),
-            {"uid": user_id, "cost": total_cost},
-        )
-
-        # 记录流水
-        await conn.execute(
-            text(
-                """
-                INSERT INTO credit_ledger (id, owner_id, amount, currency, direction, reason, created_at)
-                VALUES (gen_random_uuid(), cast(:uid as uuid), :amount, 'CREDITS', 'debit', 'AI Chat', now())
-                """
-            ),
-            {"uid": user_id, "amount": -total_cost},
-        )
-
-    AI_TOKENS_CONSUMED.labels(type="prompt").inc(usage.prompt_tokens)
-    AI_TOKENS_CONSUMED.labels(type="completion").inc(usage.completion_tokens)
-
-    return total_cost
-
-
-async def get_conversation_history(
-    conversation_id: str, user_id: str, limit: int = 20
-) -> list[ChatMessage]:
-    """获取对话历史"""
-    async with engine.begin() as conn:
-        result = await conn.execute(
-            text(
-                """
-                SELECT role, content
-                FROM ai_messages
-                WHERE conversation_id = cast(:cid as uuid) AND owner_id = cast(:uid as uuid)
-                ORDER BY created_at DESC
-                LIMIT :limit
-                """
-            ),
-            {"cid": conversation_id, "uid": user_id, "limit": limit},
-        )
-        rows = result.fetchall()
-
-        # 反转顺序（从旧到新）
-        messages = [ChatMessage(role=r[0], content=r[1]) for r in reversed(rows)]
-        return messages
+    return int(input_cost + output_cost)
 
 
 async def save_message(
-    conversation_id: str, user_id: str, role: str, content: str, citations: list = None
+    conversation_id: str,
+    user_id: str,
+    role: str,
+    content: str,
+    citations: list = None,
+    model_id: Optional[str] = None,
 ) -> str:
-    """保存消息"""
+    """
+    保存消息
+
+    【2026-10-19】保存时用对话模型的分词器计算一次 token 数（token_count），
+    历史预算直接在 SQL 中累加，不再每轮重新估算
+    """
     import json
     message_id = str(uuid.uuid4())
+    # 分词器首次加载可能需要下载，放到线程中执行
+    token_count = await asyncio.to_thread(count_tokens, content, model_id)
     async with engine.begin() as conn:
         await conn.execute(
             text(
                 """
-                INSERT INTO ai_messages (id, conversation_id, owner_id, role, content, citations, created_at)
-                VALUES (cast(:id as uuid), cast(:cid as uuid), cast(:uid as uuid), :role, :content, :citations, now())
+                INSERT INTO ai_messages (id, conversation_id, owner_id, role, content, citations, token_count, created_at)
+                VALUES (cast(:id as uuid), cast(:cid as uuid), cast(:uid as uuid), :role, :content, :citations, :token_count, now())
                 """
             ),
             {
@@ -496,6 +360,7 @@ async def save_message(
                 "role": role,
                 "content": content,
                 "citations": json.dumps(citations) if citations else None,
+                "token_count": token_count,
             },
         )
 
@@ -514,166 +379,54 @@ async def save_message(
     return message_id
 
 
-def estimate_tokens(text: str) -> int:
-    """
-    估算文本的token数量
-    
-    优先使用tiktoken（精确），fallback到字符估算
-    """
-    if tiktoken:
-        try:
-            enc = tiktoken.get_encoding("cl100k_base")  # GPT-4/DeepSeek通用
-            return len(enc.encode(text))
-        except Exception as e:
-            logger.warning(f"[AI] tiktoken encoding failed: {e}, using character estimation")
-    
-    # Fallback: 字符估算（中文约1 char = 1 token，英文约4 chars = 1 token）
-    # 使用混合比例：假设50%中文50%英文
-    return int(len(text) * 0.75)
+# 【2026-10-19】本地判断是否需要查询重写（指代词 / 省略句启发式）
+# "这本书" / "本书" 指当前检索的书籍，检索范围已经限定，不需要改写
+_SELF_REFERENCE_PATTERN = re.compile(r"这本书|这部书|这部作品|本书|this book", re.IGNORECASE)
+# 中文按完整的指代短语匹配：单字 这/那/该/此/其 会命中 应该、因此、其他、尤其 等普通词
+_ANAPHORA_PATTERN = re.compile(
+    r"(?<![其吉])[他她它](们|的)?"
+    r"|[这那](个|些|位|种|类|样|里|儿|部|本|篇|章|节|段|句|首|条|点|件|次|一|两|几)"
+    r"|(?<![应活本])该(书|作者|人物|人|理论|观点|概念|作品|章|节|段|篇|部|事件)"
+    r"|(?<![因如彼从])此(人|书|事|处|时|观点|理论|概念|作品|章|节|段|句)"
+    r"|(?<![尤极与])其(中|观点|作品|思想|理论|主张|代表作|生平|一生)"
+    r"|上述|上面|前面|刚才|后来|然后|继续|还有|呢[？?]?\s*$"
+    r"|\b(he|she|it|its|his|her|him|they|them|their|this|that|these|those|above|previous|"
+    r"what about|and then)\b",
+    re.IGNORECASE,
+)
+# 过短的追问（如 "为啥？"、"Why?"）视为省略句
+_ELLIPSIS_MAX_CHARS = 5
 
 
-def truncate_history_by_tokens(
-    history: list[ChatMessage],
-    max_tokens: int = 8000,
-) -> list[ChatMessage]:
+def needs_query_rewrite(current_query: str, history: list[ChatMessage]) -> bool:
     """
-    按token数量智能截断历史对话
-    
-    【行业最佳实践】参考LangChain ConversationBufferWindowMemory
-    
-    策略：
-    1. 从最新消息开始倒序计算token
-    2. 超过max_tokens时停止
-    3. 始终保留至少最近1轮对话（2条消息）
-    
-    Args:
-        history: 对话历史
-        max_tokens: 最大token数（默认8000，行业标准）
-    
-    Returns:
-        截断后的历史对话
+    判断当前问题是否依赖对话历史（需要 LLM 重写）
+
+    自包含的问题直接使用原问题检索，省去一次 LLM 往返。
     """
-    if not history:
-        return history
-    
-    truncated = []
-    total_tokens = 0
-    
-    # 从最新消息开始倒序遍历
-    for msg in reversed(history):
-        msg_tokens = estimate_tokens(msg.content)
-        
-        # 如果加上这条消息会超过上限，且已经有至少2条消息（1轮对话），则停止
-        if total_tokens + msg_tokens > max_tokens and len(truncated) >= 2:
-            break
-        
-        truncated.insert(0, msg)  # 插入到开头保持顺序
-        total_tokens += msg_tokens
-    
-    # 日志记录截断情况
-    if len(truncated) < len(history):
-        logger.info(
-            f"[AI] History truncated: {len(history)} -> {len(truncated)} messages "
-            f"({total_tokens} tokens, max={max_tokens})"
-        )
-    
-    return truncated
+    if not history or len(history) < 2:
+        return False
 
+    query = current_query.strip()
+    if len(query) < _ELLIPSIS_MAX_CHARS:
+        return True
 
-async def compress_conversation_summary(
-    history: list[ChatMessage],
-    model_config: dict,
-    compression_threshold: int = 10,
-) -> list[ChatMessage]:
-    """
-    对话摘要压缩
-    
-    【行业最佳实践】参考LangChain ConversationSummaryMemory
-    OpenAI/Perplexity等巨头使用的策略：
-    - 10轮对话后，将前8轮压缩为摘要
-    - 只保留最近2轮完整对话
-    - 节省约90% tokens
-    
-    Args:
-        history: 对话历史
-        model_config: 模型配置
-        compression_threshold: 触发压缩的轮数阈值（默认10轮=20条消息）
-    
-    Returns:
-        压缩后的历史（摘要 + 最近完整对话）
-    """
-    # 对话轮数 = 消息数 / 2
-    conversation_rounds = len(history) // 2
-    
-    if conversation_rounds < compression_threshold:
-        # 未达到压缩阈值，直接返回
-        return history
-    
-    try:
-        # 保留最近2轮对话（4条消息）
-        recent_messages = history[-4:] if len(history) >= 4 else history
-        
-        # 需要压缩的旧对话
-        old_messages = history[:-4] if len(history) > 4 else []
-        
-        if not old_messages:
-            return history
-        
-        # 构建摘要请求
-        conversation_text = "\n".join([
-            f"{msg.role}: {msg.content[:200]}..."
-            for msg in old_messages
-        ])
-        
-        summary_prompt = f"""请将以下对话历史压缩为一个简洁的摘要（约200字以内），保留关键信息：
+    return bool(_ANAPHORA_PATTERN.search(_SELF_REFERENCE_PATTERN.sub("", query)))
 
-{conversation_text}
 
-摘要："""
-        
-        # 调用LLM生成摘要
-        provider = get_provider(
-            model_config["provider"],
-            model_config["api_key"],
-            model_config["endpoint"],
-        )
-        
-        summary_content = ""
-        async for chunk in provider.chat_stream(
-            messages=[ChatMessage(role="user", content=summary_prompt)],
-            model=model_config["model_id"],
-            temperature=0.3,  # 低温度确保摘要稳定
-            max_tokens=300,
-        ):
-            if chunk.type == "delta" and chunk.content:
-                summary_content += chunk.content
-            elif chunk.type == "done":
-                break
-        
-        if summary_content:
-            # 构建压缩后的历史：摘要 + 最近完整对话
-            compressed_history = [
-                ChatMessage(role="system", content=f"[对话历史摘要] {summary_content.strip()}"),
-            ] + recent_messages
-            
-            logger.info(
-                f"[AI] Conversation compressed: {len(history)} -> {len(compressed_history)} messages "
-                f"(saved ~{len(old_messages)} messages)"
-            )
-            
-            return compressed_history
-        else:
-            return history
-            
-    except Exception as e:
-        logger.error(f"[AI] Conversation compression failed: {e}")
-        return history  # 失败时返回原始历史
+def _rewrite_cache_key(conversation_id: str, history: list[ChatMessage], current_query: str) -> str:
+    # 轮次用最近一轮用户/助手消息的哈希标识：history 有条数上限且会被摘要截断，长度不能唯一标识轮次
+    last_turn = "\x1f".join(f"{m.role}:{m.content}" for m in history[-2:])
+    turn = hashlib.sha1(last_turn.encode("utf-8")).hexdigest()[:16]
+    qhash = hashlib.sha1(current_query.strip().encode("utf-8")).hexdigest()[:16]
+    return f"ai:rewrite:{conversation_id}:{turn}:{qhash}"
 
 
 async def rewrite_query_with_context(
     current_query: str,
     history: list[ChatMessage],
     model_config: dict,
+    conversation_id: Optional[str] = None,
 ) -> str:
     """
     使用 LLM 重写查询，解决指代词问题
@@ -684,6 +437,7 @@ async def rewrite_query_with_context(
         current_query: 当前用户问题
         history: 对话历史
         model_config: 模型配置
+        conversation_id: 对话ID（用于按轮次缓存重写结果）
     
     Returns:
         重写后的查询（用于向量搜索）
@@ -695,39 +449,20 @@ async def rewrite_query_with_context(
     # 只取最近4轮对话（8条消息）作为上下文，避免 token 过多
     recent_history = history[-8:] if len(history) > 8 else history
     
-    # 【2026-01-16 优化】智能跳过逻辑 - 基于行业最佳实践
-    # 参考：避免不必要的LLM调用，节省0.5-2秒延迟
-    
-    # 检测1：查询很长（>30字符），可能是完整问题
-    if len(current_query.strip()) > 30:
-        logger.info(f"[AI] Query rewrite skipped: query too long (>30 chars), likely complete")
-        return current_query
-    
-    # 检测2：包含疑问词 + 较长查询（>10字符）= 完整问题
-    question_markers = {
-        'zh': ['什么', '为什么', '为何', '怎么', '如何', '哪', '谁', '几', '多少'],
-        'en': ['what', 'why', 'how', 'when', 'where', 'who', 'which'],
-        'fr': ['quoi', 'pourquoi', 'comment', 'quand', 'où', 'qui'],
-        'de': ['was', 'warum', 'wie', 'wann', 'wo', 'wer'],
-        'ja': ['何', 'なぜ', 'どう', 'いつ', 'どこ', '誰'],
-        # DeepSeek V3.2支持50+语言，LLM会自动处理其他语言
-    }
-    
-    has_question_marker = any(
-        marker in current_query.lower()
-        for markers in question_markers.values()
-        for marker in markers
-    )
-    
-    if has_question_marker and len(current_query) > 10:
-        logger.info(f"[AI] Query rewrite skipped: complete question with question marker")
+    # 【2026-10-19】本地判断替代原有的长度/疑问词启发式：不含指代或省略时直接跳过
+    if not needs_query_rewrite(current_query, history):
+        logger.info("[AI] Query rewrite skipped: self-contained question")
         return current_query
-    
-    # 检测3：查询太短（<5字符），可能是简单追问，需要rewrite
-    # 例如："他呢？"、"Why?"等
-    if len(current_query.strip()) < 5:
-        # 继续执行rewrite
-        pass
+
+    cache_key = _rewrite_cache_key(conversation_id, history, current_query) if conversation_id else None
+    if cache_key and redis_client:
+        try:
+            cached = redis_client.get(cache_key)
+            if cached:
+                logger.info(f"[AI] Query rewrite cache hit: '{current_query[:30]}' -> '{cached[:30]}'")
+                return cached
+        except Exception as e:
+            logger.warning(f"[AI] Query rewrite cache read failed: {e}")
 
     # 构建对话历史文本
     history_text_parts = []
@@ -777,6 +512,11 @@ async def rewrite_query_with_context(
         
         if rewritten_query:
             logger.info(f"[AI] Query rewrite: '{current_query[:30]}...' -> '{rewritten_query[:30]}...' (took {time.time() - start_time:.2f}s)")
+            if cache_key and redis_client:
+                try:
+                    redis_client.setex(cache_key, QUERY_REWRITE_CACHE_TTL, rewritten_query)
+                except Exception as e:
+                    logger.warning(f"[AI] Query rewrite cache write failed: {e}")
             return rewritten_query
         else:
             return current_query
@@ -786,6 +526,372 @@ async def rewrite_query_with_context(
         return current_query
 
 
+# ============================================================================
+# QA 检索（并发检索图）
+# ============================================================================
+
+
+def _search_result_key(chunk: dict) -> str:
+    """检索结果去重键：优先使用 OpenSearch 文档 ID"""
+    return chunk.get("chunk_id") or f"{chunk.get('book_id')}_{chunk.get('section_index')}_{chunk.get('chunk_index')}"
+
+
+def merge_search_results(primary: list, secondary: list, top_k: int) -> list:
+    """
+    合并两路检索结果（去重，primary 优先）
+
+    primary: 重写后查询的结果（上下文更完整）
+    secondary: 原始查询的推测性结果（用于补足）
+    """
+    merged = []
+    seen = set()
+    for chunk in list(primary) + list(secondary):
+        key = _search_result_key(chunk)
+        if key in seen:
+            continue
+        seen.add(key)
+        merged.append(chunk)
+        if len(merged) >= top_k:
+            break
+    return merged
+
+
+def _merge_user_notes(primary: list, secondary: list, top_k: int = 5) -> list:
+    """合并两路笔记检索结果（按 note_id 去重）"""
+    merged = []
+    seen = set()
+    for note in list(primary) + list(secondary):
+        key = note.get("note_id") or note.get("content")
+        if key in seen:
+            continue
+        seen.add(key)
+        merged.append(note)
+    return merged[:top_k]
+
+
+def _build_rag_context(search_results: list, book_info_map: dict) -> tuple[str, list]:
+    """将检索结果转换为 LLM 上下文和前端引用信息"""
+    citations = []
+    rag_parts = []
+    # book_id -> 书名（一次构建，避免每条引用扫描 book_info_map）
+    title_by_book_id = {info['id']: info['title'] for info in book_info_map.values()}
+    for i, chunk in enumerate(search_results, 1):
+        page_info = f" (第{chunk['page']}页)" if chunk.get('page') else ""
+        
+        # 【2026-01-16 优化】智能内容截断 - 行业标准
+        # - RAG上下文（给LLM）：300字符（Perplexity标准）
+        # - Preview（给前端）：200字符（ChatGPT标准）
+        # 参考：rag_industry_best_practices.md
+        RAG_CONTEXT_LENGTH = 300
+        PREVIEW_LENGTH = 200
+        
+        content_full = chunk['content']
+        content_for_rag = content_full[:RAG_CONTEXT_LENGTH]
+        content_for_preview = content_full[:PREVIEW_LENGTH]
+        
+        rag_parts.append(f"[{i}]{page_info} {content_for_rag}")
+        
+        # 构建引用信息供前端使用
+        # 向量索引按 content_sha256 共享，块上的 book_id 可能是其他用户的书：优先按 sha256 对应到当前用户的书
+        book_from_sha = book_info_map.get(chunk.get('content_sha256'))
+        book_id_from_chunk = book_from_sha['id'] if book_from_sha else chunk.get('book_id')
+        book_title = book_from_sha['title'] if book_from_sha else title_by_book_id.get(book_id_from_chunk, "未知书籍")
+        
+        citations.append({
+            "index": i,
+            "book_id": book_id_from_chunk,
+            "book_title": book_title,
+            "content_sha256": chunk.get('content_sha256'),
+            "page": chunk.get('page'),
+            "chapter": chunk.get('chapter'),
+            "section_index": chunk.get('section_index'),  # EPUB 章节索引，用于精确跳转
+            "section_filename": chunk.get('section_filename'),  # EPUB 章节文件名
+            "chunk_index": chunk.get('chunk_index'),
+            "preview": content_for_preview,  # 【优化】截断到200字符
+            "score": chunk.get('score', 0)
+        })
+    
+    return "\n\n".join(rag_parts), citations
+
+
+def _build_notes_context(user_notes: list) -> str:
+    """将用户笔记/高亮转换为 LLM 上下文"""
+    if not user_notes:
+        return ""
+    notes_parts = []
+    for note in user_notes:
+        note_type_label = "笔记" if note.get('note_type') == 'note' else "高亮"
+        page_info = f" (第{note['page']}页)" if note.get('page') else ""
+        notes_parts.append(f"[{note_type_label}]{page_info} {note['content'][:300]}")
+    return f"\n用户笔记和高亮:\n" + "\n\n".join(notes_parts)
+
+
+# 缓存答案按固定长度切分为 delta 事件，与实时生成保持相同的 SSE 格式
+CACHED_ANSWER_CHUNK_CHARS = 32
+
+
+def _is_first_turn(user_content: str, memory: ConversationMemory) -> bool:
+    """
+    答案缓存分区由持有相同书籍的所有用户共享，只有不带任何对话历史生成的回答才能查询或写入：
+    无滚动摘要，且除本轮刚保存的提问外没有其他消息
+    """
+    if memory.summary:
+        return False
+    prior = memory.messages
+    if prior and prior[-1].role == "user" and prior[-1].content == user_content:
+        prior = prior[:-1]
+    return not prior
+
+
+def _resolve_cached_citations(citations: list, books: list[dict]) -> list:
+    """缓存的引用只含 content_sha256：按当前用户的书籍填充 book_id / book_title"""
+    book_by_sha = {b["content_sha256"]: b for b in books if b.get("content_sha256")}
+    resolved = []
+    for citation in citations:
+        book = book_by_sha.get(citation.get("content_sha256"))
+        resolved.append({
+            **citation,
+            "book_id": book["id"] if book else None,
+            "book_title": book["title"] if book else "未知书籍",
+        })
+    return resolved
+
+
+async def _stream_cached_answer(
+    cached: dict,
+    books: list[dict],
+    conversation_id: str,
+    user_id: str,
+    user_content: str,
+    model_config: dict,
+):
+    """以正常 SSE 格式回放缓存答案（不调用 LLM，不扣 Credits）"""
+    answer = cached.get("answer") or ""
+    citations = _resolve_cached_citations(cached.get("citations") or [], books)
+    for i in range(0, len(answer), CACHED_ANSWER_CHUNK_CHARS):
+        yield _sse_event("delta", {"content": answer[i:i + CACHED_ANSWER_CHUNK_CHARS]})
+
+    payload = build_reply_payload(
+        message_id=str(uuid.uuid4()),
+        conversation_id=conversation_id,
+        user_id=user_id,
+        content=answer,
+        citations=citations,
+        model_id=model_config["model_id"],
+        title=user_content[:50] + ("..." if len(user_content) > 50 else ""),
+        credits=0,
+        created_at=datetime.now(timezone.utc),
+    )
+    await save_reply_message(payload)
+    enqueue_ai_reply(payload)
+    schedule_summary_refresh(conversation_id, user_id, model_config)
+
+    yield _sse_event("credits", {"deducted": 0})
+    if citations:
+        yield _sse_event("citations", {"citations": citations})
+    yield _sse_event("done", {"cached": True})
+
+
+async def retrieve_qa_context(
+    user_content: str,
+    history: list[ChatMessage],
+    book_ids: list[str],
+    user_id: str,
+    model_config: dict,
+    conversation_id: Optional[str] = None,
+) -> dict:
+    """
+    QA 模式检索（并发检索图）
+
+    【2026-10-19】原先 书籍信息 → 查询重写 → 向量搜索 → 笔记搜索 串行执行，
+    首 token 延迟是各阶段之和。现改为：
+    - 书籍信息、查询重写（LLM）、笔记搜索同时开始
+    - 书籍信息返回后立即用原始问题发起推测性向量搜索，不等待查询重写
+    - 查询重写返回后，若与原问题不同，再用重写后的查询搜索并合并结果
+    - 各阶段耗时写入 ai_retrieval_stage_seconds，并随结果返回
+
+    Returns:
+        {"book_info", "rag_context", "user_notes_context", "citations", "search_query", "timings"}
+    """
+    timings: dict[str, int] = {}
+    retrieval_start = time.time()
+    pending: list[asyncio.Task] = []
+
+    async def _timed(stage: str, coro):
+        t0 = time.time()
+        try:
+            return await coro
+        finally:
+            elapsed = time.time() - t0
+            timings[stage] = int(elapsed * 1000)
+            AI_RETRIEVAL_STAGE_LATENCY.labels(stage=stage).observe(elapsed)
+
+    def _spawn(stage: str, coro) -> asyncio.Task:
+        task = asyncio.create_task(_timed(stage, coro))
+        pending.append(task)
+        return task
+
+    # 限制最大书籍数量，防止请求过大
+    effective_book_ids = book_ids[:RAG_MAX_BOOKS]
+    if len(book_ids) > RAG_MAX_BOOKS:
+        logger.warning(f"[AI] Book count {len(book_ids)} exceeds limit {RAG_MAX_BOOKS}, truncating")
+
+    try:
+        # Stage 1: 查询重写、笔记搜索与书籍信息并发
+        rewrite_task = None
+        if needs_query_rewrite(user_content, history):
+            rewrite_task = _spawn("rewrite", rewrite_query_with_context(
+                current_query=user_content,
+                history=history,
+                model_config=model_config,
+                conversation_id=conversation_id,
+            ))
+
+        # 搜索用户笔记和高亮（私人数据，必须按 user_id 过滤）
+        notes_task = _spawn("notes", search_user_notes(
+            query=user_content,
+            user_id=user_id,     # 关键：安全隔离
+            book_ids=book_ids,
+            top_k=5
+        ))
+
+        # 【2026-10-19】一次 ANY(:ids) 查询批量获取（带短期缓存）
+        infos = await _timed("book_info", load_book_contexts(effective_book_ids, user_id))
+
+        # 获取书籍基本信息和 content_sha256（向量索引是公共数据，按 sha256 匹配）
+        book_info_parts = []
+        content_sha256_list = []
+        book_info_map = {}  # sha256 -> book_info 映射
+        for info in infos:
+            book_info_parts.append(f"- 《{info['title']}》 by {info['author']}")
+            # 收集 sha256 用于向量搜索
+            if info.get('content_sha256'):
+                content_sha256_list.append(info['content_sha256'])
+                book_info_map[info['content_sha256']] = {
+                    "id": info['id'],
+                    "title": info['title'],
+                    "author": info['author']
+                }
+
+        # 书籍信息摘要（多书籍时只显示前5本 + 统计）
+        if len(book_info_parts) > 5:
+            book_info = "\n".join(book_info_parts[:5]) + f"\n... 等共 {len(book_info_parts)} 本书籍"
+        else:
+            book_info = "\n".join(book_info_parts) if book_info_parts else "未知书籍"
+
+        # Stage 2: 推测性向量搜索（原始问题），与查询重写并行
+        # 【2026-01-19 优化】动态 top_k 策略：
+        # - 根据问题复杂度和书籍数量动态调整
+        # - 多书籍场景确保每本书有代表性内容
+        # - 配合 Reranker 精排，保证质量
+        speculative_task = None
+        dynamic_top_k = 0
+        if content_sha256_list:
+            dynamic_top_k = calculate_dynamic_top_k(query=user_content, book_count=len(content_sha256_list))
+            logger.info(f"[AI] Dynamic top_k={dynamic_top_k} for {len(content_sha256_list)} books")
+            speculative_task = _spawn("search_speculative", search_book_chunks(
+                query=user_content,
+                content_sha256_list=content_sha256_list,
+                top_k=dynamic_top_k,
+                use_hybrid=True,  # 使用混合搜索（向量+关键词）
+                use_rerank=True,  # 使用 Reranking 重排序
+            ))
+        else:
+            logger.warning(f"[AI] No content_sha256 found for books: {book_ids}")
+
+        # 【查询重写】解决指代词问题，提高多轮对话的搜索质量
+        search_query = user_content
+        if rewrite_task is not None:
+            try:
+                search_query = await rewrite_task
+            except Exception as e:
+                logger.warning(f"[AI] Query rewrite failed: {e}, using original query")
+        rewritten = search_query.strip() != user_content.strip()
+
+        # Stage 3: 重写后的查询与原问题不同时，补充一路搜索并合并
+        search_failed = False
+        search_results = []
+        if speculative_task is not None:
+            if rewritten:
+                rewrite_top_k = max(
+                    dynamic_top_k,
+                    calculate_dynamic_top_k(query=search_query, book_count=len(content_sha256_list)),
+                )
+                rewritten_task = _spawn("search_rewritten", search_book_chunks(
+                    query=search_query,  # 使用重写后的查询
+                    content_sha256_list=content_sha256_list,
+                    top_k=rewrite_top_k,
+                    use_hybrid=True,
+                    use_rerank=True,
+                ))
+                primary, secondary = await asyncio.gather(
+                    rewritten_task, speculative_task, return_exceptions=True
+                )
+                if isinstance(primary, Exception) and isinstance(secondary, Exception):
+                    logger.error(f"[AI] Vector search failed: {primary}")
+                    search_failed = True
+                else:
+                    search_results = merge_search_results(
+                        [] if isinstance(primary, Exception) else primary,
+                        [] if isinstance(secondary, Exception) else secondary,
+                        rewrite_top_k,
+                    )
+            else:
+                try:
+                    search_results = await speculative_task
+                except Exception as e:
+                    logger.error(f"[AI] Vector search failed: {e}")
+                    search_failed = True
+
+        citations = []
+        if search_results:
+            rag_context, citations = _build_rag_context(search_results, book_info_map)
+            logger.info(f"[AI] RAG success: found {len(search_results)} chunks, {len(citations)} citations")
+        elif search_failed:
+            rag_context = "向量搜索失败，请基于你的知识回答。"
+        else:
+            rag_context = "未找到相关内容，请基于你的知识回答。"
+            logger.warning(f"[AI] No RAG chunks found for query: {user_content[:50]}")
+
+        # 笔记搜索：原始问题结果 + 重写后查询结果
+        user_notes = []
+        notes_tasks = [notes_task]
+        if rewritten:
+            notes_tasks.insert(0, _spawn("notes_rewritten", search_user_notes(
+                query=search_query,
+                user_id=user_id,
+                book_ids=book_ids,
+                top_k=5
+            )))
+        notes_results = await asyncio.gather(*notes_tasks, return_exceptions=True)
+        for result in notes_results:
+            if isinstance(result, Exception):
+                logger.warning(f"[AI] User notes search failed: {result}")
+            else:
+                user_notes = _merge_user_notes(user_notes, result)
+        if user_notes:
+            logger.info(f"[AI] Found {len(user_notes)} user notes/highlights")
+
+        total = time.time() - retrieval_start
+        timings["total"] = int(total * 1000)
+        AI_RETRIEVAL_STAGE_LATENCY.labels(stage="total").observe(total)
+        logger.info(f"[AI] Retrieval timings (ms): {timings}")
+
+        return {
+            "book_info": book_info,
+            "rag_context": rag_context,
+            "user_notes_context": _build_notes_context(user_notes),
+            "citations": citations,
+            "search_query": search_query,
+            "timings": timings,
+        }
+    finally:
+        # 客户端断开等异常退出时，取消尚未完成的检索任务
+        for task in pending:
+            if not task.done():
+                task.cancel()
+
+
 # ============================================================================
 # API Endpoints
 # ============================================================================
@@ -1190,256 +1296,139 @@ async def send_message(
 
         try:
             # 保存用户消息
-            await save_message(conversation_id, user_id, "user", user_content)
+            await save_message(conversation_id, user_id, "user", user_content, model_id=model_config["model_id"])
 
             # 构建消息历史
-            history = await get_conversation_history(conversation_id, user_id, limit=20)
-            
-            # 【2026-01-16 优化】智能历史管理 - 行业最佳实践
-            # 1. Token截断：防止token爆炸
-            history = truncate_history_by_tokens(history, max_tokens=8000)
-            
-            # 2. 对话压缩：10轮后自动摘要（节省90% tokens）
-            # history = await compress_conversation_summary(history, model_config, compression_threshold=10)
-            # TODO: 压缩功能暂时注释，待进一步测试后启用
+            # 【2026-10-19】持久化滚动摘要 + 摘要之后的消息，替代整段历史
+            # Token 预算按已保存的 token_count 在 SQL 中累加截断，防止token爆炸
+            memory = await load_conversation_memory(conversation_id, user_id, limit=20, max_tokens=8000)
+            history = memory.messages
 
             # QA模式的引用信息
             citations = []
-            search_results = []
             
             logger.info(f"[AI] Request params: mode={mode}, book_ids={book_ids}, shelf_ids={shelf_ids}")
 
+            # 【2026-10-19】语义答案缓存（可选）：只用于对话第一轮的书籍问答
+            # （之后的回答即使问题看似独立，prompt 中也带有本对话的历史与摘要，不能共享给其他用户）
+            answer_probe = None
+            if mode == "qa" and book_ids and ANSWER_CACHE_ENABLED and _is_first_turn(user_content, memory):
+                cache_books = await load_book_contexts(book_ids[:RAG_MAX_BOOKS], user_id)
+                cached_answer, answer_probe = await lookup_answer(
+                    [b["content_sha256"] for b in cache_books if b.get("content_sha256")],
+                    model_config["model_id"],
+                    user_content,
+                )
+                if cached_answer:
+                    async for event in _stream_cached_answer(
+                        cached_answer, cache_books, conversation_id, user_id, user_content, model_config
+                    ):
+                        yield event
+                    AI_CHAT_LATENCY.labels(mode=mode).observe(time.time() - start_time)
+                    AI_CHAT_TOTAL.labels(mode=mode, status="cache_hit").inc()
+                    return
+
             # 构建系统提示词
             if mode == "qa" and book_ids:
-                # 问答模式：执行向量搜索获取 RAG 上下文
+                # 问答模式：并发检索获取 RAG 上下文
                 logger.info(f"[AI] QA mode: book_ids={book_ids[:3]}... user_id={user_id[:8]}...")
                 
-                # 获取书籍基本信息和 content_sha256（向量索引是公共数据，按 sha256 匹配）
-                # 【2026-01-19 优化】移除硬编码5本书限制，支持书架中的大量书籍
-                book_info_parts = []
-                content_sha256_list = []
-                book_info_map = {}  # sha256 -> book_info 映射
-                
-                # 限制最大书籍数量，防止请求过大
-                effective_book_ids = book_ids[:RAG_MAX_BOOKS]
-                if len(book_ids) > RAG_MAX_BOOKS:
-                    logger.warning(f"[AI] Book count {len(book_ids)} exceeds limit {RAG_MAX_BOOKS}, truncating")
-                
-                for bid in effective_book_ids:
-                    info = await get_book_info(bid, user_id)
-                    if info:
-                        book_info_parts.append(f"- 《{info['title']}》 by {info['author']}")
-                        # 收集 sha256 用于向量搜索
-                        if info.get('content_sha256'):
-                            content_sha256_list.append(info['content_sha256'])
-                            book_info_map[info['content_sha256']] = {
-                                "id": info['id'],
-                                "title": info['title'],
-                                "author": info['author']
-                            }
-                
-                # 书籍信息摘要（多书籍时只显示前5本 + 统计）
-                if len(book_info_parts) > 5:
-                    book_info = "\n".join(book_info_parts[:5]) + f"\n... 等共 {len(book_info_parts)} 本书籍"
-                else:
-                    book_info = "\n".join(book_info_parts) if book_info_parts else "未知书籍"
-                
-                # 【查询重写】解决指代词问题，提高多轮对话的搜索质量
-                search_query = user_content
-                if history and len(history) >= 2:
-                    t0 = time.time()
-                    search_query = await rewrite_query_with_context(
-                        current_query=user_content,
-                        history=history,
-                        model_config=model_config,
-                    )
-                    logger.info(f"[AI] Query rewrite took {time.time() - t0:.2f}s")
-                
-                # 执行向量搜索获取相关内容（按 sha256 匹配公共向量）
-                # 【2026-01-19 优化】动态 top_k 策略：
-                # - 根据问题复杂度和书籍数量动态调整
-                # - 多书籍场景确保每本书有代表性内容
-                # - 配合 Reranker 精排，保证质量
-                try:
-                    if content_sha256_list:
-                        t0 = time.time()
-                        
-                        # 【动态 top_k】根据问题和书籍数量计算
-                        dynamic_top_k = calculate_dynamic_top_k(
-                            query=search_query,
-                            book_count=len(content_sha256_list)
-                        )
-                        logger.info(f"[AI] Dynamic top_k={dynamic_top_k} for {len(content_sha256_list)} books")
-                        
-                        search_results = await search_book_chunks(
-                            query=search_query,  # 使用重写后的查询
-                            content_sha256_list=content_sha256_list,
-                            top_k=dynamic_top_k,  # 【优化】使用动态计算的 top_k
-                            use_hybrid=True,  # 使用混合搜索（向量+关键词）
-                            use_rerank=True,  # 使用 Reranking 重排序
-                        )
-                        logger.info(f"[AI] Search & Rerank took {time.time() - t0:.2f}s, got {len(search_results)} results")
-                    else:
-                        search_results = []
-                        logger.warning(f"[AI] No content_sha256 found for books: {book_ids}")
-                    
-                    if search_results:
-                        rag_parts = []
-                        for i, chunk in enumerate(search_results, 1):
-                            page_info = f" (第{chunk['page']}页)" if chunk.get('page') else ""
-                            
-                            # 【2026-01-16 优化】智能内容截断 - 行业标准
-                            # - RAG上下文（给LLM）：300字符（Perplexity标准）
-                            # - Preview（给前端）：200字符（ChatGPT标准）
-                            # 参考：rag_industry_best_practices.md
-                            RAG_CONTEXT_LENGTH = 300
-                            PREVIEW_LENGTH = 200
-                            
-                            content_full = chunk['content']
-                            content_for_rag = content_full[:RAG_CONTEXT_LENGTH]
-                            content_for_preview = content_full[:PREVIEW_LENGTH]
-                            
-                            rag_parts.append(f"[{i}]{page_info} {content_for_rag}")
-                            
-                            # 构建引用信息供前端使用
-                            book_id_from_chunk = chunk.get('book_id')
-                            # 尝试从 book_info_map 获取书籍信息（通过 content_sha256）
-                            # 如果没有，使用 chunk 中的 book_id
-                            book_title = "未知书籍"
-                            if book_id_from_chunk:
-                                # 查找书籍标题
-                                for sha, info in book_info_map.items():
-                                    if info['id'] == book_id_from_chunk:
-                                        book_title = info['title']
-                                        break
-                            
-                            citations.append({
-                                "index": i,
-                                "book_id": book_id_from_chunk,
-                                "book_title": book_title,
-                                "page": chunk.get('page'),
-                                "chapter": chunk.get('chapter'),
-                                "section_index": chunk.get('section_index'),  # EPUB 章节索引，用于精确跳转
-                                "section_filename": chunk.get('section_filename'),  # EPUB 章节文件名
-                                "chunk_index": chunk.get('chunk_index'),
-                                "preview": content_for_preview,  # 【优化】截断到200字符
-                                "score": chunk.get('score', 0)
-                            })
-                        
-                        rag_context = "\n\n".join(rag_parts)
-                        logger.info(f"[AI] RAG success: found {len(search_results)} chunks, {len(citations)} citations")
-                    else:
-                        rag_context = "未找到相关内容，请基于你的知识回答。"
-                        logger.warning(f"[AI] No RAG chunks found for query: {user_content[:50]}")
-                except Exception as e:
-                    logger.error(f"[AI] Vector search failed: {e}")
-                    rag_context = "向量搜索失败，请基于你的知识回答。"
-                
-                # 搜索用户笔记和高亮（私人数据，必须按 user_id 过滤）
-                user_notes_context = ""
-                try:
-                    user_notes = await search_user_notes(
-                        query=search_query,  # 使用重写后的查询
-                        user_id=user_id,     # 关键：安全隔离
-                        book_ids=book_ids,
-                        top_k=5
-                    )
-                    if user_notes:
-                        notes_parts = []
-                        for note in user_notes:
-                            note_type_label = "笔记" if note.get('note_type') == 'note' else "高亮"
-                            page_info = f" (第{note['page']}页)" if note.get('page') else ""
-                            notes_parts.append(f"[{note_type_label}]{page_info} {note['content'][:300]}")
-                        user_notes_context = f"\n用户笔记和高亮:\n" + "\n\n".join(notes_parts)
-                        logger.info(f"[AI] Found {len(user_notes)} user notes/highlights")
-                except Exception as e:
-                    logger.warning(f"[AI] User notes search failed: {e}")
+                qa_context = await retrieve_qa_context(
+                    user_content=user_content,
+                    history=history,
+                    book_ids=book_ids,
+                    user_id=user_id,
+                    model_config=model_config,
+                    conversation_id=conversation_id,
+                )
+                citations = qa_context["citations"]
+                # 使用了用户私人笔记的回答不进入共享缓存
+                if qa_context["user_notes_context"]:
+                    answer_probe = None
                 
                 system_prompt = SYSTEM_PROMPT_QA.format(
-                    book_info=book_info,
-                    rag_context=rag_context,
-                    user_notes_context=user_notes_context
+                    book_info=qa_context["book_info"],
+                    rag_context=qa_context["rag_context"],
+                    user_notes_context=qa_context["user_notes_context"]
                 )
             else:
                 system_prompt = SYSTEM_PROMPT_CHAT
 
             # 构建完整消息列表
             messages = [ChatMessage(role="system", content=system_prompt)]
-            messages.extend(history)
+            messages.extend(ConversationMemory(summary=memory.summary, messages=history).to_messages())
             messages.append(ChatMessage(role="user", content=user_content))
 
-            # 获取 LLM Provider
-            provider = get_provider(
-                model_config["provider"],
-                model_config["api_key"],
-                model_config["endpoint"],
-            )
-
             # 流式调用 LLM
+            # 【2026-10-19】可选对冲：主模型首 token 超时后并发请求备用模型，先返回者胜出
             last_usage: Optional[LLMUsage] = None
-
-            async for chunk in provider.chat_stream(
-                messages=messages,
-                model=model_config["model_id"],
+            hedge_config = None
+            if HEDGE_ENABLED:
+                hedge_config = await get_model_registry().get_hedge() or model_config
+            stream = HedgedStream(
+                model_config,
+                hedge_config,
+                messages,
                 temperature=DEFAULT_TEMPERATURE,
                 max_tokens=DEFAULT_MAX_TOKENS,
-            ):
-                if chunk.type == "delta" and chunk.content:
-                    full_response += chunk.content
-                    yield _sse_event("delta", {"content": chunk.content})
-
-                elif chunk.type == "usage" and chunk.usage:
-                    last_usage = chunk.usage
-                    yield _sse_event(
-                        "usage",
-                        {
-                            "prompt_tokens": chunk.usage.prompt_tokens,
-                            "completion_tokens": chunk.usage.completion_tokens,
-                            "total_tokens": chunk.usage.total_tokens,
-                        },
-                    )
-
-                elif chunk.type == "error":
-                    AI_CHAT_TOTAL.labels(mode=mode, status="error").inc()
-                    yield _sse_event("error", {"message": chunk.error or "Unknown error"})
-                    return
+            )
 
-                elif chunk.type == "done":
-                    break
+            # 【2026-10-19】准入控制：每用户/每模型/全局的速率与并发上限，超限时短暂排队
+            async with get_llm_governor().slot(user_id, model_config["model_id"]):
+                # 【2026-10-19】合并相邻 delta，减少逐 token 的编码与发送开销
+                async for chunk in coalesce_deltas(stream):
+                    if chunk.type == "delta" and chunk.content:
+                        full_response += chunk.content
+                        yield _sse_event("delta", {"content": chunk.content})
+
+                    elif chunk.type == "usage" and chunk.usage:
+                        last_usage = chunk.usage
+                        yield _sse_event(
+                            "usage",
+                            {
+                                "prompt_tokens": chunk.usage.prompt_tokens,
+                                "completion_tokens": chunk.usage.completion_tokens,
+                                "total_tokens": chunk.usage.total_tokens,
+                            },
+                        )
 
-            # 保存 AI 回复（包含引用信息）
+                    elif chunk.type == "error":
+                        AI_CHAT_TOTAL.labels(mode=mode, status="error").inc()
+                        yield _sse_event("error", {"message": chunk.error or "Unknown error"})
+                        return
+
+                    elif chunk.type == "done":
+                        break
+
+            # 【2026-10-19】助手消息同步写入（下一轮历史与摘要刷新立即可见），
+            # 标题与扣费交给后台 worker（幂等）
+            # 只按胜出一路的 usage 与单价扣费
+            credits_deducted = calculate_credits(last_usage, stream.winner_config) if last_usage else 0
+            if full_response or credits_deducted > 0:
+                payload = build_reply_payload(
+                    message_id=str(uuid.uuid4()),
+                    conversation_id=conversation_id,
+                    user_id=user_id,
+                    content=full_response,
+                    citations=citations,
+                    model_id=stream.winner_config["model_id"],
+                    # 标题为空时用用户的第一条消息作为标题
+                    title=user_content[:50] + ("..." if len(user_content) > 50 else ""),
+                    credits=credits_deducted,
+                    created_at=datetime.now(timezone.utc),
+                )
+                await save_reply_message(payload)
+                enqueue_ai_reply(payload)
             if full_response:
-                await save_message(conversation_id, user_id, "assistant", full_response, citations=citations)
-
-                # 更新对话标题（如果是第一条消息）
-                async with engine.begin() as conn:
-                    result = await conn.execute(
-                        text(
-                            """
-                            SELECT title FROM ai_conversations
-                            WHERE id = cast(:cid as uuid)
-                            """
-                        ),
-                        {"cid": conversation_id},
-                    )
-                    row = result.fetchone()
-                    if row and not row[0]:
-                        # 用用户的第一条消息作为标题
-                        title = user_content[:50] + ("..." if len(user_content) > 50 else "")
-                        await conn.execute(
-                            text(
-                                """
-                                UPDATE ai_conversations
-                                SET title = :title
-                                WHERE id = cast(:cid as uuid)
-                                """
-                            ),
-                            {"cid": conversation_id, "title": title},
-                        )
+                # 消息已写入后再增量刷新滚动摘要
+                schedule_summary_refresh(conversation_id, user_id, model_config)
+                # 答案缓存按模型分区，备用模型胜出的回答不写入主模型分区
+                if answer_probe is not None and stream.winner_config is model_config:
+                    schedule_store_answer(answer_probe, full_response, citations)
 
-            # 扣除 Credits
             if last_usage:
-                credits_deducted = await deduct_credits(user_id, last_usage, model_config)
+                AI_TOKENS_CONSUMED.labels(type="prompt").inc(last_usage.prompt_tokens)
+                AI_TOKENS_CONSUMED.labels(type="completion").inc(last_usage.completion_tokens)
                 yield _sse_event("credits", {"deducted": credits_deducted})
 
             # 发送引用信息（QA模式）
@@ -1456,6 +1445,10 @@ async def send_message(
 
             yield _sse_event("done", {})
 
+        except GovernorRejected:
+            AI_CHAT_TOTAL.labels(mode=mode, status="throttled").inc()
+            yield _sse_event("error", {"message": "ai_busy"})
+
         except Exception as e:
             AI_CHAT_TOTAL.labels(mode=mode, status="error").inc()
             yield _sse_event("error", {"message": str(e)})
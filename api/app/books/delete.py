@@ -11,6 +11,7 @@ from .common import (
     BOOKS_BUCKET, engine, delete_object, delete_book_from_index,
     require_user, require_write_permission,
 )
+from ..services.book_context import invalidate_book_context_cache
 
 router = APIRouter()
 
@@ -249,6 +250,8 @@ async def delete_book(book_id: str, quota=Depends(require_write_permission), aut
                 else:
                     print(f"[Delete Book] Deleted {book_id} but preserved public data ({other_books_count} other books share same SHA256)")
         
+        # 【2026-10-19】清除 AI 对话书籍上下文缓存
+        invalidate_book_context_cache(user_id)
         return {"status": "success"}
     except HTTPException:
         raise
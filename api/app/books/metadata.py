@@ -18,6 +18,7 @@ from .common import (
     upload_bytes, read_head, index_book,
     require_user, require_write_permission, _quick_confidence,
 )
+from ..services.book_context import invalidate_book_context_cache
 
 router = APIRouter()
 
@@ -472,6 +473,9 @@ async def update_book_metadata(
         )
         final_row = final_res.fetchone()
     
+    # 【2026-10-19】书名/作者已变更，清除 AI 对话书籍上下文缓存
+    invalidate_book_context_cache(user_id)
+    
     return {
         "id": str(final_row[0]),
         "title": final_row[1],
@@ -527,4 +531,5 @@ async def update_book(
         )
         if res.rowcount == 0:
             raise HTTPException(status_code=409, detail="version_conflict")
+    invalidate_book_context_cache(user_id)
     return {"status": "success"}
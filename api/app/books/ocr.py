@@ -18,7 +18,7 @@ from fastapi import APIRouter, Depends, HTTPException, Query, Response
 from sqlalchemy import text
 
 from .common import (
-    BOOKS_BUCKET, engine, read_full, celery_app, require_user,
+    BOOKS_BUCKET, engine, read_full, require_user,
 )
 
 router = APIRouter()
@@ -665,10 +665,15 @@ async def trigger_book_ocr(book_id: str, auth=Depends(require_user)):
         estimated_minutes = max(minutes_per_book, queue_position * minutes_per_book + (page_count or 100) // 50)
         
         try:
-            celery_app.send_task(
+            # 【2026-10-19】经按用户公平调度提交，会员每轮权重更高
+            from ..services.fair_queue import FAIR_QUEUE_PRO_WEIGHT, submit_task
+            submit_task(
                 "tasks.process_book_ocr",
-                args=[book_id, user_id],
-                priority=7 if is_pro else 3
+                [book_id, user_id],
+                user_id,
+                weight=FAIR_QUEUE_PRO_WEIGHT if is_pro else 1,
+                priority=7 if is_pro else 3,
+                tier="pro" if is_pro else "free",
             )
         except Exception as e:
             print(f"[OCR] Failed to dispatch Celery task: {e}")
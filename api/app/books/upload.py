@@ -172,7 +172,8 @@ async def upload_complete(
                 if idempotency_key:
                     r.setex(idem_key, 24 * 3600, str(data))
                 try:
-                    celery_app.send_task("tasks.analyze_book_type", args=[existing_book_id, user_id])
+                    from ..services.fair_queue import submit_task
+                    submit_task("tasks.analyze_book_type", [existing_book_id, user_id], user_id)
                     celery_app.send_task("tasks.deep_analyze_book", args=[existing_book_id, user_id])
                 except Exception:
                     pass
@@ -4,11 +4,18 @@ Celery 应用配置
 队列优先级策略（适用于 RTX 3060/3070 等消费级显卡）:
 - gpu_high: GPU 高优先级任务（OCR，付费服务）
 - gpu_low: GPU 低优先级任务（向量索引，免费服务）
+- gpu_interactive: 交互式查询向量化（用户提问，实时请求）
 - cpu_default: CPU 任务（元数据提取、封面提取等）
+- rerank: 本地 Cross-Encoder 重排序（可选，RERANK_BACKEND=local）
 
 Worker 部署建议:
 - worker-gpu: 并发=1，监听 gpu_high,gpu_low 队列（串行执行避免显存竞争）
-- worker-cpu: 并发=4，监听 cpu_default 队列
+- worker-gpu-interactive: 并发=1，监听 gpu_interactive 队列，与 worker-gpu 通过 GPU 锁按优先级仲裁
+- worker-cpu: 并发=4，监听 cpu_default 队列，内嵌 beat 调度定时任务（-B，只能有一个实例）
+- worker-rerank: 并发=1，监听 rerank 队列（可选，docker compose --profile rerank）
+
+【2026-10-19】公平调度：书籍处理类 GPU 任务（OCR / 类型分析 / 向量索引）先进入按用户划分的子队列，
+由 services/fair_queue 按加权轮询转发到 gpu_high / gpu_low，单个用户的大批导入不会阻塞其他用户
 
 【2026-01-09】模型预加载：
 - Worker 启动时加载 BGE-M3 和 PaddleOCR 模型
@@ -23,7 +30,7 @@ import os
 # os.environ.setdefault('HF_DATASETS_OFFLINE', '1')
 
 from celery import Celery
-from celery.signals import worker_process_init
+from celery.signals import task_postrun, worker_process_init
 from kombu import Queue, Exchange
 
 broker = os.getenv("CELERY_BROKER_URL", "redis://redis:6379/0")
@@ -46,6 +53,10 @@ CELERY_QUEUES = (
     Queue('gpu_high', gpu_exchange, routing_key='gpu.high'),
     # GPU 低优先级队列（向量索引，免费服务）
     Queue('gpu_low', gpu_exchange, routing_key='gpu.low'),
+    # 【2026-10-19】交互式查询向量化队列（独立 worker 进程，后台任务运行时也能争用 GPU 锁）
+    Queue('gpu_interactive', gpu_exchange, routing_key='gpu.interactive'),
+    # 【2026-10-19】本地 Reranker 队列（实时请求，独立 worker 消费）
+    Queue('rerank', default_exchange, routing_key='rerank'),
 )
 
 # ============================================================================
@@ -61,15 +72,21 @@ CELERY_TASK_ROUTES = {
     'tasks.index_book_vectors': {'queue': 'gpu_low', 'routing_key': 'gpu.low'},
     'tasks.delete_book_vectors': {'queue': 'gpu_low', 'routing_key': 'gpu.low'},
     # 【2026-01-14】新增：Embedding任务（用户提问、笔记向量化）
-    'tasks.get_text_embedding': {'queue': 'gpu_low', 'routing_key': 'gpu.low'},
+    # 【2026-10-19】用户提问的向量化改走 gpu_interactive，不再排在书籍索引之后
+    'tasks.get_text_embedding': {'queue': 'gpu_interactive', 'routing_key': 'gpu.interactive'},
     'tasks.get_batch_embeddings': {'queue': 'gpu_low', 'routing_key': 'gpu.low'},
     'tasks.index_user_note_vectors': {'queue': 'gpu_low', 'routing_key': 'gpu.low'},
+    # 【2026-10-19】笔记向量批量索引
+    'tasks.flush_user_note_vectors': {'queue': 'gpu_low', 'routing_key': 'gpu.low'},
     # 【2026-01-15 修复】笔记/高亮向量索引任务路由到 GPU 队列
     'search.index_note_vector': {'queue': 'gpu_low', 'routing_key': 'gpu.low'},
     'search.delete_note_vector': {'queue': 'gpu_low', 'routing_key': 'gpu.low'},
     'search.index_highlight_vector': {'queue': 'gpu_low', 'routing_key': 'gpu.low'},
     'search.delete_highlight_vector': {'queue': 'gpu_low', 'routing_key': 'gpu.low'},
     
+    # 【2026-10-19】本地 Cross-Encoder 重排序
+    'tasks.rerank_batch': {'queue': 'rerank', 'routing_key': 'rerank'},
+    
     # CPU 任务（默认）
     'tasks.extract_ebook_metadata_calibre': {'queue': 'cpu_default', 'routing_key': 'cpu.default'},
     'tasks.extract_book_cover': {'queue': 'cpu_default', 'routing_key': 'cpu.default'},
@@ -78,6 +95,31 @@ CELERY_TASK_ROUTES = {
     'tasks.deep_analyze_book': {'queue': 'cpu_default', 'routing_key': 'cpu.default'},
     'tasks.generate_srs_card': {'queue': 'cpu_default', 'routing_key': 'cpu.default'},
     'tasks.sync_book_to_opensearch': {'queue': 'cpu_default', 'routing_key': 'cpu.default'},
+    # 【2026-10-19】AI 回复后置写入（标题 / Credits；消息由 API 同步写入）
+    'tasks.persist_ai_reply': {'queue': 'cpu_default', 'routing_key': 'cpu.default'},
+    # 【2026-10-19】书籍向量索引维护（segment 合并 / refresh 调整）
+    'tasks.maintain_book_chunks_index': {'queue': 'cpu_default', 'routing_key': 'cpu.default'},
+    # 【2026-10-19】GPU 公平调度兜底转发
+    'tasks.pump_fair_queues': {'queue': 'cpu_default', 'routing_key': 'cpu.default'},
+}
+
+# ============================================================================
+# 定时任务（worker-cpu 以 -B 启动内嵌 beat）
+# ============================================================================
+
+CELERY_BEAT_SCHEDULE = {
+    # 【2026-10-19】书籍向量索引维护
+    'maintain-book-chunks-index': {
+        'task': 'tasks.maintain_book_chunks_index',
+        'schedule': float(os.getenv("RAG_INDEX_MAINT_INTERVAL", "600")),
+        'options': {'expires': 300},
+    },
+    # 【2026-10-19】GPU 公平调度兜底转发
+    'pump-fair-queues': {
+        'task': 'tasks.pump_fair_queues',
+        'schedule': float(os.getenv("FAIR_QUEUE_PUMP_INTERVAL", "15")),
+        'options': {'expires': 10},
+    },
 }
 
 # ============================================================================
@@ -88,6 +130,7 @@ celery_app.conf.update(
     # 队列配置
     task_queues=CELERY_QUEUES,
     task_routes=CELERY_TASK_ROUTES,
+    beat_schedule=CELERY_BEAT_SCHEDULE,
     task_default_queue='cpu_default',
     task_default_exchange='default',
     task_default_routing_key='cpu.default',
@@ -102,6 +145,9 @@ celery_app.conf.update(
         "app.tasks.analysis_tasks",
         "app.tasks.index_tasks",  # 向量索引任务
         "app.tasks.embedding_tasks",  # 【2026-01-14】Embedding向量化任务
+        "app.tasks.rerank_tasks",  # 【2026-10-19】本地重排序任务
+        "app.tasks.ai_tasks",  # 【2026-10-19】AI 回复后置写入
+        "app.tasks.dispatch_tasks",  # 【2026-10-19】GPU 公平调度转发
         "app.search_sync",
     ],
     
@@ -118,6 +164,20 @@ celery_app.conf.update(
     result_expires=3600,  # 1 小时
 )
 
+# ============================================================================
+# 【2026-10-19】GPU 公平调度：GPU 任务结束时转发下一个任务
+# ============================================================================
+
+@task_postrun.connect
+def pump_fair_queue_after_task(sender=None, **kwargs):
+    """GPU 任务结束后立即从用户子队列补充（见 services/fair_queue）"""
+    queue = CELERY_TASK_ROUTES.get(getattr(sender, "name", ""), {}).get('queue')
+    if queue in ('gpu_high', 'gpu_low'):
+        from app.services.fair_queue import FAIR_QUEUE_ENABLED, pump
+        if FAIR_QUEUE_ENABLED:
+            pump(queue)
+
+
 # ============================================================================
 # 【2026-01-09】模型预加载（已禁用）
 # ============================================================================
@@ -90,6 +90,14 @@ app.include_router(powersync_router)
 app.include_router(admin_ai_router)
 
 
+@app.on_event("shutdown")
+async def close_llm_http_clients():
+    # 关闭 LLM / Reranker 共享连接池
+    from .services.llm_provider import close_http_clients
+
+    await close_http_clients()
+
+
 @app.websocket("/ws/docs/{doc_id}")
 async def ws_docs(websocket, doc_id: str):
     from .ws import websocket_endpoint as _ep
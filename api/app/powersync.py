@@ -229,6 +229,8 @@ async def _handle_delete(conn, op: SyncOperation, user_id: str):
         )
         row = result.fetchone()
         logger.info(f"[PowerSync DELETE books] Result: {row}")
+        from .services.book_context import invalidate_book_context_cache
+        invalidate_book_context_cache(user_id)
     # 其他表有 is_deleted + deleted_at
     elif table in {"notes", "highlights", "bookmarks", "shelves"}:
         await conn.execute(
@@ -496,6 +498,10 @@ async def _handle_books_update(conn, record_id: str, filtered_data: dict, user_i
     result = await conn.execute(text(sql), params)
     logger.info(f"[PowerSync books UPDATE] Result rowcount: {result.rowcount}")
 
+    # 【2026-10-19】书名/作者可能已修改，清除 AI 对话的书籍上下文缓存
+    from .services.book_context import invalidate_book_context_cache
+    invalidate_book_context_cache(user_id)
+
 
 async def _handle_upsert(conn, op: SyncOperation, user_id: str):
     """处理 PUT/PATCH 操作 (UPSERT)"""
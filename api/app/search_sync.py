@@ -292,17 +292,54 @@ def task_index_note_vector(
     name="search.delete_note_vector",
     autoretry_for=(Exception,),
     retry_backoff=True,
-    retry_kwargs={"max_retries": 3},
+    retry_kwargs={"max_retries": 6},
 )
 def task_delete_note_vector(self, note_id: str):
-    """删除笔记的向量索引"""
+    """
+    删除笔记的向量索引
+
+    【2026-10-19】删除失败时抛出异常由 Celery 重试（如路由迁移切换窗口内旧索引写保护），
+    不再静默丢弃，避免已删除的笔记留在索引中
+    """
     import asyncio
     from .services.llama_rag import delete_user_note_index
     
-    try:
-        asyncio.run(delete_user_note_index(note_id))
-    except Exception as e:
-        print(f"[Search] Delete note vector failed: {e}")
+    if not asyncio.run(delete_user_note_index(note_id)):
+        raise RuntimeError(f"Delete note vector failed: {note_id}")
+
+
+def _queue_note_vector(
+    note_id: str,
+    user_id: str,
+    book_id: str,
+    content: str,
+    book_title: str | None,
+    chapter: str | None,
+    page: int | None,
+    note_type: str,
+):
+    """
+    笔记向量索引入队
+
+    【2026-10-19】加入批量索引队列（同一时间窗口的笔记合并为一次向量化与 _bulk 写入），
+    Redis 不可用时回退为单条任务
+    """
+    from .services.llama_rag import queue_user_note_vector
+
+    if not content or not content.strip():
+        return
+    if queue_user_note_vector({
+        "note_id": note_id,
+        "user_id": user_id,
+        "book_id": book_id,
+        "content": content,
+        "book_title": book_title,
+        "chapter": chapter,
+        "page": page,
+        "note_type": note_type,
+    }):
+        return
+    task_index_note_vector.delay(note_id, user_id, book_id, content, book_title, chapter, page, note_type)
 
 
 def index_note(
@@ -318,17 +355,29 @@ def index_note(
         # 全文索引（原有功能）
         task_index_note.delay(id, user_id, book_id, content, tags)
         # 向量索引（新增：用于 AI RAG）
-        task_index_note_vector.delay(id, user_id, book_id, content, book_title, chapter, page, "note")
+        _queue_note_vector(id, user_id, book_id, content, book_title, chapter, page, "note")
     except Exception:
         pass
 
 
+def _delete_note_vector(note_id: str):
+    """
+    删除笔记 / 高亮的向量索引
+
+    【2026-10-19】先写删除墓碑：批量索引队列中尚未写入的旧内容不会在删除之后被索引回来
+    """
+    from .services.llama_rag import mark_user_note_deleted
+
+    mark_user_note_deleted(note_id)
+    task_delete_note_vector.delay(note_id)
+
+
 def delete_note(id: str):
     if not ES_URL:
         return
     try:
         task_delete_note.delay(id)
-        task_delete_note_vector.delay(id)  # 同时删除向量索引
+        _delete_note_vector(id)  # 同时删除向量索引
     except Exception:
         pass
 
@@ -363,7 +412,7 @@ def index_highlight(
         if comment:
             vector_content = f"{vector_content}\n用户批注: {comment}" if vector_content else comment
         if vector_content:
-            task_index_note_vector.delay(id, user_id, book_id, vector_content, book_title, chapter, page, "highlight")
+            _queue_note_vector(id, user_id, book_id, vector_content, book_title, chapter, page, "highlight")
     except Exception:
         pass
 
@@ -373,6 +422,7 @@ def delete_highlight(id: str):
         return
     try:
         task_delete_highlight.delay(id)
+        _delete_note_vector(id)  # 高亮同样写入了向量索引
     except Exception:
         pass
 
@@ -0,0 +1,194 @@
+"""
+AI 回复后置写入（write-behind）
+
+【2026-10-19】新增：
+- 原先 SSE 流在最后一个 token 之后还要依次：保存助手消息 → 查询并更新对话标题 → 扣除 Credits，
+  高负载时这些写操作占用数据库连接并推迟流的结束
+- 现在流结束时只投递一个 Celery 任务（cpu_default，acks_late 保证至少执行一次），
+  由 worker 在一个事务内完成全部写入
+- 幂等：消息 ID 在 API 端生成，消息插入与 Credits 流水均以该 ID 做 ON CONFLICT DO NOTHING，
+  任务重试或重复投递不会重复写消息或重复扣费
+- 合并：标题与 updated_at 在一条 UPDATE 中完成（标题仅在为空时写入），不再先 SELECT
+- 投递失败（Broker 不可用）时回退为进程内后台写入
+- 助手消息行在 API 端同步写入（save_reply_message）：下一轮的历史、消息列表与滚动摘要刷新
+  都依赖这条消息，不能等 cpu_default（与 EPUB 转换、深度分析共用）排到后置任务；
+  后置任务只负责标题 / updated_at 与扣费，同步写入失败时由任务补写消息
+"""
+import asyncio
+import logging
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import text
+
+from ..db import engine
+from .token_counter import count_tokens
+
+logger = logging.getLogger(__name__)
+
+# 持有后台任务引用，防止被垃圾回收
+_background_tasks: set = set()
+
+
+def build_reply_payload(
+    *,
+    message_id: str,
+    conversation_id: str,
+    user_id: str,
+    content: str,
+    citations: Optional[list],
+    model_id: str,
+    title: str,
+    credits: int,
+    created_at: datetime,
+) -> dict:
+    """构建写入任务参数（JSON 可序列化）"""
+    return {
+        "message_id": message_id,
+        "conversation_id": conversation_id,
+        "user_id": user_id,
+        "content": content,
+        "citations": citations or None,
+        "model_id": model_id,
+        "title": title,
+        "credits": credits,
+        "created_at": created_at.isoformat(),
+    }
+
+
+async def _insert_message(conn, payload: dict, token_count: int) -> bool:
+    import json
+
+    result = await conn.execute(
+        text(
+            """
+            INSERT INTO ai_messages (id, conversation_id, owner_id, role, content, citations, token_count, created_at)
+            VALUES (cast(:id as uuid), cast(:cid as uuid), cast(:uid as uuid), 'assistant', :content,
+                    :citations, :token_count, :created_at)
+            ON CONFLICT (id) DO NOTHING
+            RETURNING id
+            """
+        ),
+        {
+            "id": payload["message_id"],
+            "cid": payload["conversation_id"],
+            "uid": payload["user_id"],
+            "content": payload["content"],
+            "citations": json.dumps(payload["citations"]) if payload.get("citations") else None,
+            "token_count": token_count,
+            "created_at": datetime.fromisoformat(payload["created_at"]),
+        },
+    )
+    return result.fetchone() is not None
+
+
+async def save_reply_message(payload: dict) -> bool:
+    """
+    同步写入助手消息行（在 SSE 结束前调用）
+
+    成功时在 payload 上标记 message_saved，后置任务不再写消息；失败时保留给后置任务补写
+
+    Returns:
+        是否已写入
+    """
+    content = payload.get("content") or ""
+    if not content:
+        return False
+    try:
+        # 分词器首次加载可能需要下载，放到线程中执行
+        token_count = await asyncio.to_thread(count_tokens, content, payload.get("model_id"))
+        async with engine.begin() as conn:
+            await _insert_message(conn, payload, token_count)
+    except Exception as e:
+        logger.warning(f"[AIWriteBehind] Saving reply {payload['message_id'][:8]} failed, deferring to worker: {e}")
+        return False
+    payload["message_saved"] = True
+    return True
+
+
+async def persist_ai_reply(payload: dict) -> bool:
+    """
+    在一个事务内写入对话标题/时间与 Credits 扣费（幂等）；消息未同步写入时一并补写
+
+    Returns:
+        本次是否插入了新消息（False 表示此前已写入）
+    """
+    created_at = datetime.fromisoformat(payload["created_at"])
+    content = payload.get("content") or ""
+
+    async with engine.begin() as conn:
+        inserted = False
+        if content:
+            if not payload.get("message_saved"):
+                inserted = await _insert_message(conn, payload, count_tokens(content, payload.get("model_id")))
+
+            # 标题为空时用用户的第一条消息作为标题，与 updated_at 合并为一次更新
+            await conn.execute(
+                text(
+                    """
+                    UPDATE ai_conversations
+                    SET title = coalesce(nullif(title, ''), :title),
+                        updated_at = greatest(updated_at, :created_at)
+                    WHERE id = cast(:cid as uuid)
+                    """
+                ),
+                {"cid": payload["conversation_id"], "title": payload["title"], "created_at": created_at},
+            )
+
+        credits = int(payload.get("credits") or 0)
+        if credits > 0:
+            # 流水 ID 即消息 ID：重复执行时插入被忽略，不会重复扣费
+            result = await conn.execute(
+                text(
+                    """
+                    INSERT INTO credit_ledger (id, owner_id, amount, currency, direction, reason, related_id, created_at)
+                    VALUES (cast(:id as uuid), cast(:uid as uuid), :amount, 'CREDITS', 'debit', 'AI Chat',
+                            cast(:id as uuid), now())
+                    ON CONFLICT (id) DO NOTHING
+                    RETURNING id
+                    """
+                ),
+                {"id": payload["message_id"], "uid": payload["user_id"], "amount": -credits},
+            )
+            if result.fetchone() is not None:
+                await conn.execute(
+                    text(
+                        """
+                        UPDATE credit_accounts
+                        SET balance = GREATEST(0, balance - :cost),
+                            updated_at = now()
+                        WHERE owner_id = cast(:uid as uuid)
+                        """
+                    ),
+                    {"uid": payload["user_id"], "cost": credits},
+                )
+
+    logger.debug(f"[AIWriteBehind] Reply {payload['message_id'][:8]} persisted (new={inserted})")
+    return inserted
+
+
+def enqueue_ai_reply(payload: dict) -> None:
+    """投递写入任务；Broker 不可用时回退为进程内后台写入"""
+    try:
+        from ..celery_app import celery_app
+
+        celery_app.send_task(
+            "tasks.persist_ai_reply",
+            args=[payload],
+            queue="cpu_default",
+            routing_key="cpu.default",
+        )
+        return
+    except Exception as e:
+        logger.warning(f"[AIWriteBehind] Enqueue failed, writing in-process: {e}")
+
+    task = asyncio.get_running_loop().create_task(_persist_in_process(payload))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+async def _persist_in_process(payload: dict) -> None:
+    try:
+        await persist_ai_reply(payload)
+    except Exception as e:
+        logger.error(f"[AIWriteBehind] In-process write failed for {payload['message_id'][:8]}: {e}")
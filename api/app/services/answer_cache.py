@@ -0,0 +1,225 @@
+"""
+书籍问答语义答案缓存（可选）
+
+【2026-10-19】新增：
+- 热门书籍的同类问题（如"第一章的主旨是什么"）反复触发检索、重排序与完整生成
+- 开启 AI_ANSWER_CACHE_ENABLED 后，答案与引用按 (书籍 content_sha256 集合, 模型) 分区缓存在 Redis
+- 命中方式：规范化问题完全一致；或问题向量余弦相似度 ≥ AI_ANSWER_CACHE_SIMILARITY
+  且章节序号与数字一致（"第一章的主旨" 与 "第二章的主旨" 向量几乎相同，但不能共用答案）
+- 分区由持有相同书籍的所有用户共享：引用只缓存公共字段（content_sha256、页码、章节、片段），
+  book_id / book_title 在回放时按当前用户的书籍重新填充
+- 失效：每本书有一个代数计数器（ai:answer_cache:gen:{sha}），重建索引时递增，
+  分区键包含各书的代数，旧分区自然失效并按 TTL 过期
+- 只缓存对话第一轮（无历史消息与摘要）、且未使用用户私人笔记的回答（由调用方 app/ai.py 判断）
+"""
+import asyncio
+import base64
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+import unicodedata
+from dataclasses import dataclass
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+ANSWER_CACHE_ENABLED = os.getenv("AI_ANSWER_CACHE_ENABLED", "false").lower() == "true"
+# 语义命中阈值；设为 1 时只做规范化文本完全匹配（不计算问题向量）
+ANSWER_CACHE_SIMILARITY = float(os.getenv("AI_ANSWER_CACHE_SIMILARITY", "0.95"))
+ANSWER_CACHE_TTL = int(os.getenv("AI_ANSWER_CACHE_TTL", str(7 * 24 * 3600)))
+# 每个分区最多保留的条目数（语义匹配需要读取整个分区的向量）
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("AI_ANSWER_CACHE_MAX_ENTRIES", "100"))
+
+REDIS_HOST = os.getenv("REDIS_HOST", "redis")
+REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
+
+_GEN_PREFIX = "ai:answer_cache:gen:"
+_PUNCT_PATTERN = re.compile(r"[\s\W_]+", re.UNICODE)
+_NUMERAL_PATTERN = re.compile(r"[\d零〇一二两三四五六七八九十百千]+")
+# 引用中属于提问用户的字段（不写入共享分区）
+_USER_CITATION_FIELDS = ("book_id", "book_title")
+
+_redis = None
+# 持有后台任务引用，防止被垃圾回收
+_background_tasks: set = set()
+
+
+def _get_redis():
+    global _redis
+    if _redis is None:
+        import redis
+        _redis = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=True)
+    return _redis
+
+
+def normalize_question(question: str) -> str:
+    """规范化问题：NFKC（全角转半角）、小写、去除空白与标点"""
+    text = unicodedata.normalize("NFKC", question).lower()
+    return _PUNCT_PATTERN.sub("", text)
+
+
+def question_markers(question: str) -> str:
+    """问题中的章节序号与数字，语义命中时要求一致"""
+    from .llama_rag import extract_chapter_number, parse_chinese_numeral
+
+    text = unicodedata.normalize("NFKC", question)
+    chapter = extract_chapter_number(text)
+    numbers = {parse_chinese_numeral(run) for run in _NUMERAL_PATTERN.findall(text)}
+    numbers.discard(None)
+    return f"{chapter or ''}/{','.join(str(n) for n in sorted(numbers))}"
+
+
+def _encode_vector(vector: List[float]) -> str:
+    import numpy as np
+
+    arr = np.asarray(vector, dtype=np.float32)
+    norm = float(np.linalg.norm(arr)) or 1.0
+    return base64.b64encode((arr / norm).astype(np.float16).tobytes()).decode("ascii")
+
+
+def _decode_vector(data: str):
+    import numpy as np
+
+    return np.frombuffer(base64.b64decode(data), dtype=np.float16).astype(np.float32)
+
+
+@dataclass
+class AnswerCacheProbe:
+    """一次查找的上下文，未命中时用于写入"""
+    scope: str
+    field: str
+    question: str  # 原始问题（用于计算向量）
+    embedding: Optional[List[float]] = None
+
+
+def invalidate_book_answers(content_sha256: str) -> None:
+    """书籍重建索引后调用：递增代数，使包含该书的所有分区失效"""
+    try:
+        _get_redis().incr(f"{_GEN_PREFIX}{content_sha256}")
+    except Exception as e:
+        logger.warning(f"[AnswerCache] Invalidation failed for {content_sha256[:12]}: {e}")
+
+
+def _scope_key(content_sha256_list: List[str], model_id: str) -> str:
+    shas = sorted(set(content_sha256_list))
+    gens = _get_redis().mget([f"{_GEN_PREFIX}{sha}" for sha in shas])
+    material = model_id + "|" + ",".join(f"{sha}:{gen or 0}" for sha, gen in zip(shas, gens))
+    return "ai:answer_cache:" + hashlib.sha1(material.encode("utf-8")).hexdigest()
+
+
+async def lookup_answer(
+    content_sha256_list: List[str], model_id: str, question: str
+) -> tuple[Optional[dict], Optional[AnswerCacheProbe]]:
+    """
+    查找缓存答案
+
+    Returns:
+        (命中的条目 {"answer", "citations"} 或 None, 用于写入的 probe；缓存不可用时为 None)
+    """
+    if not ANSWER_CACHE_ENABLED or not content_sha256_list:
+        return None, None
+
+    normalized = normalize_question(question)
+    if not normalized:
+        return None, None
+
+    try:
+        r = _get_redis()
+        scope = _scope_key(content_sha256_list, model_id)
+        # 条目字段 = "章节序号与数字:问题哈希"，语义匹配只比较数字一致的条目
+        markers = question_markers(question)
+        field = f"{markers}:{hashlib.sha1(normalized.encode('utf-8')).hexdigest()[:16]}"
+        probe = AnswerCacheProbe(scope=scope, field=field, question=question)
+
+        raw = r.hget(scope, field)
+        if raw:
+            logger.info(f"[AnswerCache] Exact hit: '{question[:30]}'")
+            return json.loads(raw), probe
+
+        if ANSWER_CACHE_SIMILARITY >= 1.0:
+            return None, probe
+
+        vectors = {
+            other_field: data
+            for other_field, data in r.hgetall(f"{scope}:emb").items()
+            if other_field.rpartition(":")[0] == markers
+        }
+        if not vectors:
+            # 分区为空时不计算问题向量，写入时再补算
+            return None, probe
+
+        import numpy as np
+        from .llama_rag import get_local_embedding
+
+        probe.embedding = await get_local_embedding(question)
+        query = np.asarray(probe.embedding, dtype=np.float32)
+        query /= float(np.linalg.norm(query)) or 1.0
+
+        best_field, best_score = None, -1.0
+        for other_field, data in vectors.items():
+            score = float(np.dot(query, _decode_vector(data)))
+            if score > best_score:
+                best_field, best_score = other_field, score
+
+        if best_field and best_score >= ANSWER_CACHE_SIMILARITY:
+            raw = r.hget(scope, best_field)
+            if raw:
+                logger.info(f"[AnswerCache] Semantic hit: '{question[:30]}' (cos={best_score:.3f})")
+                return json.loads(raw), probe
+
+        return None, probe
+
+    except Exception as e:
+        logger.warning(f"[AnswerCache] Lookup failed: {e}")
+        return None, None
+
+
+async def store_answer(probe: AnswerCacheProbe, answer: str, citations: list) -> None:
+    """写入答案（分区超出上限时淘汰最旧的条目；引用去掉提问用户的 book_id / book_title）"""
+    try:
+        r = _get_redis()
+        embedding = probe.embedding
+        if embedding is None and ANSWER_CACHE_SIMILARITY < 1.0:
+            from .llama_rag import get_local_embedding
+            embedding = await get_local_embedding(probe.question)
+
+        shared_citations = [
+            {k: v for k, v in citation.items() if k not in _USER_CITATION_FIELDS}
+            for citation in citations
+        ]
+        entry = json.dumps(
+            {"answer": answer, "citations": shared_citations, "cached_at": int(time.time())},
+            ensure_ascii=False,
+        )
+        pipe = r.pipeline(transaction=False)
+        pipe.hset(probe.scope, probe.field, entry)
+        pipe.expire(probe.scope, ANSWER_CACHE_TTL)
+        if embedding is not None:
+            pipe.hset(f"{probe.scope}:emb", probe.field, _encode_vector(embedding))
+            pipe.expire(f"{probe.scope}:emb", ANSWER_CACHE_TTL)
+        pipe.zadd(f"{probe.scope}:lru", {probe.field: time.time()})
+        pipe.expire(f"{probe.scope}:lru", ANSWER_CACHE_TTL)
+        pipe.execute()
+
+        # 淘汰最旧的条目
+        overflow = r.zcard(f"{probe.scope}:lru") - ANSWER_CACHE_MAX_ENTRIES
+        if overflow > 0:
+            stale = r.zrange(f"{probe.scope}:lru", 0, overflow - 1)
+            if stale:
+                pipe = r.pipeline(transaction=False)
+                pipe.hdel(probe.scope, *stale)
+                pipe.hdel(f"{probe.scope}:emb", *stale)
+                pipe.zrem(f"{probe.scope}:lru", *stale)
+                pipe.execute()
+    except Exception as e:
+        logger.warning(f"[AnswerCache] Store failed: {e}")
+
+
+def schedule_store_answer(probe: AnswerCacheProbe, answer: str, citations: list) -> None:
+    """回复完成后在后台写入缓存（可能需要计算问题向量，不阻塞 SSE 流）"""
+    task = asyncio.get_running_loop().create_task(store_answer(probe, answer, citations))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
@@ -0,0 +1,277 @@
+"""
+书籍批量补处理编排（OCR / 向量索引）
+
+【2026-10-19】新增：
+- 原先 check_and_queue_books / rebuild_optimized_index 一次性为所有书籍投递任务（固定 countdown 间隔），
+  队列瞬间堆积数百个任务，用户上传触发的 OCR / 向量任务要排在整批补处理之后
+- 现在由编排器按 (created_at, id) 游标分批投递，游标保存在 backfill_jobs 表中，进程中断后从断点继续
+- 只在目标队列积压低于水位线时投递（BACKFILL_OCR_WATERMARK / BACKFILL_VECTOR_WATERMARK），
+  向量补处理在 gpu_high 有任务时完全让路；补处理任务使用最低优先级
+  （kombu Redis 传输先取优先级 0 的子队列，数值越大越靠后，见 BACKFILL_PRIORITY）
+- 任务经公平调度提交（见 fair_queue），补处理作为一个独立租户，与每个用户轮流使用 GPU
+- 支持暂停 / 恢复，按最近的投递速率估算剩余时间
+- 同一任务同时只允许一个编排进程运行（Redis 锁，进程退出后自动过期）
+- 投递与游标更新不在同一事务中：进程在两者之间崩溃时最多重复投递一批（任务本身幂等）
+"""
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime, timezone
+from typing import Optional
+
+from sqlalchemy import text
+
+from ..db import engine
+from .fair_queue import _get_redis, pending_count, queue_depth, submit_task
+
+logger = logging.getLogger(__name__)
+
+OCR_WATERMARK = int(os.getenv("BACKFILL_OCR_WATERMARK", "1"))
+VECTOR_WATERMARK = int(os.getenv("BACKFILL_VECTOR_WATERMARK", "4"))
+POLL_SECONDS = float(os.getenv("BACKFILL_POLL_SECONDS", "5"))
+RUNNER_LOCK_TTL = 60
+
+BACKFILL_TENANT = "backfill"
+# kombu Redis 传输按 0/3/6/9 档位从小到大出队：9 排在用户上传任务（3 / 7）之后
+BACKFILL_PRIORITY = 9
+
+# 图片型 PDF：is_digitalized=false 或置信度 < 0.8（与上传后的数字化检测一致）
+_IMAGE_PDF = """(
+    b.original_format = 'pdf'
+    AND (b.is_digitalized = false
+         OR (b.is_digitalized = true AND b.initial_digitalization_confidence < 0.8))
+)"""
+
+_ELIGIBLE = {
+    ("ocr", "missing"): f"""{_IMAGE_PDF}
+        AND (b.ocr_status IS NULL OR b.ocr_status IN ('pending', 'failed'))""",
+    ("vector", "missing"): f"""b.vector_indexed_at IS NULL
+        AND (b.original_format = 'epub'
+             OR (b.original_format = 'pdf' AND NOT {_IMAGE_PDF})
+             OR ({_IMAGE_PDF} AND b.ocr_status = 'completed'))""",
+    ("vector", "all"): f"""(b.original_format = 'epub'
+             OR (b.original_format = 'pdf' AND NOT {_IMAGE_PDF})
+             OR ({_IMAGE_PDF} AND b.ocr_status = 'completed'))""",
+}
+
+def _backlog(queue: str) -> int:
+    """Celery 队列积压 + 公平调度子队列中尚未转发的任务"""
+    return queue_depth(queue) + pending_count(queue)
+
+
+def available_slots(kind: str) -> int:
+    """本轮可以投递的任务数（0 表示等待）"""
+    if kind == "ocr":
+        return OCR_WATERMARK - _backlog("gpu_high")
+    # 向量补处理在 gpu_high（用户 OCR）有积压时让路
+    if _backlog("gpu_high") > 0:
+        return 0
+    return VECTOR_WATERMARK - _backlog("gpu_low")
+
+
+def _where(kind: str, scope: str) -> str:
+    try:
+        return _ELIGIBLE[(kind, scope)]
+    except KeyError:
+        raise ValueError(f"unsupported backfill: kind={kind} scope={scope}")
+
+
+async def eligible_content_hashes(kind: str, scope: str = "all") -> set:
+    """符合条件书籍的 content_sha256 集合（同一内容的多本书只计一次）"""
+    where = _where(kind, scope)
+    async with engine.begin() as conn:
+        rows = (await conn.execute(text(
+            f"""SELECT DISTINCT b.content_sha256 FROM books b
+                WHERE b.deleted_at IS NULL AND b.content_sha256 IS NOT NULL AND {where}"""
+        ))).fetchall()
+    return {row[0] for row in rows}
+
+
+async def create_backfill(job_id: str, kind: str, scope: str = "missing") -> dict:
+    """
+    创建补处理任务（统计待处理书籍数）
+
+    同名任务未完成时保留原游标（继续执行）；已完成时从头开始新一轮。
+    """
+    where = _where(kind, scope)
+    async with engine.begin() as conn:
+        total = (await conn.execute(text(
+            f"SELECT COUNT(*) FROM books b WHERE b.deleted_at IS NULL AND {where}"
+        ))).scalar() or 0
+        await conn.execute(
+            text("""
+                INSERT INTO backfill_jobs (id, kind, scope, total)
+                VALUES (:id, :kind, :scope, :total)
+                ON CONFLICT (id) DO UPDATE
+                SET scope = EXCLUDED.scope, status = 'running', total = EXCLUDED.total,
+                    cursor_created_at = NULL, cursor_id = NULL, enqueued = 0,
+                    rate_started_at = now(), rate_base = 0, updated_at = now(), finished_at = NULL
+                WHERE backfill_jobs.status = 'completed' AND backfill_jobs.kind = EXCLUDED.kind
+            """),
+            {"id": job_id, "kind": kind, "scope": scope, "total": total},
+        )
+    return await get_backfill_status(job_id)
+
+
+async def _load_job(conn, job_id: str) -> Optional[dict]:
+    row = (await conn.execute(
+        text("""
+            SELECT id, kind, scope, status, cursor_created_at, cursor_id::text, total, enqueued,
+                   rate_started_at, rate_base, created_at, finished_at
+            FROM backfill_jobs WHERE id = :id
+        """),
+        {"id": job_id},
+    )).mappings().first()
+    return dict(row) if row else None
+
+
+def _with_eta(job: dict, now: Optional[datetime] = None) -> dict:
+    """按恢复运行以来的投递速率估算剩余时间"""
+    now = now or datetime.now(timezone.utc)
+    remaining = max(0, job["total"] - job["enqueued"])
+    elapsed = (now - job["rate_started_at"]).total_seconds()
+    rate = (job["enqueued"] - job["rate_base"]) / elapsed if elapsed > 0 else 0.0
+    job["remaining"] = remaining
+    job["rate_per_min"] = round(rate * 60, 2)
+    job["eta_seconds"] = round(remaining / rate) if rate > 0 and job["status"] == "running" else None
+    return job
+
+
+async def get_backfill_status(job_id: str) -> Optional[dict]:
+    async with engine.connect() as conn:
+        job = await _load_job(conn, job_id)
+    return _with_eta(job) if job else None
+
+
+async def set_backfill_paused(job_id: str, paused: bool) -> bool:
+    """暂停 / 恢复（恢复时重置速率统计起点）；已完成的任务不受影响"""
+    async with engine.begin() as conn:
+        if paused:
+            result = await conn.execute(
+                text("""
+                    UPDATE backfill_jobs SET status = 'paused', updated_at = now()
+                    WHERE id = :id AND status = 'running'
+                """),
+                {"id": job_id},
+            )
+        else:
+            result = await conn.execute(
+                text("""
+                    UPDATE backfill_jobs
+                    SET status = 'running', rate_started_at = now(), rate_base = enqueued, updated_at = now()
+                    WHERE id = :id AND status = 'paused'
+                """),
+                {"id": job_id},
+            )
+    return result.rowcount > 0
+
+
+async def _next_books(conn, job: dict, limit: int) -> list:
+    where = _where(job["kind"], job["scope"])
+    params = {"limit": limit}
+    cursor = ""
+    if job["cursor_created_at"] is not None:
+        cursor = "AND (b.created_at, b.id) > (:cursor_created_at, cast(:cursor_id as uuid))"
+        params.update(cursor_created_at=job["cursor_created_at"], cursor_id=job["cursor_id"])
+    result = await conn.execute(
+        text(f"""
+            SELECT b.id::text AS id, b.user_id::text AS user_id, b.created_at
+            FROM books b
+            WHERE b.deleted_at IS NULL AND {where} {cursor}
+            ORDER BY b.created_at, b.id
+            LIMIT :limit
+        """),
+        params,
+    )
+    return list(result.mappings())
+
+
+def _dispatch(kind: str, book: dict) -> None:
+    if kind == "ocr":
+        task_name, args = "tasks.process_book_ocr", [book["id"], book["user_id"]]
+    else:
+        task_name, args = "tasks.index_book_vectors", [book["id"]]
+    submit_task(task_name, args, BACKFILL_TENANT, priority=BACKFILL_PRIORITY, tier="system")
+
+
+async def run_backfill_step(job_id: str) -> str:
+    """
+    执行一轮：检查状态与水位线，投递一批并推进游标
+
+    Returns:
+        running（已投递或队列已满）/ paused / completed / missing
+    """
+    async with engine.connect() as conn:
+        job = await _load_job(conn, job_id)
+    if job is None:
+        return "missing"
+    if job["status"] != "running":
+        return job["status"]
+
+    slots = available_slots(job["kind"])
+    if slots <= 0:
+        return "running"
+
+    async with engine.begin() as conn:
+        books = await _next_books(conn, job, slots)
+        if not books:
+            await conn.execute(
+                text("""
+                    UPDATE backfill_jobs
+                    SET status = 'completed', finished_at = now(), updated_at = now()
+                    WHERE id = :id
+                """),
+                {"id": job_id},
+            )
+            logger.info(f"[Backfill] {job_id} completed: {job['enqueued']} tasks enqueued")
+            return "completed"
+
+        for book in books:
+            _dispatch(job["kind"], book)
+        last = books[-1]
+        await conn.execute(
+            text("""
+                UPDATE backfill_jobs
+                SET cursor_created_at = :created_at, cursor_id = cast(:book_id as uuid),
+                    enqueued = enqueued + :n, updated_at = now()
+                WHERE id = :id
+            """),
+            {"id": job_id, "created_at": last["created_at"], "book_id": last["id"], "n": len(books)},
+        )
+    logger.info(f"[Backfill] {job_id}: enqueued {len(books)} {job['kind']} tasks")
+    return "running"
+
+
+async def run_backfill(job_id: str, poll_seconds: float = POLL_SECONDS, on_progress=None) -> str:
+    """
+    持续运行直到任务完成（暂停期间保持等待，恢复后继续）
+
+    Args:
+        on_progress: 每轮投递后以任务状态 dict 调用（用于打印进度）
+    """
+    redis = _get_redis()
+    lock_key = f"backfill:runner:{job_id}"
+    token = f"{os.getpid()}:{time.time()}"
+    if not redis.set(lock_key, token, nx=True, ex=RUNNER_LOCK_TTL):
+        raise RuntimeError(f"backfill {job_id} is already running in another process")
+
+    try:
+        while True:
+            redis.expire(lock_key, RUNNER_LOCK_TTL)
+            try:
+                state = await run_backfill_step(job_id)
+            except Exception as e:
+                # Broker / 数据库短暂不可用：游标未推进，下一轮重试
+                logger.warning(f"[Backfill] {job_id} step failed, retrying: {e}")
+                state = "running"
+            if state in ("completed", "missing"):
+                return state
+            if on_progress is not None:
+                status = await get_backfill_status(job_id)
+                if status:
+                    on_progress(status)
+            await asyncio.sleep(poll_seconds)
+    finally:
+        if redis.get(lock_key) in (token, token.encode()):
+            redis.delete(lock_key)
@@ -0,0 +1,127 @@
+"""
+AI 对话书籍上下文批量加载
+
+【2026-10-19】新增：
+- QA 模式原先逐本调用 get_book_info，书架对话（最多 RAG_MAX_BOOKS 本）需要几十次数据库往返
+- 现在一次 `id = ANY(:ids)` 查询取回全部书籍信息
+- 结果按用户缓存在 Redis Hash（ai:book_ctx:{user_id}，field = book_id），条目带 books.version
+- 缓存短期有效（默认 30 秒），书籍元数据更新/删除时由 invalidate_book_context_cache 清除
+  （书籍 API、PowerSync 元数据同步、元数据/封面提取任务）
+"""
+import json
+import logging
+import os
+import time
+
+from sqlalchemy import text
+
+from ..db import engine
+
+logger = logging.getLogger(__name__)
+
+BOOK_CONTEXT_CACHE_TTL = int(os.getenv("AI_BOOK_CONTEXT_CACHE_TTL", "30"))
+
+REDIS_HOST = os.getenv("REDIS_HOST", "redis")
+REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
+
+_redis = None
+
+
+def _get_redis():
+    """Redis 客户端（worker 只配置了 REDIS_URL，元数据任务需要在 worker 中清除缓存）"""
+    global _redis
+    if _redis is None:
+        import redis
+        redis_url = os.getenv("REDIS_URL")
+        if redis_url and "://" in redis_url:
+            _redis = redis.Redis.from_url(redis_url, decode_responses=True)
+        else:
+            _redis = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=True)
+    return _redis
+
+
+def _cache_key(user_id: str) -> str:
+    return f"ai:book_ctx:{user_id}"
+
+
+def invalidate_book_context_cache(user_id: str):
+    """清除用户的书籍上下文缓存（书籍元数据更新或删除后调用）"""
+    try:
+        _get_redis().delete(_cache_key(user_id))
+    except Exception as e:
+        logger.warning(f"[BookContext] Cache invalidation failed: {e}")
+
+
+async def load_book_contexts(book_ids: list[str], user_id: str) -> list[dict]:
+    """
+    批量获取书籍信息（包括 content_sha256 用于向量搜索）
+
+    Args:
+        book_ids: 书籍ID列表
+        user_id: 用户ID（只返回该用户的书籍）
+
+    Returns:
+        与 book_ids 顺序一致的书籍信息列表（不存在的书籍被跳过），每项包含：
+        id / title / author / content_sha256 / version
+    """
+    if not book_ids:
+        return []
+
+    contexts: dict[str, dict] = {}
+
+    # 1. 读取缓存（一次 HMGET）
+    try:
+        cached = _get_redis().hmget(_cache_key(user_id), book_ids)
+        now = time.time()
+        for bid, raw in zip(book_ids, cached):
+            if raw:
+                entry = json.loads(raw)
+                # Hash 的 TTL 会被后续写入续期，单个条目按写入时间判断是否过期
+                if now - entry.pop("cached_at", 0) < BOOK_CONTEXT_CACHE_TTL:
+                    contexts[bid] = entry
+    except Exception as e:
+        logger.warning(f"[BookContext] Cache read failed: {e}")
+
+    # 2. 未命中的书籍一次查询取回
+    missing = [bid for bid in dict.fromkeys(book_ids) if bid not in contexts]
+    if missing:
+        async with engine.begin() as conn:
+            result = await conn.execute(
+                text(
+                    """
+                    SELECT id::text, title, author, content_sha256, version
+                    FROM books
+                    WHERE id = ANY(cast(:ids as uuid[])) AND user_id = cast(:uid as uuid)
+                    """
+                ),
+                {"ids": missing, "uid": user_id},
+            )
+            fetched = {
+                row[0]: {
+                    "id": row[0],
+                    "title": row[1] or "未知书名",
+                    "author": row[2] or "未知作者",
+                    "content_sha256": row[3],  # 用于向量搜索匹配
+                    "version": row[4],
+                }
+                for row in result.fetchall()
+            }
+        contexts.update(fetched)
+
+        if fetched:
+            try:
+                pipe = _get_redis().pipeline(transaction=False)
+                pipe.hset(
+                    _cache_key(user_id),
+                    mapping={
+                        bid: json.dumps({**info, "cached_at": time.time()}, ensure_ascii=False)
+                        for bid, info in fetched.items()
+                    },
+                )
+                pipe.expire(_cache_key(user_id), BOOK_CONTEXT_CACHE_TTL)
+                pipe.execute()
+            except Exception as e:
+                logger.warning(f"[BookContext] Cache write failed: {e}")
+
+    logger.debug(f"[BookContext] Loaded {len(contexts)} books ({len(missing)} from DB)")
+    return [contexts[bid] for bid in dict.fromkeys(book_ids) if bid in contexts]
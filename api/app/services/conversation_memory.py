@@ -0,0 +1,266 @@
+"""
+对话滚动摘要（长对话记忆）
+
+【2026-10-19】新增：
+- 每个对话在 ai_conversation_contexts 中持久化一份增量摘要（summary / summary_until）
+- 组装 prompt 时只携带：摘要 + summary_until 之后尚未被摘要覆盖的消息
+- 回复完成后在后台刷新摘要：未覆盖的消息超出最近窗口 AI_SUMMARY_TRIGGER_MESSAGES 条时，
+  把窗口之前的消息合并进摘要（只发送 旧摘要 + 新增消息，不重复发送全部历史）
+- 刷新失败不影响对话，下次回复后重试
+"""
+import asyncio
+import logging
+import os
+from dataclasses import dataclass, field
+from typing import Optional
+
+from sqlalchemy import text
+
+from ..db import engine
+from .llm_provider import ChatMessage, get_provider
+
+logger = logging.getLogger(__name__)
+
+# 始终原样保留的最近消息数（3 轮）
+SUMMARY_RECENT_MESSAGES = int(os.getenv("AI_SUMMARY_RECENT_MESSAGES", "6"))
+# 窗口之外累计多少条未摘要消息时触发刷新
+SUMMARY_TRIGGER_MESSAGES = int(os.getenv("AI_SUMMARY_TRIGGER_MESSAGES", "4"))
+# 单次刷新最多合并的消息数（限制摘要请求的 prompt 长度）
+SUMMARY_MAX_FOLD_MESSAGES = int(os.getenv("AI_SUMMARY_MAX_FOLD_MESSAGES", "20"))
+SUMMARY_MAX_CHARS = int(os.getenv("AI_SUMMARY_MAX_CHARS", "400"))
+SUMMARY_LOCK_TTL = 60
+
+REDIS_HOST = os.getenv("REDIS_HOST", "redis")
+REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
+
+SUMMARY_PROMPT = """请把"新增对话"合并进"已有摘要"，输出更新后的对话摘要。
+
+要求：
+1. 不超过 {max_chars} 字
+2. 保留涉及的书名、人物、关键结论、用户的偏好和尚未解决的问题
+3. 只输出摘要正文，不要任何解释
+
+已有摘要：
+{summary}
+
+新增对话：
+{conversation}
+
+更新后的摘要："""
+
+_redis = None
+# 持有后台任务引用，防止被垃圾回收
+_background_tasks: set = set()
+
+
+def _get_redis():
+    global _redis
+    if _redis is None:
+        import redis
+        _redis = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=True)
+    return _redis
+
+
+@dataclass
+class ConversationMemory:
+    """组装 prompt 用的对话记忆"""
+    summary: Optional[str] = None
+    messages: list[ChatMessage] = field(default_factory=list)  # 摘要之后的消息（从旧到新）
+
+    def to_messages(self) -> list[ChatMessage]:
+        """摘要（system 消息）+ 未摘要的消息"""
+        if not self.summary:
+            return list(self.messages)
+        return [ChatMessage(role="system", content=f"[对话历史摘要] {self.summary}")] + self.messages
+
+
+async def load_conversation_memory(
+    conversation_id: str,
+    user_id: str,
+    limit: int = 20,
+    max_tokens: Optional[int] = None,
+) -> ConversationMemory:
+    """
+    加载对话记忆：持久化摘要 + 摘要之后的最近消息
+
+    Args:
+        conversation_id: 对话ID
+        user_id: 用户ID
+        limit: 最多返回的未摘要消息数
+        max_tokens: 消息 token 预算（按 ai_messages.token_count 从新到旧累加，
+            始终保留最近 1 轮即 2 条消息）；None 表示不限制
+    """
+    async with engine.begin() as conn:
+        result = await conn.execute(
+            text(
+                """
+                SELECT summary, summary_until
+                FROM ai_conversation_contexts
+                WHERE conversation_id = cast(:cid as uuid) AND owner_id = cast(:uid as uuid)
+                """
+            ),
+            {"cid": conversation_id, "uid": user_id},
+        )
+        row = result.fetchone()
+        summary, summary_until = (row[0], row[1]) if row else (None, None)
+
+        # token_count 为 NULL 的历史消息按 0.75 token/字符估算
+        result = await conn.execute(
+            text(
+                """
+                SELECT role, content
+                FROM (
+                    SELECT role, content, created_at,
+                           row_number() OVER w AS rn,
+                           sum(coalesce(token_count, ceil(char_length(content) * 0.75)::int)) OVER w AS running_tokens
+                    FROM ai_messages
+                    WHERE conversation_id = cast(:cid as uuid) AND owner_id = cast(:uid as uuid)
+                      AND created_at > coalesce(cast(:until as timestamptz), '-infinity'::timestamptz)
+                    WINDOW w AS (ORDER BY created_at DESC)
+                    ORDER BY created_at DESC
+                    LIMIT :limit
+                ) recent
+                WHERE cast(:max_tokens as integer) IS NULL
+                   OR running_tokens <= cast(:max_tokens as integer)
+                   OR rn <= 2
+                ORDER BY created_at DESC
+                """
+            ),
+            {
+                "cid": conversation_id,
+                "uid": user_id,
+                "until": summary_until,
+                "limit": limit,
+                "max_tokens": max_tokens,
+            },
+        )
+        rows = result.fetchall()
+
+    # 反转顺序（从旧到新）
+    messages = [ChatMessage(role=r[0], content=r[1]) for r in reversed(rows)]
+    return ConversationMemory(summary=summary or None, messages=messages)
+
+
+async def refresh_rolling_summary(conversation_id: str, user_id: str, model_config: dict) -> bool:
+    """
+    增量刷新对话摘要
+
+    Returns:
+        是否更新了摘要
+    """
+    lock_key = f"ai:summary_lock:{conversation_id}"
+    try:
+        if not _get_redis().set(lock_key, "1", nx=True, ex=SUMMARY_LOCK_TTL):
+            return False  # 其他进程正在刷新
+    except Exception as e:
+        logger.warning(f"[ConvMemory] Summary lock unavailable: {e}")
+
+    try:
+        async with engine.begin() as conn:
+            result = await conn.execute(
+                text(
+                    """
+                    SELECT summary, summary_until
+                    FROM ai_conversation_contexts
+                    WHERE conversation_id = cast(:cid as uuid) AND owner_id = cast(:uid as uuid)
+                    """
+                ),
+                {"cid": conversation_id, "uid": user_id},
+            )
+            row = result.fetchone()
+            summary, summary_until = (row[0], row[1]) if row else (None, None)
+
+            result = await conn.execute(
+                text(
+                    """
+                    SELECT role, content, created_at
+                    FROM ai_messages
+                    WHERE conversation_id = cast(:cid as uuid) AND owner_id = cast(:uid as uuid)
+                      AND created_at > coalesce(cast(:until as timestamptz), '-infinity'::timestamptz)
+                    ORDER BY created_at ASC
+                    LIMIT :limit
+                    """
+                ),
+                {
+                    "cid": conversation_id,
+                    "uid": user_id,
+                    "until": summary_until,
+                    "limit": SUMMARY_MAX_FOLD_MESSAGES + SUMMARY_RECENT_MESSAGES,
+                },
+            )
+            rows = result.fetchall()
+
+        fold = rows[:-SUMMARY_RECENT_MESSAGES] if len(rows) > SUMMARY_RECENT_MESSAGES else []
+        if len(fold) < SUMMARY_TRIGGER_MESSAGES:
+            return False
+
+        conversation = "\n".join(
+            f"{'用户' if r[0] == 'user' else '助手'}: {r[1][:500]}" for r in fold
+        )
+        provider = get_provider(
+            model_config["provider"],
+            model_config["api_key"],
+            model_config["endpoint"],
+        )
+        new_summary, _ = await provider.chat(
+            messages=[ChatMessage(role="user", content=SUMMARY_PROMPT.format(
+                max_chars=SUMMARY_MAX_CHARS,
+                summary=summary or "（无）",
+                conversation=conversation,
+            ))],
+            model=model_config["model_id"],
+            temperature=0.3,  # 低温度确保摘要稳定
+            max_tokens=SUMMARY_MAX_CHARS,
+        )
+        new_summary = (new_summary or "").strip()
+        if not new_summary:
+            return False
+
+        async with engine.begin() as conn:
+            # 乐观并发：summary_until 已被其他刷新推进时放弃本次结果
+            result = await conn.execute(
+                text(
+                    """
+                    INSERT INTO ai_conversation_contexts
+                        (conversation_id, owner_id, summary, summary_until, summary_updated_at, updated_at)
+                    VALUES
+                        (cast(:cid as uuid), cast(:uid as uuid), :summary, :until, now(), now())
+                    ON CONFLICT (conversation_id) DO UPDATE
+                    SET summary = EXCLUDED.summary,
+                        summary_until = EXCLUDED.summary_until,
+                        summary_updated_at = now()
+                    WHERE ai_conversation_contexts.summary_until IS NOT DISTINCT FROM cast(:prev as timestamptz)
+                    RETURNING conversation_id
+                    """
+                ),
+                {
+                    "cid": conversation_id,
+                    "uid": user_id,
+                    "summary": new_summary,
+                    "until": fold[-1][2],
+                    "prev": summary_until,
+                },
+            )
+            updated = result.fetchone() is not None
+
+        if updated:
+            logger.info(f"[ConvMemory] Summary refreshed for {conversation_id[:8]}: folded {len(fold)} messages")
+        return updated
+
+    except Exception as e:
+        logger.warning(f"[ConvMemory] Summary refresh failed for {conversation_id[:8]}: {e}")
+        return False
+    finally:
+        try:
+            _get_redis().delete(lock_key)
+        except Exception:
+            pass
+
+
+def schedule_summary_refresh(conversation_id: str, user_id: str, model_config: dict) -> None:
+    """回复完成后在后台刷新摘要（不阻塞 SSE 流）"""
+    task = asyncio.get_running_loop().create_task(
+        refresh_rolling_summary(conversation_id, user_id, model_config)
+    )
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
@@ -0,0 +1,259 @@
+"""
+GPU 队列按用户公平调度
+
+【2026-10-19】新增：
+- gpu_high / gpu_low 是普通 FIFO 队列（worker 并发 1、prefetch 1），一个用户一次导入 500 本扫描 PDF，
+  其他用户的 OCR / 向量任务要排在全部 500 个任务之后
+- 现在书籍处理类 GPU 任务先进入按用户划分的子队列（Redis list），由调度器按加权轮询
+  （每轮每个用户可发出 weight 个任务，会员权重更高）转发到 Celery 队列
+- Celery 队列中只保留少量待执行任务（FAIR_QUEUE_WATERMARK），调度决策尽量推迟到 GPU 空闲时，
+  新用户的任务最多等待 watermark 个任务 + 一轮轮询
+- 触发转发的时机：提交任务时、GPU worker 每个任务结束时（task_postrun），以及 beat 定期兜底
+- 选取下一个任务在 Lua 脚本中原子完成；多个进程同时转发时用短锁串行
+- 每个任务记录入队时间，转发时统计等待时长（按会员等级），fair_queue_stats 提供每个用户的积压与最长等待
+- 关闭（FAIR_QUEUE_ENABLED=false）或 Redis 不可用时直接投递到 Celery 队列
+"""
+import json
+import logging
+import os
+import time
+import uuid
+from typing import Optional
+
+from prometheus_client import Counter, Gauge, Histogram
+
+logger = logging.getLogger(__name__)
+
+FAIR_QUEUE_ENABLED = os.getenv("FAIR_QUEUE_ENABLED", "true").lower() == "true"
+FAIR_QUEUE_WATERMARK = int(os.getenv("FAIR_QUEUE_WATERMARK", "1"))
+FAIR_QUEUES = ("gpu_high", "gpu_low")
+# 会员每轮可发出的任务数（免费用户为 1）
+FAIR_QUEUE_PRO_WEIGHT = int(os.getenv("FAIR_QUEUE_PRO_WEIGHT", "2"))
+PUMP_LOCK_TTL = 10
+
+BROKER_URL = os.getenv("CELERY_BROKER_URL", "redis://redis:6379/0")
+# kombu Redis 传输的优先级子队列后缀（priority_steps 默认 0/3/6/9）
+_PRIORITY_SEP = "\x06\x16"
+_PRIORITY_STEPS = (0, 3, 6, 9)
+
+GPU_FAIR_WAIT = Histogram(
+    "gpu_fair_queue_wait_seconds",
+    "Time GPU tasks spend in per-user sub-queues before dispatch",
+    ["queue", "tier"],  # tier: pro / free / system
+    buckets=(1, 5, 15, 60, 300, 900, 1800, 3600, 7200, 21600),
+)
+GPU_FAIR_DISPATCHED = Counter(
+    "gpu_fair_queue_dispatched_total", "GPU tasks forwarded to Celery", ["queue", "tier"]
+)
+GPU_FAIR_TENANTS = Gauge(
+    "gpu_fair_queue_tenants", "Users with pending GPU tasks", ["queue"]
+)
+
+# KEYS: 用户子队列, 轮询环, 权重哈希
+# ARGV: 用户, 任务 JSON, 权重
+_ENQUEUE_SCRIPT = """
+local n = redis.call('RPUSH', KEYS[1], ARGV[2])
+redis.call('HSET', KEYS[3], ARGV[1], ARGV[3])
+if n == 1 then
+  redis.call('LREM', KEYS[2], 0, ARGV[1])
+  redis.call('RPUSH', KEYS[2], ARGV[1])
+end
+return n
+"""
+
+# KEYS: 轮询环, 权重哈希, 本轮剩余额度哈希
+# ARGV: 子队列 key 前缀
+# 轮询环头部的用户发出一个任务并扣减本轮额度，额度用完或子队列为空时移到环尾 / 移出环
+_PICK_SCRIPT = """
+for _ = 1, redis.call('LLEN', KEYS[1]) do
+  local user = redis.call('LINDEX', KEYS[1], 0)
+  local item = redis.call('LPOP', ARGV[1] .. user)
+  if item then
+    local credit = tonumber(redis.call('HGET', KEYS[3], user)) or tonumber(redis.call('HGET', KEYS[2], user)) or 1
+    credit = credit - 1
+    if redis.call('LLEN', ARGV[1] .. user) == 0 then
+      redis.call('LPOP', KEYS[1])
+      redis.call('HDEL', KEYS[2], user)
+      redis.call('HDEL', KEYS[3], user)
+    elseif credit < 1 then
+      redis.call('LMOVE', KEYS[1], KEYS[1], 'LEFT', 'RIGHT')
+      redis.call('HDEL', KEYS[3], user)
+    else
+      redis.call('HSET', KEYS[3], user, credit)
+    end
+    return {user, item}
+  end
+  redis.call('LPOP', KEYS[1])
+  redis.call('HDEL', KEYS[3], user)
+end
+return false
+"""
+
+_redis = None
+_scripts = None
+
+
+def _get_redis():
+    """Broker 所在的 Redis（子队列与 Celery 队列放在一起，便于比较积压）"""
+    global _redis
+    if _redis is None:
+        import redis
+        _redis = redis.Redis.from_url(BROKER_URL, decode_responses=True)
+    return _redis
+
+
+def _get_scripts():
+    global _scripts
+    if _scripts is None:
+        redis = _get_redis()
+        _scripts = (redis.register_script(_ENQUEUE_SCRIPT), redis.register_script(_PICK_SCRIPT))
+    return _scripts
+
+
+def _keys(queue: str) -> dict:
+    base = f"fair:{queue}"
+    return {
+        "prefix": f"{base}:user:",
+        "ring": f"{base}:ring",
+        "weight": f"{base}:weight",
+        "credit": f"{base}:credit",
+        "lock": f"{base}:pump",
+    }
+
+
+def queue_depth(queue: str) -> int:
+    """Celery 队列中等待执行的任务数（含各优先级子队列）"""
+    pipe = _get_redis().pipeline(transaction=False)
+    for step in _PRIORITY_STEPS:
+        pipe.llen(queue if step == 0 else f"{queue}{_PRIORITY_SEP}{step}")
+    return sum(pipe.execute())
+
+
+def pending_count(queue: str) -> int:
+    """各用户子队列中尚未转发的任务总数"""
+    redis = _get_redis()
+    keys = _keys(queue)
+    users = redis.lrange(keys["ring"], 0, -1)
+    if not users:
+        return 0
+    pipe = redis.pipeline(transaction=False)
+    for user in users:
+        pipe.llen(keys["prefix"] + user)
+    return sum(pipe.execute())
+
+
+def _route(task_name: str) -> Optional[str]:
+    from ..celery_app import CELERY_TASK_ROUTES
+
+    return CELERY_TASK_ROUTES.get(task_name, {}).get("queue")
+
+
+def submit_task(
+    task_name: str,
+    args: list,
+    tenant: str,
+    *,
+    weight: int = 1,
+    priority: Optional[int] = None,
+    tier: str = "free",
+) -> None:
+    """
+    提交 GPU 任务（替代 celery_app.send_task）
+
+    Args:
+        tenant: 公平调度的单位，通常为 user_id；补处理等系统任务使用固定名称
+        weight: 每轮可发出的任务数
+        tier: 等待时长指标的标签（pro / free / system）
+    """
+    from ..celery_app import celery_app
+
+    queue = _route(task_name)
+    if not FAIR_QUEUE_ENABLED or queue not in FAIR_QUEUES:
+        celery_app.send_task(task_name, args=args, priority=priority)
+        return
+
+    keys = _keys(queue)
+    item = json.dumps({
+        "id": uuid.uuid4().hex,
+        "task": task_name,
+        "args": args,
+        "priority": priority,
+        "tier": tier,
+        "enqueued_at": time.time(),
+    })
+    try:
+        enqueue, _ = _get_scripts()
+        enqueue(keys=[keys["prefix"] + tenant, keys["ring"], keys["weight"]], args=[tenant, item, max(1, weight)])
+    except Exception as e:
+        logger.warning(f"[FairQueue] Redis unavailable, sending {task_name} directly: {e}")
+        celery_app.send_task(task_name, args=args, priority=priority)
+        return
+    pump(queue)
+
+
+def pump(queue: str) -> int:
+    """
+    把子队列中的任务按加权轮询转发到 Celery 队列，直到 Celery 队列积压达到水位线
+
+    Returns:
+        本次转发的任务数
+    """
+    from ..celery_app import celery_app
+
+    keys = _keys(queue)
+    redis = _get_redis()
+    token = uuid.uuid4().hex
+    dispatched = 0
+    try:
+        if not redis.set(keys["lock"], token, nx=True, ex=PUMP_LOCK_TTL):
+            return 0
+        _, pick = _get_scripts()
+        try:
+            while queue_depth(queue) < FAIR_QUEUE_WATERMARK:
+                picked = pick(keys=[keys["ring"], keys["weight"], keys["credit"]], args=[keys["prefix"]])
+                if not picked:
+                    break
+                tenant, raw = picked
+                item = json.loads(raw)
+                try:
+                    celery_app.send_task(item["task"], args=item["args"], priority=item.get("priority"))
+                except Exception:
+                    # Broker 不可用：放回该用户子队列头部，等待下次转发
+                    redis.lpush(keys["prefix"] + tenant, raw)
+                    redis.lrem(keys["ring"], 0, tenant)
+                    redis.lpush(keys["ring"], tenant)
+                    raise
+                tier = item.get("tier", "free")
+                GPU_FAIR_WAIT.labels(queue=queue, tier=tier).observe(max(0.0, time.time() - item["enqueued_at"]))
+                GPU_FAIR_DISPATCHED.labels(queue=queue, tier=tier).inc()
+                dispatched += 1
+            GPU_FAIR_TENANTS.labels(queue=queue).set(redis.llen(keys["ring"]))
+        finally:
+            if redis.get(keys["lock"]) == token:
+                redis.delete(keys["lock"])
+    except Exception as e:
+        logger.warning(f"[FairQueue] Pump {queue} failed: {e}")
+    if dispatched:
+        logger.info(f"[FairQueue] Dispatched {dispatched} tasks to {queue}")
+    return dispatched
+
+
+def pump_all() -> dict:
+    """转发所有 GPU 队列（beat 定期兜底）"""
+    return {queue: pump(queue) for queue in FAIR_QUEUES}
+
+
+def fair_queue_stats(queue: str) -> list:
+    """每个用户的积压任务数与最长等待秒数（按轮询顺序）"""
+    redis = _get_redis()
+    keys = _keys(queue)
+    now = time.time()
+    stats = []
+    for tenant in redis.lrange(keys["ring"], 0, -1):
+        head = redis.lindex(keys["prefix"] + tenant, 0)
+        stats.append({
+            "tenant": tenant,
+            "pending": redis.llen(keys["prefix"] + tenant),
+            "oldest_wait_seconds": round(now - json.loads(head)["enqueued_at"], 1) if head else 0.0,
+        })
+    return stats
@@ -4,35 +4,137 @@ GPU 任务锁服务
 使用 Redis 分布式锁确保 GPU 密集型任务（OCR、向量索引）串行执行，
 避免多任务同时占用 GPU 导致显存溢出。
 
+【2026-10-19】改为带优先级的 GPU 仲裁：
+- 旧实现：单个 SET NX 锁（7200 秒过期）+ 每 5 秒轮询重试，每次交接 GPU 最多空闲 5 秒，
+  低优先级的补处理持有锁时，交互式的查询向量化只能排队
+- 等待者按优先级登记在有序集合中（同级按到达顺序），释放锁时在 Lua 脚本内原子地
+  唤醒队首等待者（向其专属 list RPUSH，等待者 BLPOP 阻塞等待），交接无轮询延迟
+- 锁空闲时只有队首等待者能拿到锁，高优先级任务不会被后到的低优先级任务抢先
+- 锁为短租约（GPU_LEASE_TTL 秒），持有期间由后台线程每 1/3 租约续期；进程崩溃后
+  租约很快过期，等待者在 GPU_WAIT_RECHECK 秒内重新检查（仅作通知丢失时的兜底）
+- 长任务在安全点调用 yield_if_needed()：有更高优先级的等待者时先让出 GPU 再重新排队
+  （OCR 在页段之间、向量索引在批次之间）；租约丢失（续期失败）时同样在安全点重新排队获取
+- 交互式的查询向量化走独立的 gpu_interactive 队列和 worker-gpu-interactive 进程，
+  才能在后台任务运行期间与其并发争用锁（同一个并发为 1 的 worker 内排队则无从仲裁）
+- Redis 不可用时不加锁直接执行（与改造前 GPU 任务未加锁的行为一致）
+
+优先级（高 → 低）：interactive（用户提问的向量化）、high、normal（OCR / 类型分析）、
+background（书籍向量索引 / 补处理）
+
 使用方式:
     from app.services.gpu_lock import gpu_lock, acquire_gpu_lock
 
     # 方式1：上下文管理器
-    with gpu_lock():
-        # GPU 密集型操作
-        process_ocr()
+    with gpu_lock(priority="normal", name="ocr") as lock:
+        for segment in segments:
+            process_ocr(segment)
+            lock.yield_if_needed()
 
     # 方式2：装饰器（用于 Celery 任务）
-    @acquire_gpu_lock
+    @acquire_gpu_lock(priority="interactive")
     def my_gpu_task():
         ...
 """
 import os
 import time
+import uuid
 import logging
+import threading
 from contextlib import contextmanager
 from functools import wraps
 from typing import Optional
 
+from prometheus_client import Counter, Histogram
+
 logger = logging.getLogger(__name__)
 
 # Redis 配置
 REDIS_URL = os.getenv("REDIS_URL", "redis://valkey:6379")
 GPU_LOCK_KEY = "athena:gpu_task_lock"
-GPU_LOCK_TIMEOUT = int(os.getenv("GPU_LOCK_TIMEOUT", "7200"))  # 默认 2 小时
-GPU_LOCK_RETRY_INTERVAL = float(os.getenv("GPU_LOCK_RETRY_INTERVAL", "5.0"))  # 重试间隔
+GPU_HOLDER_KEY = "athena:gpu:holder"
+GPU_WAITERS_KEY = "athena:gpu:waiters"
+GPU_WAITERS_SEEN_KEY = "athena:gpu:waiters:seen"
+GPU_WAKE_PREFIX = "athena:gpu:wake:"
+
+GPU_LOCK_ENABLED = os.getenv("GPU_LOCK_ENABLED", "true").lower() == "true"
+GPU_LEASE_TTL = int(os.getenv("GPU_LEASE_TTL", "30"))  # 租约（秒），持有期间自动续期
+GPU_WAIT_RECHECK = float(os.getenv("GPU_WAIT_RECHECK", "5.0"))  # 未收到通知时的兜底检查间隔
+
+# 优先级等级：数值越小越优先
+GPU_PRIORITIES = {"interactive": 0, "high": 1, "normal": 2, "background": 3}
+# 有序集合分值 = 等级 * _RANK_SPAN + 到达毫秒时间戳（同级先到先得）
+_RANK_SPAN = 10 ** 13
+
+GPU_LOCK_WAIT = Histogram(
+    "gpu_lock_wait_seconds",
+    "Time spent waiting for the GPU lock",
+    ["priority"],
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 15, 60, 300, 1800),
+)
+GPU_LOCK_YIELDS = Counter(
+    "gpu_lock_yields_total", "GPU lock handed over to higher-priority waiters", ["priority"]
+)
+
+# KEYS: 锁, 持有者哈希, 等待者有序集合, 等待者存活期限
+# ARGV: token, 排队分值, 租约毫秒, 等待者存活毫秒, 优先级, 名称, 唤醒 key 前缀
+_ACQUIRE_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+for _, w in ipairs(redis.call('ZRANGEBYSCORE', KEYS[4], '-inf', now)) do
+  redis.call('ZREM', KEYS[3], w)
+  redis.call('ZREM', KEYS[4], w)
+end
+redis.call('ZADD', KEYS[3], 'NX', ARGV[2], ARGV[1])
+redis.call('ZADD', KEYS[4], now + tonumber(ARGV[4]), ARGV[1])
+if redis.call('EXISTS', KEYS[1]) == 1 then
+  return 0
+end
+local head = redis.call('ZRANGE', KEYS[3], 0, 0)[1]
+if head ~= ARGV[1] then
+  -- 锁空闲但队首另有其人（如上一个持有者崩溃未发通知）：替它补发唤醒
+  redis.call('RPUSH', ARGV[7] .. head, 1)
+  redis.call('PEXPIRE', ARGV[7] .. head, ARGV[4])
+  return 0
+end
+redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[3])
+redis.call('ZREM', KEYS[3], ARGV[1])
+redis.call('ZREM', KEYS[4], ARGV[1])
+redis.call('DEL', KEYS[2])
+redis.call('HSET', KEYS[2], 'token', ARGV[1], 'priority', ARGV[5], 'name', ARGV[6], 'since', now)
+redis.call('PEXPIRE', KEYS[2], ARGV[3])
+return 1
+"""
+
+# KEYS: 锁, 持有者哈希, 等待者有序集合
+# ARGV: token（空字符串表示强制释放）, 唤醒 key 前缀, 唤醒 key 存活毫秒
+_RELEASE_SCRIPT = """
+if ARGV[1] ~= '' and redis.call('GET', KEYS[1]) ~= ARGV[1] then
+  return false
+end
+redis.call('DEL', KEYS[1])
+redis.call('DEL', KEYS[2])
+local head = redis.call('ZRANGE', KEYS[3], 0, 0)[1]
+if head then
+  redis.call('RPUSH', ARGV[2] .. head, 1)
+  redis.call('PEXPIRE', ARGV[2] .. head, ARGV[3])
+  return head
+end
+return ''
+"""
+
+# KEYS: 锁, 持有者哈希
+# ARGV: token, 租约毫秒
+_RENEW_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+  redis.call('PEXPIRE', KEYS[1], ARGV[2])
+  redis.call('PEXPIRE', KEYS[2], ARGV[2])
+  return 1
+end
+return 0
+"""
 
 _redis_client = None
+_scripts = None
 
 
 def _get_redis():
@@ -44,6 +146,24 @@ def _get_redis():
     return _redis_client
 
 
+def _get_scripts():
+    global _scripts
+    if _scripts is None:
+        redis_client = _get_redis()
+        _scripts = (
+            redis_client.register_script(_ACQUIRE_SCRIPT),
+            redis_client.register_script(_RELEASE_SCRIPT),
+            redis_client.register_script(_RENEW_SCRIPT),
+        )
+    return _scripts
+
+
+def _rank(priority: str) -> int:
+    if priority not in GPU_PRIORITIES:
+        raise ValueError(f"Unknown GPU priority: {priority}")
+    return GPU_PRIORITIES[priority]
+
+
 class GPULockAcquisitionError(Exception):
     """无法获取 GPU 锁"""
     pass
@@ -51,143 +171,211 @@ class GPULockAcquisitionError(Exception):
 
 class GPULock:
     """
-    Redis 分布式 GPU 锁
-    
+    Redis 分布式 GPU 锁（带优先级）
+
     确保同一时刻只有一个 GPU 密集型任务运行，
     适用于 RTX 3060/3070 等消费级显卡（显存 8-12GB）。
     """
-    
+
     def __init__(
         self,
-        lock_key: str = GPU_LOCK_KEY,
-        timeout: int = GPU_LOCK_TIMEOUT,
+        priority: str = "normal",
+        name: str = "",
+        lease_ttl: int = GPU_LEASE_TTL,
         blocking: bool = True,
         blocking_timeout: Optional[float] = None,
     ):
-        self.lock_key = lock_key
-        self.timeout = timeout
+        self.priority = priority
+        self.rank = _rank(priority)
+        self.name = name
+        self.lease_ttl = lease_ttl
         self.blocking = blocking
         self.blocking_timeout = blocking_timeout  # None 表示无限等待
-        self._lock = None
+        self.lost = False  # 租约续期失败（锁已被他人接手）
         self._lock_id = None
-    
+        self._heartbeat = None
+        self._stop = threading.Event()
+
+    @property
+    def held(self) -> bool:
+        return self._lock_id is not None
+
+    def _try(self, token: str, score: int) -> bool:
+        acquire, _, _ = _get_scripts()
+        return bool(acquire(
+            keys=[GPU_LOCK_KEY, GPU_HOLDER_KEY, GPU_WAITERS_KEY, GPU_WAITERS_SEEN_KEY],
+            args=[
+                token, score, self.lease_ttl * 1000, int(GPU_WAIT_RECHECK * 3000),
+                self.priority, self.name, GPU_WAKE_PREFIX,
+            ],
+        ))
+
+    def _leave_queue(self, token: str):
+        redis_client = _get_redis()
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.zrem(GPU_WAITERS_KEY, token)
+        pipe.zrem(GPU_WAITERS_SEEN_KEY, token)
+        pipe.delete(GPU_WAKE_PREFIX + token)
+        pipe.execute()
+
     def acquire(self) -> bool:
         """
-        获取 GPU 锁
-        
+        获取 GPU 锁（按优先级排队，释放时立即被唤醒）
+
         Returns:
-            True 如果成功获取，False 如果非阻塞模式下获取失败
-        
+            True 如果成功获取（Redis 不可用时也返回 True，但不持有锁），
+            False 如果非阻塞模式下获取失败
+
         Raises:
             GPULockAcquisitionError: 阻塞模式下超时
         """
-        import uuid
-        redis_client = _get_redis()
-        self._lock_id = str(uuid.uuid4())
-        
+        if not GPU_LOCK_ENABLED:
+            return True
+
+        token = uuid.uuid4().hex
+        score = self.rank * _RANK_SPAN + int(time.time() * 1000)
         start_time = time.time()
-        
-        while True:
-            # 尝试设置锁（NX = 不存在时才设置，EX = 过期时间）
-            acquired = redis_client.set(
-                self.lock_key,
-                self._lock_id,
-                nx=True,
-                ex=self.timeout,
-            )
-            
-            if acquired:
-                logger.info(f"[GPULock] Acquired lock: {self._lock_id}")
-                return True
-            
-            if not self.blocking:
-                logger.warning(f"[GPULock] Failed to acquire lock (non-blocking)")
-                return False
-            
-            # 检查超时
-            if self.blocking_timeout is not None:
-                elapsed = time.time() - start_time
-                if elapsed >= self.blocking_timeout:
-                    raise GPULockAcquisitionError(
-                        f"Failed to acquire GPU lock after {elapsed:.1f}s"
-                    )
-            
-            # 等待后重试
-            current_holder = redis_client.get(self.lock_key)
-            logger.debug(f"[GPULock] Lock held by {current_holder}, waiting {GPU_LOCK_RETRY_INTERVAL}s...")
-            time.sleep(GPU_LOCK_RETRY_INTERVAL)
-    
+        try:
+            redis_client = _get_redis()
+            while not self._try(token, score):
+                if not self.blocking:
+                    self._leave_queue(token)
+                    logger.warning(f"[GPULock] Failed to acquire lock (non-blocking)")
+                    return False
+
+                wait = GPU_WAIT_RECHECK
+                if self.blocking_timeout is not None:
+                    remaining = self.blocking_timeout - (time.time() - start_time)
+                    if remaining <= 0:
+                        self._leave_queue(token)
+                        raise GPULockAcquisitionError(
+                            f"Failed to acquire GPU lock after {time.time() - start_time:.1f}s"
+                        )
+                    wait = min(wait, remaining)
+
+                # 等待释放通知；超时后重新检查（同时刷新等待者存活期限）
+                redis_client.blpop([GPU_WAKE_PREFIX + token], timeout=max(1, int(wait)))
+            redis_client.delete(GPU_WAKE_PREFIX + token)
+        except GPULockAcquisitionError:
+            raise
+        except Exception as e:
+            logger.warning(f"[GPULock] Redis unavailable, running {self.name or 'task'} without GPU lock: {e}")
+            return True
+
+        waited = time.time() - start_time
+        GPU_LOCK_WAIT.labels(priority=self.priority).observe(waited)
+        self._lock_id = token
+        self.lost = False
+        self._start_heartbeat()
+        logger.info(f"[GPULock] Acquired lock: {self.name} ({self.priority}) after {waited:.2f}s")
+        return True
+
+    def _start_heartbeat(self):
+        self._stop = threading.Event()
+        self._heartbeat = threading.Thread(
+            target=self._renew_loop, args=(self._lock_id, self._stop), name="GPULock-Heartbeat", daemon=True
+        )
+        self._heartbeat.start()
+
+    def _renew_loop(self, token: str, stop: threading.Event):
+        while not stop.wait(self.lease_ttl / 3):
+            try:
+                _, _, renew = _get_scripts()
+                if not renew(keys=[GPU_LOCK_KEY, GPU_HOLDER_KEY], args=[token, self.lease_ttl * 1000]):
+                    logger.error(f"[GPULock] Lease lost: {self.name} ({token})")
+                    self.lost = True
+                    return
+            except Exception as e:
+                logger.warning(f"[GPULock] Failed to renew lease: {e}")
+
     def release(self) -> bool:
         """
-        释放 GPU 锁
-        
+        释放 GPU 锁并唤醒优先级最高的等待者
+
         使用 Lua 脚本确保只有锁的持有者才能释放锁（防止误删）
-        
+
         Returns:
             True 如果成功释放，False 如果锁已不属于当前持有者
         """
         if self._lock_id is None:
             return False
-        
-        redis_client = _get_redis()
-        
-        # Lua 脚本：只有锁 ID 匹配时才删除
-        lua_script = """
-        if redis.call("get", KEYS[1]) == ARGV[1] then
-            return redis.call("del", KEYS[1])
-        else
-            return 0
-        end
-        """
-        
-        result = redis_client.eval(lua_script, 1, self.lock_key, self._lock_id)
-        
-        if result:
-            logger.info(f"[GPULock] Released lock: {self._lock_id}")
-        else:
-            logger.warning(f"[GPULock] Lock {self._lock_id} was not held or already released")
-        
-        self._lock_id = None
-        return bool(result)
-    
+
+        token, self._lock_id = self._lock_id, None
+        self._stop.set()
+        try:
+            _, release, _ = _get_scripts()
+            result = release(
+                keys=[GPU_LOCK_KEY, GPU_HOLDER_KEY, GPU_WAITERS_KEY],
+                args=[token, GPU_WAKE_PREFIX, int(GPU_WAIT_RECHECK * 3000)],
+            )
+        except Exception as e:
+            logger.warning(f"[GPULock] Failed to release lock: {e}")
+            return False
+
+        if result is None:
+            logger.warning(f"[GPULock] Lock {token} was not held or already released")
+            return False
+        logger.info(f"[GPULock] Released lock: {self.name}" + (f", woke {result}" if result else ""))
+        return True
+
     def extend(self, additional_time: int = None) -> bool:
         """
-        延长锁的过期时间
-        
+        延长锁的过期时间（持有期间已自动续期，一般无需调用）
+
         Args:
-            additional_time: 额外时间（秒），默认使用初始 timeout
-        
+            additional_time: 新的剩余时间（秒），默认使用租约时长
+
         Returns:
             True 如果成功延长
         """
         if self._lock_id is None:
             return False
-        
-        if additional_time is None:
-            additional_time = self.timeout
-        
-        redis_client = _get_redis()
-        
-        # Lua 脚本：只有锁 ID 匹配时才延长
-        lua_script = """
-        if redis.call("get", KEYS[1]) == ARGV[1] then
-            return redis.call("expire", KEYS[1], ARGV[2])
-        else
-            return 0
-        end
+        ttl = additional_time if additional_time is not None else self.lease_ttl
+        _, _, renew = _get_scripts()
+        return bool(renew(keys=[GPU_LOCK_KEY, GPU_HOLDER_KEY], args=[self._lock_id, ttl * 1000]))
+
+    def should_yield(self) -> bool:
+        """是否有更高优先级的任务在等待 GPU"""
+        if self._lock_id is None:
+            return False
+        try:
+            head = _get_redis().zrange(GPU_WAITERS_KEY, 0, 0, withscores=True)
+        except Exception:
+            return False
+        return bool(head) and int(head[0][1]) // _RANK_SPAN < self.rank
+
+    def yield_if_needed(self) -> bool:
         """
-        
-        result = redis_client.eval(lua_script, 1, self.lock_key, self._lock_id, additional_time)
-        
-        if result:
-            logger.debug(f"[GPULock] Extended lock by {additional_time}s")
-        
-        return bool(result)
-    
+        长任务的安全点：有更高优先级的等待者时释放 GPU，待其完成后重新排队获取
+
+        租约已丢失（心跳续期失败，锁可能已被他人接手）时不再继续占用 GPU，
+        同样重新排队获取后再继续
+
+        Returns:
+            True 如果本次让出过 GPU（或重新获取过丢失的租约）
+        """
+        if self.lost and self._lock_id is not None:
+            logger.warning(f"[GPULock] {self.name} ({self.priority}) lost its lease, re-acquiring GPU")
+            # 锁已不属于本持有者：只停止心跳、丢弃令牌，不唤醒其他等待者
+            self._lock_id = None
+            self._stop.set()
+        elif not self.should_yield():
+            return False
+        else:
+            logger.info(f"[GPULock] {self.name} ({self.priority}) yielding GPU to higher-priority work")
+            GPU_LOCK_YIELDS.labels(priority=self.priority).inc()
+            self.release()
+        blocking_timeout, self.blocking_timeout = self.blocking_timeout, None
+        try:
+            self.acquire()
+        finally:
+            self.blocking_timeout = blocking_timeout
+        return True
+
     def __enter__(self):
         self.acquire()
         return self
-    
+
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.release()
         return False
@@ -195,20 +383,22 @@ class GPULock:
 
 @contextmanager
 def gpu_lock(
-    timeout: int = GPU_LOCK_TIMEOUT,
+    priority: str = "normal",
+    name: str = "",
     blocking: bool = True,
     blocking_timeout: Optional[float] = None,
 ):
     """
     GPU 锁上下文管理器
-    
+
     用法:
-        with gpu_lock():
+        with gpu_lock(priority="interactive", name="query_embedding"):
             # GPU 密集型操作
-            process_ocr()
+            embed_query()
     """
     lock = GPULock(
-        timeout=timeout,
+        priority=priority,
+        name=name,
         blocking=blocking,
         blocking_timeout=blocking_timeout,
     )
@@ -219,38 +409,56 @@ def gpu_lock(
         lock.release()
 
 
-def acquire_gpu_lock(func):
+def acquire_gpu_lock(func=None, *, priority: str = "normal"):
     """
     GPU 锁装饰器
-    
+
     用法:
         @acquire_gpu_lock
         def my_gpu_task():
             ...
+
+        @acquire_gpu_lock(priority="interactive")
+        def my_query_task():
+            ...
     """
-    @wraps(func)
-    def wrapper(*args, **kwargs):
-        with gpu_lock():
-            return func(*args, **kwargs)
-    return wrapper
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            with gpu_lock(priority=priority, name=f.__name__):
+                return f(*args, **kwargs)
+        return wrapper
+
+    if func is not None:
+        return decorator(func)
+    return decorator
 
 
 def get_gpu_lock_status() -> dict:
     """
     获取 GPU 锁状态
-    
+
     Returns:
-        包含 locked, holder, ttl 的字典
+        包含 locked, holder, priority, name, ttl, waiters 的字典
     """
     try:
         redis_client = _get_redis()
         holder = redis_client.get(GPU_LOCK_KEY)
+        info = redis_client.hgetall(GPU_HOLDER_KEY) if holder else {}
         ttl = redis_client.ttl(GPU_LOCK_KEY) if holder else -1
-        
+        ranks = {rank: name for name, rank in GPU_PRIORITIES.items()}
+        waiters = [
+            {"token": token, "priority": ranks.get(int(score) // _RANK_SPAN, "unknown")}
+            for token, score in redis_client.zrange(GPU_WAITERS_KEY, 0, -1, withscores=True)
+        ]
+
         return {
             "locked": holder is not None,
             "holder": holder,
+            "priority": info.get("priority"),
+            "name": info.get("name"),
             "ttl_seconds": ttl if ttl > 0 else None,
+            "waiters": waiters,
         }
     except Exception as e:
         logger.error(f"[GPULock] Failed to get lock status: {e}")
@@ -259,18 +467,21 @@ def get_gpu_lock_status() -> dict:
 
 def force_release_gpu_lock() -> bool:
     """
-    强制释放 GPU 锁（管理员操作）
-    
+    强制释放 GPU 锁（管理员操作），并唤醒队首等待者
+
     警告：这可能导致正在运行的 GPU 任务出现问题
-    
+
     Returns:
         True 如果成功释放
     """
     try:
-        redis_client = _get_redis()
-        result = redis_client.delete(GPU_LOCK_KEY)
+        _, release, _ = _get_scripts()
+        release(
+            keys=[GPU_LOCK_KEY, GPU_HOLDER_KEY, GPU_WAITERS_KEY],
+            args=["", GPU_WAKE_PREFIX, int(GPU_WAIT_RECHECK * 3000)],
+        )
         logger.warning(f"[GPULock] Force released GPU lock")
-        return bool(result)
+        return True
     except Exception as e:
         logger.error(f"[GPULock] Failed to force release: {e}")
         return False
@@ -0,0 +1,192 @@
+"""
+书籍向量索引维护
+
+【2026-10-19】新增：
+- 书籍块索引为单分片、无副本、默认 refresh；逐书 _bulk 写入与 delete_book_index 的
+  按书删除会留下大量小 segment 和已删除文档（tombstone），kNN 查询需要逐 segment 搜索 HNSW 图，
+  时间越长越慢
+- maintain_book_chunks_index 由 Celery beat 定期调用（RAG_INDEX_MAINT_INTERVAL 秒）：
+  - 写入繁忙（每分钟写入/删除文档数超过 RAG_INDEX_BUSY_WRITES_PER_MIN）时把 refresh_interval
+    调大到 RAG_INDEX_BUSY_REFRESH，减少小 segment；空闲后恢复默认
+  - 只在静默时段（RAG_INDEX_MAINT_QUIET_HOURS，本地小时，如 "2-6"）且写入空闲时 force merge：
+    已删除比例超过 RAG_INDEX_MAINT_DELETED_RATIO 时 expunge deletes，
+    segment 数超过 RAG_INDEX_MAINT_MAX_SEGMENTS 时合并到该数量
+  - 全量重建进行中（读/写别名指向不同索引）时跳过
+- collect_book_chunks_stats 返回 segment 与 HNSW 图统计，get_index_stats 一并输出
+"""
+import logging
+import os
+import time
+from typing import Optional
+
+from prometheus_client import Counter, Gauge
+
+from .llama_rag import OPENSEARCH_URL, _get_redis, resolve_book_chunk_indices
+
+logger = logging.getLogger(__name__)
+
+MAINT_INTERVAL_SECONDS = int(os.getenv("RAG_INDEX_MAINT_INTERVAL", "600"))
+MAINT_QUIET_HOURS = os.getenv("RAG_INDEX_MAINT_QUIET_HOURS", "2-6")
+MAINT_DELETED_RATIO = float(os.getenv("RAG_INDEX_MAINT_DELETED_RATIO", "0.1"))
+MAINT_MAX_SEGMENTS = int(os.getenv("RAG_INDEX_MAINT_MAX_SEGMENTS", "8"))
+MAINT_MERGE_TIMEOUT = int(os.getenv("RAG_INDEX_MAINT_MERGE_TIMEOUT", "3600"))
+BUSY_WRITES_PER_MIN = float(os.getenv("RAG_INDEX_BUSY_WRITES_PER_MIN", "2000"))
+BUSY_REFRESH_INTERVAL = os.getenv("RAG_INDEX_BUSY_REFRESH", "30s")
+
+MAINT_LOCK_KEY = "rag:index_maint:lock"
+MAINT_LAST_KEY = "rag:index_maint:last"
+
+RAG_INDEX_SEGMENTS = Gauge("rag_book_chunks_segments", "Segment count of the book chunks index")
+RAG_INDEX_DELETED_RATIO = Gauge("rag_book_chunks_deleted_ratio", "Deleted docs / total docs of the book chunks index")
+RAG_INDEX_MAINT_ACTIONS = Counter(
+    "rag_index_maintenance_actions_total",
+    "Book chunks index maintenance actions",
+    ["action"],  # busy_refresh / restore_refresh / expunge_deletes / merge_segments / skipped_rebuild
+)
+
+
+def in_quiet_hours(hour: int, spec: str = MAINT_QUIET_HOURS) -> bool:
+    """hour 是否落在 "start-end" 时段内（end 不含，支持跨零点如 "23-5"；空字符串表示不限）"""
+    if not spec:
+        return True
+    start, end = (int(part) for part in spec.split("-", 1))
+    if start <= end:
+        return start <= hour < end
+    return hour >= start or hour < end
+
+
+async def collect_book_chunks_stats(client, index: str) -> dict:
+    """
+    读取物理索引的文档 / segment / 写入统计，以及 k-NN 插件的 HNSW 图统计
+
+    Lucene 引擎的 HNSW 图存放在各 segment 中，segment 数即每次 kNN 查询需要搜索的图数量。
+    """
+    response = await client.indices.stats(index=index, metric="docs,segments,indexing")
+    primaries = response["_all"]["primaries"]
+    docs = primaries.get("docs", {})
+    segments = primaries.get("segments", {})
+    indexing = primaries.get("indexing", {})
+    live, deleted = docs.get("count", 0), docs.get("deleted", 0)
+
+    stats = {
+        "index": index,
+        "docs": live,
+        "deleted_docs": deleted,
+        "deleted_ratio": round(deleted / (live + deleted), 4) if live + deleted else 0.0,
+        "segments": segments.get("count", 0),
+        "segments_memory_bytes": segments.get("memory_in_bytes", 0),
+        "write_ops_total": indexing.get("index_total", 0) + indexing.get("delete_total", 0),
+    }
+
+    # k-NN 插件统计为节点级（插件未安装或无权限时忽略）
+    try:
+        knn = await client.transport.perform_request("GET", "/_plugins/_knn/stats")
+        nodes = knn.get("nodes", {}).values()
+        stats["hnsw"] = {
+            "graph_memory_usage_kb": sum(n.get("graph_memory_usage", 0) for n in nodes),
+            "graph_query_requests": sum(n.get("knn_query_requests", 0) for n in nodes),
+            "graph_index_requests": sum(n.get("graph_index_requests", 0) for n in nodes),
+            "cache_capacity_reached": any(n.get("cache_capacity_reached") for n in nodes),
+        }
+    except Exception as e:
+        logger.debug(f"[IndexMaint] k-NN stats unavailable: {e}")
+
+    RAG_INDEX_SEGMENTS.set(stats["segments"])
+    RAG_INDEX_DELETED_RATIO.set(stats["deleted_ratio"])
+    return stats
+
+
+def plan_maintenance(stats: dict, writes_per_min: Optional[float], refresh_interval: Optional[str], hour: int) -> list:
+    """
+    根据统计决定本轮动作
+
+    Returns:
+        动作列表：("refresh", 值或 None) / ("expunge_deletes",) / ("merge", 目标 segment 数)
+    """
+    actions = []
+    busy = writes_per_min is not None and writes_per_min >= BUSY_WRITES_PER_MIN
+
+    if busy and refresh_interval is None:
+        actions.append(("refresh", BUSY_REFRESH_INTERVAL))
+    elif not busy and refresh_interval == BUSY_REFRESH_INTERVAL:
+        actions.append(("refresh", None))
+
+    # 首轮没有写入速率基线，不做合并
+    if busy or writes_per_min is None or not in_quiet_hours(hour):
+        return actions
+
+    if stats["deleted_ratio"] >= MAINT_DELETED_RATIO:
+        actions.append(("expunge_deletes",))
+    elif stats["segments"] > MAINT_MAX_SEGMENTS:
+        actions.append(("merge", MAINT_MAX_SEGMENTS))
+    return actions
+
+
+def _write_rate(stats: dict) -> Optional[float]:
+    """根据上一轮记录的累计写入数计算每分钟写入速率"""
+    now = time.time()
+    try:
+        redis = _get_redis()
+        previous = redis.hgetall(MAINT_LAST_KEY)
+        redis.hset(MAINT_LAST_KEY, mapping={"index": stats["index"], "ops": stats["write_ops_total"], "ts": now})
+    except Exception as e:
+        logger.warning(f"[IndexMaint] Redis unavailable for write rate: {e}")
+        return None
+    # 物理索引变化（重建切换）或计数回退（节点重启）时重新建立基线
+    if not previous or previous.get("index") != stats["index"]:
+        return None
+    elapsed = now - float(previous["ts"])
+    ops = stats["write_ops_total"] - int(previous["ops"])
+    if elapsed <= 0 or ops < 0:
+        return None
+    return ops / elapsed * 60
+
+
+async def maintain_book_chunks_index() -> dict:
+    """执行一轮书籍向量索引维护（多个 worker 同时触发时只有一个执行）"""
+    from opensearchpy import AsyncOpenSearch
+
+    redis = _get_redis()
+    if not redis.set(MAINT_LOCK_KEY, "1", nx=True, ex=MAINT_MERGE_TIMEOUT + 60):
+        return {"skipped": "locked"}
+
+    client = AsyncOpenSearch(hosts=[OPENSEARCH_URL])
+    try:
+        read_targets, write_targets = await resolve_book_chunk_indices(client)
+        if not read_targets:
+            return {"skipped": "missing"}
+        if not set(write_targets) <= set(read_targets):
+            RAG_INDEX_MAINT_ACTIONS.labels(action="skipped_rebuild").inc()
+            return {"skipped": "rebuilding"}
+
+        index = read_targets[0]
+        stats = await collect_book_chunks_stats(client, index)
+        writes_per_min = _write_rate(stats)
+        settings = await client.indices.get_settings(index=index, name="index.refresh_interval")
+        refresh_interval = settings.get(index, {}).get("settings", {}).get("index", {}).get("refresh_interval")
+
+        actions = plan_maintenance(stats, writes_per_min, refresh_interval, time.localtime().tm_hour)
+        for action in actions:
+            if action[0] == "refresh":
+                await client.indices.put_settings(index=index, body={"index": {"refresh_interval": action[1]}})
+                RAG_INDEX_MAINT_ACTIONS.labels(action="busy_refresh" if action[1] else "restore_refresh").inc()
+            elif action[0] == "expunge_deletes":
+                await client.indices.forcemerge(
+                    index=index, only_expunge_deletes=True, request_timeout=MAINT_MERGE_TIMEOUT
+                )
+                RAG_INDEX_MAINT_ACTIONS.labels(action="expunge_deletes").inc()
+            elif action[0] == "merge":
+                await client.indices.forcemerge(
+                    index=index, max_num_segments=action[1], request_timeout=MAINT_MERGE_TIMEOUT
+                )
+                RAG_INDEX_MAINT_ACTIONS.labels(action="merge_segments").inc()
+
+        if actions:
+            logger.info(
+                f"[IndexMaint] {index}: segments={stats['segments']} deleted_ratio={stats['deleted_ratio']} "
+                f"writes/min={writes_per_min} actions={actions}"
+            )
+        return {"index": index, "writes_per_min": writes_per_min, "actions": [a[0] for a in actions], **stats}
+    finally:
+        await client.close()
+        redis.delete(MAINT_LOCK_KEY)
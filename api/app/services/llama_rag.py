@@ -14,8 +14,9 @@ LlamaIndex RAG 服务
 注意：所有 LlamaIndex 导入使用延迟加载，避免模块导入时初始化 PyTorch CUDA。
 """
 import os
+from collections import OrderedDict
 import logging
-from typing import Optional, List, TYPE_CHECKING
+from typing import Optional, List, Dict, Tuple, TYPE_CHECKING
 
 # 类型检查时导入（不会执行）
 if TYPE_CHECKING:
@@ -31,8 +32,16 @@ logger = logging.getLogger(__name__)
 
 OPENSEARCH_URL = os.getenv("ES_URL", "http://opensearch:9200")
 BOOK_CHUNKS_INDEX = "athena_book_chunks"
+# 【2026-10-19】零停机重建：BOOK_CHUNKS_INDEX 为读别名（查询），写入走写别名，
+# 二者平时指向同一个带时间戳的物理索引；重建期间写别名指向新索引，完成后原子切换读别名
+BOOK_CHUNKS_WRITE_ALIAS = f"{BOOK_CHUNKS_INDEX}_write"
 # 私人数据索引（笔记和高亮）- 必须按 user_id 过滤
 USER_NOTES_INDEX = "athena_user_notes"
+# 【2026-10-19】笔记索引按 user_id 自定义路由：USER_NOTES_INDEX 为别名，指向带版本号的物理索引，
+# 一个用户的笔记只落在一个分片上，搜索只访问该分片。
+# 旧的单分片物理索引由 scripts/migrate_user_notes_routing.py 迁移
+USER_NOTES_PHYSICAL_INDEX = f"{USER_NOTES_INDEX}_v2"
+USER_NOTES_INDEX_SHARDS = int(os.getenv("RAG_USER_NOTES_SHARDS", "6"))
 USER_HIGHLIGHTS_INDEX = "athena_user_highlights"
 
 EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL_NAME", "BAAI/bge-m3")
@@ -45,6 +54,8 @@ EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "16"))
 INDEX_NODE_BATCH_SIZE = int(os.getenv("INDEX_NODE_BATCH_SIZE", "450"))
 # GPU 可用性显存阈值（GB），低于此值回退 CPU
 GPU_MIN_FREE_GB = float(os.getenv("GPU_MIN_FREE_GB", "2.0"))
+# 【2026-10-19】Embedding 推理后端：torch（默认）| onnx（ONNX Runtime int8）| auto（CPU 时用 onnx）
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch").lower()
 
 # ============================================================================
 # Embedding 模型初始化（单例模式）
@@ -112,6 +123,20 @@ def get_gpu_memory_info() -> dict:
         return {}
 
 
+def gpu_section(priority: str, name: str = ""):
+    """
+    【2026-10-19】Embedding 模型在 GPU 上时按优先级获取 GPU 锁（见 services/gpu_lock），
+    CPU / ONNX 推理不占 GPU，不加锁
+
+    须在 get_embed_model() 之后调用（此时设备已确定）
+    """
+    if _embed_device != "cuda":
+        from contextlib import nullcontext
+        return nullcontext()
+    from .gpu_lock import gpu_lock
+    return gpu_lock(priority=priority, name=name)
+
+
 def get_embed_model():
     """
     获取 Embedding 模型实例（单例模式）
@@ -156,6 +181,28 @@ def get_embed_model():
     logger.info(f"[LlamaRAG] Loading embedding model {EMBEDDING_MODEL} on {device}")
     logger.info(f"[LlamaRAG] Config: batch_size={EMBEDDING_BATCH_SIZE}, node_batch={INDEX_NODE_BATCH_SIZE}, min_gpu={GPU_MIN_FREE_GB}GB")
     
+    # 【性能优化 2026-01-09】
+    # max_length: 限制最大token长度（大多数chunk不需要8192这么长）
+    MAX_LENGTH = int(os.getenv("EMBEDDING_MAX_LENGTH", "2048"))
+    
+    # 【2026-10-19】CPU 推理后端：ONNX Runtime + 动态 int8 量化
+    # 精度/吞吐对比见 scripts/bench_embedding_backend.py
+    if EMBEDDING_BACKEND == "onnx" or (EMBEDDING_BACKEND == "auto" and device == "cpu"):
+        from .onnx_embedding import create_onnx_embedding
+        
+        onnx_model = create_onnx_embedding(
+            model_name=EMBEDDING_MODEL,
+            cache_folder=cache_folder,
+            embed_batch_size=EMBEDDING_BATCH_SIZE,
+            max_length=MAX_LENGTH,
+        )
+        if onnx_model is not None:
+            _embed_device = "cpu"
+            _embed_model = onnx_model
+            logger.info("[LlamaRAG] Embedding model loaded successfully with ONNX Runtime backend")
+            return _embed_model
+        logger.warning("[LlamaRAG] ONNX backend unavailable, falling back to PyTorch")
+    
     # 延迟导入
     from llama_index.embeddings.huggingface import HuggingFaceEmbedding
     import torch
@@ -165,10 +212,6 @@ def get_embed_model():
         "torch_dtype": torch.float16 if device == "cuda" else torch.float32,
     }
     
-    # 【性能优化 2026-01-09】
-    # max_length: 限制最大token长度（大多数chunk不需要8192这么长）
-    MAX_LENGTH = int(os.getenv("EMBEDDING_MAX_LENGTH", "2048"))
-    
     _embed_model = HuggingFaceEmbedding(
         model_name=EMBEDDING_MODEL,
         device=device,
@@ -377,8 +420,9 @@ async def index_book_chunks(
     
     # 【重要】先删除该书籍的旧索引数据，避免重复
     # 这是幂等操作：无论之前有无数据，都能正确工作
+    # 【2026-10-19】只删除写入目标中的旧数据：全量重建期间旧索引继续提供查询
     logger.info(f"[LlamaRAG] Deleting existing index data for book {book_id} before rebuild...")
-    await delete_book_index(book_id)
+    await delete_book_index(book_id, index=BOOK_CHUNKS_WRITE_ALIAS)
     
     # 延迟导入
     import numpy as np
@@ -494,8 +538,10 @@ async def index_book_chunks(
             logger.info(f"[LlamaRAG] Indexing batch {batch_num}/{total_batches} ({len(batch_chunks)} chunks)")
             
             # 批量生成 embedding
+            # 【2026-10-19】每批单独获取 GPU 锁（后台优先级），批次之间交互请求可插队
             embedding_texts = [c["embedding_text"] for c in batch_chunks]
-            embeddings = embed_model.get_text_embedding_batch(embedding_texts)
+            with gpu_section("background", "book_vectors"):
+                embeddings = embed_model.get_text_embedding_batch(embedding_texts)
             
             # 【2026-01-15 重大优化】向量转换为 int8 (byte 量化)
             # 将 float32 向量转换为 int8，存储空间减少 75%
@@ -530,6 +576,12 @@ async def index_book_chunks(
                     }
                 }
                 
+                # 【2026-10-19】章节序号，章节查询使用 term 精确匹配
+                if chunk_info["chapter_title"]:
+                    chapter_ordinal = parse_chapter_ordinal(chunk_info["chapter_title"])
+                    if chapter_ordinal is not None:
+                        doc["metadata"]["chapter_ordinal"] = chapter_ordinal
+                
                 # 添加可选字段
                 if "section_index" in chunk_info:
                     doc["metadata"]["section_index"] = chunk_info["section_index"]
@@ -538,7 +590,7 @@ async def index_book_chunks(
                 if "page" in chunk_info and chunk_info["page"] is not None:
                     doc["metadata"]["page"] = chunk_info["page"]
                 
-                bulk_body.append({"index": {"_index": BOOK_CHUNKS_INDEX, "_id": doc_id}})
+                bulk_body.append({"index": {"_index": BOOK_CHUNKS_WRITE_ALIAS, "_id": doc_id}})
                 bulk_body.append(doc)
             
             # 执行批量写入
@@ -558,8 +610,14 @@ async def index_book_chunks(
             except Exception:
                 pass
         
-        # 最后刷新索引
-        await client.indices.refresh(index=BOOK_CHUNKS_INDEX)
+        # 最后刷新索引（全量重建期间新索引关闭了 refresh，切换时统一刷新）
+        read_targets, write_targets = await resolve_book_chunk_indices(client)
+        if set(write_targets) <= set(read_targets):
+            await client.indices.refresh(index=BOOK_CHUNKS_WRITE_ALIAS)
+        invalidate_chunk_count_cache(content_sha256)
+        # 【2026-10-19】重建索引后，包含该书的答案缓存分区失效
+        from .answer_cache import invalidate_book_answers
+        invalidate_book_answers(content_sha256)
         
     finally:
         await client.close()
@@ -573,6 +631,71 @@ async def index_book_chunks(
 # ============================================================================
 
 import re
+import unicodedata
+
+# 【2026-10-19】中文数字 → 阿拉伯数字（支持 零〇一二两…九 十 百 千，最大 9999）
+_CN_DIGITS = {'零': 0, '〇': 0, '一': 1, '二': 2, '两': 2, '三': 3, '四': 4,
+              '五': 5, '六': 6, '七': 7, '八': 8, '九': 9}
+_CN_UNITS = {'十': 10, '百': 100, '千': 1000}
+_CN_NUMERAL_CHARS = "零〇一二两三四五六七八九十百千"
+
+# 章节标题中的序号："第三章"、"第 12 回"、"第一百零一章"、"Chapter 7"
+_CHAPTER_ORDINAL_RE = re.compile(rf'第\s*([{_CN_NUMERAL_CHARS}\d]+)\s*[章回]')
+_CHAPTER_EN_RE = re.compile(r'chapter\s*(\d+)', re.IGNORECASE)
+
+
+def parse_chinese_numeral(text: str) -> Optional[int]:
+    """
+    将中文数字或阿拉伯数字字符串转换为整数
+    
+    - "三" → 3, "十二" → 12, "二十" → 20, "一百零五" → 105
+    - "一二三" → 123（逐位写法）
+    - "12" → 12
+    
+    Returns:
+        整数，无法解析时返回 None
+    """
+    if not text:
+        return None
+    if text.isdigit():
+        return int(text)
+    if any(c not in _CN_DIGITS and c not in _CN_UNITS for c in text):
+        return None
+    
+    # 逐位写法（无单位）："一二三" → 123
+    if not any(c in _CN_UNITS for c in text):
+        return int("".join(str(_CN_DIGITS[c]) for c in text))
+    
+    total = 0
+    current = 0
+    for c in text:
+        if c in _CN_DIGITS:
+            current = _CN_DIGITS[c]
+        else:
+            # "十二" 省略了前导的 "一"
+            total += (current or 1) * _CN_UNITS[c]
+            current = 0
+    return total + current
+
+
+def parse_chapter_ordinal(title: str) -> Optional[int]:
+    """
+    从章节标题中解析章节序号（索引时写入 metadata.chapter_ordinal）
+    
+    Returns:
+        章节序号（1-based），无法识别时返回 None
+    """
+    if not title:
+        return None
+    title = unicodedata.normalize("NFKC", title)
+    match = _CHAPTER_ORDINAL_RE.search(title)
+    if match:
+        return parse_chinese_numeral(match.group(1))
+    match = _CHAPTER_EN_RE.search(title)
+    if match:
+        return int(match.group(1))
+    return None
+
 
 def extract_chapter_number(query: str) -> Optional[int]:
     """
@@ -583,35 +706,60 @@ def extract_chapter_number(query: str) -> Optional[int]:
     - "第3章" → 3
     - "chapter 3" → 3
     - "第一章" → 1
+    - "第一百零一回" → 101
     
     Returns:
         章节编号（1-based），如果没有匹配则返回 None
     """
-    # 中文数字映射
-    chinese_nums = {
-        '一': 1, '二': 2, '三': 3, '四': 4, '五': 5,
-        '六': 6, '七': 7, '八': 8, '九': 9, '十': 10,
-        '十一': 11, '十二': 12, '十三': 13, '十四': 14, '十五': 15,
-        '十六': 16, '十七': 17, '十八': 18, '十九': 19, '二十': 20,
-        '二十一': 21, '二十二': 22, '二十三': 23, '二十四': 24, '二十五': 25,
-    }
-    
-    # 匹配 "第X章" 格式（中文数字）
-    for cn, num in sorted(chinese_nums.items(), key=lambda x: -len(x[0])):
-        if f"第{cn}章" in query:
-            return num
-    
-    # 匹配 "第N章" 格式（阿拉伯数字）
-    match = re.search(r'第(\d+)章', query)
-    if match:
-        return int(match.group(1))
-    
-    # 匹配 "chapter N" 格式（英文）
-    match = re.search(r'chapter\s*(\d+)', query, re.IGNORECASE)
-    if match:
-        return int(match.group(1))
-    
-    return None
+    # 【2026-10-19】与索引时的 parse_chapter_ordinal 共用解析逻辑，不再限于 1-25
+    return parse_chapter_ordinal(query)
+
+
+def _parse_chapter_hits(hits: List[dict], chapter_num: int) -> List[dict]:
+    """将章节查询命中转换为统一的结果格式"""
+    results = []
+    for hit in hits:
+        src = hit["_source"]
+        meta = src.get("metadata", {})
+        
+        # 【优化 2026-01-15】直接使用text字段（存储的就是纯正文）
+        content = src.get("text", "")
+        
+        results.append({
+            "content": content,
+            "book_id": meta.get("book_id"),
+            "content_sha256": meta.get("content_sha256"),
+            "page": meta.get("page"),
+            "chapter": meta.get("chapter_title") or f"第{chapter_num}章",
+            "section_index": meta.get("section_index"),
+            "section_filename": meta.get("section_filename"),
+            "chunk_index": meta.get("chunk_index"),
+            "score": 1.0  # 精确匹配，给最高分
+        })
+    return results
+
+
+async def _shas_without_chapter_ordinal(client, content_sha256_list: List[str]) -> List[str]:
+    """返回没有任何带 chapter_ordinal 文档的书籍（未按新逻辑重建索引的旧数据）"""
+    response = await client.search(
+        index=BOOK_CHUNKS_INDEX,
+        body={
+            "size": 0,
+            "query": {
+                "bool": {
+                    "filter": [
+                        {"terms": {"metadata.content_sha256": content_sha256_list}},
+                        {"exists": {"field": "metadata.chapter_ordinal"}},
+                    ]
+                }
+            },
+            "aggs": {
+                "per_book": {"terms": {"field": "metadata.content_sha256", "size": len(content_sha256_list)}}
+            },
+        },
+    )
+    indexed = {bucket["key"] for bucket in response["aggregations"]["per_book"]["buckets"]}
+    return [sha for sha in content_sha256_list if sha not in indexed]
 
 
 async def search_by_chapter(
@@ -625,6 +773,9 @@ async def search_by_chapter(
     【修复 2026-01-13】改用 metadata.chapter_title 进行匹配
     之前使用 text 字段的 match_phrase 查询，但 text 字段设置了 index: false，导致查询失败
     
+    【2026-10-19】改用索引时写入的 metadata.chapter_ordinal 做 term 查询
+    前导通配符 *pattern* 会扫描整个 term 字典，仅对没有 chapter_ordinal 的旧数据（exists 检查）保留 wildcard 回退
+    
     Args:
         chapter_num: 章节编号（1-based）
         content_sha256_list: 书籍SHA256列表
@@ -638,6 +789,46 @@ async def search_by_chapter(
     client = AsyncOpenSearch(hosts=[OPENSEARCH_URL], timeout=30)
     
     try:
+        # 【2026-10-19】Step 0: 按章节序号精确查询（一次查询取回整章内容）
+        ordinal_query = {
+            "size": top_k,
+            "_source": ["text", "metadata"],
+            "query": {
+                "bool": {
+                    "filter": [
+                        {"term": {"metadata.chapter_ordinal": chapter_num}},
+                        {"terms": {"metadata.content_sha256": content_sha256_list}},
+                    ]
+                }
+            },
+            "sort": [
+                {"metadata.section_index": {"order": "asc", "unmapped_type": "integer"}},
+                {"metadata.chunk_index": "asc"}
+            ]
+        }
+        ordinal_response = await client.search(index=BOOK_CHUNKS_INDEX, body=ordinal_query)
+        ordinal_hits = ordinal_response["hits"]["hits"]
+        
+        if ordinal_hits:
+            results = _parse_chapter_hits(ordinal_hits, chapter_num)
+            logger.info(f"[LlamaRAG] Chapter search (ordinal) found {len(results)} chunks for chapter {chapter_num}")
+            return results
+        
+        # 旧索引数据没有 chapter_ordinal 字段，只对这些书籍回退到 wildcard 匹配；
+        # 已重建索引的书籍序号未命中即为确实没有该章节，不再做前导通配符扫描
+        legacy_shas = await _shas_without_chapter_ordinal(client, content_sha256_list)
+        if not legacy_shas:
+            logger.info(
+                f"[LlamaRAG] No ordinal match for chapter {chapter_num}; all {len(content_sha256_list)} books "
+                f"have chapter_ordinal, skipping wildcard lookup"
+            )
+            return []
+        logger.info(
+            f"[LlamaRAG] No ordinal match for chapter {chapter_num}, falling back to wildcard lookup on "
+            f"{len(legacy_shas)}/{len(content_sha256_list)} books without chapter_ordinal"
+        )
+        content_sha256_list = legacy_shas
+        
         # 构建章节标题的多种可能形式
         chinese_nums = ['', '一', '二', '三', '四', '五', '六', '七', '八', '九', '十',
                        '十一', '十二', '十三', '十四', '十五', '十六', '十七', '十八', '十九', '二十']
@@ -720,24 +911,7 @@ async def search_by_chapter(
         
         section_response = await client.search(index=BOOK_CHUNKS_INDEX, body=section_query)
         
-        results = []
-        for hit in section_response["hits"]["hits"]:
-            src = hit["_source"]
-            meta = src.get("metadata", {})
-            
-            # 【优化 2026-01-15】直接使用text字段（存储的就是纯正文）
-            content = src.get("text", "")
-            
-            results.append({
-                "content": content,
-                "book_id": meta.get("book_id"),
-                "page": meta.get("page"),
-                "chapter": meta.get("chapter_title") or f"第{chapter_num}章",
-                "section_index": meta.get("section_index"),
-                "section_filename": meta.get("section_filename"),
-                "chunk_index": meta.get("chunk_index"),
-                "score": 1.0  # 精确匹配，给最高分
-            })
+        results = _parse_chapter_hits(section_response["hits"]["hits"], chapter_num)
         
         logger.info(f"[LlamaRAG] Chapter search found {len(results)} chunks for chapter {chapter_num}")
         return results
@@ -755,6 +929,7 @@ async def search_book_chunks(
     top_k: int = 10,
     use_hybrid: bool = True,
     use_rerank: bool = True,
+    per_book_limit: Optional[int] = None,
 ) -> List[dict]:
     """
     在指定书籍中搜索相关内容块
@@ -767,6 +942,9 @@ async def search_book_chunks(
       1. 初始搜索取 3 倍候选 (30个)
       2. 使用 BGE-Reranker 精排
       3. 按相似度阈值动态过滤，返回高质量结果
+    - 2026-10-19: 多书籍按书分组检索（collapse + inner_hits）
+      书籍数 ≥ RAG_DIVERSIFY_MIN_BOOKS 时，候选总量不变但按书均分配额，
+      避免少数书籍占满候选，送入 Rerank 的候选更少、覆盖更广
     
     架构说明：
     - 向量索引是公共数据，按 content_sha256 匹配
@@ -786,6 +964,7 @@ async def search_book_chunks(
         top_k: 期望返回的最大结果数量
         use_hybrid: 是否使用混合搜索（向量+关键词），默认True
         use_rerank: 是否使用 Reranking 重排序，默认True
+        per_book_limit: 每本书的候选配额，None 时按书籍数自动计算
     
     Returns:
         相关内容块列表，每项包含：
@@ -833,6 +1012,12 @@ async def search_book_chunks(
     # 如果启用 Rerank，初始搜索取 3 倍候选用于重排序
     initial_top_k = top_k * 3 if use_rerank else top_k
     
+    # 【2026-10-19】多书籍时按书均分候选配额
+    if per_book_limit is None and len(content_sha256_list) >= DIVERSIFY_MIN_BOOKS:
+        per_book_limit = max(1, initial_top_k // len(content_sha256_list))
+    if per_book_limit:
+        logger.info(f"[LlamaRAG] Diversified retrieval: {per_book_limit} chunks/book across {len(content_sha256_list)} books")
+    
     # Step 2: 【2026-01-15 优化】使用混合搜索或纯向量搜索
     try:
         search_start = time.time()
@@ -843,7 +1028,8 @@ async def search_book_chunks(
                 query_text=query,
                 query_vector=query_vector,
                 content_sha256_list=content_sha256_list,
-                top_k=initial_top_k
+                top_k=initial_top_k,
+                per_book_limit=per_book_limit,
             )
             search_type = "hybrid"
         else:
@@ -851,7 +1037,8 @@ async def search_book_chunks(
             results = await opensearch_knn_search(
                 query_vector=query_vector,
                 content_sha256_list=content_sha256_list,
-                top_k=initial_top_k
+                top_k=initial_top_k,
+                per_book_limit=per_book_limit,
             )
             search_type = "knn"
         
@@ -860,8 +1047,10 @@ async def search_book_chunks(
         
         # Step 3: 【2026-01-16 优化】智能Batch Rerank - 行业最佳实践
         # 当候选数量<10时，质量已经足够好，跳过Rerank节省API调用
+        # 【2026-10-19】本地 Reranker 无 API 成本，小候选集也重排序
         if use_rerank and results:
-            if len(results) < 10:
+            from .local_reranker import RERANK_BACKEND
+            if len(results) < 10 and RERANK_BACKEND != "local":
                 logger.info(f"[LlamaRAG] Rerank skipped: only {len(results)} candidates (< 10), quality sufficient")
                 # 截断到top_k
                 results = results[:top_k]
@@ -888,7 +1077,8 @@ async def search_book_chunks(
                 results = await opensearch_knn_search(
                     query_vector=query_vector,
                     content_sha256_list=content_sha256_list,
-                    top_k=initial_top_k
+                    top_k=initial_top_k,
+                    per_book_limit=per_book_limit,
                 )
                 # 即使回退，也尝试 Rerank
                 if use_rerank and results:
@@ -936,8 +1126,8 @@ async def get_embedding_via_celery(text: str, timeout: float = 30.0) -> List[flo
         'tasks.get_text_embedding',
         args=[text],
         kwargs={'max_length': 8000},
-        queue='gpu_low',
-        routing_key='gpu.low',
+        queue='gpu_interactive',
+        routing_key='gpu.interactive',
     )
     
     # 异步等待任务完成
@@ -964,6 +1154,11 @@ async def get_embedding_via_celery(text: str, timeout: float = 30.0) -> List[flo
         raise TimeoutError(f"Embedding task timeout after {timeout}s")
 
 
+# 【2026-10-19】查询向量进程内 LRU：答案缓存查找与随后的检索共用同一次向量化
+QUERY_EMBEDDING_CACHE_SIZE = int(os.getenv("RAG_QUERY_EMBEDDING_CACHE_SIZE", "512"))
+_query_embedding_cache: "OrderedDict[str, List[float]]" = OrderedDict()
+
+
 async def get_local_embedding(text: str) -> List[float]:
     """
     获取文本向量（自动选择最佳执行方式）
@@ -989,6 +1184,11 @@ async def get_local_embedding(text: str) -> List[float]:
     # 判断当前运行环境
     # CELERY_QUEUES 环境变量只在 Worker 容器中设置
     is_gpu_worker = os.getenv("CELERY_QUEUES", "").find("gpu") >= 0
+
+    cached = _query_embedding_cache.get(text)
+    if cached is not None:
+        _query_embedding_cache.move_to_end(text)
+        return cached
     
     if is_gpu_worker:
         # 在GPU Worker中，直接本地执行
@@ -999,15 +1199,21 @@ async def get_local_embedding(text: str) -> List[float]:
         
         def _embed():
             truncated_text = text[:8000]
-            return embed_model.get_text_embedding(truncated_text)
+            with gpu_section("interactive", "query_embedding"):
+                return embed_model.get_text_embedding(truncated_text)
         
         embedding = await loop.run_in_executor(None, _embed)
         logger.debug(f"[LlamaRAG] Local embedding: {len(embedding)} dimensions")
-        return embedding
     else:
         # 在API容器中，通过Celery委托给GPU Worker
         logger.info("[LlamaRAG] Running in API container, delegating to GPU Worker via Celery")
-        return await get_embedding_via_celery(text)
+        embedding = await get_embedding_via_celery(text)
+
+    if QUERY_EMBEDDING_CACHE_SIZE > 0 and len(text) <= 2000:
+        _query_embedding_cache[text] = embedding
+        while len(_query_embedding_cache) > QUERY_EMBEDDING_CACHE_SIZE:
+            _query_embedding_cache.popitem(last=False)
+    return embedding
 
 
 async def get_remote_embedding(text: str) -> List[float]:
@@ -1114,6 +1320,11 @@ async def rerank_results(
     if not candidates:
         return []
     
+    # 【2026-10-19】优先使用集群内 Cross-Encoder，失败时回退到远程 Reranker
+    local_results = await _rerank_local(query, candidates, top_k)
+    if local_results is not None:
+        return local_results
+    
     try:
         from .llm_provider import get_reranker
         
@@ -1160,6 +1371,45 @@ async def rerank_results(
         return candidates[:top_k]
 
 
+async def _rerank_local(
+    query: str,
+    candidates: List[dict],
+    top_k: int,
+) -> Optional[List[dict]]:
+    """
+    使用集群内 Cross-Encoder 重排序（RERANK_BACKEND=local）
+    
+    Returns:
+        重排序结果；未启用或失败时返回 None，由调用方回退到远程 Reranker
+    """
+    from .local_reranker import get_local_reranker
+    
+    reranker = get_local_reranker()
+    if reranker is None:
+        return None
+    
+    try:
+        rerank_results_list = await reranker.rerank(
+            query=query,
+            documents=[c.get("content", "")[:2000] for c in candidates],
+            chunk_ids=[c.get("chunk_id") for c in candidates],
+            top_n=top_k,
+        )
+    except Exception as e:
+        logger.warning(f"[LlamaRAG] Local rerank failed: {e}, falling back to remote reranker")
+        return None
+    
+    results = []
+    for rr in rerank_results_list:
+        doc = candidates[rr.index].copy()
+        doc["score"] = rr.relevance_score
+        doc["original_score"] = candidates[rr.index].get("score")
+        results.append(doc)
+    
+    logger.info(f"[LlamaRAG] Local rerank complete: {len(candidates)} → {len(results)} (top_k={top_k})")
+    return results
+
+
 def quantize_vector_to_byte(vector: List[float]) -> List[int]:
     """
     将 float32 向量量化为 int8 (byte)
@@ -1187,11 +1437,154 @@ def quantize_vector_to_byte(vector: List[float]) -> List[int]:
     return emb_int8.tolist()
 
 
+# 【2026-10-19】小语料精确搜索
+# 过滤后的候选块数不超过该阈值时，跳过 HNSW，直接对候选集做精确打分（script_score）
+# 单本/少量书籍通常只有几千个块，精确扫描既更快又有 100% 召回
+EXACT_SEARCH_MAX_CHUNKS = int(os.getenv("RAG_EXACT_SEARCH_MAX_CHUNKS", "20000"))
+# 书籍块数缓存有效期（秒），索引/删除由其他进程执行，依赖 TTL 过期
+CHUNK_COUNT_CACHE_TTL = int(os.getenv("RAG_CHUNK_COUNT_CACHE_TTL", "600"))
+
+# content_sha256 -> (chunk_count, cached_at)
+_chunk_count_cache: Dict[str, Tuple[int, float]] = {}
+
+
+def invalidate_chunk_count_cache(content_sha256: Optional[str] = None):
+    """清除块数缓存（content_sha256 为空时清空全部）"""
+    if content_sha256:
+        _chunk_count_cache.pop(content_sha256, None)
+    else:
+        _chunk_count_cache.clear()
+
+
+async def get_chunk_counts(client, content_sha256_list: List[str]) -> Dict[str, int]:
+    """
+    获取各书籍在向量索引中的块数（带进程内 TTL 缓存）
+    
+    未命中缓存的部分通过一次 terms 聚合查询补齐。
+    """
+    import time
+    
+    now = time.time()
+    counts: Dict[str, int] = {}
+    missing: List[str] = []
+    for sha in content_sha256_list:
+        cached = _chunk_count_cache.get(sha)
+        if cached and now - cached[1] < CHUNK_COUNT_CACHE_TTL:
+            counts[sha] = cached[0]
+        else:
+            missing.append(sha)
+    
+    if missing:
+        response = await client.search(
+            index=BOOK_CHUNKS_INDEX,
+            body={
+                "size": 0,
+                "query": {"terms": {"metadata.content_sha256": missing}},
+                "aggs": {
+                    "per_book": {
+                        "terms": {"field": "metadata.content_sha256", "size": len(missing)}
+                    }
+                },
+            },
+        )
+        buckets = response.get("aggregations", {}).get("per_book", {}).get("buckets", [])
+        fetched = {b["key"]: b["doc_count"] for b in buckets}
+        for sha in missing:
+            count = fetched.get(sha, 0)
+            counts[sha] = count
+            # 0 表示尚未索引完成，不缓存，避免索引完成后仍走错误路径
+            if count > 0:
+                _chunk_count_cache[sha] = (count, now)
+    
+    return counts
+
+
+# 【2026-10-19】按书籍分组多样化检索
+# 参与搜索的书籍数达到该值时，自动启用每本书配额（collapse + inner_hits）
+DIVERSIFY_MIN_BOOKS = int(os.getenv("RAG_DIVERSIFY_MIN_BOOKS", "3"))
+
+
+def _per_book_collapse(per_book_limit: int) -> dict:
+    """按 content_sha256 折叠，每本书通过 inner_hits 返回分数最高的 per_book_limit 个块"""
+    return {
+        "field": "metadata.content_sha256",
+        "inner_hits": {
+            "name": "per_book",
+            "size": per_book_limit,
+            "sort": [{"_score": "desc"}],
+            "_source": ["text", "metadata"],
+        },
+    }
+
+
+def _flatten_hits(response: dict, per_book_limit: Optional[int]) -> List[dict]:
+    """展开 collapse 分组的 inner_hits，按分数全局排序；未折叠时原样返回"""
+    hits = response["hits"]["hits"]
+    if not per_book_limit:
+        return hits
+    flattened = []
+    for group in hits:
+        flattened.extend(group.get("inner_hits", {}).get("per_book", {}).get("hits", {}).get("hits", []))
+    return sorted(flattened, key=lambda h: h.get("_score") or 0.0, reverse=True)
+
+
+def _apply_per_book_limit(results: List[dict], per_book_limit: Optional[int]) -> List[dict]:
+    """结果已按分数排序，每本书只保留前 per_book_limit 个"""
+    if not per_book_limit:
+        return results
+    counts: Dict[str, int] = {}
+    limited = []
+    for doc in results:
+        # 与 _per_book_collapse 一致按 content_sha256 计数：同一内容的多份副本共用一个配额
+        key = doc.get("content_sha256") or doc.get("book_id") or ""
+        if counts.get(key, 0) < per_book_limit:
+            counts[key] = counts.get(key, 0) + 1
+            limited.append(doc)
+    return limited
+
+
+async def _knn_search_per_book(
+    client,
+    query_vector_byte: List[int],
+    content_sha256_list: List[str],
+    per_book_limit: int,
+) -> dict:
+    """HNSW 路径的按书配额检索：每本书一个 knn 子查询，合并为按分数排序的 search 响应"""
+    shas = list(dict.fromkeys(content_sha256_list))
+    searches = []
+    for sha in shas:
+        searches.append({"index": BOOK_CHUNKS_INDEX})
+        searches.append({
+            "size": per_book_limit,
+            "_source": ["text", "metadata"],
+            "query": {
+                "knn": {
+                    "embedding": {
+                        "vector": query_vector_byte,
+                        "k": per_book_limit,
+                        "filter": {"bool": {"filter": [{"term": {"metadata.content_sha256": sha}}]}},
+                    }
+                }
+            },
+        })
+    response = await client.msearch(body=searches)
+
+    hits = []
+    for sha, sub in zip(shas, response.get("responses", [])):
+        if sub.get("error"):
+            logger.warning(f"[LlamaRAG] Per-book k-NN search failed for {sha[:16]}: {sub['error']}")
+            continue
+        hits.extend(sub["hits"]["hits"])
+    hits.sort(key=lambda h: h.get("_score") or 0.0, reverse=True)
+    return {"hits": {"hits": hits}}
+
+
 async def opensearch_knn_search(
     query_vector: List[float],
     content_sha256_list: List[str],
     top_k: int = 10,
     min_score: float = None,
+    per_book_limit: Optional[int] = None,
 ) -> List[dict]:
     """
     OpenSearch k-NN 向量相似度搜索
@@ -1201,6 +1594,14 @@ async def opensearch_knn_search(
     - 使用原生 knn 查询（更高效）
     - 支持相似度阈值过滤
     
+    【2026-10-19】小语料精确搜索
+    - 指定书籍且总块数 ≤ RAG_EXACT_SEARCH_MAX_CHUNKS 时，对过滤后的候选集精确打分
+    - 全库搜索或大书架仍使用 HNSW 近似搜索
+    - 精确搜索失败时自动回退到 HNSW
+    
+    【2026-10-19】per_book_limit：每本书最多返回 per_book_limit 个块
+    （精确搜索按书籍折叠；HNSW 路径每本书单独查询，避免强势书籍占满全局 k）
+    
     Args:
         query_vector: 用户问题的向量（float32，1024维）
         content_sha256_list: 要搜索的书籍 SHA256 列表，空列表表示搜索全部
@@ -1226,40 +1627,94 @@ async def opensearch_knn_search(
         if content_sha256_list:
             filter_clause.append({"terms": {"metadata.content_sha256": content_sha256_list}})
         
-        # 【2026-01-15】使用 Lucene 原生 knn 查询
-        # 这比 script_score 更高效
-        query_body = {
-            "size": top_k,
-            "_source": ["text", "metadata"],
-            "query": {
-                "knn": {
-                    "embedding": {
-                        "vector": query_vector_byte,
-                        "k": top_k,
-                        "filter": {
-                            "bool": {
-                                "filter": filter_clause
-                            }
-                        } if filter_clause else None
+        # 【2026-10-19】小语料判断：按缓存的块数决定是否走精确搜索
+        use_exact = False
+        if content_sha256_list and EXACT_SEARCH_MAX_CHUNKS > 0:
+            try:
+                counts = await get_chunk_counts(client, content_sha256_list)
+                total_chunks = sum(counts.values())
+                use_exact = total_chunks <= EXACT_SEARCH_MAX_CHUNKS
+                logger.debug(f"[LlamaRAG] Filtered corpus: {total_chunks} chunks, exact={use_exact}")
+            except Exception as e:
+                logger.warning(f"[LlamaRAG] Failed to get chunk counts: {e}, using HNSW")
+        
+        response = None
+        # 分数换算系数：Lucene knn 的 cosinesimil 分数为 (1 + cos) / 2，
+        # knn_score 脚本返回 1 + cos，除以 2 后与 HNSW 路径的分数尺度一致
+        score_scale = 1.0
+        
+        if use_exact:
+            exact_body = {
+                "size": top_k,
+                "_source": ["text", "metadata"],
+                "query": {
+                    "script_score": {
+                        "query": {"bool": {"filter": filter_clause}},
+                        "script": {
+                            "source": "knn_score",
+                            "lang": "knn",
+                            "params": {
+                                "field": "embedding",
+                                "query_value": query_vector_byte,
+                                "space_type": "cosinesimil",
+                            },
+                        },
+                    }
+                },
+            }
+            if per_book_limit:
+                exact_body["size"] = len(content_sha256_list)
+                exact_body["collapse"] = _per_book_collapse(per_book_limit)
+            try:
+                response = await client.search(index=BOOK_CHUNKS_INDEX, body=exact_body)
+                score_scale = 0.5
+            except Exception as e:
+                logger.warning(f"[LlamaRAG] Exact search failed: {e}, falling back to HNSW")
+                response = None
+        
+        if response is None:
+            # 【2026-01-15】使用 Lucene 原生 knn 查询
+            # 这比 script_score 更高效
+            query_body = {
+                "size": top_k,
+                "_source": ["text", "metadata"],
+                "query": {
+                    "knn": {
+                        "embedding": {
+                            "vector": query_vector_byte,
+                            "k": top_k,
+                            "filter": {
+                                "bool": {
+                                    "filter": filter_clause
+                                }
+                            } if filter_clause else None
+                        }
                     }
                 }
             }
-        }
-        
-        # 如果没有过滤条件，移除 filter 字段
-        if not filter_clause:
-            del query_body["query"]["knn"]["embedding"]["filter"]
-        
-        response = await client.search(
-            index=BOOK_CHUNKS_INDEX,
-            body=query_body
-        )
+            
+            # 如果没有过滤条件，移除 filter 字段
+            if not filter_clause:
+                del query_body["query"]["knn"]["embedding"]["filter"]
+            
+            if per_book_limit and content_sha256_list:
+                # HNSW 先取过滤后的全局前 k 个近邻再折叠，强势书籍会占满 k、其余书籍拿不到候选；
+                # 改为每本书一个过滤子查询（msearch 一次往返），每本书各取前 per_book_limit 个
+                response = await _knn_search_per_book(
+                    client, query_vector_byte, content_sha256_list, per_book_limit
+                )
+                per_book_limit = None
+            else:
+                response = await client.search(
+                    index=BOOK_CHUNKS_INDEX,
+                    body=query_body
+                )
         
         results = []
         filtered_count = 0
         
-        for hit in response["hits"]["hits"]:
-            score = hit["_score"]
+        for hit in _flatten_hits(response, per_book_limit)[:top_k]:
+            score = hit["_score"] * score_scale
             
             # 【2026-01-15】Lucene knn 返回的分数已经是余弦相似度
             # 范围通常在 [0, 1]，但 byte 量化后可能略有偏差
@@ -1276,11 +1731,14 @@ async def opensearch_knn_search(
             results.append({
                 "content": content,
                 "book_id": meta.get("book_id"),
+                "content_sha256": meta.get("content_sha256"),
                 "book_title": meta.get("book_title"),
                 "page": meta.get("page"),
                 "chapter": meta.get("chapter_title"),
                 "section_index": meta.get("section_index"),  # EPUB 章节索引，用于精确跳转
                 "section_filename": meta.get("section_filename"),  # EPUB 章节文件名
+                "chunk_index": meta.get("chunk_index"),  # 混合搜索 RRF 去重键
+                "chunk_id": hit.get("_id"),  # Rerank 分数缓存键
                 "score": score,
             })
         
@@ -1306,11 +1764,14 @@ async def opensearch_keyword_search(
     query_text: str,
     content_sha256_list: List[str],
     top_k: int = 10,
+    per_book_limit: Optional[int] = None,
 ) -> List[dict]:
     """
     OpenSearch 关键词搜索（BM25）
     
     用于混合搜索中的关键词部分
+    
+    【2026-10-19】per_book_limit：按书籍折叠，每本书最多返回 per_book_limit 个块
     """
     from opensearchpy import AsyncOpenSearch
     
@@ -1335,24 +1796,33 @@ async def opensearch_keyword_search(
             }
         }
         
+        if per_book_limit and content_sha256_list:
+            query_body["size"] = len(content_sha256_list)
+            query_body["collapse"] = _per_book_collapse(per_book_limit)
+        else:
+            per_book_limit = None
+        
         response = await client.search(
             index=BOOK_CHUNKS_INDEX,
             body=query_body
         )
         
         results = []
-        for hit in response["hits"]["hits"]:
+        for hit in _flatten_hits(response, per_book_limit)[:top_k]:
             src = hit["_source"]
             meta = src.get("metadata", {})
             
             results.append({
                 "content": src.get("text", ""),
                 "book_id": meta.get("book_id"),
+                "content_sha256": meta.get("content_sha256"),
                 "book_title": meta.get("book_title"),
                 "page": meta.get("page"),
                 "chapter": meta.get("chapter_title"),
                 "section_index": meta.get("section_index"),
                 "section_filename": meta.get("section_filename"),
+                "chunk_index": meta.get("chunk_index"),
+                "chunk_id": hit.get("_id"),
                 "score": hit["_score"],
             })
         
@@ -1371,6 +1841,7 @@ async def opensearch_hybrid_search(
     content_sha256_list: List[str],
     top_k: int = 10,
     min_score: float = None,
+    per_book_limit: Optional[int] = None,
 ) -> List[dict]:
     """
     OpenSearch 混合搜索（向量 + 关键词）
@@ -1393,6 +1864,7 @@ async def opensearch_hybrid_search(
         content_sha256_list: 要搜索的书籍 SHA256 列表
         top_k: 返回结果数量
         min_score: 最小相似度分数阈值（用于向量搜索过滤）
+        per_book_limit: 每本书最多返回的块数（None 表示不限制）
     
     Returns:
         融合后的相关内容块列表
@@ -1411,13 +1883,15 @@ async def opensearch_hybrid_search(
             query_vector=query_vector,
             content_sha256_list=content_sha256_list,
             top_k=top_k * 2,  # 多取一些用于融合
-            min_score=min_score
+            min_score=min_score,
+            per_book_limit=per_book_limit,
         )
         
         keyword_task = opensearch_keyword_search(
             query_text=query_text,
             content_sha256_list=content_sha256_list,
-            top_k=top_k * 2
+            top_k=top_k * 2,
+            per_book_limit=per_book_limit,
         )
         
         vector_results, keyword_results = await asyncio.gather(vector_task, keyword_task)
@@ -1453,7 +1927,7 @@ async def opensearch_hybrid_search(
             rrf_scores.values(),
             key=lambda x: x["score"],
             reverse=True
-        )[:top_k]
+        )
         
         results = []
         for item in sorted_results:
@@ -1461,6 +1935,9 @@ async def opensearch_hybrid_search(
             doc["score"] = item["score"]  # 使用 RRF 分数
             results.append(doc)
         
+        # 向量/关键词两路各自满足配额，融合后需再次限制每本书的数量
+        results = _apply_per_book_limit(results, per_book_limit)[:top_k]
+        
         logger.info(f"[LlamaRAG] Hybrid search (RRF) returned {len(results)} results")
         return results
         
@@ -1469,12 +1946,13 @@ async def opensearch_hybrid_search(
         raise
 
 
-async def delete_book_index(book_id: str) -> bool:
+async def delete_book_index(book_id: str, index: Optional[str] = None) -> bool:
     """
     删除书籍的所有向量索引
     
     Args:
         book_id: 书籍 ID
+        index: 目标索引/别名；默认同时删除读、写别名指向的索引（重建期间两边都要删除）
     
     Returns:
         是否成功
@@ -1488,7 +1966,7 @@ async def delete_book_index(book_id: str) -> bool:
     client = AsyncOpenSearch(hosts=[OPENSEARCH_URL])
     try:
         response = await client.delete_by_query(
-            index=BOOK_CHUNKS_INDEX,
+            index=index or f"{BOOK_CHUNKS_INDEX},{BOOK_CHUNKS_WRITE_ALIAS}",
             body={
                 "query": {
                     # 使用 .keyword 后缀进行精确匹配，否则UUID会被分词导致匹配失败
@@ -1499,6 +1977,9 @@ async def delete_book_index(book_id: str) -> bool:
         )
         deleted = response.get("deleted", 0)
         logger.info(f"[LlamaRAG] Deleted {deleted} chunks for book {book_id}")
+        # 只知道 book_id，无法定位 content_sha256，清空全部块数缓存
+        # （答案缓存在重新索引时由 index_book_chunks 按 content_sha256 失效）
+        invalidate_chunk_count_cache()
         return True
     except Exception as e:
         logger.error(f"[LlamaRAG] Failed to delete book index: {e}")
@@ -1516,10 +1997,25 @@ async def get_index_stats() -> dict:
     client = AsyncOpenSearch(hosts=[OPENSEARCH_URL])
     try:
         count_response = await client.count(index=BOOK_CHUNKS_INDEX)
-        return {
+        read_targets, write_targets = await resolve_book_chunk_indices(client)
+        stats = {
             "index": BOOK_CHUNKS_INDEX,
             "count": count_response.get("count", 0),
+            # 【2026-10-19】别名指向的物理索引；二者不同表示正在全量重建
+            "read_indices": read_targets,
+            "write_indices": write_targets,
+            "rebuilding": not set(write_targets) <= set(read_targets),
         }
+        # 【2026-10-19】segment / 已删除文档 / HNSW 图统计（见 index_maintenance）
+        try:
+            from .index_maintenance import collect_book_chunks_stats
+            stats["physical"] = [
+                await collect_book_chunks_stats(client, index)
+                for index in dict.fromkeys(read_targets + write_targets)
+            ]
+        except Exception as e:
+            logger.warning(f"[LlamaRAG] Failed to collect segment stats: {e}")
+        return stats
     except Exception as e:
         logger.error(f"[LlamaRAG] Failed to get index stats: {e}")
         return {"index": BOOK_CHUNKS_INDEX, "count": 0, "error": str(e)}
@@ -1531,6 +2027,94 @@ async def get_index_stats() -> dict:
 # 书籍向量索引配置（公共数据）
 # ============================================================================
 
+def book_chunks_index_body() -> dict:
+    """书籍向量物理索引的 settings + mappings"""
+    return {
+        "settings": {
+            "index": {
+                "knn": True,
+                "number_of_shards": 1,
+                "number_of_replicas": 0,  # 单节点无需副本
+            },
+        },
+        "mappings": {
+            "properties": {
+                # 【重大优化】使用 Lucene 引擎 + byte 量化
+                # byte 量化将向量从 float32 (4字节) 压缩到 int8 (1字节)
+                # 存储空间减少 75%，精度损失 < 3%，配合重排序可忽略
+                "embedding": {
+                    "type": "knn_vector",
+                    "dimension": EMBEDDING_DIM,
+                    "data_type": "byte",  # 关键：使用 byte 量化
+                    "method": {
+                        "name": "hnsw",
+                        "engine": "lucene",  # 关键：使用 Lucene 引擎（支持 byte 量化）
+                        "space_type": "cosinesimil",
+                        "parameters": {
+                            "m": 16,
+                            "ef_construction": 100
+                        }
+                    }
+                },
+                # 【混合搜索】text字段启用索引
+                "text": {
+                    "type": "text",
+                    "index": True,   # 启用倒排索引，支持关键词搜索
+                    "store": True,   # 存储用于返回给前端
+                    "analyzer": "standard",  # 标准分词器
+                },
+                # 元数据字段
+                "metadata": {
+                    "properties": {
+                        "book_id": {"type": "keyword"},
+                        "content_sha256": {"type": "keyword"},
+                        "book_title": {"type": "keyword"},
+                        "chapter_title": {"type": "keyword"},
+                        "chapter_ordinal": {"type": "integer"},
+                        "chunk_index": {"type": "integer"},
+                        "section_index": {"type": "integer"},
+                        "section_filename": {"type": "keyword"},
+                        "page": {"type": "integer"},
+                    }
+                }
+            }
+        }
+    }
+
+
+def _new_book_chunks_index_name() -> str:
+    """带时间戳的物理索引名，如 athena_book_chunks_20261019083000"""
+    import time
+    return f"{BOOK_CHUNKS_INDEX}_{time.strftime('%Y%m%d%H%M%S', time.gmtime())}"
+
+
+async def _alias_targets(client, alias: str) -> List[str]:
+    """别名指向的物理索引（别名不存在时返回空列表）"""
+    from opensearchpy.exceptions import NotFoundError
+    
+    try:
+        response = await client.indices.get_alias(name=alias)
+    except NotFoundError:
+        return []
+    return sorted(response.keys())
+
+
+async def resolve_book_chunk_indices(client) -> Tuple[List[str], List[str]]:
+    """
+    解析读/写别名当前指向的物理索引
+    
+    迁移前的部署中 BOOK_CHUNKS_INDEX 本身是物理索引，此时读目标即为它自己。
+    
+    Returns:
+        (读目标列表, 写目标列表)
+    """
+    read_targets = await _alias_targets(client, BOOK_CHUNKS_INDEX)
+    if not read_targets and await client.indices.exists(index=BOOK_CHUNKS_INDEX):
+        read_targets = [BOOK_CHUNKS_INDEX]
+    write_targets = await _alias_targets(client, BOOK_CHUNKS_WRITE_ALIAS)
+    return read_targets, write_targets
+
+
 async def ensure_book_chunks_index():
     """
     确保书籍向量索引存在，并应用优化配置
@@ -1545,6 +2129,9 @@ async def ensure_book_chunks_index():
       - 向量存储空间减少 75%
       - text字段启用索引，支持向量+关键词混合搜索
       - 总体存储可能更小，同时获得混合搜索能力
+    - 2026-10-19:
+      - 新建时创建带时间戳的物理索引，读别名 + 写别名都指向它
+      - 已有索引缺少写别名时（迁移前的部署）补上写别名，指向当前读取的索引
     
     如果索引已存在，会尝试更新settings（但mapping不可变）
     """
@@ -1552,64 +2139,20 @@ async def ensure_book_chunks_index():
     
     client = AsyncOpenSearch(hosts=[OPENSEARCH_URL])
     try:
-        exists = await client.indices.exists(index=BOOK_CHUNKS_INDEX)
+        read_targets, write_targets = await resolve_book_chunk_indices(client)
         
-        if not exists:
+        if not read_targets:
             # 【2026-01-15 重大优化】Lucene 引擎 + byte 量化 + 混合搜索
-            mapping = {
-                "settings": {
-                    "index": {
-                        "knn": True,
-                        "number_of_shards": 1,
-                        "number_of_replicas": 0,  # 单节点无需副本
-                    },
-                },
-                "mappings": {
-                    "properties": {
-                        # 【重大优化】使用 Lucene 引擎 + byte 量化
-                        # byte 量化将向量从 float32 (4字节) 压缩到 int8 (1字节)
-                        # 存储空间减少 75%，精度损失 < 3%，配合重排序可忽略
-                        "embedding": {
-                            "type": "knn_vector",
-                            "dimension": EMBEDDING_DIM,
-                            "data_type": "byte",  # 关键：使用 byte 量化
-                            "method": {
-                                "name": "hnsw",
-                                "engine": "lucene",  # 关键：使用 Lucene 引擎（支持 byte 量化）
-                                "space_type": "cosinesimil",
-                                "parameters": {
-                                    "m": 16,
-                                    "ef_construction": 100
-                                }
-                            }
-                        },
-                        # 【混合搜索】text字段启用索引
-                        "text": {
-                            "type": "text",
-                            "index": True,   # 启用倒排索引，支持关键词搜索
-                            "store": True,   # 存储用于返回给前端
-                            "analyzer": "standard",  # 标准分词器
-                        },
-                        # 元数据字段
-                        "metadata": {
-                            "properties": {
-                                "book_id": {"type": "keyword"},
-                                "content_sha256": {"type": "keyword"},
-                                "book_title": {"type": "keyword"},
-                                "chapter_title": {"type": "keyword"},
-                                "chunk_index": {"type": "integer"},
-                                "section_index": {"type": "integer"},
-                                "section_filename": {"type": "keyword"},
-                                "page": {"type": "integer"},
-                            }
-                        }
-                    }
-                }
-            }
-            await client.indices.create(index=BOOK_CHUNKS_INDEX, body=mapping)
-            logger.info(f"[LlamaRAG] Created optimized book chunks index with byte quantization: {BOOK_CHUNKS_INDEX}")
-            return {"created": True, "optimized": True, "quantization": "byte"}
+            physical = _new_book_chunks_index_name()
+            body = book_chunks_index_body()
+            body["aliases"] = {BOOK_CHUNKS_INDEX: {}, BOOK_CHUNKS_WRITE_ALIAS: {}}
+            await client.indices.create(index=physical, body=body)
+            logger.info(f"[LlamaRAG] Created optimized book chunks index with byte quantization: {physical}")
+            return {"created": True, "optimized": True, "quantization": "byte", "index": physical}
         else:
+            if not write_targets:
+                await client.indices.put_alias(index=read_targets[0], name=BOOK_CHUNKS_WRITE_ALIAS)
+                logger.info(f"[LlamaRAG] Added write alias {BOOK_CHUNKS_WRITE_ALIAS} -> {read_targets[0]}")
             # 索引已存在，尝试更新settings（只有部分设置可动态更新）
             try:
                 await client.indices.put_settings(
@@ -1621,6 +2164,19 @@ async def ensure_book_chunks_index():
                     }
                 )
                 logger.info(f"[LlamaRAG] Updated book chunks index settings: replicas=0")
+                # 【2026-10-19】为已有索引补充章节字段（新增字段可动态添加，旧文档需重建索引后才有值）
+                await client.indices.put_mapping(
+                    index=BOOK_CHUNKS_INDEX,
+                    body={
+                        "properties": {
+                            "metadata": {
+                                "properties": {
+                                    "chapter_ordinal": {"type": "integer"},
+                                }
+                            }
+                        }
+                    }
+                )
                 return {"created": False, "settings_updated": True}
             except Exception as e:
                 logger.warning(f"[LlamaRAG] Could not update index settings: {e}")
@@ -1632,38 +2188,152 @@ async def ensure_book_chunks_index():
         await client.close()
 
 
-async def recreate_book_chunks_index():
+async def begin_book_chunks_rebuild() -> dict:
     """
-    删除并重新创建书籍向量索引（用于应用新的mapping配置）
+    开始零停机全量重建：创建新物理索引并把写别名切换过去
     
-    ⚠️ 警告：这会删除所有已索引的书籍向量！
-    之后需要重新索引所有书籍。
+    【2026-10-19】替代原先的删除重建：
+    - 新索引在重建期间关闭 refresh、副本为 0，批量写入更快
+    - 读别名仍指向旧索引，查询在整个重建过程中不受影响
+    - 调用方随后重新排队所有书籍，全部完成后调用 finish_book_chunks_rebuild 切换
     """
     from opensearchpy import AsyncOpenSearch
     
+    await ensure_book_chunks_index()
+    
     client = AsyncOpenSearch(hosts=[OPENSEARCH_URL])
     try:
-        # 删除现有索引
-        exists = await client.indices.exists(index=BOOK_CHUNKS_INDEX)
-        if exists:
-            await client.indices.delete(index=BOOK_CHUNKS_INDEX)
-            logger.warning(f"[LlamaRAG] Deleted existing index: {BOOK_CHUNKS_INDEX}")
-        
-        # 使用优化配置重新创建
-        result = await ensure_book_chunks_index()
-        logger.info(f"[LlamaRAG] Recreated index with optimized settings: {result}")
+        read_targets, write_targets = await resolve_book_chunk_indices(client)
+        if not set(write_targets) <= set(read_targets):
+            return {"started": False, "error": "rebuild already in progress", "index": write_targets[0]}
+        
+        physical = _new_book_chunks_index_name()
+        body = book_chunks_index_body()
+        body["settings"]["index"].update({"refresh_interval": "-1", "number_of_replicas": 0})
+        await client.indices.create(index=physical, body=body)
+        
+        actions = [{"remove": {"index": t, "alias": BOOK_CHUNKS_WRITE_ALIAS}} for t in write_targets]
+        actions.append({"add": {"index": physical, "alias": BOOK_CHUNKS_WRITE_ALIAS}})
+        await client.indices.update_aliases(body={"actions": actions})
+        
+        logger.warning(f"[LlamaRAG] Rebuild started: writes -> {physical}, reads stay on {read_targets}")
+        return {"started": True, "index": physical, "serving": read_targets}
+    finally:
+        await client.close()
+
+
+async def finish_book_chunks_rebuild(delete_old: bool = False) -> dict:
+    """
+    完成全量重建：恢复新索引的 refresh 设置，并原子切换读别名
+    
+    Args:
+        delete_old: 切换后是否删除旧物理索引（默认保留以便回滚）
+    """
+    from opensearchpy import AsyncOpenSearch
+    
+    client = AsyncOpenSearch(hosts=[OPENSEARCH_URL])
+    try:
+        read_targets, write_targets = await resolve_book_chunk_indices(client)
+        if not write_targets or set(write_targets) <= set(read_targets):
+            return {"swapped": False, "error": "no rebuild in progress"}
+        
+        physical = write_targets[0]
+        await client.indices.put_settings(index=physical, body={"index": {"refresh_interval": None}})
+        await client.indices.refresh(index=physical)
+        
+        if read_targets == [BOOK_CHUNKS_INDEX]:
+            # 迁移前的部署：旧物理索引与读别名同名，删除与建别名在同一次操作中完成
+            actions = [{"remove_index": {"index": BOOK_CHUNKS_INDEX}}]
+        else:
+            actions = [{"remove": {"index": t, "alias": BOOK_CHUNKS_INDEX}} for t in read_targets]
+        actions.append({"add": {"index": physical, "alias": BOOK_CHUNKS_INDEX}})
+        await client.indices.update_aliases(body={"actions": actions})
+        invalidate_chunk_count_cache()
+        logger.warning(f"[LlamaRAG] Rebuild finished: reads {read_targets} -> {physical}")
+        
+        old = [t for t in read_targets if t != BOOK_CHUNKS_INDEX]
+        if delete_old and old:
+            await client.indices.delete(index=",".join(old))
+            logger.warning(f"[LlamaRAG] Deleted previous indices: {old}")
+        return {"swapped": True, "index": physical, "previous": read_targets}
+    finally:
+        await client.close()
+
+
+async def recreate_book_chunks_index():
+    """
+    重新创建书籍向量索引（用于应用新的mapping配置）
+    
+    【2026-10-19】不再删除现有索引：改为开始零停机重建（见 begin_book_chunks_rebuild），
+    之后需要重新索引所有书籍，并调用 finish_book_chunks_rebuild 切换。
+    """
+    try:
+        result = await begin_book_chunks_rebuild()
+        logger.info(f"[LlamaRAG] Recreating index with optimized settings: {result}")
         return result
     except Exception as e:
         logger.error(f"[LlamaRAG] Failed to recreate index: {e}")
         return {"error": str(e)}
-    finally:
-        await client.close()
 
 
 # ============================================================================
 # 用户笔记/高亮向量索引（私人数据 - 必须按 user_id 隔离）
 # ============================================================================
 
+def user_notes_index_body() -> dict:
+    """
+    用户笔记物理索引的 settings + mappings
+    
+    【2026-10-19】按 user_id 路由（_routing 必填），分片数按增长预留（RAG_USER_NOTES_SHARDS）
+    """
+    return {
+        "settings": {
+            "index": {
+                "knn": True,
+                "number_of_shards": USER_NOTES_INDEX_SHARDS,
+            }
+        },
+        "mappings": {
+            # 写入、按 ID 读取/删除都必须携带 routing=user_id
+            "_routing": {"required": True},
+            "properties": {
+                "embedding": {
+                    "type": "knn_vector",
+                    "dimension": EMBEDDING_DIM,
+                    "data_type": "byte",  # int8 量化，压缩75%
+                    "method": {
+                        "name": "hnsw",
+                        "space_type": "cosinesimil",
+                        "engine": "lucene",  # Lucene 引擎支持 byte
+                        "parameters": {
+                            "ef_construction": 128,
+                            "m": 16
+                        }
+                    }
+                },
+                # 【重要】启用 text 索引，支持 BM25 关键词搜索
+                "text": {
+                    "type": "text",
+                    "analyzer": "ik_max_word",
+                    "index": True  # 启用索引，支持混合搜索
+                },
+                "metadata": {
+                    "properties": {
+                        "note_id": {"type": "keyword"},
+                        "user_id": {"type": "keyword"},  # 关键：隔离键
+                        "book_id": {"type": "keyword"},
+                        "book_title": {"type": "text", "index": True},
+                        "chapter": {"type": "text", "index": True},
+                        "page": {"type": "integer"},
+                        "note_type": {"type": "keyword"},  # note 或 highlight
+                        "created_at": {"type": "date"}
+                    }
+                }
+            }
+        }
+    }
+
+
 async def ensure_user_notes_index():
     """
     确保用户笔记向量索引存在
@@ -1672,6 +2342,9 @@ async def ensure_user_notes_index():
     【2026-01-15】架构优化：
     - 使用 Lucene 引擎 + byte 量化（压缩75%）
     - 启用 text 字段索引，支持混合搜索
+    
+    【2026-10-19】新建时创建按 user_id 路由的物理索引 + USER_NOTES_INDEX 别名；
+    已存在（别名或迁移前的旧物理索引）时不做改动
     """
     from opensearchpy import AsyncOpenSearch
     
@@ -1679,59 +2352,222 @@ async def ensure_user_notes_index():
     try:
         exists = await client.indices.exists(index=USER_NOTES_INDEX)
         if not exists:
-            # 【2026-01-15】使用 Lucene 引擎 + byte 量化
-            # 与 book_chunks 索引保持一致的架构
-            mapping = {
-                "settings": {
-                    "index": {
-                        "knn": True
-                    }
-                },
-                "mappings": {
-                    "properties": {
-                        "embedding": {
-                            "type": "knn_vector",
-                            "dimension": EMBEDDING_DIM,
-                            "data_type": "byte",  # int8 量化，压缩75%
-                            "method": {
-                                "name": "hnsw",
-                                "space_type": "cosinesimil",
-                                "engine": "lucene",  # Lucene 引擎支持 byte
-                                "parameters": {
-                                    "ef_construction": 128,
-                                    "m": 16
-                                }
-                            }
-                        },
-                        # 【重要】启用 text 索引，支持 BM25 关键词搜索
-                        "text": {
-                            "type": "text",
-                            "analyzer": "ik_max_word",
-                            "index": True  # 启用索引，支持混合搜索
-                        },
-                        "metadata": {
-                            "properties": {
-                                "note_id": {"type": "keyword"},
-                                "user_id": {"type": "keyword"},  # 关键：隔离键
-                                "book_id": {"type": "keyword"},
-                                "book_title": {"type": "text", "index": True},
-                                "chapter": {"type": "text", "index": True},
-                                "page": {"type": "integer"},
-                                "note_type": {"type": "keyword"},  # note 或 highlight
-                                "created_at": {"type": "date"}
-                            }
-                        }
-                    }
-                }
-            }
-            await client.indices.create(index=USER_NOTES_INDEX, body=mapping)
-            logger.info(f"[LlamaRAG] Created user notes index: {USER_NOTES_INDEX} (Lucene + byte)")
+            body = user_notes_index_body()
+            body["aliases"] = {USER_NOTES_INDEX: {}}
+            await client.indices.create(index=USER_NOTES_PHYSICAL_INDEX, body=body)
+            logger.info(
+                f"[LlamaRAG] Created user notes index: {USER_NOTES_PHYSICAL_INDEX} -> {USER_NOTES_INDEX} "
+                f"(Lucene + byte, {USER_NOTES_INDEX_SHARDS} shards, routed by user_id)"
+            )
     except Exception as e:
         logger.error(f"[LlamaRAG] Failed to create user notes index: {e}")
     finally:
         await client.close()
 
 
+# 【2026-10-19】笔记向量批量索引
+# 原先每条笔记一个 Celery 任务：单独一次前向计算 + 新建客户端 + refresh=True 强制刷新，
+# PowerSync 同步数百条笔记时产生数百次前向计算和刷新。现在：
+# - 待索引笔记先写入 Redis 列表，同一时间窗口只调度一个 flush 任务（gpu_low，延迟 RAG_NOTES_VECTOR_FLUSH_DELAY 秒）
+# - flush 任务按 RAG_NOTES_VECTOR_BATCH_SIZE 分批取出，同一笔记只保留最新内容，
+#   一次批量向量化 + 一次 _bulk 写入，不强制刷新（依赖索引 refresh_interval）
+# - 删除笔记时写入墓碑（rag:notes_vector:deleted:{note_id}），待索引列表中的旧内容不再写入，
+#   避免删除任务先于 flush 执行后笔记又被索引回来
+NOTES_VECTOR_PENDING_KEY = "rag:notes_vector:pending"
+NOTES_VECTOR_FLUSH_KEY = "rag:notes_vector:flush_scheduled"
+NOTES_VECTOR_DELETED_PREFIX = "rag:notes_vector:deleted:"
+NOTES_VECTOR_TOMBSTONE_TTL = int(os.getenv("RAG_NOTES_VECTOR_TOMBSTONE_TTL", "86400"))
+NOTES_VECTOR_BATCH_SIZE = int(os.getenv("RAG_NOTES_VECTOR_BATCH_SIZE", "64"))
+NOTES_VECTOR_FLUSH_DELAY = float(os.getenv("RAG_NOTES_VECTOR_FLUSH_DELAY", "2"))
+NOTE_EMBED_MAX_CHARS = 2000  # 笔记通常较短
+
+_redis = None
+
+
+def _get_redis():
+    """Redis 客户端（GPU / CPU worker 只配置了 REDIS_URL，API 配置了 REDIS_HOST）"""
+    global _redis
+    if _redis is None:
+        import redis
+        redis_url = os.getenv("REDIS_URL")
+        if redis_url and "://" in redis_url:
+            _redis = redis.Redis.from_url(redis_url, decode_responses=True)
+        else:
+            _redis = redis.Redis(
+                host=os.getenv("REDIS_HOST", "redis"),
+                port=int(os.getenv("REDIS_PORT", "6379")),
+                decode_responses=True,
+            )
+    return _redis
+
+
+def mark_user_note_deleted(note_id: str) -> None:
+    """写入笔记删除墓碑（在投递删除任务之前调用）"""
+    try:
+        _get_redis().set(NOTES_VECTOR_DELETED_PREFIX + note_id, "1", ex=NOTES_VECTOR_TOMBSTONE_TTL)
+    except Exception as e:
+        logger.warning(f"[LlamaRAG] Failed to write note tombstone {note_id[:8]}...: {e}")
+
+
+def _deleted_note_ids(note_ids: List[str]) -> set:
+    """返回已写入删除墓碑的 note_id"""
+    if not note_ids:
+        return set()
+    try:
+        flags = _get_redis().mget([NOTES_VECTOR_DELETED_PREFIX + note_id for note_id in note_ids])
+    except Exception as e:
+        logger.warning(f"[LlamaRAG] Failed to read note tombstones: {e}")
+        return set()
+    return {note_id for note_id, flag in zip(note_ids, flags) if flag}
+
+
+def _user_note_doc(note: dict, byte_embedding: List[int]) -> dict:
+    """构建笔记向量文档"""
+    import time
+
+    return {
+        "embedding": byte_embedding,  # 使用量化后的 int8 向量
+        "text": note["content"],
+        "metadata": {
+            "note_id": note["note_id"],
+            "user_id": note["user_id"],
+            "book_id": note["book_id"],
+            "book_title": note.get("book_title") or "",
+            "chapter": note.get("chapter") or "",
+            "page": note.get("page"),
+            "note_type": note.get("note_type") or "note",
+            "created_at": int(time.time() * 1000)
+        }
+    }
+
+
+async def bulk_index_user_notes(notes: List[dict]) -> int:
+    """
+    批量索引用户笔记（在 GPU Worker 中执行）
+
+    Args:
+        notes: 笔记字典列表，字段与 index_user_note 参数一致；同一 note_id 以最后一条为准，
+            已写入删除墓碑的笔记跳过
+
+    Returns:
+        成功写入的笔记数
+    """
+    from opensearchpy import AsyncOpenSearch
+
+    latest: Dict[str, dict] = {}
+    for note in notes:
+        if note.get("content") and note["content"].strip():
+            latest[note["note_id"]] = note
+    for note_id in _deleted_note_ids(list(latest)):
+        del latest[note_id]
+    if not latest:
+        return 0
+
+    await ensure_user_notes_index()
+
+    items = list(latest.values())
+    embed_model = get_embed_model()
+    with gpu_section("normal", "note_vectors"):
+        embeddings = embed_model.get_text_embedding_batch(
+            [n["content"][:NOTE_EMBED_MAX_CHARS] for n in items]
+        )
+
+    bulk_body = []
+    for note, embedding in zip(items, embeddings):
+        # 【2026-01-15】向量量化：float32 → int8（Lucene byte 格式）
+        bulk_body.append({"index": {"_index": USER_NOTES_INDEX, "_id": note["note_id"], "routing": note["user_id"]}})
+        bulk_body.append(_user_note_doc(note, quantize_vector_to_byte(embedding)))
+
+    client = AsyncOpenSearch(hosts=[OPENSEARCH_URL])
+    try:
+        response = await client.bulk(body=bulk_body, refresh=False)
+    finally:
+        await client.close()
+
+    # 向量化期间被删除的笔记：删除任务可能已先于本次写入执行，写入后再删一次
+    deleted = _deleted_note_ids([note["note_id"] for note in items])
+    if deleted:
+        for note in items:
+            if note["note_id"] in deleted:
+                await delete_user_note_index(note["note_id"], note["user_id"])
+
+    failed = [item for item in response.get("items", []) if "error" in item.get("index", {})]
+    if failed:
+        logger.error(f"[LlamaRAG] Bulk note indexing errors: {failed[:3]}")
+        # 索引写保护（路由迁移切换窗口）：整批抛出，由 flush 任务放回队列重试
+        if any("cluster_block_exception" in str(item["index"]["error"]) for item in failed):
+            raise RuntimeError("user notes index is write-blocked")
+    indexed = len(items) - len(failed)
+    logger.info(f"[LlamaRAG] Bulk indexed {indexed}/{len(items)} user notes (byte quantized)")
+    return indexed
+
+
+def queue_user_note_vector(note: dict) -> bool:
+    """
+    将笔记加入待索引列表，并确保已调度一个 flush 任务
+
+    Returns:
+        是否入队成功（Redis 不可用时返回 False，调用方回退为单条任务）
+    """
+    import json
+
+    try:
+        r = _get_redis()
+        pipe = r.pipeline(transaction=False)
+        pipe.rpush(NOTES_VECTOR_PENDING_KEY, json.dumps(note, ensure_ascii=False))
+        # 标记在 flush 任务开始时删除；过期时间兜底任务丢失的情况
+        pipe.set(NOTES_VECTOR_FLUSH_KEY, "1", nx=True, ex=int(NOTES_VECTOR_FLUSH_DELAY) + 60)
+        _, scheduled = pipe.execute()
+    except Exception as e:
+        logger.warning(f"[LlamaRAG] Note vector queue unavailable: {e}")
+        return False
+
+    if scheduled:
+        try:
+            from app.celery_app import celery_app
+
+            celery_app.send_task(
+                'tasks.flush_user_note_vectors',
+                queue='gpu_low',
+                routing_key='gpu.low',
+                countdown=NOTES_VECTOR_FLUSH_DELAY,
+            )
+        except Exception as e:
+            # 标记过期后下一条笔记会重新调度
+            logger.error(f"[LlamaRAG] Failed to schedule note vector flush: {e}")
+    return True
+
+
+async def drain_user_note_vectors() -> int:
+    """
+    取出全部待索引笔记并分批写入（flush 任务调用）
+
+    Returns:
+        成功写入的笔记数
+    """
+    import json
+
+    r = _get_redis()
+    # 先删除调度标记：之后到达的笔记会调度新的 flush 任务
+    r.delete(NOTES_VECTOR_FLUSH_KEY)
+
+    total = 0
+    while True:
+        pipe = r.pipeline(transaction=True)
+        pipe.lrange(NOTES_VECTOR_PENDING_KEY, 0, NOTES_VECTOR_BATCH_SIZE - 1)
+        pipe.ltrim(NOTES_VECTOR_PENDING_KEY, NOTES_VECTOR_BATCH_SIZE, -1)
+        raw, _ = pipe.execute()
+        if not raw:
+            break
+        try:
+            total += await bulk_index_user_notes([json.loads(item) for item in raw])
+        except Exception:
+            # 按原顺序放回队列头部，由任务重试处理（不能排到同一笔记更新的内容之后）
+            r.lpush(NOTES_VECTOR_PENDING_KEY, *reversed(raw))
+            raise
+    return total
+
+
 async def index_user_note(
     note_id: str,
     user_id: str,
@@ -1750,6 +2586,8 @@ async def index_user_note(
     - API立即返回，索引在后台异步执行
     - 保证Embedding使用GPU加速
     
+    【2026-10-19】API 容器中改为加入批量索引队列（见 queue_user_note_vector）
+    
     ⚠️ 安全说明：
     - 此索引包含 user_id，搜索时必须按 user_id 过滤
     - 严禁跨用户访问笔记数据
@@ -1767,95 +2605,72 @@ async def index_user_note(
     Returns:
         是否成功发送任务（注意：不是索引是否成功）
     """
-    import os
-    
     if not content or not content.strip():
         return False
     
-    logger.info(f"[LlamaRAG] Queuing user note indexing: {note_id[:8]}... for user {user_id[:8]}...")
+    note = {
+        "note_id": note_id,
+        "user_id": user_id,
+        "book_id": book_id,
+        "content": content,
+        "book_title": book_title,
+        "chapter": chapter,
+        "page": page,
+        "note_type": note_type,
+    }
     
     # 判断当前运行环境
     is_gpu_worker = os.getenv("CELERY_QUEUES", "").find("gpu") >= 0
     
     if is_gpu_worker:
-        # 在GPU Worker中，直接本地执行（同步）
+        # 在GPU Worker中，直接本地执行
         try:
-            await ensure_user_notes_index()
-            
-            embed_model = get_embed_model()
-            truncated_content = content[:2000]
-            embedding = embed_model.get_text_embedding(truncated_content)
-            
-            # 【2026-01-15】向量量化：float32 → int8（Lucene byte 格式）
-            byte_embedding = quantize_vector_to_byte(embedding)
-            
-            from opensearchpy import AsyncOpenSearch
-            import time
-            
-            client = AsyncOpenSearch(hosts=[OPENSEARCH_URL])
-            try:
-                doc = {
-                    "embedding": byte_embedding,  # 使用量化后的 int8 向量
-                    "text": content,
-                    "metadata": {
-                        "note_id": note_id,
-                        "user_id": user_id,
-                        "book_id": book_id,
-                        "book_title": book_title or "",
-                        "chapter": chapter or "",
-                        "page": page,
-                        "note_type": note_type,
-                        "created_at": int(time.time() * 1000)
-                    }
-                }
-                
-                await client.index(
-                    index=USER_NOTES_INDEX,
-                    id=note_id,
-                    body=doc,
-                    refresh=True
-                )
-                logger.info(f"[LlamaRAG] Indexed user note: {note_id[:8]}... (byte quantized)")
-                return True
-            finally:
-                await client.close()
+            return await bulk_index_user_notes([note]) > 0
         except Exception as e:
             logger.error(f"[LlamaRAG] Failed to index user note: {e}")
             return False
-    else:
-        # 在API容器中，通过Celery任务异步执行
-        try:
-            from app.celery_app import celery_app
-            
-            celery_app.send_task(
-                'tasks.index_user_note_vectors',
-                kwargs={
-                    'note_id': note_id,
-                    'user_id': user_id,
-                    'book_id': book_id,
-                    'content': content,
-                    'book_title': book_title,
-                    'chapter': chapter,
-                    'page': page,
-                    'note_type': note_type,
-                },
-                queue='gpu_low',
-                routing_key='gpu.low',
-            )
-            logger.info(f"[LlamaRAG] Queued user note indexing task: {note_id[:8]}...")
-            return True  # 任务已发送
-        except Exception as e:
-            logger.error(f"[LlamaRAG] Failed to queue user note indexing: {e}")
-            return False
+    
+    if queue_user_note_vector(note):
+        logger.info(f"[LlamaRAG] Queued user note for batch indexing: {note_id[:8]}...")
+        return True
+    
+    # Redis 不可用：回退为单条 Celery 任务
+    try:
+        from app.celery_app import celery_app
+        
+        celery_app.send_task(
+            'tasks.index_user_note_vectors',
+            kwargs=note,
+            queue='gpu_low',
+            routing_key='gpu.low',
+        )
+        logger.info(f"[LlamaRAG] Queued user note indexing task: {note_id[:8]}...")
+        return True  # 任务已发送
+    except Exception as e:
+        logger.error(f"[LlamaRAG] Failed to queue user note indexing: {e}")
+        return False
 
 
-async def delete_user_note_index(note_id: str) -> bool:
-    """删除用户笔记的向量索引"""
+async def delete_user_note_index(note_id: str, user_id: Optional[str] = None) -> bool:
+    """
+    删除用户笔记的向量索引
+    
+    【2026-10-19】索引按 user_id 路由：已知 user_id 时按路由直接删除，
+    否则按 note_id 查询删除（访问所有分片）
+    """
     from opensearchpy import AsyncOpenSearch
     
     client = AsyncOpenSearch(hosts=[OPENSEARCH_URL])
     try:
-        await client.delete(index=USER_NOTES_INDEX, id=note_id, ignore=[404])
+        if user_id:
+            await client.delete(index=USER_NOTES_INDEX, id=note_id, routing=user_id, ignore=[404])
+        else:
+            await client.delete_by_query(
+                index=USER_NOTES_INDEX,
+                body={"query": {"term": {"metadata.note_id": note_id}}},
+                conflicts="proceed",
+                ignore=[404],
+            )
         logger.info(f"[LlamaRAG] Deleted user note index: {note_id[:8]}...")
         return True
     except Exception as e:
@@ -1916,15 +2731,16 @@ async def search_user_notes(
             if book_ids:
                 base_filter.append({"terms": {"metadata.book_id": book_ids}})
             
+            # 【2026-10-19】routing=user_id：只访问该用户笔记所在的分片（过滤条件仍保留）
             if use_hybrid:
                 # 【混合搜索】使用 RRF 算法融合向量和关键词结果
                 results = await _search_user_notes_hybrid(
-                    client, query, query_vector_byte, base_filter, top_k
+                    client, query, query_vector_byte, base_filter, top_k, routing=user_id
                 )
             else:
                 # 【纯向量搜索】使用 Lucene knn 查询
                 results = await _search_user_notes_vector(
-                    client, query_vector_byte, base_filter, top_k
+                    client, query_vector_byte, base_filter, top_k, routing=user_id
                 )
             
             # 【2026-01-15】应用相似度阈值过滤
@@ -1948,7 +2764,8 @@ async def _search_user_notes_vector(
     client,
     query_vector_byte: List[int],
     base_filter: List[dict],
-    top_k: int
+    top_k: int,
+    routing: Optional[str] = None,
 ) -> List[dict]:
     """
     用户笔记纯向量搜索（内部函数）
@@ -1974,7 +2791,8 @@ async def _search_user_notes_vector(
     
     response = await client.search(
         index=USER_NOTES_INDEX,
-        body=query_body
+        body=query_body,
+        routing=routing,
     )
     
     return _parse_user_notes_results(response)
@@ -1985,7 +2803,8 @@ async def _search_user_notes_hybrid(
     query: str,
     query_vector_byte: List[int],
     base_filter: List[dict],
-    top_k: int
+    top_k: int,
+    routing: Optional[str] = None,
 ) -> List[dict]:
     """
     用户笔记混合搜索（内部函数）
@@ -2032,8 +2851,8 @@ async def _search_user_notes_hybrid(
     
     # 并行执行两个查询
     import asyncio
-    vector_task = client.search(index=USER_NOTES_INDEX, body=vector_query)
-    keyword_task = client.search(index=USER_NOTES_INDEX, body=keyword_query)
+    vector_task = client.search(index=USER_NOTES_INDEX, body=vector_query, routing=routing)
+    keyword_task = client.search(index=USER_NOTES_INDEX, body=keyword_query, routing=routing)
     
     vector_response, keyword_response = await asyncio.gather(
         vector_task, keyword_task, return_exceptions=True
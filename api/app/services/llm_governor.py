@@ -0,0 +1,233 @@
+"""
+LLM 请求准入控制（Redis 令牌桶 + 并发上限）
+
+【2026-10-19】新增：
+- 原先 send_message 直接调用上游 LLM，单个用户多标签页或突发流量会把 SiliconFlow / OpenRouter 打出 429
+- 现在每次生成前先获取一个"租约"，需要同时满足：
+  - 令牌桶：每用户、每模型的请求速率（允许突发）
+  - 并发上限：每用户、每模型、全局同时进行中的请求数
+- 检查与占用在一个 Lua 脚本内原子完成，多 API 进程共享同一份计数
+- 不满足时短暂排队（最多 AI_GOVERNOR_MAX_WAIT 秒）而不是立即失败
+- 租约带过期时间，进程崩溃未释放的租约会被自动清理
+- Redis 不可用时放行（fail open），不影响对话
+"""
+import asyncio
+import logging
+import os
+import random
+import time
+import uuid
+from contextlib import asynccontextmanager
+from typing import Optional
+
+from prometheus_client import Counter, Gauge, Histogram
+
+logger = logging.getLogger(__name__)
+
+GOVERNOR_ENABLED = os.getenv("AI_GOVERNOR_ENABLED", "true").lower() == "true"
+# 并发上限（0 表示不限制）
+USER_MAX_CONCURRENT = int(os.getenv("AI_USER_MAX_CONCURRENT", "2"))
+MODEL_MAX_CONCURRENT = int(os.getenv("AI_MODEL_MAX_CONCURRENT", "40"))
+GLOBAL_MAX_CONCURRENT = int(os.getenv("AI_GLOBAL_MAX_CONCURRENT", "80"))
+# 令牌桶：每秒补充速率与桶容量（速率 0 表示不限制）
+USER_RATE_PER_SEC = float(os.getenv("AI_USER_RATE_PER_SEC", "0.5"))
+USER_BURST = int(os.getenv("AI_USER_BURST", "5"))
+MODEL_RATE_PER_SEC = float(os.getenv("AI_MODEL_RATE_PER_SEC", "20"))
+MODEL_BURST = int(os.getenv("AI_MODEL_BURST", "40"))
+# 最长排队时间与租约有效期
+MAX_WAIT_SECONDS = float(os.getenv("AI_GOVERNOR_MAX_WAIT", "5"))
+LEASE_TTL_SECONDS = int(os.getenv("AI_GOVERNOR_LEASE_TTL", "300"))
+
+REDIS_HOST = os.getenv("REDIS_HOST", "redis")
+REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
+
+AI_GOVERNOR_QUEUE_DEPTH = Gauge(
+    "ai_governor_queue_depth", "AI requests waiting for admission in this process"
+)
+AI_GOVERNOR_WAIT = Histogram(
+    "ai_governor_wait_seconds",
+    "Time spent waiting for AI request admission",
+    ["outcome"],  # admitted / rejected / bypassed
+    buckets=(0.005, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0),
+)
+AI_GOVERNOR_REJECTED = Counter(
+    "ai_governor_rejected_total", "AI requests rejected after max wait"
+)
+
+# KEYS: 用户桶, 模型桶, 用户并发, 模型并发, 全局并发
+# ARGV: now_ms, lease_id, lease_ttl_ms,
+#       user_rate, user_burst, model_rate, model_burst,
+#       user_max, model_max, global_max
+# 返回 0 表示获得租约，否则为建议的重试等待毫秒数
+_ACQUIRE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local lease_ttl = tonumber(ARGV[3])
+
+for i = 3, 5 do
+  redis.call('ZREMRANGEBYSCORE', KEYS[i], '-inf', now)
+end
+
+local limits = {tonumber(ARGV[8]), tonumber(ARGV[9]), tonumber(ARGV[10])}
+for i = 1, 3 do
+  if limits[i] > 0 and redis.call('ZCARD', KEYS[i + 2]) >= limits[i] then
+    return 100
+  end
+end
+
+local function refill(key, rate, burst)
+  local state = redis.call('HMGET', key, 'tokens', 'ts')
+  local tokens = tonumber(state[1]) or burst
+  local ts = tonumber(state[2]) or now
+  return math.min(burst, tokens + math.max(0, now - ts) / 1000 * rate)
+end
+
+local user_rate, user_burst = tonumber(ARGV[4]), tonumber(ARGV[5])
+local model_rate, model_burst = tonumber(ARGV[6]), tonumber(ARGV[7])
+local user_tokens, model_tokens = 0, 0
+
+if user_rate > 0 then
+  user_tokens = refill(KEYS[1], user_rate, user_burst)
+  if user_tokens < 1 then
+    return math.ceil((1 - user_tokens) / user_rate * 1000)
+  end
+end
+if model_rate > 0 then
+  model_tokens = refill(KEYS[2], model_rate, model_burst)
+  if model_tokens < 1 then
+    return math.ceil((1 - model_tokens) / model_rate * 1000)
+  end
+end
+
+if user_rate > 0 then
+  redis.call('HSET', KEYS[1], 'tokens', user_tokens - 1, 'ts', now)
+  redis.call('PEXPIRE', KEYS[1], math.ceil(user_burst / user_rate * 1000) + 1000)
+end
+if model_rate > 0 then
+  redis.call('HSET', KEYS[2], 'tokens', model_tokens - 1, 'ts', now)
+  redis.call('PEXPIRE', KEYS[2], math.ceil(model_burst / model_rate * 1000) + 1000)
+end
+for i = 3, 5 do
+  redis.call('ZADD', KEYS[i], now + lease_ttl, ARGV[2])
+  redis.call('PEXPIRE', KEYS[i], lease_ttl)
+end
+return 0
+"""
+
+
+class GovernorRejected(Exception):
+    """排队超时仍未获得准入"""
+
+
+class LLMGovernor:
+    """LLM 请求准入控制器（API 进程单例）"""
+
+    def __init__(self):
+        self._redis = None
+        self._script = None
+
+    def _get_script(self):
+        if self._script is None:
+            import redis
+            self._redis = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=True)
+            self._script = self._redis.register_script(_ACQUIRE_SCRIPT)
+        return self._script
+
+    @staticmethod
+    def _keys(user_id: str, model_id: str) -> list[str]:
+        return [
+            f"ai:gov:bucket:user:{user_id}",
+            f"ai:gov:bucket:model:{model_id}",
+            f"ai:gov:conc:user:{user_id}",
+            f"ai:gov:conc:model:{model_id}",
+            "ai:gov:conc:global",
+        ]
+
+    def _try_acquire(self, keys: list[str], lease_id: str) -> int:
+        return int(self._get_script()(
+            keys=keys,
+            args=[
+                int(time.time() * 1000), lease_id, LEASE_TTL_SECONDS * 1000,
+                USER_RATE_PER_SEC, USER_BURST, MODEL_RATE_PER_SEC, MODEL_BURST,
+                USER_MAX_CONCURRENT, MODEL_MAX_CONCURRENT, GLOBAL_MAX_CONCURRENT,
+            ],
+        ))
+
+    def _release(self, keys: list[str], lease_id: str) -> None:
+        try:
+            pipe = self._redis.pipeline(transaction=False)
+            for key in keys[2:]:
+                pipe.zrem(key, lease_id)
+            pipe.execute()
+        except Exception as e:
+            logger.warning(f"[LLMGovernor] Lease release failed (expires in {LEASE_TTL_SECONDS}s): {e}")
+
+    async def acquire(self, user_id: str, model_id: str, max_wait: Optional[float] = None) -> Optional[str]:
+        """
+        获取租约，必要时短暂排队
+
+        Returns:
+            租约 ID；Redis 不可用时返回 None（放行）
+
+        Raises:
+            GovernorRejected: 排队超过 max_wait 秒
+        """
+        keys = self._keys(user_id, model_id)
+        lease_id = uuid.uuid4().hex
+        max_wait = MAX_WAIT_SECONDS if max_wait is None else max_wait
+        start = time.monotonic()
+        queued = False
+
+        try:
+            while True:
+                try:
+                    retry_ms = self._try_acquire(keys, lease_id)
+                except Exception as e:
+                    logger.warning(f"[LLMGovernor] Redis unavailable, bypassing admission control: {e}")
+                    AI_GOVERNOR_WAIT.labels(outcome="bypassed").observe(time.monotonic() - start)
+                    return None
+
+                if retry_ms <= 0:
+                    AI_GOVERNOR_WAIT.labels(outcome="admitted").observe(time.monotonic() - start)
+                    return lease_id
+
+                waited = time.monotonic() - start
+                if waited >= max_wait:
+                    AI_GOVERNOR_WAIT.labels(outcome="rejected").observe(waited)
+                    AI_GOVERNOR_REJECTED.inc()
+                    logger.warning(f"[LLMGovernor] Rejected user={user_id[:8]} model={model_id} after {waited:.2f}s")
+                    raise GovernorRejected("ai_busy")
+
+                if not queued:
+                    queued = True
+                    AI_GOVERNOR_QUEUE_DEPTH.inc()
+                # 加抖动，避免排队的请求同时重试
+                delay = min(retry_ms / 1000, 0.5, max_wait - waited) * random.uniform(0.8, 1.2)
+                await asyncio.sleep(max(delay, 0.01))
+        finally:
+            if queued:
+                AI_GOVERNOR_QUEUE_DEPTH.dec()
+
+    @asynccontextmanager
+    async def slot(self, user_id: str, model_id: str):
+        """在租约内执行 LLM 调用：async with governor.slot(user_id, model_id): ..."""
+        if not GOVERNOR_ENABLED:
+            yield
+            return
+
+        lease_id = await self.acquire(user_id, model_id)
+        try:
+            yield
+        finally:
+            if lease_id is not None:
+                self._release(self._keys(user_id, model_id), lease_id)
+
+
+_governor: Optional[LLMGovernor] = None
+
+
+def get_llm_governor() -> LLMGovernor:
+    """获取准入控制器（单例）"""
+    global _governor
+    if _governor is None:
+        _governor = LLMGovernor()
+    return _governor
@@ -0,0 +1,146 @@
+"""
+LLM 对冲请求（降低首 token 长尾延迟）
+
+【2026-10-19】新增：
+- 主模型在 AI_HEDGE_AFTER_SECONDS 内没有返回首个 chunk 时，用同一 prompt 向备用模型发起第二个请求
+- 备用模型由 AI_HEDGE_MODEL_ID 指定（ai_models 中的激活模型），未指定时对主模型重复请求
+- 两路中先返回有效 chunk 的一路胜出并继续流式输出，另一路立即取消（关闭 HTTP 流）
+- 一路报错时继续等待另一路；两路都失败才返回错误
+- Credits 只按胜出一路的 usage 与单价计算（调用方读取 winner_config）
+- 默认关闭（AI_HEDGE_ENABLED=false），对冲会增加上游调用量
+"""
+import asyncio
+import contextlib
+import logging
+import os
+from typing import AsyncIterator, Optional
+
+from prometheus_client import Counter
+
+from .llm_provider import ChatMessage, LLMStreamChunk, get_provider
+
+logger = logging.getLogger(__name__)
+
+HEDGE_ENABLED = os.getenv("AI_HEDGE_ENABLED", "false").lower() == "true"
+HEDGE_AFTER_SECONDS = float(os.getenv("AI_HEDGE_AFTER_SECONDS", "3"))
+HEDGE_MODEL_ID = os.getenv("AI_HEDGE_MODEL_ID", "")
+
+AI_HEDGE_TOTAL = Counter(
+    "ai_hedge_total",
+    "Hedged LLM stream outcomes",
+    ["outcome"],  # primary_fast / primary_won / hedge_won / failed
+)
+
+
+class HedgedStream:
+    """
+    对冲流：async for chunk in HedgedStream(...) 与 provider.chat_stream 用法一致
+
+    迭代开始后 winner_config 指向实际输出内容的一路模型配置。
+    """
+
+    def __init__(
+        self,
+        primary_config: dict,
+        hedge_config: Optional[dict],
+        messages: list[ChatMessage],
+        *,
+        temperature: float,
+        max_tokens: int,
+        hedge_after: float = HEDGE_AFTER_SECONDS,
+    ):
+        self.primary_config = primary_config
+        self.hedge_config = hedge_config
+        self.messages = messages
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.hedge_after = hedge_after
+        self.winner_config = primary_config
+        self.hedged = False
+
+    def _open(self, config: dict) -> AsyncIterator[LLMStreamChunk]:
+        provider = get_provider(config["provider"], config["api_key"], config["endpoint"])
+        return provider.chat_stream(
+            messages=self.messages,
+            model=config["model_id"],
+            temperature=self.temperature,
+            max_tokens=self.max_tokens,
+        ).__aiter__()
+
+    @staticmethod
+    async def _next(stream: AsyncIterator[LLMStreamChunk]) -> Optional[LLMStreamChunk]:
+        try:
+            return await stream.__anext__()
+        except StopAsyncIteration:
+            return None
+        except Exception as e:
+            return LLMStreamChunk(type="error", error=str(e))
+
+    @staticmethod
+    async def _cancel(task: asyncio.Task, stream: AsyncIterator[LLMStreamChunk]) -> None:
+        task.cancel()
+        with contextlib.suppress(BaseException):
+            await task
+        with contextlib.suppress(Exception):
+            await stream.aclose()
+
+    async def _race(self) -> tuple[dict, AsyncIterator[LLMStreamChunk], Optional[LLMStreamChunk]]:
+        """返回 (胜出配置, 胜出流, 胜出流的首个 chunk)"""
+        primary = self._open(self.primary_config)
+        primary_task = asyncio.ensure_future(self._next(primary))
+
+        if self.hedge_config is None:
+            return self.primary_config, primary, await primary_task
+
+        done, _ = await asyncio.wait({primary_task}, timeout=self.hedge_after)
+        if done:
+            AI_HEDGE_TOTAL.labels(outcome="primary_fast").inc()
+            return self.primary_config, primary, primary_task.result()
+
+        self.hedged = True
+        logger.info(
+            f"[LLMHedge] No first token from {self.primary_config['model_id']} after {self.hedge_after}s, "
+            f"hedging with {self.hedge_config['model_id']}"
+        )
+        hedge = self._open(self.hedge_config)
+        hedge_task = asyncio.ensure_future(self._next(hedge))
+        legs = {
+            primary_task: (self.primary_config, primary, "primary"),
+            hedge_task: (self.hedge_config, hedge, "hedge"),
+        }
+        first_error: Optional[LLMStreamChunk] = None
+
+        try:
+            while legs:
+                done, _ = await asyncio.wait(set(legs), return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    config, stream, leg = legs.pop(task)
+                    chunk = task.result()
+                    if chunk is not None and chunk.type != "error":
+                        for other_task, (_, other_stream, _) in list(legs.items()):
+                            await self._cancel(other_task, other_stream)
+                        legs.clear()
+                        AI_HEDGE_TOTAL.labels(outcome=f"{leg}_won").inc()
+                        return config, stream, chunk
+                    # 这一路失败或空响应，继续等待另一路
+                    logger.warning(f"[LLMHedge] {leg} leg failed: {chunk.error if chunk else 'empty response'}")
+                    if first_error is None or task is primary_task:
+                        first_error = chunk
+        finally:
+            # 调用方中途断开时取消仍在进行的请求
+            for task, (_, stream, _) in legs.items():
+                await self._cancel(task, stream)
+
+        AI_HEDGE_TOTAL.labels(outcome="failed").inc()
+        return self.primary_config, primary, first_error
+
+    async def __aiter__(self) -> AsyncIterator[LLMStreamChunk]:
+        config, stream, first = await self._race()
+        self.winner_config = config
+        if first is None:
+            return
+        yield first
+        if first.type == "error":
+            return
+        async for chunk in stream:
+            yield chunk
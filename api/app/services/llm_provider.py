@@ -10,17 +10,31 @@ LLM 服务商适配层
 - SSE 流式响应
 - Token 计数
 - 错误处理与重试
+- 按端点共享的 HTTP/2 长连接池
 """
 
+import asyncio
+import hashlib
 import json
+import logging
 import os
+import time
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
 from typing import Any, AsyncIterator, Optional
+from urllib.parse import urlsplit
 
 import httpx
 from prometheus_client import Counter, Histogram
 
+# 【2026-10-19】SSE 行解析优先使用 orjson（每个 token 一次解码，高并发时是主要 CPU 开销之一）
+try:
+    from orjson import loads as _json_loads
+except ImportError:  # pragma: no cover - orjson 为可选依赖
+    _json_loads = json.loads
+
+logger = logging.getLogger(__name__)
+
 # Prometheus 指标
 LLM_REQUEST_LATENCY = Histogram(
     "llm_request_latency_seconds",
@@ -37,6 +51,144 @@ LLM_TOKENS_TOTAL = Counter(
     "Total tokens consumed",
     ["provider", "model", "type"],  # metric_type: prompt/completion
 )
+# 【2026-10-19】首 token 延迟，phase: connect（连接池等待 + DNS/TCP/TLS）/ provider（请求发出到首 token）/ total
+LLM_TTFT = Histogram(
+    "llm_time_to_first_token_seconds",
+    "LLM time to first token in seconds",
+    ["provider", "model", "phase"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 4.0, 8.0, 16.0, 32.0),
+)
+
+
+# ============================================================================
+# 共享 HTTP 连接池
+# ============================================================================
+# 【2026-10-19】按服务端点 (scheme://host) 共享长连接客户端：
+# - 同一端点的所有 Provider / Reranker 复用连接，避免每次调用重新 DNS/TCP/TLS 握手
+# - 安装了 h2 时启用 HTTP/2 多路复用
+# - max_connections 限制对单个端点的并发连接数，连接池等待超过 LLM_HTTP_POOL_TIMEOUT 即失败
+# - 应用关闭时由 close_http_clients() 统一关闭
+
+LLM_HTTP2_ENABLED = os.getenv("LLM_HTTP2", "true").lower() == "true"
+LLM_HTTP_MAX_CONNECTIONS = int(os.getenv("LLM_HTTP_MAX_CONNECTIONS", "100"))
+LLM_HTTP_MAX_KEEPALIVE = int(os.getenv("LLM_HTTP_MAX_KEEPALIVE", "20"))
+LLM_HTTP_KEEPALIVE_EXPIRY = float(os.getenv("LLM_HTTP_KEEPALIVE_EXPIRY", "60"))
+LLM_HTTP_CONNECT_TIMEOUT = float(os.getenv("LLM_HTTP_CONNECT_TIMEOUT", "10"))
+LLM_HTTP_POOL_TIMEOUT = float(os.getenv("LLM_HTTP_POOL_TIMEOUT", "10"))
+
+# origin -> (client, 创建时的事件循环)
+_http_clients: dict[str, tuple[httpx.AsyncClient, Any]] = {}
+
+
+def _http2_supported() -> bool:
+    if not LLM_HTTP2_ENABLED:
+        return False
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def get_http_client(base_url: str, timeout: float = 120.0) -> httpx.AsyncClient:
+    """
+    获取端点共享的 HTTP 客户端
+
+    Args:
+        base_url: 服务端点地址（按 scheme://host 分组）
+        timeout: 默认读写超时（单次请求可覆盖）
+    """
+    parts = urlsplit(base_url)
+    origin = f"{parts.scheme}://{parts.netloc}"
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        loop = None
+
+    entry = _http_clients.get(origin)
+    # 连接绑定在创建它的事件循环上，循环变化（如 Celery 中的 asyncio.run）时重新创建
+    if entry is not None and not entry[0].is_closed and entry[1] is loop:
+        return entry[0]
+    if entry is not None:
+        _close_stale_client(*entry)
+
+    http2 = _http2_supported()
+    client = httpx.AsyncClient(
+        http2=http2,
+        timeout=httpx.Timeout(
+            timeout, connect=LLM_HTTP_CONNECT_TIMEOUT, pool=LLM_HTTP_POOL_TIMEOUT
+        ),
+        limits=httpx.Limits(
+            max_connections=LLM_HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=LLM_HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=LLM_HTTP_KEEPALIVE_EXPIRY,
+        ),
+    )
+    _http_clients[origin] = (client, loop)
+    logger.info(f"[LLMProvider] HTTP client created for {origin} (http2={http2})")
+    return client
+
+
+def _close_stale_client(client: httpx.AsyncClient, loop: Any) -> None:
+    """
+    关闭绑定在旧事件循环上的客户端，避免替换后连接泄漏
+
+    - 旧循环仍在运行（其他线程）：在该循环上 aclose()
+    - 旧循环空闲且当前线程没有运行中的循环：在旧循环上同步执行 aclose()
+    - 旧循环空闲但当前线程已有运行中的循环：排入旧循环，下次运行时关闭
+    - 旧循环已关闭：无法再 await，只能丢弃引用，由传输层回收时关闭 socket
+    """
+    if client.is_closed or loop is None:
+        return
+    try:
+        if loop.is_running():
+            asyncio.run_coroutine_threadsafe(client.aclose(), loop)
+        elif not loop.is_closed():
+            try:
+                asyncio.get_running_loop()
+            except RuntimeError:
+                loop.run_until_complete(client.aclose())
+            else:
+                loop.create_task(client.aclose())
+    except Exception as e:
+        logger.warning(f"[LLMProvider] Failed to close stale HTTP client: {e}")
+
+
+async def close_http_clients() -> None:
+    """关闭所有共享 HTTP 客户端（应用关闭时调用）"""
+    entries = list(_http_clients.values())
+    _http_clients.clear()
+    for client, _ in entries:
+        try:
+            await client.aclose()
+        except Exception as e:
+            logger.warning(f"[LLMProvider] Failed to close HTTP client: {e}")
+
+
+class _FirstTokenTimer:
+    """用 httpx trace 扩展拆分首 token 延迟中的连接时间与服务商处理时间"""
+
+    def __init__(self, provider: str, model: str):
+        self.provider = provider
+        self.model = model
+        self.started_at = time.perf_counter()
+        self.sent_at: Optional[float] = None
+        self.observed = False
+
+    async def trace(self, event_name: str, info: dict) -> None:
+        # http11.send_request_headers.started / http2.send_request_headers.started
+        if self.sent_at is None and event_name.endswith("send_request_headers.started"):
+            self.sent_at = time.perf_counter()
+
+    def first_token(self) -> None:
+        if self.observed:
+            return
+        self.observed = True
+        now = time.perf_counter()
+        sent_at = self.sent_at or self.started_at
+        LLM_TTFT.labels(provider=self.provider, model=self.model, phase="connect").observe(sent_at - self.started_at)
+        LLM_TTFT.labels(provider=self.provider, model=self.model, phase="provider").observe(now - sent_at)
+        LLM_TTFT.labels(provider=self.provider, model=self.model, phase="total").observe(now - self.started_at)
 
 
 @dataclass
@@ -71,6 +223,13 @@ class LLMProvider(ABC):
     """LLM 服务商抽象基类"""
 
     provider_name: str = "base"
+    request_timeout: float = 120.0
+
+    base_url: str = ""
+
+    def _get_client(self) -> httpx.AsyncClient:
+        """获取端点共享的长连接 HTTP 客户端"""
+        return get_http_client(self.base_url, timeout=self.request_timeout)
 
     @abstractmethod
     async def chat_stream(
@@ -153,82 +312,85 @@ class SiliconFlowProvider(LLMProvider):
                 payload[k] = v
 
         try:
-            async with httpx.AsyncClient(timeout=120.0) as client:
-                async with client.stream(
-                    "POST",
-                    url,
-                    headers=self._make_headers(),
-                    json=payload,
-                ) as response:
-                    if response.status_code != 200:
-                        error_text = await response.aread()
-                        LLM_REQUEST_TOTAL.labels(
-                            provider=self.provider_name,
-                            model=model,
-                            status="error",
-                        ).inc()
-                        yield LLMStreamChunk(
-                            type="error",
-                            error=f"HTTP {response.status_code}: {error_text.decode()}",
-                        )
-                        return
-
+            client = self._get_client()
+            timer = _FirstTokenTimer(self.provider_name, model)
+            async with client.stream(
+                "POST",
+                url,
+                headers=self._make_headers(),
+                json=payload,
+                extensions={"trace": timer.trace},
+            ) as response:
+                if response.status_code != 200:
+                    error_text = await response.aread()
                     LLM_REQUEST_TOTAL.labels(
                         provider=self.provider_name,
                         model=model,
-                        status="success",
+                        status="error",
                     ).inc()
+                    yield LLMStreamChunk(
+                        type="error",
+                        error=f"HTTP {response.status_code}: {error_text.decode()}",
+                    )
+                    return
 
-                    last_usage: Optional[LLMUsage] = None
-
-                    async for line in response.aiter_lines():
-                        if not line:
-                            continue
-                        if not line.startswith("data: "):
-                            continue
-
-                        data = line[6:]  # 去掉 "data: " 前缀
-
-                        if data == "[DONE]":
-                            # 流结束
-                            if last_usage:
-                                yield LLMStreamChunk(type="usage", usage=last_usage)
-                            yield LLMStreamChunk(type="done")
-                            return
-
-                        try:
-                            chunk = json.loads(data)
-                            choices = chunk.get("choices", [])
-
-                            # 提取 usage (有些 provider 在最后一个 chunk 返回)
-                            if "usage" in chunk and chunk["usage"]:
-                                u = chunk["usage"]
-                                last_usage = LLMUsage(
-                                    prompt_tokens=u.get("prompt_tokens", 0),
-                                    completion_tokens=u.get("completion_tokens", 0),
-                                    total_tokens=u.get("total_tokens", 0),
-                                )
+                LLM_REQUEST_TOTAL.labels(
+                    provider=self.provider_name,
+                    model=model,
+                    status="success",
+                ).inc()
+
+                last_usage: Optional[LLMUsage] = None
+
+                async for line in response.aiter_lines():
+                    if not line:
+                        continue
+                    if not line.startswith("data: "):
+                        continue
 
-                            if choices:
-                                choice = choices[0]
-                                delta = choice.get("delta", {})
-                                content = delta.get("content")
-                                finish_reason = choice.get("finish_reason")
+                    data = line[6:]  # 去掉 "data: " 前缀
 
-                                if content:
-                                    yield LLMStreamChunk(
-                                        type="delta",
-                                        content=content,
-                                    )
+                    if data == "[DONE]":
+                        # 流结束
+                        if last_usage:
+                            yield LLMStreamChunk(type="usage", usage=last_usage)
+                        yield LLMStreamChunk(type="done")
+                        return
+
+                    try:
+                        chunk = _json_loads(data)
+                        choices = chunk.get("choices", [])
+
+                        # 提取 usage (有些 provider 在最后一个 chunk 返回)
+                        if "usage" in chunk and chunk["usage"]:
+                            u = chunk["usage"]
+                            last_usage = LLMUsage(
+                                prompt_tokens=u.get("prompt_tokens", 0),
+                                completion_tokens=u.get("completion_tokens", 0),
+                                total_tokens=u.get("total_tokens", 0),
+                            )
+
+                        if choices:
+                            choice = choices[0]
+                            delta = choice.get("delta", {})
+                            content = delta.get("content")
+                            finish_reason = choice.get("finish_reason")
+
+                            if content:
+                                timer.first_token()
+                                yield LLMStreamChunk(
+                                    type="delta",
+                                    content=content,
+                                )
 
-                                if finish_reason:
-                                    yield LLMStreamChunk(
-                                        type="delta",
-                                        finish_reason=finish_reason,
-                                    )
+                            if finish_reason:
+                                yield LLMStreamChunk(
+                                    type="delta",
+                                    finish_reason=finish_reason,
+                                )
 
-                        except json.JSONDecodeError:
-                            continue
+                    except json.JSONDecodeError:
+                        continue
 
         except httpx.TimeoutException:
             LLM_REQUEST_TOTAL.labels(
@@ -268,49 +430,49 @@ class SiliconFlowProvider(LLMProvider):
             if v is not None:
                 payload[k] = v
 
-        async with httpx.AsyncClient(timeout=120.0) as client:
-            response = await client.post(
-                url,
-                headers=self._make_headers(),
-                json=payload,
-            )
-
-            if response.status_code != 200:
-                LLM_REQUEST_TOTAL.labels(
-                    provider=self.provider_name,
-                    model=model,
-                    status="error",
-                ).inc()
-                raise Exception(f"HTTP {response.status_code}: {response.text}")
+        client = self._get_client()
+        response = await client.post(
+            url,
+            headers=self._make_headers(),
+            json=payload,
+        )
 
+        if response.status_code != 200:
             LLM_REQUEST_TOTAL.labels(
                 provider=self.provider_name,
                 model=model,
-                status="success",
+                status="error",
             ).inc()
-
-            data = response.json()
-            content = data["choices"][0]["message"]["content"]
-            usage_data = data.get("usage", {})
-            usage = LLMUsage(
-                prompt_tokens=usage_data.get("prompt_tokens", 0),
-                completion_tokens=usage_data.get("completion_tokens", 0),
-                total_tokens=usage_data.get("total_tokens", 0),
-            )
-
-            # 记录 token 指标
-            LLM_TOKENS_TOTAL.labels(
-                provider=self.provider_name,
-                model=model,
-                type="prompt",
-            ).inc(usage.prompt_tokens)
-            LLM_TOKENS_TOTAL.labels(
-                provider=self.provider_name,
-                model=model,
-                type="completion",
-            ).inc(usage.completion_tokens)
-
-            return content, usage
+            raise Exception(f"HTTP {response.status_code}: {response.text}")
+
+        LLM_REQUEST_TOTAL.labels(
+            provider=self.provider_name,
+            model=model,
+            status="success",
+        ).inc()
+
+        data = response.json()
+        content = data["choices"][0]["message"]["content"]
+        usage_data = data.get("usage", {})
+        usage = LLMUsage(
+            prompt_tokens=usage_data.get("prompt_tokens", 0),
+            completion_tokens=usage_data.get("completion_tokens", 0),
+            total_tokens=usage_data.get("total_tokens", 0),
+        )
+
+        # 记录 token 指标
+        LLM_TOKENS_TOTAL.labels(
+            provider=self.provider_name,
+            model=model,
+            type="prompt",
+        ).inc(usage.prompt_tokens)
+        LLM_TOKENS_TOTAL.labels(
+            provider=self.provider_name,
+            model=model,
+            type="completion",
+        ).inc(usage.completion_tokens)
+
+        return content, usage
 
 
 class OpenRouterProvider(LLMProvider):
@@ -368,76 +530,79 @@ class OpenRouterProvider(LLMProvider):
                 payload[k] = v
 
         try:
-            async with httpx.AsyncClient(timeout=120.0) as client:
-                async with client.stream(
-                    "POST",
-                    url,
-                    headers=self._make_headers(),
-                    json=payload,
-                ) as response:
-                    if response.status_code != 200:
-                        error_text = await response.aread()
-                        LLM_REQUEST_TOTAL.labels(
-                            provider=self.provider_name,
-                            model=model,
-                            status="error",
-                        ).inc()
-                        yield LLMStreamChunk(
-                            type="error",
-                            error=f"HTTP {response.status_code}: {error_text.decode()}",
-                        )
-                        return
-
+            client = self._get_client()
+            timer = _FirstTokenTimer(self.provider_name, model)
+            async with client.stream(
+                "POST",
+                url,
+                headers=self._make_headers(),
+                json=payload,
+                extensions={"trace": timer.trace},
+            ) as response:
+                if response.status_code != 200:
+                    error_text = await response.aread()
                     LLM_REQUEST_TOTAL.labels(
                         provider=self.provider_name,
                         model=model,
-                        status="success",
+                        status="error",
                     ).inc()
+                    yield LLMStreamChunk(
+                        type="error",
+                        error=f"HTTP {response.status_code}: {error_text.decode()}",
+                    )
+                    return
 
-                    last_usage: Optional[LLMUsage] = None
+                LLM_REQUEST_TOTAL.labels(
+                    provider=self.provider_name,
+                    model=model,
+                    status="success",
+                ).inc()
 
-                    async for line in response.aiter_lines():
-                        if not line:
-                            continue
-                        if not line.startswith("data: "):
-                            continue
+                last_usage: Optional[LLMUsage] = None
 
-                        data = line[6:]
+                async for line in response.aiter_lines():
+                    if not line:
+                        continue
+                    if not line.startswith("data: "):
+                        continue
 
-                        if data == "[DONE]":
-                            if last_usage:
-                                yield LLMStreamChunk(type="usage", usage=last_usage)
-                            yield LLMStreamChunk(type="done")
-                            return
+                    data = line[6:]
 
-                        try:
-                            chunk = json.loads(data)
-                            choices = chunk.get("choices", [])
+                    if data == "[DONE]":
+                        if last_usage:
+                            yield LLMStreamChunk(type="usage", usage=last_usage)
+                        yield LLMStreamChunk(type="done")
+                        return
 
-                            if "usage" in chunk and chunk["usage"]:
-                                u = chunk["usage"]
-                                last_usage = LLMUsage(
-                                    prompt_tokens=u.get("prompt_tokens", 0),
-                                    completion_tokens=u.get("completion_tokens", 0),
-                                    total_tokens=u.get("total_tokens", 0),
+                    try:
+                        chunk = _json_loads(data)
+                        choices = chunk.get("choices", [])
+
+                        if "usage" in chunk and chunk["usage"]:
+                            u = chunk["usage"]
+                            last_usage = LLMUsage(
+                                prompt_tokens=u.get("prompt_tokens", 0),
+                                completion_tokens=u.get("completion_tokens", 0),
+                                total_tokens=u.get("total_tokens", 0),
+                            )
+
+                        if choices:
+                            choice = choices[0]
+                            delta = choice.get("delta", {})
+                            content = delta.get("content")
+                            finish_reason = choice.get("finish_reason")
+
+                            if content:
+                                timer.first_token()
+                                yield LLMStreamChunk(type="delta", content=content)
+
+                            if finish_reason:
+                                yield LLMStreamChunk(
+                                    type="delta", finish_reason=finish_reason
                                 )
 
-                            if choices:
-                                choice = choices[0]
-                                delta = choice.get("delta", {})
-                                content = delta.get("content")
-                                finish_reason = choice.get("finish_reason")
-
-                                if content:
-                                    yield LLMStreamChunk(type="delta", content=content)
-
-                                if finish_reason:
-                                    yield LLMStreamChunk(
-                                        type="delta", finish_reason=finish_reason
-                                    )
-
-                        except json.JSONDecodeError:
-                            continue
+                    except json.JSONDecodeError:
+                        continue
 
         except httpx.TimeoutException:
             LLM_REQUEST_TOTAL.labels(
@@ -477,37 +642,37 @@ class OpenRouterProvider(LLMProvider):
             if v is not None:
                 payload[k] = v
 
-        async with httpx.AsyncClient(timeout=120.0) as client:
-            response = await client.post(
-                url,
-                headers=self._make_headers(),
-                json=payload,
-            )
-
-            if response.status_code != 200:
-                LLM_REQUEST_TOTAL.labels(
-                    provider=self.provider_name,
-                    model=model,
-                    status="error",
-                ).inc()
-                raise Exception(f"HTTP {response.status_code}: {response.text}")
+        client = self._get_client()
+        response = await client.post(
+            url,
+            headers=self._make_headers(),
+            json=payload,
+        )
 
+        if response.status_code != 200:
             LLM_REQUEST_TOTAL.labels(
                 provider=self.provider_name,
                 model=model,
-                status="success",
+                status="error",
             ).inc()
+            raise Exception(f"HTTP {response.status_code}: {response.text}")
 
-            data = response.json()
-            content = data["choices"][0]["message"]["content"]
-            usage_data = data.get("usage", {})
-            usage = LLMUsage(
-                prompt_tokens=usage_data.get("prompt_tokens", 0),
-                completion_tokens=usage_data.get("completion_tokens", 0),
-                total_tokens=usage_data.get("total_tokens", 0),
-            )
+        LLM_REQUEST_TOTAL.labels(
+            provider=self.provider_name,
+            model=model,
+            status="success",
+        ).inc()
+
+        data = response.json()
+        content = data["choices"][0]["message"]["content"]
+        usage_data = data.get("usage", {})
+        usage = LLMUsage(
+            prompt_tokens=usage_data.get("prompt_tokens", 0),
+            completion_tokens=usage_data.get("completion_tokens", 0),
+            total_tokens=usage_data.get("total_tokens", 0),
+        )
 
-            return content, usage
+        return content, usage
 
 
 # ============================================================================
@@ -530,6 +695,9 @@ def get_provider(
 
     Returns:
         LLMProvider 实例
+
+    【2026-10-19】实例按 (服务商, API Key 摘要, base_url) 缓存复用，
+    模型配置变更时由 model_registry 调用 clear_provider_cache 清理。
     """
     providers = {
         "siliconflow": SiliconFlowProvider,
@@ -540,7 +708,21 @@ def get_provider(
     if not provider_class:
         raise ValueError(f"Unknown provider: {provider_name}. Supported: {list(providers.keys())}")
 
-    return provider_class(api_key=api_key, base_url=base_url)
+    key_digest = hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+    cache_key = (provider_name.lower(), key_digest, base_url or "")
+    provider = _provider_cache.get(cache_key)
+    if provider is None:
+        provider = provider_class(api_key=api_key, base_url=base_url)
+        _provider_cache[cache_key] = provider
+    return provider
+
+
+_provider_cache: dict[tuple[str, str, str], LLMProvider] = {}
+
+
+def clear_provider_cache() -> None:
+    """清空 Provider 缓存（模型配置变更后调用；HTTP 连接池按端点共享，不受影响）"""
+    _provider_cache.clear()
 
 
 # ============================================================================
@@ -657,33 +839,36 @@ class SiliconFlowReranker:
             payload["max_chunks_per_doc"] = max_chunks_per_doc
         
         try:
-            async with httpx.AsyncClient(timeout=60.0) as client:
-                response = await client.post(
-                    url,
-                    headers=self._make_headers(),
-                    json=payload,
-                )
-                
-                if response.status_code != 200:
-                    raise Exception(f"Rerank API error: HTTP {response.status_code}: {response.text}")
-                
-                data = response.json()
-                results = []
-                
-                for item in data.get("results", []):
-                    text = None
-                    if return_documents and "document" in item:
-                        text = item["document"].get("text")
-                    
-                    results.append(RerankResult(
-                        index=item["index"],
-                        relevance_score=item["relevance_score"],
-                        text=text,
-                    ))
-                
-                # API 已按 relevance_score 降序排列，直接返回
-                return results
+            client = get_http_client(self.base_url)
+            response = await client.post(
+                url,
+                headers=self._make_headers(),
+                json=payload,
+                timeout=httpx.Timeout(
+                    60.0, connect=LLM_HTTP_CONNECT_TIMEOUT, pool=LLM_HTTP_POOL_TIMEOUT
+                ),
+            )
+            
+            if response.status_code != 200:
+                raise Exception(f"Rerank API error: HTTP {response.status_code}: {response.text}")
+            
+            data = response.json()
+            results = []
+            
+            for item in data.get("results", []):
+                text = None
+                if return_documents and "document" in item:
+                    text = item["document"].get("text")
                 
+                results.append(RerankResult(
+                    index=item["index"],
+                    relevance_score=item["relevance_score"],
+                    text=text,
+                ))
+            
+            # API 已按 relevance_score 降序排列，直接返回
+            return results
+            
         except httpx.TimeoutException:
             raise Exception("Rerank API timeout")
         except Exception as e:
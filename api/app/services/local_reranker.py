@@ -0,0 +1,194 @@
+"""
+本地 Cross-Encoder 重排序（集群内 Reranker Worker）
+
+【2026-10-19】新增：
+- Cross-Encoder 模型运行在独立的 worker-rerank 容器（CPU，队列 rerank）
+- API 端把并发的重排序请求在很短的时间窗口内合并为一个 Celery 任务（微批处理）
+- 打分结果缓存在 Redis，键为 (查询哈希, chunk_id)，相同问题的重复检索不再重新打分
+- 任何失败由调用方回退到远程 SiliconFlow Reranker
+
+启用方式：RERANK_BACKEND=local，并启动 docker compose 的 rerank profile
+"""
+import asyncio
+import hashlib
+import logging
+import os
+from typing import Dict, List, Optional, Tuple
+
+from .llm_provider import RerankResult
+
+logger = logging.getLogger(__name__)
+
+# 重排序后端：remote（SiliconFlow，默认）| local（集群内 Cross-Encoder）
+RERANK_BACKEND = os.getenv("RERANK_BACKEND", "remote").lower()
+RERANK_LOCAL_MODEL = os.getenv("RERANK_LOCAL_MODEL", "BAAI/bge-reranker-base")
+# 微批窗口：第一个请求到达后等待该时长，合并期间到达的其他请求
+RERANK_BATCH_WINDOW_MS = int(os.getenv("RERANK_BATCH_WINDOW_MS", "15"))
+# 单批最大 (query, doc) 对数，达到后立即发送
+RERANK_BATCH_MAX_PAIRS = int(os.getenv("RERANK_BATCH_MAX_PAIRS", "256"))
+RERANK_LOCAL_TIMEOUT = float(os.getenv("RERANK_LOCAL_TIMEOUT", "5.0"))
+RERANK_CACHE_TTL = int(os.getenv("RERANK_CACHE_TTL", "3600"))
+
+REDIS_HOST = os.getenv("REDIS_HOST", "redis")
+REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
+
+
+def _query_hash(query: str) -> str:
+    return hashlib.sha1(query.strip().encode("utf-8")).hexdigest()[:16]
+
+
+def _cache_key(query_hash: str, chunk_id: str) -> str:
+    return f"rerank:score:{RERANK_LOCAL_MODEL}:{query_hash}:{chunk_id}"
+
+
+class LocalRerankClient:
+    """
+    集群内 Reranker 客户端（API 进程单例）
+
+    接口与 SiliconFlowReranker.rerank 保持一致，额外接收 chunk_ids 用于打分缓存。
+    """
+
+    def __init__(self):
+        self._pending: List[Tuple[str, List[str], asyncio.Future]] = []
+        self._pending_pairs = 0
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._redis = None
+
+    def _get_redis(self):
+        if self._redis is None:
+            import redis
+            self._redis = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=True)
+        return self._redis
+
+    def _cache_get(self, keys: List[str]) -> List[Optional[str]]:
+        try:
+            return self._get_redis().mget(keys)
+        except Exception as e:
+            logger.warning(f"[LocalRerank] Score cache read failed: {e}")
+            return [None] * len(keys)
+
+    def _cache_set(self, items: Dict[str, float]):
+        if not items:
+            return
+        try:
+            pipe = self._get_redis().pipeline(transaction=False)
+            for key, score in items.items():
+                pipe.setex(key, RERANK_CACHE_TTL, f"{score:.6f}")
+            pipe.execute()
+        except Exception as e:
+            logger.warning(f"[LocalRerank] Score cache write failed: {e}")
+
+    async def rerank(
+        self,
+        query: str,
+        documents: List[str],
+        *,
+        chunk_ids: Optional[List[str]] = None,
+        top_n: Optional[int] = None,
+        return_documents: bool = False,
+    ) -> List[RerankResult]:
+        """
+        对文档进行重排序
+
+        Args:
+            query: 查询文本
+            documents: 待排序的文档列表
+            chunk_ids: 与 documents 对应的块 ID（缺省时使用文本哈希）
+            top_n: 返回前 N 个结果（默认全部返回）
+            return_documents: 是否返回文档文本
+
+        Returns:
+            按相关性降序排列的 RerankResult 列表
+        """
+        if not documents:
+            return []
+
+        qhash = _query_hash(query)
+        ids = chunk_ids or [None] * len(documents)
+        keys = [_cache_key(qhash, cid or hashlib.sha1(d.encode("utf-8")).hexdigest()[:16])
+                for cid, d in zip(ids, documents)]
+
+        cached = self._cache_get(keys)
+        scores: List[Optional[float]] = [float(v) if v is not None else None for v in cached]
+        missing = [i for i, s in enumerate(scores) if s is None]
+
+        if missing:
+            fresh = await self._submit(query, [documents[i] for i in missing])
+            for i, score in zip(missing, fresh):
+                scores[i] = score
+            self._cache_set({keys[i]: scores[i] for i in missing})
+
+        logger.debug(f"[LocalRerank] {len(documents)} docs, {len(documents) - len(missing)} cache hits")
+
+        order = sorted(range(len(documents)), key=lambda i: scores[i], reverse=True)
+        if top_n is not None:
+            order = order[:top_n]
+        return [
+            RerankResult(
+                index=i,
+                relevance_score=scores[i],
+                text=documents[i] if return_documents else None,
+            )
+            for i in order
+        ]
+
+    async def _submit(self, query: str, documents: List[str]) -> List[float]:
+        """加入当前微批，等待批次完成后返回该请求的分数"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((query, documents, future))
+        self._pending_pairs += len(documents)
+
+        if self._pending_pairs >= RERANK_BATCH_MAX_PAIRS:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(RERANK_BATCH_WINDOW_MS / 1000, self._flush)
+
+        return await asyncio.wait_for(future, timeout=RERANK_LOCAL_TIMEOUT)
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending, self._pending_pairs = self._pending, [], 0
+        if batch:
+            asyncio.get_running_loop().create_task(self._run_batch(batch))
+
+    async def _run_batch(self, batch: List[Tuple[str, List[str], asyncio.Future]]):
+        """把一个微批作为单个 Celery 任务发送给 worker-rerank"""
+        from app.celery_app import celery_app
+
+        groups = [{"query": q, "documents": docs} for q, docs, _ in batch]
+        loop = asyncio.get_running_loop()
+        try:
+            task = celery_app.send_task(
+                "tasks.rerank_batch",
+                args=[groups],
+                queue="rerank",
+                routing_key="rerank",
+            )
+            results = await loop.run_in_executor(
+                None, lambda: task.get(timeout=RERANK_LOCAL_TIMEOUT)
+            )
+            for (_, _, future), group_scores in zip(batch, results):
+                if not future.done():
+                    future.set_result(group_scores)
+            logger.info(f"[LocalRerank] Batch of {len(batch)} requests "
+                        f"({sum(len(g['documents']) for g in groups)} pairs) scored")
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(RuntimeError(f"Local rerank failed: {e}"))
+
+
+_local_reranker: Optional[LocalRerankClient] = None
+
+
+def get_local_reranker() -> Optional[LocalRerankClient]:
+    """获取集群内 Reranker 客户端（RERANK_BACKEND != local 时返回 None）"""
+    global _local_reranker
+    if RERANK_BACKEND != "local":
+        return None
+    if _local_reranker is None:
+        _local_reranker = LocalRerankClient()
+    return _local_reranker
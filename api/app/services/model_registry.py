@@ -0,0 +1,225 @@
+"""
+AI 模型配置注册表（进程内缓存）
+
+【2026-10-19】新增：
+- 原先每条聊天消息都查询 ai_models 并解密 API Key
+- 现在进程内缓存默认模型配置（含已解密的 API Key），聊天请求不再访问数据库
+- admin_ai 修改模型后调用 bump_model_config_version()，递增 Redis 中的版本号
+- 各进程最多每 AI_MODEL_CONFIG_CHECK_INTERVAL 秒读取一次版本号，版本变化时重新加载
+- 重新加载时同时清理 Provider 缓存（旧 API Key / endpoint 的 HTTP 客户端）
+- 缓存最长保留 AI_MODEL_CONFIG_MAX_AGE 秒，未递增版本号的修改（如直接执行 SQL）到期后也会生效
+"""
+import asyncio
+import logging
+import os
+import time
+from typing import Optional
+
+from sqlalchemy import text
+
+from ..db import engine
+
+logger = logging.getLogger(__name__)
+
+MODEL_CONFIG_VERSION_KEY = "ai:model_config:version"
+# 版本号检查间隔（秒），0 表示每次都检查
+MODEL_CONFIG_CHECK_INTERVAL = float(os.getenv("AI_MODEL_CONFIG_CHECK_INTERVAL", "5"))
+# 缓存最长有效期（秒），到期后无论版本号是否变化都重新加载
+MODEL_CONFIG_MAX_AGE = float(os.getenv("AI_MODEL_CONFIG_MAX_AGE", "300"))
+
+REDIS_HOST = os.getenv("REDIS_HOST", "redis")
+REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
+
+
+class ModelConfigRegistry:
+    """默认模型配置缓存，按 Redis 版本号失效"""
+
+    def __init__(self):
+        self._config: Optional[dict] = None
+        self._hedge_config: Optional[dict] = None
+        self._version: Optional[str] = None
+        self._checked_at = 0.0
+        self._loaded_at = 0.0
+        self._lock = asyncio.Lock()
+        self._redis = None
+
+    def _get_redis(self):
+        if self._redis is None:
+            import redis
+            self._redis = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=True)
+        return self._redis
+
+    def _read_version(self) -> Optional[str]:
+        try:
+            return self._get_redis().get(MODEL_CONFIG_VERSION_KEY) or "0"
+        except Exception as e:
+            # Redis 不可用时保留当前缓存，依赖本进程内的失效
+            logger.warning(f"[ModelRegistry] Failed to read config version: {e}")
+            return self._version
+
+    def invalidate(self):
+        """本进程内立即失效"""
+        self._config = None
+        self._checked_at = 0.0
+
+    async def get_default(self) -> Optional[dict]:
+        """
+        获取默认模型配置
+
+        Returns:
+            模型配置字典；数据库和环境变量都未配置时返回 None
+        """
+        now = time.monotonic()
+        fresh = now - self._loaded_at < MODEL_CONFIG_MAX_AGE
+        if self._config is not None and fresh and now - self._checked_at < MODEL_CONFIG_CHECK_INTERVAL:
+            return self._config
+
+        version = self._read_version()
+        if self._config is not None and fresh and version == self._version:
+            self._checked_at = now
+            return self._config
+
+        async with self._lock:
+            # 等锁期间其他协程可能已完成加载
+            if (
+                self._config is not None
+                and version == self._version
+                and time.monotonic() - self._loaded_at < MODEL_CONFIG_MAX_AGE
+            ):
+                return self._config
+
+            config = await _load_default_model_config()
+            from .llm_hedge import HEDGE_MODEL_ID
+            self._hedge_config = await _load_model_config(HEDGE_MODEL_ID) if HEDGE_MODEL_ID else None
+            if self._version is not None and version != self._version:
+                logger.info(f"[ModelRegistry] Model config version {self._version} -> {version}, reloading")
+                from .llm_provider import clear_provider_cache
+                clear_provider_cache()
+
+            self._config = config
+            self._version = version
+            self._checked_at = self._loaded_at = time.monotonic()
+            return config
+
+    async def get_hedge(self) -> Optional[dict]:
+        """获取对冲备用模型配置（AI_HEDGE_MODEL_ID，与默认配置一同缓存和失效）"""
+        await self.get_default()
+        return self._hedge_config
+
+
+async def _load_model_config(model_id: str) -> Optional[dict]:
+    """按 model_id 加载激活的模型配置（解密 API Key）"""
+    async with engine.begin() as conn:
+        result = await conn.execute(
+            text(
+                """
+                SELECT provider, model_id, api_key_encrypted, endpoint,
+                       input_price_per_1k, output_price_per_1k
+                FROM ai_models
+                WHERE model_id = :model_id AND active = true
+                ORDER BY is_default DESC, updated_at DESC
+                LIMIT 1
+                """
+            ),
+            {"model_id": model_id},
+        )
+        row = result.fetchone()
+
+    if not row:
+        logger.warning(f"[ModelRegistry] Model {model_id} not found or inactive")
+        return None
+    return _row_to_config(row)
+
+
+async def _load_default_model_config() -> Optional[dict]:
+    """从数据库加载默认模型配置（解密 API Key）"""
+    from ..ai import CREDITS_PER_1K_INPUT, CREDITS_PER_1K_OUTPUT, DEFAULT_MODEL
+
+    async with engine.begin() as conn:
+        # 先尝试获取默认模型
+        result = await conn.execute(
+            text(
+                """
+                SELECT provider, model_id, api_key_encrypted, endpoint,
+                       input_price_per_1k, output_price_per_1k
+                FROM ai_models
+                WHERE is_default = true AND active = true
+                LIMIT 1
+                """
+            )
+        )
+        row = result.fetchone()
+
+        if not row:
+            # 回退到任意激活的模型
+            result = await conn.execute(
+                text(
+                    """
+                    SELECT provider, model_id, api_key_encrypted, endpoint,
+                           input_price_per_1k, output_price_per_1k
+                    FROM ai_models
+                    WHERE active = true
+                    ORDER BY updated_at DESC
+                    LIMIT 1
+                    """
+                )
+            )
+            row = result.fetchone()
+
+    if not row:
+        # 使用环境变量配置
+        api_key = os.getenv("SILICONFLOW_API_KEY", "")
+        if not api_key:
+            return None
+        return {
+            "provider": "siliconflow",
+            "model_id": DEFAULT_MODEL,
+            "api_key": api_key,
+            "endpoint": None,
+            "input_price": CREDITS_PER_1K_INPUT,
+            "output_price": CREDITS_PER_1K_OUTPUT,
+        }
+
+    return _row_to_config(row)
+
+
+def _row_to_config(row) -> dict:
+    """ai_models 行 → 模型配置字典（解密 API Key）"""
+    from ..admin_ai import decrypt_api_key
+    from ..ai import CREDITS_PER_1K_INPUT, CREDITS_PER_1K_OUTPUT
+
+    api_key = decrypt_api_key(row[2]) if row[2] else os.getenv("SILICONFLOW_API_KEY", "")
+
+    return {
+        "provider": row[0],
+        "model_id": row[1],
+        "api_key": api_key,
+        "endpoint": row[3],
+        "input_price": float(row[4]) if row[4] else CREDITS_PER_1K_INPUT,
+        "output_price": float(row[5]) if row[5] else CREDITS_PER_1K_OUTPUT,
+    }
+
+
+_registry: Optional[ModelConfigRegistry] = None
+
+
+def get_model_registry() -> ModelConfigRegistry:
+    """获取模型配置注册表（单例）"""
+    global _registry
+    if _registry is None:
+        _registry = ModelConfigRegistry()
+    return _registry
+
+
+def bump_model_config_version():
+    """
+    模型配置已变更：递增全局版本号并使本进程缓存立即失效
+
+    由 admin_ai 在创建/更新/删除模型后调用，其他进程在下次检查版本号时重新加载。
+    """
+    registry = get_model_registry()
+    registry.invalidate()
+    try:
+        registry._get_redis().incr(MODEL_CONFIG_VERSION_KEY)
+    except Exception as e:
+        logger.warning(f"[ModelRegistry] Failed to bump config version: {e}")
@@ -0,0 +1,194 @@
+"""
+ONNX Runtime Embedding 后端（CPU 优化）
+
+用于 CPU-only 主机或 GPU 繁忙时的 BGE-M3 推理：
+- 首次使用时通过 optimum 将 HuggingFace 模型导出为 ONNX
+- 使用 onnxruntime 动态 int8 量化（权重 int8，激活运行时量化）
+- 量化后的模型缓存在 HF_HOME/onnx 下，后续启动直接加载
+
+接口与 LlamaIndex HuggingFaceEmbedding 保持一致（get_text_embedding /
+get_query_embedding / get_text_embedding_batch），可在 get_embed_model() 中直接替换。
+
+依赖（仅 worker 镜像安装，见 Dockerfile SKIP_HEAVY）：
+- optimum[onnxruntime]
+- transformers
+
+注意：所有重型依赖延迟导入，避免 API 容器导入本模块时加载 onnxruntime。
+"""
+import logging
+import os
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+# ONNX Runtime 线程数（0 = 由 onnxruntime 按物理核数自动决定）
+ONNX_INTRA_OP_THREADS = int(os.getenv("EMBEDDING_ONNX_THREADS", "0"))
+# 是否使用 int8 动态量化（关闭时使用 FP32 ONNX 图，仍比 PyTorch eager 快）
+ONNX_QUANTIZE = os.getenv("EMBEDDING_ONNX_QUANTIZE", "true").lower() == "true"
+
+
+def is_onnx_available() -> bool:
+    """检查 ONNX 后端依赖是否已安装"""
+    try:
+        import onnxruntime  # noqa: F401
+        import optimum.onnxruntime  # noqa: F401
+        import transformers  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def _export_dir(cache_folder: str, model_name: str, quantized: bool) -> str:
+    """ONNX 模型缓存目录：{cache}/onnx/{model}-{int8|fp32}"""
+    safe_name = model_name.replace("/", "--")
+    suffix = "int8" if quantized else "fp32"
+    return os.path.join(cache_folder, "onnx", f"{safe_name}-{suffix}")
+
+
+def _ensure_onnx_model(model_name: str, cache_folder: str, quantize: bool) -> str:
+    """
+    确保 ONNX 模型已导出（并量化），返回 .onnx 文件路径
+
+    导出和量化只在第一次执行（BGE-M3 约 1-2 分钟），结果缓存到磁盘。
+    """
+    fp32_dir = _export_dir(cache_folder, model_name, quantized=False)
+    fp32_path = os.path.join(fp32_dir, "model.onnx")
+
+    if not os.path.exists(fp32_path):
+        from optimum.onnxruntime import ORTModelForFeatureExtraction
+        from transformers import AutoTokenizer
+
+        logger.info(f"[OnnxEmbedding] Exporting {model_name} to ONNX: {fp32_dir}")
+        model = ORTModelForFeatureExtraction.from_pretrained(
+            model_name, export=True, cache_dir=cache_folder
+        )
+        model.save_pretrained(fp32_dir)
+        AutoTokenizer.from_pretrained(model_name, cache_dir=cache_folder).save_pretrained(fp32_dir)
+
+    if not quantize:
+        return fp32_path
+
+    int8_dir = _export_dir(cache_folder, model_name, quantized=True)
+    int8_path = os.path.join(int8_dir, "model_quantized.onnx")
+
+    if not os.path.exists(int8_path):
+        from optimum.onnxruntime import ORTQuantizer
+        from optimum.onnxruntime.configuration import AutoQuantizationConfig
+        from transformers import AutoTokenizer
+
+        logger.info(f"[OnnxEmbedding] Applying dynamic int8 quantization: {int8_dir}")
+        quantizer = ORTQuantizer.from_pretrained(fp32_dir, file_name="model.onnx")
+        # 动态量化：无需校准数据集，avx2 配置兼容绝大多数 x86 服务器
+        qconfig = AutoQuantizationConfig.avx2(is_static=False, per_channel=False)
+        quantizer.quantize(
+            save_dir=int8_dir,
+            quantization_config=qconfig,
+            use_external_data_format=True,  # BGE-M3 FP32 图超过 2GB protobuf 限制
+        )
+        AutoTokenizer.from_pretrained(fp32_dir).save_pretrained(int8_dir)
+
+    return int8_path
+
+
+class OnnxEmbedding:
+    """
+    基于 ONNX Runtime 的 BGE-M3 dense embedding
+
+    与 BGE-M3 官方 sentence-transformers 配置一致：
+    - CLS pooling（取 last_hidden_state[:, 0]）
+    - L2 归一化
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        cache_folder: str,
+        embed_batch_size: int = 16,
+        max_length: int = 2048,
+        quantize: bool = ONNX_QUANTIZE,
+        intra_op_threads: int = ONNX_INTRA_OP_THREADS,
+    ):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        self.model_name = model_name
+        self.embed_batch_size = embed_batch_size
+        self.max_length = max_length
+        self.quantized = quantize
+
+        model_path = _ensure_onnx_model(model_name, cache_folder, quantize)
+
+        sess_options = ort.SessionOptions()
+        sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if intra_op_threads > 0:
+            sess_options.intra_op_num_threads = intra_op_threads
+
+        self._session = ort.InferenceSession(
+            model_path,
+            sess_options=sess_options,
+            providers=["CPUExecutionProvider"],
+        )
+        self._input_names = {i.name for i in self._session.get_inputs()}
+        self._tokenizer = AutoTokenizer.from_pretrained(os.path.dirname(model_path))
+
+        logger.info(
+            f"[OnnxEmbedding] Loaded {model_path} "
+            f"(quantized={quantize}, threads={intra_op_threads or 'auto'}, max_length={max_length})"
+        )
+
+    def _encode(self, texts: List[str]) -> List[List[float]]:
+        import numpy as np
+
+        encoded = self._tokenizer(
+            texts,
+            padding=True,
+            truncation=True,
+            max_length=self.max_length,
+            return_tensors="np",
+        )
+        feeds = {k: v.astype(np.int64) for k, v in encoded.items() if k in self._input_names}
+        last_hidden_state = self._session.run(None, feeds)[0]
+
+        cls = last_hidden_state[:, 0]
+        norms = np.linalg.norm(cls, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return (cls / norms).astype(np.float32).tolist()
+
+    def get_text_embedding(self, text: str) -> List[float]:
+        return self._encode([text])[0]
+
+    def get_query_embedding(self, query: str) -> List[float]:
+        # BGE-M3 不需要查询指令前缀，与文本编码一致
+        return self._encode([query])[0]
+
+    def get_text_embedding_batch(
+        self, texts: List[str], show_progress: bool = False, **kwargs
+    ) -> List[List[float]]:
+        embeddings: List[List[float]] = []
+        for start in range(0, len(texts), self.embed_batch_size):
+            embeddings.extend(self._encode(texts[start:start + self.embed_batch_size]))
+        return embeddings
+
+
+def create_onnx_embedding(
+    model_name: str,
+    cache_folder: str,
+    embed_batch_size: int,
+    max_length: int,
+) -> Optional[OnnxEmbedding]:
+    """
+    创建 ONNX Embedding 实例，依赖缺失或导出失败时返回 None（由调用方回退到 PyTorch）
+    """
+    if not is_onnx_available():
+        logger.warning("[OnnxEmbedding] onnxruntime/optimum not installed, ONNX backend unavailable")
+        return None
+    try:
+        return OnnxEmbedding(
+            model_name=model_name,
+            cache_folder=cache_folder,
+            embed_batch_size=embed_batch_size,
+            max_length=max_length,
+        )
+    except Exception as e:
+        logger.error(f"[OnnxEmbedding] Failed to initialize ONNX backend: {e}")
+        return None
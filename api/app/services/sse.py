@@ -0,0 +1,130 @@
+"""
+SSE 事件编码与增量合并
+
+【2026-10-19】新增：
+- 原先 send_message 对上游的每个 delta 单独编码并发送一个 SSE 事件，高并发时逐 token 的
+  JSON 编码与 ASGI send 开销占据了 API 的大部分 CPU
+- coalesce_deltas：在一个小的时间窗口（AI_SSE_COALESCE_MS）或字符上限（AI_SSE_COALESCE_MAX_CHARS）
+  内合并相邻 delta，首个 delta 立即发送，不影响首字延迟
+- 背压：客户端慢时（上一个事件的发送耗时超过窗口）窗口自动放大到 AI_SSE_COALESCE_MAX_MS，
+  事件更少更大；生成器按需拉取上游，不会在内存中无限堆积
+- 安装了 orjson 时用其编码/解码 JSON，否则回退到标准库
+"""
+import asyncio
+import json
+import os
+from typing import AsyncIterator
+
+from prometheus_client import Counter
+
+from .llm_provider import LLMStreamChunk
+
+SSE_COALESCE_MS = float(os.getenv("AI_SSE_COALESCE_MS", "30"))
+SSE_COALESCE_MAX_MS = float(os.getenv("AI_SSE_COALESCE_MAX_MS", "250"))
+SSE_COALESCE_MAX_CHARS = int(os.getenv("AI_SSE_COALESCE_MAX_CHARS", "256"))
+
+AI_SSE_DELTAS = Counter(
+    "ai_sse_deltas_total",
+    "Streamed deltas before and after coalescing",
+    ["stage"],  # upstream / emitted
+)
+
+try:
+    import orjson
+
+    def json_dumps(data) -> bytes:
+        return orjson.dumps(data)
+except ImportError:  # pragma: no cover - orjson 为可选依赖
+    def json_dumps(data) -> bytes:
+        return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def sse_event(event_type: str, data: dict) -> bytes:
+    """生成 SSE 事件"""
+    return b"data: " + json_dumps({"type": event_type, **data}) + b"\n\n"
+
+
+async def coalesce_deltas(
+    stream: AsyncIterator[LLMStreamChunk],
+    window_ms: float = SSE_COALESCE_MS,
+    max_window_ms: float = SSE_COALESCE_MAX_MS,
+    max_chars: int = SSE_COALESCE_MAX_CHARS,
+) -> AsyncIterator[LLMStreamChunk]:
+    """
+    合并相邻的内容 delta
+
+    非内容 chunk（usage / error / done / finish_reason）会先冲刷缓冲区再原样输出，顺序不变。
+    """
+    loop = asyncio.get_running_loop()
+    upstream = stream.__aiter__()
+    base_window = window_ms / 1000
+    window = base_window
+    buffer: list[str] = []
+    size = 0
+    deadline = 0.0
+    first = True
+    pending = None
+
+    def flush() -> LLMStreamChunk:
+        nonlocal buffer, size
+        chunk = LLMStreamChunk(type="delta", content="".join(buffer))
+        buffer, size = [], 0
+        return chunk
+
+    def adapt(send_seconds: float) -> float:
+        # 按消费方（ASGI send）耗时调整窗口：客户端慢时放大，恢复后回落
+        return min(max_window_ms / 1000, max(base_window, send_seconds * 2))
+
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(upstream.__anext__())
+            timeout = max(0.0, deadline - loop.time()) if buffer else None
+            done, _ = await asyncio.wait({pending}, timeout=timeout)
+
+            if done:
+                task, pending = pending, None
+                try:
+                    chunk = task.result()
+                except StopAsyncIteration:
+                    break
+            else:
+                chunk = None  # 窗口到期，上游仍未返回
+
+            if chunk is not None and chunk.type == "delta" and chunk.content and not chunk.finish_reason:
+                AI_SSE_DELTAS.labels(stage="upstream").inc()
+                if not first:
+                    if not buffer:
+                        deadline = loop.time() + window
+                    buffer.append(chunk.content)
+                    size += len(chunk.content)
+                    if size < max_chars:
+                        continue
+                    chunk = flush()
+                # 首个 delta 立即发送，不增加首字延迟
+                first = False
+            elif buffer:
+                # 窗口到期或遇到非内容 chunk：先冲刷缓冲区
+                started = loop.time()
+                AI_SSE_DELTAS.labels(stage="emitted").inc()
+                yield flush()
+                window = adapt(loop.time() - started)
+                if chunk is None:
+                    continue
+            elif chunk is None:
+                continue
+
+            if chunk.type == "delta" and chunk.content:
+                AI_SSE_DELTAS.labels(stage="emitted").inc()
+            started = loop.time()
+            yield chunk
+            window = adapt(loop.time() - started)
+
+        if buffer:
+            AI_SSE_DELTAS.labels(stage="emitted").inc()
+            yield flush()
+    finally:
+        if pending is not None:
+            pending.cancel()
+        elif hasattr(upstream, "aclose"):
+            await upstream.aclose()
@@ -0,0 +1,169 @@
+"""
+书籍处理任务的 in-flight 去重（singleflight）
+
+【2026-10-19】新增：
+- upload_complete、trigger_book_ocr、补处理脚本、重建索引都可能为同一份文件（content_sha256）
+  投递 OCR / 类型分析 / 向量索引任务，多个 worker 会对同一内容重复做 GPU 计算
+- 任务开始时按 (任务类型, content_sha256, 版本) 申领：
+  - leader：没有进行中的同类任务，正常执行
+  - attached：已有进行中的任务，把本书记为等待者后直接返回，不做计算
+  - done：刚完成（SINGLEFLIGHT_DONE_TTL 秒内），直接拿到结果应用到本书
+- leader 完成（或失败）时取出所有等待者，由任务把结果扇出到每一本书
+- 申领、登记等待者、完成与取出等待者都在 Lua 脚本内原子完成，不会漏掉完成瞬间加入的等待者
+- leader 崩溃时租约按 TTL 过期，之后的新请求重新成为 leader
+- Redis 不可用时按 leader 处理（不去重）
+"""
+import json
+import logging
+import os
+import uuid
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+from prometheus_client import Counter
+
+logger = logging.getLogger(__name__)
+
+SINGLEFLIGHT_ENABLED = os.getenv("TASK_SINGLEFLIGHT_ENABLED", "true").lower() == "true"
+SINGLEFLIGHT_DONE_TTL = int(os.getenv("SINGLEFLIGHT_DONE_TTL", "600"))
+
+TASK_SINGLEFLIGHT_TOTAL = Counter(
+    "task_singleflight_total",
+    "Book processing task claims by role",
+    ["task_type", "role"],  # leader / attached / done / bypassed
+)
+
+# KEYS: 租约, 等待者集合, 完成结果
+# ARGV: 成员, leader token, 租约 TTL（秒）
+_CLAIM_SCRIPT = """
+local done = redis.call('GET', KEYS[3])
+if done then
+  return {'done', done}
+end
+if redis.call('SET', KEYS[1], ARGV[2], 'NX', 'EX', ARGV[3]) then
+  return {'leader', ''}
+end
+redis.call('SADD', KEYS[2], ARGV[1])
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+return {'attached', ''}
+"""
+
+# KEYS: 租约, 等待者集合, 完成结果
+# ARGV: leader token, 结果 JSON（空字符串表示失败）, 结果保留秒数
+_FINISH_SCRIPT = """
+local members = redis.call('SMEMBERS', KEYS[2])
+redis.call('DEL', KEYS[2])
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+  redis.call('DEL', KEYS[1])
+end
+if ARGV[2] ~= '' then
+  redis.call('SET', KEYS[3], ARGV[2], 'EX', ARGV[3])
+end
+return members
+"""
+
+
+@dataclass
+class Flight:
+    """一次申领的结果"""
+    role: str  # leader / attached / done / bypassed
+    task_type: str
+    keys: List[str] = field(default_factory=list)
+    token: str = ""
+    result: Optional[dict] = None
+
+    @property
+    def is_leader(self) -> bool:
+        return self.role in ("leader", "bypassed")
+
+
+class TaskSingleflight:
+    """任务级 singleflight（worker 进程单例）"""
+
+    def __init__(self):
+        self._redis = None
+        self._claim = None
+        self._finish = None
+
+    def _scripts(self):
+        if self._claim is None:
+            import redis
+            url = os.getenv("REDIS_URL")
+            if url and "://" in url:
+                self._redis = redis.Redis.from_url(url, decode_responses=True)
+            else:
+                self._redis = redis.Redis(
+                    host=os.getenv("REDIS_HOST", "redis"),
+                    port=int(os.getenv("REDIS_PORT", "6379")),
+                    decode_responses=True,
+                )
+            self._claim = self._redis.register_script(_CLAIM_SCRIPT)
+            self._finish = self._redis.register_script(_FINISH_SCRIPT)
+        return self._claim, self._finish
+
+    @staticmethod
+    def _keys(task_type: str, content_sha256: str, version: str) -> List[str]:
+        base = f"task:sf:{task_type}:{content_sha256}:{version}"
+        return [f"{base}:lease", f"{base}:waiters", f"{base}:done"]
+
+    def claim(self, task_type: str, content_sha256: Optional[str], version: str, member: str, ttl: int) -> Flight:
+        """
+        申领任务
+
+        Args:
+            member: 等待者标识（由任务自行编码，如 "book_id:user_id"）
+            ttl: 租约有效期（应大于任务的最长执行时间）
+        """
+        if not SINGLEFLIGHT_ENABLED or not content_sha256:
+            return Flight(role="bypassed", task_type=task_type)
+
+        keys = self._keys(task_type, content_sha256, version)
+        token = uuid.uuid4().hex
+        try:
+            claim, _ = self._scripts()
+            role, payload = claim(keys=keys, args=[member, token, ttl])
+        except Exception as e:
+            logger.warning(f"[Singleflight] Redis unavailable, running {task_type} without dedup: {e}")
+            TASK_SINGLEFLIGHT_TOTAL.labels(task_type=task_type, role="bypassed").inc()
+            return Flight(role="bypassed", task_type=task_type)
+
+        TASK_SINGLEFLIGHT_TOTAL.labels(task_type=task_type, role=role).inc()
+        if role != "leader":
+            logger.info(f"[Singleflight] {task_type} {content_sha256[:16]}... {role} ({member})")
+        return Flight(
+            role=role,
+            task_type=task_type,
+            keys=keys,
+            token=token,
+            result=json.loads(payload) if role == "done" else None,
+        )
+
+    def _close(self, flight: Flight, result: Optional[dict]) -> List[str]:
+        if flight.role != "leader":
+            return []
+        try:
+            _, finish = self._scripts()
+            payload = json.dumps(result) if result is not None else ""
+            return list(finish(keys=flight.keys, args=[flight.token, payload, SINGLEFLIGHT_DONE_TTL]))
+        except Exception as e:
+            logger.warning(f"[Singleflight] Failed to release {flight.task_type} lease: {e}")
+            return []
+
+    def complete(self, flight: Flight, result: dict) -> List[str]:
+        """leader 成功：保存结果并返回需要扇出的等待者"""
+        return self._close(flight, result)
+
+    def fail(self, flight: Flight) -> List[str]:
+        """leader 失败：释放租约并返回等待者（由任务决定标记失败或重新投递）"""
+        return self._close(flight, None)
+
+
+_singleflight: Optional[TaskSingleflight] = None
+
+
+def get_task_singleflight() -> TaskSingleflight:
+    """获取 singleflight（单例）"""
+    global _singleflight
+    if _singleflight is None:
+        _singleflight = TaskSingleflight()
+    return _singleflight
@@ -0,0 +1,93 @@
+"""
+消息 Token 计数
+
+【2026-10-19】新增：
+- 消息保存时用对话模型的分词器计算一次 token 数，写入 ai_messages.token_count
+- 分词器按模型 ID 从 HuggingFace 加载（tokenizers 包，HF_HOME 缓存），
+  可用 AI_TOKENIZER_REPO 指定；加载失败时依次回退到 tiktoken cl100k_base、按字符类别估算
+- 字符估算区分 CJK（约 1 字 1 token）与其他文本（约 4 字符 1 token），
+  避免中英混排时偏差过大
+"""
+import logging
+import os
+import re
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+TOKENIZER_REPO = os.getenv("AI_TOKENIZER_REPO", "")
+
+_CJK_PATTERN = re.compile("[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af]")
+
+# repo -> Tokenizer（None 表示加载失败，不再重试）
+_tokenizers: dict = {}
+_tiktoken_encoding = None
+
+
+def _tokenizer_repo(model_id: Optional[str]) -> Optional[str]:
+    """模型 ID → HuggingFace 仓库名（去掉 SiliconFlow 的 Pro/ 等前缀）"""
+    if TOKENIZER_REPO:
+        return TOKENIZER_REPO
+    if not model_id:
+        return None
+    parts = model_id.split("/")
+    return "/".join(parts[-2:]) if len(parts) >= 2 else None
+
+
+def _get_tokenizer(model_id: Optional[str]):
+    repo = _tokenizer_repo(model_id)
+    if not repo:
+        return None
+    if repo not in _tokenizers:
+        try:
+            from tokenizers import Tokenizer
+
+            _tokenizers[repo] = Tokenizer.from_pretrained(repo)
+            logger.info(f"[TokenCounter] Loaded tokenizer {repo}")
+        except Exception as e:
+            logger.warning(f"[TokenCounter] Tokenizer {repo} unavailable: {e}")
+            _tokenizers[repo] = None
+    return _tokenizers[repo]
+
+
+def _get_tiktoken():
+    global _tiktoken_encoding
+    if _tiktoken_encoding is None:
+        try:
+            import tiktoken
+
+            _tiktoken_encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception:
+            _tiktoken_encoding = False
+    return _tiktoken_encoding or None
+
+
+def estimate_tokens_by_chars(text: str) -> int:
+    """按字符类别估算 token 数"""
+    cjk = len(_CJK_PATTERN.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def count_tokens(text: str, model_id: Optional[str] = None) -> int:
+    """
+    计算文本的 token 数
+
+    Args:
+        text: 文本
+        model_id: 对话模型 ID（用于选择分词器）
+    """
+    if not text:
+        return 0
+
+    tokenizer = _get_tokenizer(model_id)
+    if tokenizer is not None:
+        try:
+            return len(tokenizer.encode(text, add_special_tokens=False).ids)
+        except Exception as e:
+            logger.warning(f"[TokenCounter] Tokenizer encode failed: {e}")
+
+    encoding = _get_tiktoken()
+    if encoding is not None:
+        return len(encoding.encode(text))
+
+    return estimate_tokens_by_chars(text)
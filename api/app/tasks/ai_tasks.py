@@ -0,0 +1,34 @@
+"""
+AI 对话后置写入任务
+
+【2026-10-19】新增：
+- SSE 流结束后由 API 投递，在 worker 中写入对话标题与 Credits 扣费
+  （助手消息由 API 同步写入，同步写入失败时由本任务补写）
+- 写入逻辑见 services/ai_write_behind.persist_ai_reply（幂等，可安全重试）
+
+队列：cpu_default
+"""
+
+import asyncio
+import logging
+
+from celery import shared_task
+
+logger = logging.getLogger(__name__)
+
+
+@shared_task(
+    name="tasks.persist_ai_reply",
+    bind=True,
+    max_retries=5,
+    default_retry_delay=5,
+)
+def persist_ai_reply(self, payload: dict) -> bool:
+    """写入一条 AI 回复及其附带的标题/计费更新"""
+    from ..services.ai_write_behind import persist_ai_reply as _persist
+
+    try:
+        return asyncio.get_event_loop().run_until_complete(_persist(payload))
+    except Exception as e:
+        logger.warning(f"[AITask] Persist reply {payload.get('message_id', '')[:8]} failed: {e}, retrying")
+        raise self.retry(exc=e)
@@ -24,151 +24,226 @@ from .common import _quick_confidence
 from .ocr_tasks import _pdf_to_images
 
 
+# 【2026-10-19】同一 content_sha256 的深度分析去重（分析包含整本 OCR）
+ANALYSIS_TASK_VERSION = "paddleocr:dpi150"
+ANALYSIS_SINGLEFLIGHT_TTL = int(os.getenv("ANALYSIS_SINGLEFLIGHT_TTL", "7200"))
+
+
+async def _publish_analysis(book_id: str, user_id: str, report_data: dict, search_regions: list) -> str:
+    """
+    把深度分析报告应用到一本书：建立搜索索引、上传报告、更新数据库、WebSocket 通知、审计日志
+    
+    【2026-10-19】从 deep_analyze_book 中拆出，执行者对自己和所有等待的同内容书籍逐一调用。
+    
+    Returns:
+        报告的存储 key
+    """
+    img, conf = report_data["is_image_based"], report_data["confidence"]
+    digitalized = (not img and conf >= 0.8)
+    
+    # 触发搜索索引
+    if search_regions:
+        try:
+            from ..search_sync import index_book_content
+            index_book_content(book_id, user_id, search_regions)
+            print(f"[OCR] Triggered search indexing for book {book_id}")
+        except Exception as e:
+            print(f"[OCR] Warning: Failed to index book content: {e}")
+    
+    rep_key = make_object_key(user_id, f"digitalize-report-{book_id}.json")
+    upload_bytes(
+        BUCKET,
+        rep_key,
+        json.dumps(report_data).encode("utf-8"),
+        "application/json",
+    )
+    
+    async with engine.begin() as conn:
+        await conn.execute(
+            text("SELECT set_config('app.user_id', :v, true)"), {"v": user_id}
+        )
+        await conn.execute(
+            text(
+                "UPDATE books SET is_digitalized = :dig, digitalize_report_key = :rk, updated_at = now() WHERE id = cast(:id as uuid)"
+            ),
+            {"dig": digitalized, "rk": rep_key, "id": book_id},
+        )
+    
+    # WebSocket 通知
+    try:
+        asyncio.create_task(
+            ws_broadcast(
+                f"book:{book_id}",
+                json.dumps(
+                    {
+                        "event": "DEEP_ANALYZED",
+                        "digitalized": digitalized,
+                        "confidence": conf,
+                    }
+                ),
+            )
+        )
+    except Exception:
+        pass
+    
+    # 审计日志
+    try:
+        async with engine.begin() as conn2:
+            await conn2.execute(
+                text(
+                    "INSERT INTO audit_logs(id, owner_id, action, details) VALUES (gen_random_uuid(), cast(:uid as uuid), :act, cast(:det as jsonb))"
+                ),
+                {
+                    "uid": user_id,
+                    "act": "task_deep_analyze_book",
+                    "det": json.dumps(
+                        {
+                            "book_id": book_id,
+                            "digitalized": digitalized,
+                            "confidence": conf,
+                        }
+                    ),
+                },
+            )
+    except Exception:
+        pass
+    
+    return rep_key
+
+
 @shared_task(name="tasks.deep_analyze_book")
 def deep_analyze_book(book_id: str, user_id: str):
     """
     对书籍进行深度分析：类型检测 + OCR
     
     用于手动触发的完整分析，生成详细报告
+    
+    【2026-10-19】按 content_sha256 去重（见 services/task_singleflight）：
+    同一文件已有进行中的分析时只登记等待，执行者完成后把报告扇出到每一本等待的书。
     """
+    from ..services.task_singleflight import get_task_singleflight
+    
+    singleflight = get_task_singleflight()
+    
     async def _run():
         async with engine.begin() as conn:
             await conn.execute(
                 text("SELECT set_config('app.user_id', :v, true)"), {"v": user_id}
             )
             res = await conn.execute(
-                text("SELECT minio_key FROM books WHERE id = cast(:id as uuid)"),
+                text("SELECT minio_key, content_sha256 FROM books WHERE id = cast(:id as uuid)"),
                 {"id": book_id},
             )
             row = res.fetchone()
-            if not row:
+        if not row:
+            return
+        key, content_sha256 = row
+        
+        flight = singleflight.claim(
+            "analysis", content_sha256, ANALYSIS_TASK_VERSION, f"{book_id}:{user_id}", ANALYSIS_SINGLEFLIGHT_TTL
+        )
+        if flight.role == "attached":
+            print(f"[Analyze] Same content is already being analyzed, waiting for its result: {book_id}")
+            return
+        if flight.role == "done":
+            report_bytes = read_full(BUCKET, flight.result["report_key"])
+            if report_bytes:
+                report_data = json.loads(report_bytes)
+                regions = report_data["ocr"].get("regions", []) if key.lower().endswith('.pdf') else []
+                await _publish_analysis(book_id, user_id, report_data, regions)
                 return
-            key = row[0]
-            img, conf = _quick_confidence(key)
-            
-            ocr = get_ocr()
-            ocr_res = {"regions": [], "text": ""}
-            
-            # 判断文件类型
-            is_pdf = key.lower().endswith('.pdf')
-            
-            # 图片尺寸变量
-            ocr_image_width = 0
-            ocr_image_height = 0
-            
-            if is_pdf:
-                # PDF 文件：先转换为图片再 OCR（处理所有页面）
-                print(f"[OCR] Processing PDF: {key}")
-                pdf_data = read_full(BUCKET, key)
-                if pdf_data:
-                    page_images, ocr_image_width, ocr_image_height = _pdf_to_images(pdf_data, max_pages=0, dpi=150)
-                    all_text = []
-                    all_regions = []
-                    total_pages = page_images[0][2] if page_images else 0
-                    
-                    for page_num, img_bytes, _ in page_images:
-                        fd, temp_path = tempfile.mkstemp(suffix='.png')
-                        try:
-                            os.write(fd, img_bytes)
-                            os.close(fd)
-                            
-                            page_result = ocr.recognize("", temp_path)
-                            if page_result.get("text"):
-                                all_text.append(f"--- Page {page_num} ---")
-                                all_text.append(page_result["text"])
-                                for r in page_result.get("regions", []):
-                                    r["page"] = page_num
-                                    all_regions.append(r)
-                            print(f"[OCR] Page {page_num}/{total_pages}: {len(page_result.get('text', ''))} chars, {len(page_result.get('regions', []))} regions")
-                        except Exception as e:
-                            print(f"[OCR] Page {page_num}/{total_pages} failed: {e}")
-                        finally:
-                            try:
-                                os.remove(temp_path)
-                            except Exception:
-                                pass
-                    
-                    print(f"[OCR] Completed: {len(all_regions)} text regions, {len(''.join(all_text))} total chars")
-                    ocr_res = {"regions": all_regions, "text": "\n".join(all_text)}
-                    
-                    # 触发搜索索引
-                    try:
-                        from ..search_sync import index_book_content
-                        index_book_content(book_id, user_id, all_regions)
-                        print(f"[OCR] Triggered search indexing for book {book_id}")
-                    except Exception as e:
-                        print(f"[OCR] Warning: Failed to index book content: {e}")
-            else:
-                # 图片文件：直接 OCR
-                ocr_res = ocr.recognize(BUCKET, key)
-            
-            # 生成报告
-            rep_key = make_object_key(user_id, f"digitalize-report-{book_id}.json")
-            report_data = {
-                "is_image_based": img, 
-                "confidence": conf, 
-                "ocr": ocr_res,
-            }
-            if ocr_image_width > 0 and ocr_image_height > 0:
-                report_data["image_width"] = ocr_image_width
-                report_data["image_height"] = ocr_image_height
-            
-            upload_bytes(
-                BUCKET,
-                rep_key,
-                json.dumps(report_data).encode("utf-8"),
-                "application/json",
-            )
-            
-            await conn.execute(
-                text(
-                    "UPDATE books SET is_digitalized = :dig, digitalize_report_key = :rk, updated_at = now() WHERE id = cast(:id as uuid)"
-                ),
-                {"dig": (not img and conf >= 0.8), "rk": rep_key, "id": book_id},
-            )
         
-        # WebSocket 通知
         try:
-            asyncio.create_task(
-                ws_broadcast(
-                    f"book:{book_id}",
-                    json.dumps(
-                        {
-                            "event": "DEEP_ANALYZED",
-                            "digitalized": (not img and conf >= 0.8),
-                            "confidence": conf,
-                        }
-                    ),
-                )
-            )
-        except Exception:
-            pass
+            report_data, search_regions = _analyze(key)
+            rep_key = await _publish_analysis(book_id, user_id, report_data, search_regions)
+        except BaseException:
+            # 失败可能是暂时性的（下载 / 存储错误）：等待的书重新投递，各自重新申领
+            for member in singleflight.fail(flight):
+                waiter_book_id, _, waiter_user_id = member.partition(":")
+                try:
+                    deep_analyze_book.delay(waiter_book_id, waiter_user_id)
+                except Exception as e:
+                    print(f"[Analyze] Failed to resubmit waiting book {waiter_book_id}: {e}")
+            raise
         
-        # 审计日志
-        try:
-            async with engine.begin() as conn2:
-                await conn2.execute(
-                    text(
-                        "INSERT INTO audit_logs(id, owner_id, action, details) VALUES (gen_random_uuid(), cast(:uid as uuid), :act, cast(:det as jsonb))"
-                    ),
-                    {
-                        "uid": user_id,
-                        "act": "task_deep_analyze_book",
-                        "det": json.dumps(
-                            {
-                                "book_id": book_id,
-                                "digitalized": (not img and conf >= 0.8),
-                                "confidence": conf,
-                            }
-                        ),
-                    },
-                )
-        except Exception:
-            pass
+        for member in singleflight.complete(flight, {"report_key": rep_key}):
+            waiter_book_id, _, waiter_user_id = member.partition(":")
+            try:
+                await _publish_analysis(waiter_book_id, waiter_user_id, report_data, search_regions)
+            except Exception as e:
+                print(f"[Analyze] Failed to share analysis with {waiter_book_id}: {e}")
 
     asyncio.get_event_loop().run_until_complete(_run())
 
 
+def _analyze(key: str) -> tuple:
+    """
+    类型检测 + OCR，返回 (报告, 搜索索引区域)
+    """
+    img, conf = _quick_confidence(key)
+    
+    ocr = get_ocr()
+    ocr_res = {"regions": [], "text": ""}
+    search_regions = []
+    
+    # 判断文件类型
+    is_pdf = key.lower().endswith('.pdf')
+    
+    # 图片尺寸变量
+    ocr_image_width = 0
+    ocr_image_height = 0
+    
+    if is_pdf:
+        # PDF 文件：先转换为图片再 OCR（处理所有页面）
+        print(f"[OCR] Processing PDF: {key}")
+        pdf_data = read_full(BUCKET, key)
+        if pdf_data:
+            page_images, ocr_image_width, ocr_image_height = _pdf_to_images(pdf_data, max_pages=0, dpi=150)
+            all_text = []
+            all_regions = []
+            total_pages = page_images[0][2] if page_images else 0
+            
+            for page_num, img_bytes, _ in page_images:
+                fd, temp_path = tempfile.mkstemp(suffix='.png')
+                try:
+                    os.write(fd, img_bytes)
+                    os.close(fd)
+                    
+                    page_result = ocr.recognize("", temp_path)
+                    if page_result.get("text"):
+                        all_text.append(f"--- Page {page_num} ---")
+                        all_text.append(page_result["text"])
+                        for r in page_result.get("regions", []):
+                            r["page"] = page_num
+                            all_regions.append(r)
+                    print(f"[OCR] Page {page_num}/{total_pages}: {len(page_result.get('text', ''))} chars, {len(page_result.get('regions', []))} regions")
+                except Exception as e:
+                    print(f"[OCR] Page {page_num}/{total_pages} failed: {e}")
+                finally:
+                    try:
+                        os.remove(temp_path)
+                    except Exception:
+                        pass
+            
+            print(f"[OCR] Completed: {len(all_regions)} text regions, {len(''.join(all_text))} total chars")
+            ocr_res = {"regions": all_regions, "text": "\n".join(all_text)}
+            search_regions = all_regions
+    else:
+        # 图片文件：直接 OCR
+        ocr_res = ocr.recognize(BUCKET, key)
+    
+    # 生成报告
+    report_data = {
+        "is_image_based": img, 
+        "confidence": conf, 
+        "ocr": ocr_res,
+    }
+    if ocr_image_width > 0 and ocr_image_height > 0:
+        report_data["image_width"] = ocr_image_width
+        report_data["image_height"] = ocr_image_height
+    return report_data, search_regions
+
+
 @shared_task(name="tasks.generate_srs_card")
 def generate_srs_card(highlight_id: str):
     """
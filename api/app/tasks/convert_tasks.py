@@ -236,7 +236,8 @@ def convert_to_epub(book_id: str, user_id: str):
             # 【App-First】触发向量索引
             try:
                 print(f"[Convert] Triggering vector index for converted book: {book_id}")
-                celery_app.send_task("tasks.index_book_vectors", args=[book_id])
+                from ..services.fair_queue import submit_task
+                submit_task("tasks.index_book_vectors", [book_id], user_id)
             except Exception as e:
                 print(f"[Convert] Failed to trigger vector index: {e}")
             
@@ -18,6 +18,7 @@ from ..storage import (
     BUCKET,
 )
 from ..realtime import ws_broadcast
+from ..services.book_context import invalidate_book_context_cache
 from .common import (
     _optimize_cover_image,
     _extract_epub_cover,
@@ -253,6 +254,8 @@ def extract_book_cover_and_metadata(book_id: str, user_id: str):
                 update_sql = f"UPDATE books SET {', '.join(updates)} WHERE id = cast(:id as uuid)"
                 await conn.execute(text(update_sql), params)
                 print(f"[CoverMeta] Updated book: {book_id}")
+                # 【2026-10-19】书名/作者可能已更新，清除 AI 对话的书籍上下文缓存
+                invalidate_book_context_cache(user_id)
             
             # 广播更新事件
             try:
@@ -0,0 +1,20 @@
+"""
+GPU 公平调度转发任务
+
+【2026-10-19】新增：beat 定期把各用户子队列中的任务转发到 GPU 队列（见 services/fair_queue），
+兜底提交时与 GPU 任务结束时未能触发的转发（如 worker 崩溃）
+"""
+
+import logging
+
+from celery import shared_task
+
+logger = logging.getLogger(__name__)
+
+
+@shared_task(name="tasks.pump_fair_queues")
+def pump_fair_queues() -> dict:
+    """转发所有 GPU 队列的公平调度子队列"""
+    from app.services.fair_queue import pump_all
+
+    return pump_all()
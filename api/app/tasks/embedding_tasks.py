@@ -7,10 +7,13 @@ Embedding 向量化 Celery 任务
 - 保证索引和查询使用完全相同的模型和硬件
 
 队列：gpu_low（与书籍索引任务同优先级）
+【2026-10-19】get_text_embedding 改走 gpu_interactive（worker-gpu-interactive 独立进程），
+书籍索引 / OCR 运行期间仍能按 interactive 优先级争用 GPU 锁，由长任务在安全点让出
 
 任务类型：
 - get_text_embedding: 单文本向量化（用户提问、笔记等）
 - get_batch_embeddings: 批量文本向量化（未来优化）
+- flush_user_note_vectors: 笔记向量批量索引（【2026-10-19】）
 """
 
 import logging
@@ -48,7 +51,7 @@ def get_text_embedding(self, text: str, max_length: int = 8000) -> Optional[List
     
     try:
         # 延迟导入，避免在API容器中加载模型
-        from app.services.llama_rag import get_embed_model
+        from app.services.llama_rag import get_embed_model, gpu_section
         
         # 获取模型（单例，会被缓存）
         embed_model = get_embed_model()
@@ -56,8 +59,9 @@ def get_text_embedding(self, text: str, max_length: int = 8000) -> Optional[List
         # 截断文本
         truncated_text = text[:max_length]
         
-        # 执行向量化
-        embedding = embed_model.get_text_embedding(truncated_text)
+        # 执行向量化（【2026-10-19】用户提问等实时请求，以最高优先级获取 GPU）
+        with gpu_section("interactive", "text_embedding"):
+            embedding = embed_model.get_text_embedding(truncated_text)
         
         logger.info(f"[EmbeddingTask] Generated embedding: {len(embedding)} dims for text ({len(truncated_text)} chars)")
         return embedding
@@ -90,7 +94,7 @@ def get_batch_embeddings(self, texts: List[str], max_length: int = 8000) -> Opti
         return []
     
     try:
-        from app.services.llama_rag import get_embed_model
+        from app.services.llama_rag import get_embed_model, gpu_section
         
         embed_model = get_embed_model()
         
@@ -98,7 +102,8 @@ def get_batch_embeddings(self, texts: List[str], max_length: int = 8000) -> Opti
         truncated_texts = [t[:max_length] for t in texts]
         
         # 批量向量化
-        embeddings = embed_model.get_text_embedding_batch(truncated_texts)
+        with gpu_section("normal", "batch_embeddings"):
+            embeddings = embed_model.get_text_embedding_batch(truncated_texts)
         
         logger.info(f"[EmbeddingTask] Generated {len(embeddings)} batch embeddings")
         return embeddings
@@ -146,68 +151,52 @@ def index_user_note_vectors(
         是否成功
     """
     import asyncio
+    from app.services.llama_rag import bulk_index_user_notes
     
-    async def _index():
-        from app.services.llama_rag import (
-            ensure_user_notes_index,
-            get_embed_model,
-            quantize_vector_to_byte,  # 【2026-01-15】添加向量量化
-            USER_NOTES_INDEX,
-            OPENSEARCH_URL,
-        )
-        from opensearchpy import AsyncOpenSearch
-        import time
-        
-        if not content or not content.strip():
-            logger.warning(f"[EmbeddingTask] Empty content for note {note_id[:8]}...")
-            return False
-        
-        logger.info(f"[EmbeddingTask] Indexing user note: {note_id[:8]}... for user {user_id[:8]}...")
-        
-        try:
-            # 确保索引存在
-            await ensure_user_notes_index()
-            
-            # 使用本地模型生成向量
-            embed_model = get_embed_model()
-            truncated_content = content[:2000]  # 笔记通常较短
-            embedding = embed_model.get_text_embedding(truncated_content)
-            
-            # 【2026-01-15】向量量化：float32 → int8（Lucene byte 格式）
-            byte_embedding = quantize_vector_to_byte(embedding)
-            
-            # 存储到OpenSearch
-            client = AsyncOpenSearch(hosts=[OPENSEARCH_URL])
-            try:
-                doc = {
-                    "embedding": byte_embedding,  # 使用量化后的 int8 向量
-                    "text": content,
-                    "metadata": {
-                        "note_id": note_id,
-                        "user_id": user_id,
-                        "book_id": book_id,
-                        "book_title": book_title or "",
-                        "chapter": chapter or "",
-                        "page": page,
-                        "note_type": note_type,
-                        "created_at": int(time.time() * 1000)
-                    }
-                }
-                
-                await client.index(
-                    index=USER_NOTES_INDEX,
-                    id=note_id,
-                    body=doc,
-                    refresh=True
-                )
-                logger.info(f"[EmbeddingTask] Successfully indexed user note: {note_id[:8]}... (byte quantized)")
-                return True
-            finally:
-                await client.close()
-                
-        except Exception as e:
-            logger.error(f"[EmbeddingTask] Failed to index user note: {e}")
-            return False
-    
-    # 运行异步函数
-    return asyncio.run(_index())
+    if not content or not content.strip():
+        logger.warning(f"[EmbeddingTask] Empty content for note {note_id[:8]}...")
+        return False
+    
+    logger.info(f"[EmbeddingTask] Indexing user note: {note_id[:8]}... for user {user_id[:8]}...")
+    
+    # 【2026-10-19】复用批量索引路径（单条批次），不再强制刷新索引
+    try:
+        return asyncio.run(bulk_index_user_notes([{
+            "note_id": note_id,
+            "user_id": user_id,
+            "book_id": book_id,
+            "content": content,
+            "book_title": book_title,
+            "chapter": chapter,
+            "page": page,
+            "note_type": note_type,
+        }])) > 0
+    except Exception as e:
+        logger.error(f"[EmbeddingTask] Failed to index user note: {e}")
+        return False
+
+
+@shared_task(
+    name="tasks.flush_user_note_vectors",
+    bind=True,
+    max_retries=3,
+    default_retry_delay=10,
+)
+def flush_user_note_vectors(self) -> int:
+    """
+    批量索引待处理的用户笔记（在GPU Worker中执行）
+    
+    【2026-10-19】新增：由 queue_user_note_vector 调度，同一时间窗口内的笔记
+    合并为一次批量向量化 + 一次 _bulk 写入
+    
+    Returns:
+        成功写入的笔记数
+    """
+    import asyncio
+    from app.services.llama_rag import drain_user_note_vectors
+    
+    try:
+        return asyncio.run(drain_user_note_vectors())
+    except Exception as e:
+        logger.error(f"[EmbeddingTask] Note vector flush failed: {e}")
+        raise self.retry(exc=e)
@@ -17,7 +17,14 @@ from celery import shared_task
 from sqlalchemy import text
 from sqlalchemy.ext.asyncio import create_async_engine
 
-from app.services.llama_rag import index_book_chunks, delete_book_index
+from app.services.llama_rag import (
+    EMBEDDING_MODEL,
+    OPENSEARCH_URL,
+    delete_book_index,
+    index_book_chunks,
+    resolve_book_chunk_indices,
+)
+from app.services.task_singleflight import get_task_singleflight
 from app.storage import get_storage_client, read_full, BUCKET
 
 logger = logging.getLogger(__name__)
@@ -28,6 +35,10 @@ DATABASE_URL = os.getenv(
 )
 
 
+# 【2026-10-19】同一 content_sha256 的向量任务去重：租约有效期（秒）
+VECTOR_SINGLEFLIGHT_TTL = int(os.getenv("VECTOR_SINGLEFLIGHT_TTL", "7200"))
+
+
 def _create_task_engine():
     """
     为 Celery 任务创建独立的数据库引擎
@@ -504,8 +515,63 @@ def extract_pdf_text(pdf_bytes: bytes) -> str:
 # ============================================================================
 
 
+async def _vector_task_version() -> str:
+    """向量任务版本：Embedding 模型 + 当前写入的物理索引（全量重建开始后版本随之变化）"""
+    from opensearchpy import AsyncOpenSearch
+    
+    client = AsyncOpenSearch(hosts=[OPENSEARCH_URL])
+    try:
+        _, write_targets = await resolve_book_chunk_indices(client)
+        return f"{EMBEDDING_MODEL}:{','.join(write_targets)}"
+    except Exception as e:
+        logger.warning(f"[IndexBook] Failed to resolve write index for singleflight version: {e}")
+        return EMBEDDING_MODEL
+    finally:
+        await client.close()
+
+
+async def _mark_vector_indexed(conn, book_ids: list) -> None:
+    await conn.execute(
+        text("""
+            UPDATE books 
+            SET vector_indexed_at = NOW()
+            WHERE id = ANY(cast(:ids as uuid[]))
+        """),
+        {"ids": [str(b) for b in book_ids]},
+    )
+
+
+async def _resubmit_vector_waiters(task_engine, waiters: list) -> None:
+    """leader 失败：重新投递等待的书（各自重新申领，下一本成为 leader）"""
+    if not waiters:
+        return
+    from app.services.fair_queue import submit_task
+    
+    try:
+        async with task_engine.begin() as conn:
+            result = await conn.execute(
+                text("""
+                    SELECT id::text, user_id::text
+                    FROM books
+                    WHERE id = ANY(cast(:ids as uuid[])) AND deleted_at IS NULL
+                """),
+                {"ids": [str(b) for b in waiters]},
+            )
+            rows = result.fetchall()
+        for waiter_book_id, waiter_user_id in rows:
+            submit_task("tasks.index_book_vectors", [waiter_book_id], waiter_user_id)
+        logger.info(f"[IndexBook] Leader failed, resubmitted {len(rows)} waiting books")
+    except Exception as e:
+        logger.error(f"[IndexBook] Failed to resubmit waiting books {waiters}: {e}")
+
+
 async def _index_book_async(book_id: str) -> dict:
-    """异步索引单本书籍"""
+    """
+    异步索引单本书籍
+    
+    【2026-10-19】按 content_sha256 去重：同一内容已有进行中的向量任务时只登记等待，
+    完成后由执行者为所有等待的书籍写入 vector_indexed_at（向量为公共数据，按 content_sha256 共享）
+    """
     # 为每个任务创建独立的数据库引擎，避免 Event Loop 冲突
     task_engine = _create_task_engine()
     try:
@@ -535,80 +601,108 @@ async def _index_book_async(book_id: str) -> dict:
             if original_format == 'pdf' and is_digitalized is False and ocr_status != 'completed':
                 return {"status": "skipped", "message": "Image-based PDF needs OCR first"}
             
-            # 下载文件
-            try:
-                file_bytes = await asyncio.to_thread(
-                    read_full,
-                    BUCKET,
-                    minio_key
-                )
-                if not file_bytes:
-                    raise Exception("Empty file content")
-                logger.info(f"[IndexBook] Downloaded {len(file_bytes)} bytes from {minio_key}")
-            except Exception as e:
-                logger.error(f"[IndexBook] Failed to download {minio_key}: {e}")
-                return {"status": "error", "message": f"Download failed: {e}"}
-            
-            # 提取文本（结构化：保留章节/页码信息）
-            structured_content = None
-            text_content = ""
-            
-            # 确定实际文件格式（可能与original_format不同，如MOBI转换为EPUB）
-            actual_format = 'epub' if minio_key and minio_key.endswith('.epub') else \
-                           'pdf' if minio_key and minio_key.endswith('.pdf') else \
-                           original_format
-            
-            if actual_format == 'epub':
-                logger.info(f"[IndexBook] Extracting structured text from EPUB (original: {original_format})...")
-                structured_content = extract_epub_text_with_sections(file_bytes)
-                text_content = '\n\n'.join([s['text'] for s in structured_content]) if structured_content else ""
-            elif actual_format == 'pdf':
-                logger.info(f"[IndexBook] Extracting structured text from PDF...")
-                structured_content = extract_pdf_text_with_pages(file_bytes)
-                text_content = '\n\n'.join([p['text'] for p in structured_content]) if structured_content else ""
-            else:
-                return {"status": "skipped", "message": f"Unsupported format: {original_format} (actual: {actual_format})"}
-            
-            logger.info(f"[IndexBook] Extracted text length: {len(text_content)} chars, sections/pages: {len(structured_content) if structured_content else 0}")
-            
-            if not text_content or len(text_content) < 100:
-                return {"status": "skipped", "message": "Insufficient text content"}
-            
-            # 创建向量索引（使用 content_sha256 作为公共数据标识）
-            try:
-                chunks_count = await index_book_chunks(
-                    book_id=str(book_uuid),
-                    content_sha256=content_sha256 or "",  # 公共数据匹配
-                    text_content=text_content,
-                    book_title=title,
-                    structured_content=structured_content,  # 传递结构化内容
-                    original_format=actual_format,  # 使用实际文件格式，而非上传时的原始格式
-                )
-                
-                # 更新 vector_indexed_at
-                await conn.execute(
-                    text("""
-                        UPDATE books 
-                        SET vector_indexed_at = NOW()
-                        WHERE id = :book_id
-                    """),
-                    {"book_id": book_uuid}
-                )
-                
+            singleflight = get_task_singleflight()
+            flight = singleflight.claim(
+                "vector", content_sha256, await _vector_task_version(), str(book_uuid), VECTOR_SINGLEFLIGHT_TTL
+            )
+            if flight.role == "attached":
+                return {"status": "attached", "book_id": str(book_uuid), "content_sha256": content_sha256}
+            if flight.role == "done":
+                await _mark_vector_indexed(conn, [book_uuid])
                 return {
                     "status": "success",
                     "book_id": str(book_uuid),
                     "title": title,
-                    "chunks_indexed": chunks_count,
+                    "chunks_indexed": flight.result.get("chunks_indexed", 0),
+                    "shared": True,
                 }
-            except Exception as e:
-                logger.error(f"[IndexBook] Indexing failed for {book_id}: {e}")
-                return {"status": "error", "message": str(e)}
+            
+            try:
+                result = await _index_claimed_book(book_uuid, title, minio_key, original_format, content_sha256)
+            except BaseException:
+                await _resubmit_vector_waiters(task_engine, singleflight.fail(flight))
+                raise
+            
+            if result["status"] != "success":
+                waiters = singleflight.fail(flight)
+                # 同一内容跳过的原因相同（格式不支持 / 文本不足），只在出错时让等待者各自重试
+                if result["status"] == "error":
+                    await _resubmit_vector_waiters(task_engine, waiters)
+                return result
+            
+            waiters = singleflight.complete(flight, {"chunks_indexed": result["chunks_indexed"]})
+            await _mark_vector_indexed(conn, [book_uuid, *waiters])
+            if waiters:
+                logger.info(f"[IndexBook] Shared vectors of {book_id} with {len(waiters)} waiting books")
+            return result
     finally:
         # 确保关闭引擎连接
         await task_engine.dispose()
 
 
+async def _index_claimed_book(book_uuid, title, minio_key, original_format, content_sha256) -> dict:
+    """下载、提取文本并写入向量索引（vector_indexed_at 由调用方统一更新）"""
+    book_id = str(book_uuid)
+    # 下载文件
+    try:
+        file_bytes = await asyncio.to_thread(
+            read_full,
+            BUCKET,
+            minio_key
+        )
+        if not file_bytes:
+            raise Exception("Empty file content")
+        logger.info(f"[IndexBook] Downloaded {len(file_bytes)} bytes from {minio_key}")
+    except Exception as e:
+        logger.error(f"[IndexBook] Failed to download {minio_key}: {e}")
+        return {"status": "error", "message": f"Download failed: {e}"}
+    
+    # 提取文本（结构化：保留章节/页码信息）
+    structured_content = None
+    text_content = ""
+    
+    # 确定实际文件格式（可能与original_format不同，如MOBI转换为EPUB）
+    actual_format = 'epub' if minio_key and minio_key.endswith('.epub') else \
+                   'pdf' if minio_key and minio_key.endswith('.pdf') else \
+                   original_format
+    
+    if actual_format == 'epub':
+        logger.info(f"[IndexBook] Extracting structured text from EPUB (original: {original_format})...")
+        structured_content = extract_epub_text_with_sections(file_bytes)
+        text_content = '\n\n'.join([s['text'] for s in structured_content]) if structured_content else ""
+    elif actual_format == 'pdf':
+        logger.info(f"[IndexBook] Extracting structured text from PDF...")
+        structured_content = extract_pdf_text_with_pages(file_bytes)
+        text_content = '\n\n'.join([p['text'] for p in structured_content]) if structured_content else ""
+    else:
+        return {"status": "skipped", "message": f"Unsupported format: {original_format} (actual: {actual_format})"}
+    
+    logger.info(f"[IndexBook] Extracted text length: {len(text_content)} chars, sections/pages: {len(structured_content) if structured_content else 0}")
+    
+    if not text_content or len(text_content) < 100:
+        return {"status": "skipped", "message": "Insufficient text content"}
+    
+    # 创建向量索引（使用 content_sha256 作为公共数据标识）
+    try:
+        chunks_count = await index_book_chunks(
+            book_id=str(book_uuid),
+            content_sha256=content_sha256 or "",  # 公共数据匹配
+            text_content=text_content,
+            book_title=title,
+            structured_content=structured_content,  # 传递结构化内容
+            original_format=actual_format,  # 使用实际文件格式，而非上传时的原始格式
+        )
+        
+        return {
+            "status": "success",
+            "book_id": str(book_uuid),
+            "title": title,
+            "chunks_indexed": chunks_count,
+        }
+    except Exception as e:
+        logger.error(f"[IndexBook] Indexing failed for {book_id}: {e}")
+        return {"status": "error", "message": str(e)}
+
 
 # ============================================================================
 # Celery 任务
@@ -661,3 +755,26 @@ def delete_book_vectors(self, book_id: str) -> dict:
     except Exception as e:
         logger.error(f"[IndexBook] Task failed: {e}")
         raise
+
+
+@shared_task(name="tasks.maintain_book_chunks_index", bind=True)
+def maintain_book_chunks_index(self) -> dict:
+    """
+    书籍向量索引维护（【2026-10-19】由 Celery beat 定期触发）
+    
+    根据写入速率调整 refresh_interval，静默时段内 force merge（见 index_maintenance）
+    """
+    from app.services.index_maintenance import maintain_book_chunks_index as _maintain
+    
+    try:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            result = loop.run_until_complete(_maintain())
+        finally:
+            loop.close()
+        logger.info(f"[IndexMaint] Result: {result}")
+        return result
+    except Exception as e:
+        logger.error(f"[IndexMaint] Task failed: {e}")
+        raise
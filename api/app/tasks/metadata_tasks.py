@@ -21,6 +21,7 @@ from ..storage import (
     BUCKET,
 )
 from ..realtime import ws_broadcast
+from ..services.book_context import invalidate_book_context_cache
 from .common import (
     _optimize_cover_image,
     _extract_epub_metadata,
@@ -243,6 +244,8 @@ def extract_ebook_metadata_calibre(book_id: str, user_id: str):
                     )
                     await conn.execute(text(update_sql), params)
                     print(f"[CalibreMeta] Updated book: {book_id}")
+                # 【2026-10-19】书名/作者已更新，清除 AI 对话的书籍上下文缓存
+                invalidate_book_context_cache(user_id)
             
             # 【向量索引触发】EPUB 和 PDF 文字型在后台任务完成后触发
             # - 图片型 PDF：等待 OCR 完成后触发（在 ocr_tasks.py）
@@ -264,8 +267,8 @@ def extract_ebook_metadata_calibre(book_id: str, user_id: str):
             
             if should_index_vectors:
                 try:
-                    from ..celery_app import celery_app
-                    celery_app.send_task("tasks.index_book_vectors", args=[book_id])
+                    from ..services.fair_queue import submit_task
+                    submit_task("tasks.index_book_vectors", [book_id], user_id)
                     print(f"[CalibreMeta] ✓ Triggered vector indexing for book: {book_id}")
                 except Exception as e:
                     print(f"[CalibreMeta] ✗ Failed to trigger vector indexing: {e}")
@@ -407,6 +410,7 @@ def extract_book_metadata(book_id: str, user_id: str):
                 update_sql = f"UPDATE books SET {', '.join(updates)} WHERE id = cast(:id as uuid)"
                 await conn.execute(text(update_sql), params)
                 print(f"[Metadata] Updated book metadata for: {book_id}, metadata_extracted=true")
+                invalidate_book_context_cache(user_id)
                 
                 # 广播更新事件
                 try:
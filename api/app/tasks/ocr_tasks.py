@@ -393,6 +393,200 @@ def analyze_book_type(book_id: str, user_id: str):
         loop.close()
 
 
+# 【2026-10-19】同一 content_sha256 的 OCR 去重
+# 版本随 OCR 流水线变化（语言 / 引擎参数变化时修改），租约需覆盖最长的 OCR 耗时
+OCR_TASK_VERSION = "ocrmypdf-paddleocr:chi_sim:force"
+OCR_SINGLEFLIGHT_TTL = int(os.getenv("OCR_SINGLEFLIGHT_TTL", "14400"))
+
+# 【2026-10-19】PaddleOCR 使用 GPU 时持有 GPU 锁（见 services/gpu_lock），并按页段处理，
+# 每段之间检查是否有更高优先级的 GPU 任务（如用户提问的向量化）在等待，有则先让出
+OCR_PADDLE_USE_GPU = os.getenv("OCR_PADDLE_USE_GPU", "false").lower() == "true"  # Docker 环境暂不使用 GPU
+OCR_YIELD_PAGES = int(os.getenv("OCR_YIELD_PAGES", "20"))
+
+
+def _ocr_layered_pdf(pdf_data: bytes):
+    """
+    生成双层 PDF
+
+    CPU 模式与改造前一致（整本一次处理）；GPU 模式下超过 OCR_YIELD_PAGES 页的 PDF
+    拆成页段逐段 OCR 后合并，段与段之间可让出 GPU
+    """
+    from ..services.ocrmypdf_paddleocr_service import ocr_pdf_bytes
+
+    def _ocr(data: bytes):
+        return ocr_pdf_bytes(
+            pdf_data=data,
+            language="chi_sim",  # 默认简体中文，可根据书籍语言调整
+            use_gpu=OCR_PADDLE_USE_GPU,
+            force_ocr=True,  # 强制 OCR 所有页面
+        )
+
+    if not OCR_PADDLE_USE_GPU:
+        return _ocr(pdf_data)
+
+    import fitz
+    from ..services.gpu_lock import gpu_lock
+
+    with gpu_lock(priority="normal", name="ocr") as lock:
+        doc = fitz.open(stream=pdf_data, filetype="pdf")
+        total_pages = len(doc)
+        if OCR_YIELD_PAGES <= 0 or total_pages <= OCR_YIELD_PAGES:
+            doc.close()
+            return _ocr(pdf_data)
+
+        merged = fitz.open()
+        try:
+            for start in range(0, total_pages, OCR_YIELD_PAGES):
+                end = min(start + OCR_YIELD_PAGES, total_pages) - 1
+                segment = fitz.open()
+                segment.insert_pdf(doc, from_page=start, to_page=end)
+                layered = _ocr(segment.tobytes())
+                segment.close()
+                if not layered:
+                    return None
+                with fitz.open(stream=layered, filetype="pdf") as layered_doc:
+                    merged.insert_pdf(layered_doc)
+                print(f"[OCR] Segment pages {start + 1}-{end + 1}/{total_pages} done")
+                if end + 1 < total_pages:
+                    lock.yield_if_needed()
+            merged.set_toc(doc.get_toc())
+            return merged.tobytes(garbage=3, deflate=True)
+        finally:
+            merged.close()
+            doc.close()
+
+
+async def _set_ocr_status(task_engine, book_id: str, user_id: str, status: str):
+    async with task_engine.begin() as conn:
+        await conn.execute(
+            text("SELECT set_config('app.user_id', :v, true)"), {"v": user_id}
+        )
+        await conn.execute(
+            text("UPDATE books SET ocr_status = :s, updated_at = now() WHERE id = cast(:id as uuid)"),
+            {"s": status, "id": book_id}
+        )
+
+
+def _split_member(member: str) -> tuple:
+    """singleflight 等待者标识 "book_id:user_id" """
+    book_id, _, user_id = member.partition(":")
+    return book_id, user_id
+
+
+def _resubmit_ocr_waiters(members: list) -> None:
+    """执行者失败：重新投递等待的书（各自重新申领，下一本成为执行者）"""
+    if not members:
+        return
+    from ..services.fair_queue import submit_task
+    
+    for member in members:
+        waiter_book_id, waiter_user_id = _split_member(member)
+        try:
+            submit_task("tasks.process_book_ocr", [waiter_book_id, waiter_user_id], waiter_user_id)
+        except Exception as e:
+            print(f"[OCR] Failed to resubmit waiting book {waiter_book_id}: {e}")
+    print(f"[OCR] Leader failed, resubmitted {len(members)} waiting books")
+
+
+async def _publish_ocr_result(task_engine, book_id: str, user_id: str, pdf_data: bytes, layered_pdf_data: bytes) -> str:
+    """
+    把双层 PDF 应用到一本书：上传到该书的路径、备份原始 PDF、更新数据库、建立搜索索引、WebSocket 通知
+    
+    【2026-10-19】从 process_book_ocr 中拆出，OCR 执行者对自己和所有等待的同内容书籍逐一调用。
+    上传双层 PDF 失败时抛出异常，由调用方把该书标记为 failed。
+    
+    Returns:
+        双层 PDF 的存储 key
+    """
+    layered_pdf_key = f"users/{user_id}/layered/{book_id}.pdf"
+    upload_bytes(BUCKET, layered_pdf_key, layered_pdf_data, "application/pdf")
+    print(f"[OCR] Uploaded layered PDF: {layered_pdf_key}")
+    
+    # 备份原始 PDF
+    backup_key = f"users/{user_id}/backups/{book_id}_original.pdf"
+    try:
+        try:
+            read_head(BUCKET, backup_key)
+            print(f"[OCR] Backup already exists: {backup_key}")
+        except Exception:
+            upload_bytes(BUCKET, backup_key, pdf_data, "application/pdf")
+            print(f"[OCR] Created backup: {backup_key}")
+    except Exception as e:
+        print(f"[OCR] Warning: Failed to create backup: {e}")
+    
+    # 更新数据库
+    async with task_engine.begin() as conn:
+        await conn.execute(
+            text("SELECT set_config('app.user_id', :v, true)"), {"v": user_id}
+        )
+        
+        # 注意：全文搜索通过 OpenSearch 实现，不需要在数据库中存储 ocr_text
+        await conn.execute(
+            text("""
+                UPDATE books 
+                SET 
+                    minio_key = :layered_key,
+                    ocr_status = 'completed',
+                    updated_at = now()
+                WHERE id = cast(:id as uuid)
+            """),
+            {
+                "id": book_id,
+                "layered_key": layered_pdf_key,
+            }
+        )
+        
+        print(f"[OCR] Successfully completed OCR for book {book_id}")
+        print(f"[OCR]   Backup: {backup_key}")
+        print(f"[OCR]   Layered PDF: {layered_pdf_key}")
+    
+    # 触发搜索索引 - 从生成的双层 PDF 中提取文字
+    try:
+        from ..search_sync import index_book_content
+        import fitz  # PyMuPDF
+        
+        # 从双层 PDF 中提取文字用于搜索索引
+        search_regions = []
+        try:
+            doc = fitz.open(stream=layered_pdf_data, filetype="pdf")
+            for page_num in range(len(doc)):
+                page = doc[page_num]
+                page_text = page.get_text()  # 不能用 text 作为变量名，会覆盖 SQLAlchemy 的 text 函数
+                if page_text.strip():
+                    search_regions.append({
+                        "text": page_text.strip(),
+                        "page": page_num + 1
+                    })
+            doc.close()
+        except Exception as extract_err:
+            print(f"[OCR] Warning: Failed to extract text from PDF for indexing: {extract_err}")
+        
+        if search_regions:
+            index_book_content(book_id, user_id, search_regions)
+            print(f"[OCR] Triggered search indexing for book {book_id} with {len(search_regions)} pages")
+        else:
+            print(f"[OCR] Warning: No text extracted for search indexing")
+    except Exception as e:
+        print(f"[OCR] Warning: Failed to index book content for search: {e}")
+    
+    # WebSocket 通知
+    try:
+        await ws_broadcast(
+            f"book:{book_id}",
+            json.dumps({
+                "event": "OCR_COMPLETED",
+                "book_id": book_id,
+                "ocr_status": "completed",
+                "layered_pdf_key": layered_pdf_key,
+                "message": "OCR processing completed successfully"
+            })
+        )
+    except Exception as e:
+        print(f"[OCR] Warning: Failed to broadcast WebSocket message: {e}")
+    
+    return layered_pdf_key
+
+
 @shared_task(name="tasks.process_book_ocr")
 def process_book_ocr(book_id: str, user_id: str):
     """
@@ -408,13 +602,20 @@ def process_book_ocr(book_id: str, user_id: str):
     3. 自动处理页面旋转、DPI 转换等复杂问题
     4. 代码简洁，维护成本低
     
+    【2026-10-19】按 content_sha256 去重（见 services/task_singleflight）：
+    同一文件已有进行中的 OCR 时只登记等待，执行者完成后把双层 PDF 扇出到每一本等待的书；
+    执行失败时只把执行者标记为 failed，等待的书重新投递、各自重新申领（失败可能是暂时性的，
+    如下载 / 上传错误、显存不足、worker 崩溃）。
+    
     参考：
     - https://github.com/ocrmypdf/OCRmyPDF (GitHub 30k+ stars)
     - https://github.com/clefru/ocrmypdf-paddleocr
     """
-    from ..services.ocrmypdf_paddleocr_service import ocr_pdf_bytes
+    from ..services.task_singleflight import Flight, get_task_singleflight
     
     print(f"[OCR] Starting OCR task for book {book_id} (OCRmyPDF + PaddleOCR Plugin Mode)")
+    singleflight = get_task_singleflight()
+    state = {}
 
     async def _run():
         engine = _create_task_engine()  # 覆盖全局 engine，避免 Event Loop 冲突
@@ -425,7 +626,7 @@ def process_book_ocr(book_id: str, user_id: str):
             )
             
             res = await conn.execute(
-                text("SELECT minio_key, title FROM books WHERE id = cast(:id as uuid)"),
+                text("SELECT minio_key, title, content_sha256 FROM books WHERE id = cast(:id as uuid)"),
                 {"id": book_id},
             )
             row = res.fetchone()
@@ -433,7 +634,7 @@ def process_book_ocr(book_id: str, user_id: str):
                 print(f"[OCR] Book not found: {book_id}")
                 return
             
-            minio_key, book_title = row
+            minio_key, book_title, content_sha256 = row
             
             await conn.execute(
                 text("""
@@ -444,36 +645,47 @@ def process_book_ocr(book_id: str, user_id: str):
                 {"id": book_id}
             )
         
-        original_minio_key = minio_key
+        flight = singleflight.claim(
+            "ocr", content_sha256, OCR_TASK_VERSION, f"{book_id}:{user_id}", OCR_SINGLEFLIGHT_TTL
+        )
+        if flight.role == "attached":
+            print(f"[OCR] Same content is already being processed, waiting for its result: {book_id}")
+            return
+        state["flight"] = flight
+        
         print(f"[OCR] Processing: {book_title} ({minio_key})")
         
+        async def _fail(reason: str):
+            print(f"[OCR] {reason}")
+            await _set_ocr_status(engine, book_id, user_id, "failed")
+            _resubmit_ocr_waiters(singleflight.fail(flight))
+        
         # 下载 PDF
         pdf_data = read_full(BUCKET, minio_key)
         if not pdf_data:
-            print(f"[OCR] Failed to download PDF: {minio_key}")
-            async with engine.begin() as conn:
-                await conn.execute(
-                    text("SELECT set_config('app.user_id', :v, true)"), {"v": user_id}
-                )
-                await conn.execute(
-                    text("UPDATE books SET ocr_status = 'failed', updated_at = now() WHERE id = cast(:id as uuid)"),
-                    {"id": book_id}
-                )
+            await _fail(f"Failed to download PDF: {minio_key}")
             return
         
         print(f"[OCR] Downloaded PDF: {len(pdf_data)} bytes")
         
+        if flight.role == "done":
+            # 同一文件刚完成 OCR：直接复用其双层 PDF
+            layered_pdf_data = read_full(BUCKET, flight.result["layered_key"])
+            if layered_pdf_data:
+                print(f"[OCR] Reusing layered PDF of the same content: {flight.result['layered_key']}")
+                try:
+                    await _publish_ocr_result(engine, book_id, user_id, pdf_data, layered_pdf_data)
+                except Exception as e:
+                    await _fail(f"Failed to upload layered PDF: {e}")
+                return
+            flight = state["flight"] = Flight(role="bypassed", task_type="ocr")
+        
         # 【新方案】使用 OCRmyPDF + PaddleOCR 插件一步到位生成双层 PDF
         print(f"[OCR] Generating layered PDF with OCRmyPDF + PaddleOCR Plugin...")
         start_time = time.time()
         
         try:
-            layered_pdf_data = ocr_pdf_bytes(
-                pdf_data=pdf_data,
-                language="chi_sim",  # 默认简体中文，可根据书籍语言调整
-                use_gpu=False,  # Docker 环境暂不使用 GPU
-                force_ocr=True,  # 强制 OCR 所有页面
-            )
+            layered_pdf_data = _ocr_layered_pdf(pdf_data)
             
             if not layered_pdf_data:
                 raise Exception("OCR returned empty result")
@@ -482,118 +694,30 @@ def process_book_ocr(book_id: str, user_id: str):
             print(f"[OCR] Layered PDF generated in {elapsed:.1f}s: {len(layered_pdf_data)} bytes")
             
         except Exception as e:
-            print(f"[OCR] Failed to generate layered PDF: {e}")
             import traceback
             traceback.print_exc()
-            async with engine.begin() as conn:
-                await conn.execute(
-                    text("SELECT set_config('app.user_id', :v, true)"), {"v": user_id}
-                )
-                await conn.execute(
-                    text("UPDATE books SET ocr_status = 'failed', updated_at = now() WHERE id = cast(:id as uuid)"),
-                    {"id": book_id}
-                )
+            await _fail(f"Failed to generate layered PDF: {e}")
             return
         
-        # 上传双层 PDF
-        layered_pdf_key = f"users/{user_id}/layered/{book_id}.pdf"
+        # 上传双层 PDF 并更新本书
         try:
-            upload_bytes(BUCKET, layered_pdf_key, layered_pdf_data, "application/pdf")
-            print(f"[OCR] Uploaded layered PDF: {layered_pdf_key}")
+            layered_pdf_key = await _publish_ocr_result(engine, book_id, user_id, pdf_data, layered_pdf_data)
         except Exception as e:
-            print(f"[OCR] Failed to upload layered PDF: {e}")
-            async with engine.begin() as conn:
-                await conn.execute(
-                    text("SELECT set_config('app.user_id', :v, true)"), {"v": user_id}
-                )
-                await conn.execute(
-                    text("UPDATE books SET ocr_status = 'failed', updated_at = now() WHERE id = cast(:id as uuid)"),
-                    {"id": book_id}
-                )
+            await _fail(f"Failed to upload layered PDF: {e}")
             return
+        print(f"[OCR]   Original: {minio_key}")
         
-        # 备份原始 PDF
-        backup_key = f"users/{user_id}/backups/{book_id}_original.pdf"
-        try:
-            try:
-                read_head(BUCKET, backup_key)
-                print(f"[OCR] Backup already exists: {backup_key}")
-            except Exception:
-                upload_bytes(BUCKET, backup_key, pdf_data, "application/pdf")
-                print(f"[OCR] Created backup: {backup_key}")
-        except Exception as e:
-            print(f"[OCR] Warning: Failed to create backup: {e}")
-        
-        # 更新数据库
-        async with engine.begin() as conn:
-            await conn.execute(
-                text("SELECT set_config('app.user_id', :v, true)"), {"v": user_id}
-            )
-            
-            # 注意：全文搜索通过 OpenSearch 实现，不需要在数据库中存储 ocr_text
-            await conn.execute(
-                text("""
-                    UPDATE books 
-                    SET 
-                        minio_key = :layered_key,
-                        ocr_status = 'completed',
-                        updated_at = now()
-                    WHERE id = cast(:id as uuid)
-                """),
-                {
-                    "id": book_id,
-                    "layered_key": layered_pdf_key,
-                }
-            )
-            
-            print(f"[OCR] Successfully completed OCR for book {book_id}")
-            print(f"[OCR]   Original: {original_minio_key}")
-            print(f"[OCR]   Backup: {backup_key}")
-            print(f"[OCR]   Layered PDF: {layered_pdf_key}")
-        
-        # 触发搜索索引 - 从生成的双层 PDF 中提取文字
-        try:
-            from ..search_sync import index_book_content
-            import fitz  # PyMuPDF
-            
-            # 从双层 PDF 中提取文字用于搜索索引
-            search_regions = []
+        # 扇出到等待中的同内容书籍（只做存储与数据库写入，不再重复 OCR）
+        waiters = singleflight.complete(flight, {"layered_key": layered_pdf_key})
+        for member in waiters:
+            waiter_book_id, waiter_user_id = _split_member(member)
             try:
-                doc = fitz.open(stream=layered_pdf_data, filetype="pdf")
-                for page_num in range(len(doc)):
-                    page = doc[page_num]
-                    page_text = page.get_text()  # 不能用 text 作为变量名，会覆盖 SQLAlchemy 的 text 函数
-                    if page_text.strip():
-                        search_regions.append({
-                            "text": page_text.strip(),
-                            "page": page_num + 1
-                        })
-                doc.close()
-            except Exception as extract_err:
-                print(f"[OCR] Warning: Failed to extract text from PDF for indexing: {extract_err}")
-            
-            if search_regions:
-                index_book_content(book_id, user_id, search_regions)
-                print(f"[OCR] Triggered search indexing for book {book_id} with {len(search_regions)} pages")
-            else:
-                print(f"[OCR] Warning: No text extracted for search indexing")
-        except Exception as e:
-            print(f"[OCR] Warning: Failed to index book content for search: {e}")
-        
-        # WebSocket 通知
-        try:
-            await ws_broadcast(
-                f"book:{book_id}",
-                json.dumps({
-                    "event": "OCR_COMPLETED",
-                    "book_id": book_id,
-                    "ocr_status": "completed",
-                    "layered_pdf_key": layered_pdf_key,
-                    "message": "OCR processing completed successfully"
-                })
-            )
-        except Exception as e:
-            print(f"[OCR] Warning: Failed to broadcast WebSocket message: {e}")
+                await _publish_ocr_result(engine, waiter_book_id, waiter_user_id, pdf_data, layered_pdf_data)
+            except Exception as e:
+                print(f"[OCR] Failed to share OCR result with {waiter_book_id}: {e}")
+                await _set_ocr_status(engine, waiter_book_id, waiter_user_id, "failed")
+        if waiters:
+            print(f"[OCR] Shared OCR result of {book_id} with {len(waiters)} waiting books")
     
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
@@ -604,15 +728,12 @@ def process_book_ocr(book_id: str, user_id: str):
         import traceback
         traceback.print_exc()
         
+        # 执行者异常退出时释放租约，等待的同内容书籍重新投递
+        if "flight" in state:
+            _resubmit_ocr_waiters(singleflight.fail(state["flight"]))
+        
         async def _mark_failed():
-            async with engine.begin() as conn:
-                await conn.execute(
-                    text("SELECT set_config('app.user_id', :v, true)"), {"v": user_id}
-                )
-                await conn.execute(
-                    text("UPDATE books SET ocr_status = 'failed', updated_at = now() WHERE id = cast(:id as uuid)"),
-                    {"id": book_id}
-                )
+            await _set_ocr_status(engine, book_id, user_id, "failed")
         loop_fallback = asyncio.new_event_loop()
         asyncio.set_event_loop(loop_fallback)
         try:
@@ -0,0 +1,78 @@
+"""
+Cross-Encoder 重排序 Celery 任务
+
+【2026-10-19】新增：
+- 在 worker-rerank 容器中以 CPU 运行小型 Cross-Encoder（默认 BAAI/bge-reranker-base）
+- API 端已将并发请求合并为微批，本任务一次性对批内所有 (query, doc) 对打分
+
+队列：rerank（独立队列，不与 GPU OCR/索引任务争抢）
+"""
+
+import logging
+import os
+from typing import List
+
+from celery import shared_task
+
+logger = logging.getLogger(__name__)
+
+RERANK_LOCAL_MODEL = os.getenv("RERANK_LOCAL_MODEL", "BAAI/bge-reranker-base")
+RERANK_LOCAL_DEVICE = os.getenv("RERANK_LOCAL_DEVICE", "cpu")
+RERANK_LOCAL_BATCH_SIZE = int(os.getenv("RERANK_LOCAL_BATCH_SIZE", "32"))
+RERANK_LOCAL_MAX_LENGTH = int(os.getenv("RERANK_LOCAL_MAX_LENGTH", "512"))
+
+_cross_encoder = None
+
+
+def get_cross_encoder():
+    """获取 Cross-Encoder 模型（单例，首次调用时加载）"""
+    global _cross_encoder
+    if _cross_encoder is None:
+        # 延迟导入，避免在API容器中加载模型
+        from sentence_transformers import CrossEncoder
+
+        cache_folder = os.getenv("HF_HOME", "/app/.hf_cache")
+        logger.info(f"[RerankTask] Loading cross-encoder {RERANK_LOCAL_MODEL} on {RERANK_LOCAL_DEVICE}")
+        _cross_encoder = CrossEncoder(
+            RERANK_LOCAL_MODEL,
+            device=RERANK_LOCAL_DEVICE,
+            max_length=RERANK_LOCAL_MAX_LENGTH,
+            cache_folder=cache_folder,
+        )
+    return _cross_encoder
+
+
+@shared_task(
+    name="tasks.rerank_batch",
+    bind=True,
+    max_retries=0,  # 实时请求，失败由 API 端回退到远程 Reranker
+)
+def rerank_batch(self, groups: List[dict]) -> List[List[float]]:
+    """
+    对一个微批内的所有请求打分
+
+    Args:
+        groups: [{"query": str, "documents": [str, ...]}, ...]
+
+    Returns:
+        与 groups 一一对应的分数列表（0-1，sigmoid 后的相关性）
+    """
+    pairs = []
+    for group in groups:
+        pairs.extend((group["query"], doc) for doc in group["documents"])
+
+    if not pairs:
+        return [[] for _ in groups]
+
+    model = get_cross_encoder()
+    scores = model.predict(pairs, batch_size=RERANK_LOCAL_BATCH_SIZE, show_progress_bar=False)
+
+    results = []
+    offset = 0
+    for group in groups:
+        n = len(group["documents"])
+        results.append([float(s) for s in scores[offset:offset + n]])
+        offset += n
+
+    logger.info(f"[RerankTask] Scored {len(pairs)} pairs for {len(groups)} requests")
+    return results
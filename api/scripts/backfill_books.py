@@ -0,0 +1,75 @@
+"""
+书籍批量补处理（OCR / 向量索引）
+
+【2026-10-19】按队列水位线分批投递，游标保存在 backfill_jobs 表中（见 app/services/backfill.py）。
+编排进程中断后重新执行 run 即可从断点继续。
+
+使用方法（在 api 或 worker 容器内）:
+    python -m scripts.backfill_books start --kind vector            # 补齐缺少向量索引的书籍
+    python -m scripts.backfill_books start --kind ocr               # 补齐需要 OCR 的图片型 PDF
+    python -m scripts.backfill_books start --kind vector --scope all --job rebuild-20261019
+    python -m scripts.backfill_books run --job vector-missing       # 继续运行已有任务
+    python -m scripts.backfill_books pause --job vector-missing
+    python -m scripts.backfill_books resume --job vector-missing
+    python -m scripts.backfill_books status --job vector-missing
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+
+# 添加项目路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.services.backfill import (
+    create_backfill,
+    get_backfill_status,
+    run_backfill,
+    set_backfill_paused,
+)
+
+
+def format_status(job: dict) -> str:
+    eta = job.get("eta_seconds")
+    eta_text = f"{eta // 3600}h{eta % 3600 // 60:02d}m" if eta is not None else "-"
+    return (
+        f"[{job['id']}] {job['kind']}/{job['scope']} {job['status']}: "
+        f"{job['enqueued']}/{job['total']} 已投递, {job['rate_per_min']}/min, ETA {eta_text}"
+    )
+
+
+async def run_and_report(job_id: str) -> str:
+    state = await run_backfill(job_id, on_progress=lambda job: print(format_status(job), flush=True))
+    job = await get_backfill_status(job_id)
+    if job:
+        print(format_status(job))
+    return state
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="书籍批量补处理（按队列水位线分批投递）")
+    parser.add_argument("command", choices=["start", "run", "pause", "resume", "status"])
+    parser.add_argument("--job", help="任务名（start 时默认 <kind>-<scope>）")
+    parser.add_argument("--kind", choices=["ocr", "vector"], default="vector")
+    parser.add_argument("--scope", choices=["missing", "all"], default="missing",
+                        help="missing: 仅未处理的书籍；all: 全部书籍（全量重建，仅 vector）")
+    args = parser.parse_args()
+    job_id = args.job or f"{args.kind}-{args.scope}"
+
+    if args.command == "start":
+        job = await create_backfill(job_id, args.kind, args.scope)
+        print(format_status(job))
+        await run_and_report(job_id)
+    elif args.command == "run":
+        await run_and_report(job_id)
+    elif args.command in ("pause", "resume"):
+        changed = await set_backfill_paused(job_id, args.command == "pause")
+        print(f"{'✅' if changed else '⚠️ 状态未变化'} {args.command} {job_id}")
+    else:
+        job = await get_backfill_status(job_id)
+        print(format_status(job) if job else f"❌ 任务不存在: {job_id}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
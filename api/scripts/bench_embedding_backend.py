@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+Embedding 后端对比：PyTorch (HuggingFaceEmbedding) vs ONNX Runtime int8
+
+1. 精度一致性：同一批文本两种后端的余弦相似度（均值/最小值）
+2. 检索一致性：以 PyTorch 结果为基准，查询 top-k 召回重合率
+3. 吞吐：batch=1 与 batch=EMBEDDING_BATCH_SIZE 下的 texts/s
+
+用法（在 worker-gpu 容器内运行）：
+    python scripts/bench_embedding_backend.py [--samples 200] [--min-cosine 0.98]
+
+精度低于阈值时以非零状态码退出，可作为切换 EMBEDDING_BACKEND=onnx 前的验收。
+"""
+import argparse
+import os
+import sys
+import time
+
+# 添加app路径
+sys.path.insert(0, '/app')
+
+SAMPLE_TEXTS = [
+    "第一章 少年时代的回忆总是伴随着夏天的蝉鸣和外婆家的老槐树。",
+    "经济学研究的是稀缺资源在不同用途之间的配置问题。",
+    "The quick brown fox jumps over the lazy dog near the river bank.",
+    "量子力学中的测不准原理指出，粒子的位置和动量不能同时被精确测量。",
+    "他推开窗户，看见远处的山峦在晨雾中若隐若现。",
+    "Machine learning models require careful evaluation on held-out data.",
+    "唐代诗人李白以豪放飘逸的诗风著称，被后人誉为诗仙。",
+    "光合作用是植物利用光能将二氧化碳和水转化为有机物的过程。",
+]
+
+SAMPLE_QUERIES = [
+    "作者小时候在哪里度过夏天？",
+    "什么是稀缺资源配置？",
+    "测不准原理讲了什么",
+    "李白的诗歌风格",
+]
+
+
+def build_corpus(n: int):
+    """由样例句子拼接出 n 条长度不一的文本"""
+    corpus = []
+    for i in range(n):
+        base = SAMPLE_TEXTS[i % len(SAMPLE_TEXTS)]
+        repeat = 1 + (i % 5)
+        corpus.append(" ".join([base] * repeat) + f" ({i})")
+    return corpus
+
+
+def cosine(a, b):
+    import numpy as np
+    a = np.asarray(a, dtype=np.float32)
+    b = np.asarray(b, dtype=np.float32)
+    return float(a @ b / (np.linalg.norm(a) * np.linalg.norm(b) + 1e-12))
+
+
+def topk_ids(query_vec, doc_vecs, k):
+    import numpy as np
+    scores = np.asarray(doc_vecs, dtype=np.float32) @ np.asarray(query_vec, dtype=np.float32)
+    return set(np.argsort(-scores)[:k].tolist())
+
+
+def throughput(model, texts, batch_size):
+    model.embed_batch_size = batch_size
+    start = time.perf_counter()
+    if batch_size == 1:
+        for t in texts:
+            model.get_text_embedding(t)
+    else:
+        model.get_text_embedding_batch(texts)
+    elapsed = time.perf_counter() - start
+    return len(texts) / elapsed if elapsed > 0 else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare torch vs onnx embedding backends")
+    parser.add_argument("--samples", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--min-cosine", type=float, default=0.98)
+    parser.add_argument("--min-topk-overlap", type=float, default=0.9)
+    args = parser.parse_args()
+
+    from llama_index.embeddings.huggingface import HuggingFaceEmbedding
+    from app.services.llama_rag import EMBEDDING_MODEL, EMBEDDING_BATCH_SIZE
+    from app.services.onnx_embedding import OnnxEmbedding
+
+    cache_folder = os.getenv("HF_HOME", "/app/.hf_cache")
+    max_length = int(os.getenv("EMBEDDING_MAX_LENGTH", "2048"))
+    corpus = build_corpus(args.samples)
+
+    print("=" * 60)
+    print(f"模型: {EMBEDDING_MODEL}  样本数: {len(corpus)}  batch: {EMBEDDING_BATCH_SIZE}")
+    print("=" * 60)
+
+    torch_model = HuggingFaceEmbedding(
+        model_name=EMBEDDING_MODEL,
+        device="cpu",
+        cache_folder=cache_folder,
+        embed_batch_size=EMBEDDING_BATCH_SIZE,
+        normalize=True,
+        max_length=max_length,
+    )
+    onnx_model = OnnxEmbedding(
+        model_name=EMBEDDING_MODEL,
+        cache_folder=cache_folder,
+        embed_batch_size=EMBEDDING_BATCH_SIZE,
+        max_length=max_length,
+    )
+
+    # 1. 向量余弦一致性
+    torch_vecs = torch_model.get_text_embedding_batch(corpus)
+    onnx_vecs = onnx_model.get_text_embedding_batch(corpus)
+    cosines = [cosine(a, b) for a, b in zip(torch_vecs, onnx_vecs)]
+    mean_cos = sum(cosines) / len(cosines)
+    min_cos = min(cosines)
+    print(f"\n[精度] cosine mean={mean_cos:.4f} min={min_cos:.4f}")
+
+    # 2. 检索 top-k 重合率
+    k = min(args.top_k, len(corpus))
+    overlaps = []
+    for q in SAMPLE_QUERIES:
+        ref = topk_ids(torch_model.get_query_embedding(q), torch_vecs, k)
+        got = topk_ids(onnx_model.get_query_embedding(q), onnx_vecs, k)
+        overlaps.append(len(ref & got) / k)
+    mean_overlap = sum(overlaps) / len(overlaps)
+    print(f"[检索] top-{k} overlap mean={mean_overlap:.3f}")
+
+    # 3. 吞吐
+    bench_texts = corpus[:min(64, len(corpus))]
+    for name, model in (("torch", torch_model), ("onnx", onnx_model)):
+        single = throughput(model, bench_texts[:16], 1)
+        batched = throughput(model, bench_texts, EMBEDDING_BATCH_SIZE)
+        print(f"[吞吐] {name:5s} batch=1: {single:7.2f} texts/s  batch={EMBEDDING_BATCH_SIZE}: {batched:7.2f} texts/s")
+
+    passed = min_cos >= args.min_cosine and mean_overlap >= args.min_topk_overlap
+    print("\n" + ("✓ ONNX 后端精度达标" if passed else "✗ ONNX 后端精度未达标"))
+    return 0 if passed else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,169 @@
+"""
+用户笔记向量索引路由迁移脚本
+
+【2026-10-19】athena_user_notes 改为按 user_id 自定义路由的多分片索引，
+旧的物理索引（无路由、单分片）需要迁移一次：
+
+1. 创建路由版物理索引 athena_user_notes_v2（迁移期间 refresh 关闭、副本为 0）
+2. _reindex 全量复制，脚本中设置 ctx._routing = metadata.user_id
+3. 旧索引加写保护（index.blocks.write），进入切换窗口
+4. 补齐迁移期间新写入/更新的笔记（按 metadata.created_at）
+5. 对比两个索引的 note_id，删除新索引中已在旧索引删除的笔记
+6. 恢复 refresh / 副本设置
+7. 一次 _aliases 原子操作：删除旧物理索引并把 athena_user_notes 作为别名指向新索引
+
+迁移过程中旧索引持续提供查询。切换窗口（步骤 3-7）内的写入 / 删除会被写保护拒绝，
+由 flush / 删除任务重试，切换后经别名写入新索引；迁移中止时移除写保护。
+
+使用方法：
+docker exec athena-api-1 python scripts/migrate_user_notes_routing.py
+"""
+
+import asyncio
+import os
+import sys
+import time
+
+# 添加项目路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from opensearchpy import AsyncOpenSearch
+from opensearchpy.helpers import async_scan
+
+from app.services.llama_rag import (
+    OPENSEARCH_URL,
+    USER_NOTES_INDEX,
+    USER_NOTES_PHYSICAL_INDEX,
+    user_notes_index_body,
+)
+
+ROUTING_SCRIPT = {"source": "ctx._routing = ctx._source.metadata.user_id", "lang": "painless"}
+# 补齐窗口往前多取一段，覆盖时钟偏差
+CATCH_UP_MARGIN_MS = 60_000
+
+
+async def reindex(client, query: dict | None = None) -> int:
+    """执行 _reindex 并等待完成，返回处理的文档数"""
+    source = {"index": USER_NOTES_INDEX}
+    if query:
+        source["query"] = query
+    task = await client.reindex(
+        body={"source": source, "dest": {"index": USER_NOTES_PHYSICAL_INDEX}, "script": ROUTING_SCRIPT},
+        wait_for_completion=False,
+        refresh=False,
+    )
+    task_id = task["task"]
+    while True:
+        status = await client.tasks.get(task_id=task_id)
+        progress = status["task"]["status"]
+        print(f"   进度: {progress.get('created', 0) + progress.get('updated', 0)}/{progress.get('total', 0)}")
+        if status.get("completed"):
+            failures = status.get("response", {}).get("failures") or []
+            if failures:
+                raise RuntimeError(f"reindex failures: {failures[:3]}")
+            return progress.get("total", 0)
+        await asyncio.sleep(2)
+
+
+async def note_ids(client, index: str) -> set:
+    """索引中所有文档的 _id（即 note_id）"""
+    return {
+        hit["_id"]
+        async for hit in async_scan(client, index=index, query={"_source": False}, size=2000)
+    }
+
+
+async def set_write_block(client, blocked: bool):
+    """旧索引写保护（切换窗口内拒绝写入，避免写入在切换时丢失）"""
+    await client.indices.put_settings(
+        index=USER_NOTES_INDEX,
+        body={"index": {"blocks": {"write": True if blocked else None}}},
+    )
+
+
+async def main():
+    print("=" * 60)
+    print("用户笔记向量索引路由迁移")
+    print("=" * 60)
+    print()
+
+    client = AsyncOpenSearch(hosts=[OPENSEARCH_URL])
+    try:
+        if await client.indices.exists_alias(name=USER_NOTES_INDEX):
+            print(f"✅ {USER_NOTES_INDEX} 已经是别名，无需迁移")
+            return
+        if not await client.indices.exists(index=USER_NOTES_INDEX):
+            print(f"✅ {USER_NOTES_INDEX} 不存在，首次写入时会直接创建路由索引")
+            return
+
+        count = (await client.count(index=USER_NOTES_INDEX))["count"]
+        print(f"📊 旧索引文档数: {count}")
+
+        # 1. 创建新物理索引（迁移期间关闭 refresh、副本为 0）
+        if await client.indices.exists(index=USER_NOTES_PHYSICAL_INDEX):
+            print(f"⚠️  {USER_NOTES_PHYSICAL_INDEX} 已存在（上次迁移中断？），继续复制")
+        else:
+            body = user_notes_index_body()
+            body["settings"]["index"].update({"refresh_interval": "-1", "number_of_replicas": 0})
+            await client.indices.create(index=USER_NOTES_PHYSICAL_INDEX, body=body)
+            print(f"🆕 已创建 {USER_NOTES_PHYSICAL_INDEX}")
+
+        # 2. 全量复制
+        started_ms = int(time.time() * 1000)
+        print("🔄 全量复制...")
+        await reindex(client)
+
+        # 3. 进入切换窗口：旧索引写保护
+        print("🔒 旧索引写保护（切换窗口开始）...")
+        await set_write_block(client, True)
+        await client.indices.refresh(index=USER_NOTES_INDEX)
+        swapped = False
+        try:
+            # 4. 补齐复制期间写入的笔记
+            print("🔄 补齐迁移期间的新笔记...")
+            await reindex(client, {"range": {"metadata.created_at": {"gte": started_ms - CATCH_UP_MARGIN_MS}}})
+
+            # 5. 同步删除：全量复制之后在旧索引删除的笔记
+            await client.indices.refresh(index=USER_NOTES_PHYSICAL_INDEX)
+            deleted = await note_ids(client, USER_NOTES_PHYSICAL_INDEX) - await note_ids(client, USER_NOTES_INDEX)
+            if deleted:
+                print(f"🗑️  删除迁移期间已删除的 {len(deleted)} 条笔记...")
+                await client.delete_by_query(
+                    index=USER_NOTES_PHYSICAL_INDEX,
+                    body={"query": {"ids": {"values": sorted(deleted)}}},
+                    conflicts="proceed",
+                    refresh=True,
+                )
+
+            # 6. 恢复设置
+            await client.indices.put_settings(
+                index=USER_NOTES_PHYSICAL_INDEX,
+                body={"index": {"refresh_interval": None, "number_of_replicas": None}},
+            )
+            await client.indices.refresh(index=USER_NOTES_PHYSICAL_INDEX)
+            count = (await client.count(index=USER_NOTES_INDEX))["count"]
+            new_count = (await client.count(index=USER_NOTES_PHYSICAL_INDEX))["count"]
+            print(f"📊 旧索引文档数: {count}，新索引文档数: {new_count}")
+            if new_count != count:
+                print("❌ 新旧索引文档数不一致，已中止（旧索引保持不变）")
+                return
+
+            # 7. 原子切换：删除旧物理索引 + 创建同名别名
+            await client.indices.update_aliases(body={
+                "actions": [
+                    {"remove_index": {"index": USER_NOTES_INDEX}},
+                    {"add": {"index": USER_NOTES_PHYSICAL_INDEX, "alias": USER_NOTES_INDEX}},
+                ]
+            })
+            swapped = True
+            print(f"✅ 完成：{USER_NOTES_INDEX} -> {USER_NOTES_PHYSICAL_INDEX}")
+        finally:
+            if not swapped:
+                await set_write_block(client, False)
+                print("🔓 已移除旧索引写保护")
+    finally:
+        await client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -95,6 +95,673 @@ class TestGetProvider:
         with pytest.raises(ValueError, match="Unknown provider"):
             get_provider("unknown", "test-key")
 
+    def test_provider_instances_are_reused(self):
+        from app.services.llm_provider import clear_provider_cache
+
+        first = get_provider("siliconflow", "test-key")
+        assert get_provider("siliconflow", "test-key") is first
+        assert get_provider("siliconflow", "other-key") is not first
+
+        clear_provider_cache()
+        assert get_provider("siliconflow", "test-key") is not first
+
+
+class TestHttpClientPool:
+    """共享 HTTP 连接池测试"""
+
+    @pytest.mark.asyncio
+    async def test_clients_shared_per_origin(self):
+        from app.services.llm_provider import close_http_clients, get_http_client
+
+        a = get_http_client("https://api.siliconflow.cn/v1")
+        assert get_http_client("https://api.siliconflow.cn/v1/rerank") is a
+        assert get_http_client("https://openrouter.ai/api/v1") is not a
+
+        await close_http_clients()
+        assert a.is_closed
+        assert get_http_client("https://api.siliconflow.cn/v1") is not a
+        await close_http_clients()
+
+    def test_client_closed_when_loop_changes(self):
+        import asyncio
+        from app.services.llm_provider import close_http_clients, get_http_client
+
+        async def _get():
+            return get_http_client("https://api.siliconflow.cn/v1")
+
+        old_loop, new_loop = asyncio.new_event_loop(), asyncio.new_event_loop()
+        try:
+            first = old_loop.run_until_complete(_get())
+            second = new_loop.run_until_complete(_get())
+            assert second is not first
+            # 旧循环空闲：关闭排入旧循环，下次运行时执行
+            old_loop.run_until_complete(asyncio.sleep(0))
+            assert first.is_closed
+            new_loop.run_until_complete(close_http_clients())
+        finally:
+            old_loop.close()
+            new_loop.close()
+
+    @pytest.mark.asyncio
+    async def test_first_token_timer_splits_phases(self):
+        from app.services.llm_provider import _FirstTokenTimer
+
+        timer = _FirstTokenTimer("siliconflow", "m")
+        await timer.trace("http2.send_request_headers.started", {})
+        with patch("app.services.llm_provider.LLM_TTFT") as mock_hist:
+            timer.first_token()
+            timer.first_token()
+
+        phases = [c.kwargs["phase"] for c in mock_hist.labels.call_args_list]
+        assert phases == ["connect", "provider", "total"]
+
+
+class TestConversationMemory:
+    """对话滚动摘要测试"""
+
+    def test_summary_prepended_as_system_message(self):
+        from app.services.conversation_memory import ConversationMemory
+
+        recent = [ChatMessage(role="user", content="问题"), ChatMessage(role="assistant", content="回答")]
+        memory = ConversationMemory(summary="之前聊了王强", messages=recent)
+        msgs = memory.to_messages()
+        assert msgs[0].role == "system" and "之前聊了王强" in msgs[0].content
+        assert msgs[1:] == recent
+        assert ConversationMemory(messages=recent).to_messages() == recent
+
+    @staticmethod
+    def _mock_engine(*results):
+        conn = AsyncMock()
+        conn.execute.side_effect = list(results)
+        engine = MagicMock()
+        engine.begin.return_value.__aenter__.return_value = conn
+        return engine, conn
+
+    @staticmethod
+    def _result(rows=None, row=None):
+        result = MagicMock()
+        result.fetchall.return_value = rows or []
+        result.fetchone.return_value = row
+        return result
+
+    @pytest.mark.asyncio
+    async def test_refresh_skipped_below_trigger(self):
+        from app.services import conversation_memory as cm
+
+        rows = [("user", f"m{i}", i) for i in range(cm.SUMMARY_RECENT_MESSAGES + 1)]
+        engine, conn = self._mock_engine(self._result(row=None), self._result(rows=rows))
+        provider = MagicMock()
+        with patch.object(cm, "engine", engine), patch.object(cm, "_get_redis"), \
+             patch.object(cm, "get_provider", return_value=provider):
+            assert await cm.refresh_rolling_summary("c1", "u1", {}) is False
+        provider.chat.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_refresh_folds_messages_before_recent_window(self):
+        from app.services import conversation_memory as cm
+
+        n_fold = cm.SUMMARY_TRIGGER_MESSAGES
+        rows = [("user", f"m{i}", i) for i in range(n_fold + cm.SUMMARY_RECENT_MESSAGES)]
+        engine, conn = self._mock_engine(
+            self._result(row=("旧摘要", None)),
+            self._result(rows=rows),
+            self._result(row=("c1",)),
+        )
+        provider = MagicMock()
+        provider.chat = AsyncMock(return_value=("新摘要", None))
+        config = {"provider": "siliconflow", "api_key": "k", "endpoint": None, "model_id": "m"}
+        with patch.object(cm, "engine", engine), patch.object(cm, "_get_redis"), \
+             patch.object(cm, "get_provider", return_value=provider):
+            assert await cm.refresh_rolling_summary("c1", "u1", config) is True
+
+        prompt = provider.chat.call_args.kwargs["messages"][0].content
+        assert "旧摘要" in prompt and f"m{n_fold - 1}" in prompt and f"m{n_fold}" not in prompt
+        params = conn.execute.call_args_list[-1].args[1]
+        assert params["summary"] == "新摘要"
+        assert params["until"] == n_fold - 1
+
+
+class TestAIWriteBehind:
+    """AI 回复后置写入测试"""
+
+    @staticmethod
+    def _payload():
+        from datetime import datetime, timezone
+        from app.services.ai_write_behind import build_reply_payload
+
+        return build_reply_payload(
+            message_id="00000000-0000-0000-0000-000000000001",
+            conversation_id="c1",
+            user_id="u1",
+            content="回答",
+            citations=None,
+            model_id="m",
+            title="问题",
+            credits=3,
+            created_at=datetime(2026, 10, 19, tzinfo=timezone.utc),
+        )
+
+    @staticmethod
+    def _run(conn):
+        from app.services import ai_write_behind
+
+        engine = MagicMock()
+        engine.begin.return_value.__aenter__.return_value = conn
+        return patch.object(ai_write_behind, "engine", engine)
+
+    @pytest.mark.asyncio
+    async def test_first_delivery_writes_message_and_debits(self):
+        from app.services.ai_write_behind import persist_ai_reply
+
+        inserted = MagicMock()
+        inserted.fetchone.return_value = ("id",)
+        conn = AsyncMock()
+        conn.execute.return_value = inserted
+        with self._run(conn):
+            assert await persist_ai_reply(self._payload()) is True
+
+        sql = [str(c.args[0]) for c in conn.execute.call_args_list]
+        assert len(sql) == 4
+        assert "UPDATE credit_accounts" in sql[-1]
+
+    @pytest.mark.asyncio
+    async def test_redelivery_is_idempotent(self):
+        from app.services.ai_write_behind import persist_ai_reply
+
+        duplicate = MagicMock()
+        duplicate.fetchone.return_value = None
+        conn = AsyncMock()
+        conn.execute.return_value = duplicate
+        with self._run(conn):
+            assert await persist_ai_reply(self._payload()) is False
+
+        sql = [str(c.args[0]) for c in conn.execute.call_args_list]
+        assert not any("UPDATE credit_accounts" in q for q in sql)
+
+    @pytest.mark.asyncio
+    async def test_reply_saved_synchronously_worker_skips_message(self):
+        from app.services.ai_write_behind import persist_ai_reply, save_reply_message
+
+        inserted = MagicMock()
+        inserted.fetchone.return_value = ("id",)
+        conn = AsyncMock()
+        conn.execute.return_value = inserted
+        payload = self._payload()
+        with self._run(conn):
+            assert await save_reply_message(payload) is True
+        assert payload["message_saved"] is True
+        assert "INSERT INTO ai_messages" in str(conn.execute.call_args.args[0])
+
+        conn.execute.reset_mock()
+        with self._run(conn):
+            await persist_ai_reply(payload)
+        sql = [str(c.args[0]) for c in conn.execute.call_args_list]
+        assert not any("INSERT INTO ai_messages" in q for q in sql)
+        assert "UPDATE credit_accounts" in sql[-1]
+
+    @pytest.mark.asyncio
+    async def test_failed_synchronous_save_is_left_to_worker(self):
+        from app.services.ai_write_behind import save_reply_message
+
+        conn = AsyncMock()
+        conn.execute.side_effect = ConnectionError("db down")
+        payload = self._payload()
+        with self._run(conn):
+            assert await save_reply_message(payload) is False
+        assert "message_saved" not in payload
+
+    def test_enqueue_sends_celery_task(self):
+        from app.services.ai_write_behind import enqueue_ai_reply
+
+        payload = self._payload()
+        with patch("app.celery_app.celery_app.send_task") as send_task:
+            enqueue_ai_reply(payload)
+
+        assert send_task.call_args.args[0] == "tasks.persist_ai_reply"
+        assert send_task.call_args.kwargs["args"] == [payload]
+
+
+class _FakeRedis:
+    """答案缓存测试用的最小 Redis 替身"""
+
+    def __init__(self):
+        self.kv, self.hashes, self.zsets = {}, {}, {}
+
+    def mget(self, keys):
+        return [self.kv.get(k) for k in keys]
+
+    def incr(self, key):
+        self.kv[key] = str(int(self.kv.get(key, 0)) + 1)
+
+    def hget(self, key, field):
+        return self.hashes.get(key, {}).get(field)
+
+    def hgetall(self, key):
+        return dict(self.hashes.get(key, {}))
+
+    def hset(self, key, field, value):
+        self.hashes.setdefault(key, {})[field] = value
+
+    def zadd(self, key, mapping):
+        self.zsets.setdefault(key, {}).update(mapping)
+
+    def zcard(self, key):
+        return len(self.zsets.get(key, {}))
+
+    def expire(self, key, ttl):
+        pass
+
+    def pipeline(self, transaction=False):
+        fake = self
+
+        class _Pipe:
+            def __getattr__(self, name):
+                return getattr(fake, name)
+
+            def execute(self):
+                return []
+
+        return _Pipe()
+
+
+class TestAnswerCache:
+    """语义答案缓存测试"""
+
+    @pytest.fixture
+    def cache(self):
+        from app.services import answer_cache
+
+        with patch.object(answer_cache, "ANSWER_CACHE_ENABLED", True), \
+             patch.object(answer_cache, "_redis", _FakeRedis()):
+            yield answer_cache
+
+    def test_normalize_question(self, cache):
+        assert cache.normalize_question("第一章的主旨是什么？") == cache.normalize_question("第一章的主旨是什么 ?")
+        assert cache.normalize_question("ＡＢＣ") == "abc"
+
+    @pytest.mark.asyncio
+    async def test_exact_hit_after_store(self, cache):
+        embed = AsyncMock(return_value=[1.0, 0.0, 0.0])
+        with patch("app.services.llama_rag.get_local_embedding", embed):
+            hit, probe = await cache.lookup_answer(["sha-a"], "m", "第一章讲了什么？")
+            assert hit is None
+            await cache.store_answer(probe, "答案", [{"index": 1}])
+            hit, _ = await cache.lookup_answer(["sha-a"], "m", "第一章讲了什么")
+
+        assert hit["answer"] == "答案"
+        assert hit["citations"] == [{"index": 1}]
+
+    @pytest.mark.asyncio
+    async def test_cached_citations_drop_requester_books(self, cache):
+        from app.ai import _resolve_cached_citations
+
+        citation = {"index": 1, "book_id": "alice-book", "book_title": "Alice 的自定义书名", "content_sha256": "sha-a"}
+        with patch("app.services.llama_rag.get_local_embedding", AsyncMock(return_value=[1.0, 0.0])):
+            _, probe = await cache.lookup_answer(["sha-a"], "m", "第一章讲了什么")
+            await cache.store_answer(probe, "答案", [citation])
+            hit, _ = await cache.lookup_answer(["sha-a"], "m", "第一章讲了什么")
+
+        assert hit["citations"] == [{"index": 1, "content_sha256": "sha-a"}]
+        resolved = _resolve_cached_citations(
+            hit["citations"], [{"id": "bob-book", "title": "Bob 的书", "content_sha256": "sha-a"}]
+        )
+        assert resolved[0]["book_id"] == "bob-book" and resolved[0]["book_title"] == "Bob 的书"
+
+    @pytest.mark.asyncio
+    async def test_semantic_hit_by_similarity(self, cache):
+        vectors = {"第一章讲了什么": [1.0, 0.0, 0.0], "第一章主要内容": [0.99, 0.05, 0.0], "作者是谁": [0.0, 1.0, 0.0]}
+        embed = AsyncMock(side_effect=lambda q: vectors[q])
+        with patch("app.services.llama_rag.get_local_embedding", embed):
+            _, probe = await cache.lookup_answer(["sha-a"], "m", "第一章讲了什么")
+            await cache.store_answer(probe, "答案", [])
+            similar, _ = await cache.lookup_answer(["sha-a"], "m", "第一章主要内容")
+            different, _ = await cache.lookup_answer(["sha-a"], "m", "作者是谁")
+
+        assert similar["answer"] == "答案"
+        assert different is None
+
+    @pytest.mark.asyncio
+    async def test_semantic_hit_requires_same_chapter(self, cache):
+        # 向量几乎相同，但章节不同
+        vectors = {"第一章的主旨": [1.0, 0.0, 0.0], "第二章的主旨": [0.999, 0.01, 0.0], "第1章讲的主旨": [0.99, 0.02, 0.0]}
+        embed = AsyncMock(side_effect=lambda q: vectors[q])
+        with patch("app.services.llama_rag.get_local_embedding", embed):
+            _, probe = await cache.lookup_answer(["sha-a"], "m", "第一章的主旨")
+            await cache.store_answer(probe, "第一章答案", [])
+            other_chapter, _ = await cache.lookup_answer(["sha-a"], "m", "第二章的主旨")
+            same_chapter, _ = await cache.lookup_answer(["sha-a"], "m", "第1章讲的主旨")
+
+        assert other_chapter is None
+        assert same_chapter["answer"] == "第一章答案"
+
+    @pytest.mark.asyncio
+    async def test_reindex_invalidates_scope(self, cache):
+        embed = AsyncMock(return_value=[1.0, 0.0, 0.0])
+        with patch("app.services.llama_rag.get_local_embedding", embed):
+            _, probe = await cache.lookup_answer(["sha-a", "sha-b"], "m", "问题")
+            await cache.store_answer(probe, "答案", [])
+            cache.invalidate_book_answers("sha-b")
+            hit, _ = await cache.lookup_answer(["sha-b", "sha-a"], "m", "问题")
+
+        assert hit is None
+
+    @staticmethod
+    async def _qa_turn(memory, cached=None):
+        """走一轮问答请求（数据库、检索与 LLM 均为替身），返回 (lookup, store) mock"""
+        from app import ai
+
+        conv = MagicMock()
+        conv.fetchone.return_value = ("c1", "qa", ["b1"])
+        conn = AsyncMock()
+        conn.execute.return_value = conv
+        model_config = {"model_id": "m"}
+        stream = MagicMock(winner_config=model_config)
+
+        async def chunks(_stream):
+            yield LLMStreamChunk(type="delta", content="回答")
+            yield LLMStreamChunk(type="done")
+
+        lookup = AsyncMock(return_value=(cached, object()))
+        store = MagicMock()
+        with patch.object(ai, "engine") as engine, \
+             patch.object(ai, "ANSWER_CACHE_ENABLED", True), \
+             patch.object(ai, "check_credits", AsyncMock(return_value=True)), \
+             patch.object(ai, "get_default_model_config", AsyncMock(return_value=model_config)), \
+             patch.object(ai, "save_message", AsyncMock()), \
+             patch.object(ai, "load_conversation_memory", AsyncMock(return_value=memory)), \
+             patch.object(ai, "load_book_contexts", AsyncMock(return_value=[{"id": "b1", "title": "书", "content_sha256": "sha-a"}])), \
+             patch.object(ai, "retrieve_qa_context", AsyncMock(return_value={
+                 "citations": [], "user_notes_context": "", "book_info": "", "rag_context": "",
+             })), \
+             patch.object(ai, "HedgedStream", return_value=stream), \
+             patch.object(ai, "coalesce_deltas", chunks), \
+             patch.object(ai, "get_llm_governor") as governor, \
+             patch.object(ai, "save_reply_message", AsyncMock()), \
+             patch.object(ai, "enqueue_ai_reply"), \
+             patch.object(ai, "schedule_summary_refresh"), \
+             patch.object(ai, "lookup_answer", lookup), \
+             patch.object(ai, "schedule_store_answer", store):
+            engine.begin.return_value.__aenter__.return_value = conn
+            governor.return_value.slot.return_value.__aenter__ = AsyncMock()
+            governor.return_value.slot.return_value.__aexit__ = AsyncMock(return_value=False)
+            response = await ai.send_message("c1", ai.SendMessageRequest(content="第一章讲了什么"), auth=("u1", "user"))
+            events = [event async for event in response.body_iterator]
+        assert any("done" in str(e) for e in events)
+        return lookup, store
+
+    @pytest.mark.asyncio
+    async def test_first_turn_looks_up_and_stores(self):
+        from app.services.conversation_memory import ConversationMemory
+
+        # 本轮提问已先写入 ai_messages，加载的历史中只有它自己
+        memory = ConversationMemory(messages=[ChatMessage(role="user", content="第一章讲了什么")])
+        lookup, store = await self._qa_turn(memory)
+        lookup.assert_awaited_once()
+        store.assert_called_once()
+
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("memory_kwargs", [
+        {"messages": [
+            ChatMessage(role="user", content="我是王强，正在备考"),
+            ChatMessage(role="assistant", content="好的，王强"),
+            ChatMessage(role="user", content="第一章讲了什么"),
+        ]},
+        {"summary": "用户王强在备考", "messages": [ChatMessage(role="user", content="第一章讲了什么")]},
+    ])
+    async def test_conversation_with_history_neither_hits_nor_stores(self, memory_kwargs):
+        from app.services.conversation_memory import ConversationMemory
+
+        # 即使缓存中有答案、问题看似独立，带有历史的对话也不查询、不写入共享缓存
+        lookup, store = await self._qa_turn(ConversationMemory(**memory_kwargs), cached={"answer": "别人的答案"})
+        lookup.assert_not_awaited()
+        store.assert_not_called()
+
+
+class TestLLMGovernor:
+    """LLM 准入控制测试（Lua 脚本由 MagicMock 替代，返回建议重试毫秒数）"""
+
+    @pytest.fixture
+    def governor(self):
+        from app.services.llm_governor import LLMGovernor
+
+        gov = LLMGovernor()
+        gov._redis = MagicMock()
+        gov._script = MagicMock(return_value=0)
+        return gov
+
+    @pytest.mark.asyncio
+    async def test_slot_acquires_and_releases_lease(self, governor):
+        async with governor.slot("user-1", "model-a"):
+            lease_id = governor._script.call_args.kwargs["args"][1]
+
+        pipe = governor._redis.pipeline.return_value
+        released = {c.args for c in pipe.zrem.call_args_list}
+        assert released == {
+            ("ai:gov:conc:user:user-1", lease_id),
+            ("ai:gov:conc:model:model-a", lease_id),
+            ("ai:gov:conc:global", lease_id),
+        }
+
+    @pytest.mark.asyncio
+    async def test_queues_briefly_until_admitted(self, governor):
+        governor._script.side_effect = [20, 20, 0]
+
+        with patch("app.services.llm_governor.asyncio.sleep", new=AsyncMock()) as sleep:
+            lease_id = await governor.acquire("user-1", "model-a", max_wait=5)
+
+        assert lease_id
+        assert sleep.await_count == 2
+
+    @pytest.mark.asyncio
+    async def test_rejects_after_max_wait(self, governor):
+        from app.services.llm_governor import GovernorRejected
+
+        governor._script.return_value = 100
+        with pytest.raises(GovernorRejected):
+            await governor.acquire("user-1", "model-a", max_wait=0)
+
+    @pytest.mark.asyncio
+    async def test_fails_open_when_redis_unavailable(self, governor):
+        governor._script.side_effect = ConnectionError("redis down")
+
+        async with governor.slot("user-1", "model-a"):
+            pass
+
+        governor._redis.pipeline.assert_not_called()
+
+
+class TestHedgedStream:
+    """LLM 对冲请求测试"""
+
+    PRIMARY = {"provider": "siliconflow", "api_key": "k1", "endpoint": None, "model_id": "primary"}
+    HEDGE = {"provider": "openrouter", "api_key": "k2", "endpoint": None, "model_id": "hedge"}
+
+    @staticmethod
+    def _provider(delay: float, text: str, closed: list):
+        import asyncio
+
+        async def chat_stream(**kwargs):
+            try:
+                await asyncio.sleep(delay)
+                yield LLMStreamChunk(type="delta", content=text)
+                yield LLMStreamChunk(type="done")
+            finally:
+                closed.append(text)
+
+        provider = MagicMock()
+        provider.chat_stream = chat_stream
+        return provider
+
+    async def _collect(self, providers: dict, hedge_config, hedge_after=0.01):
+        from app.services.llm_hedge import HedgedStream
+
+        stream = HedgedStream(
+            self.PRIMARY, hedge_config, [ChatMessage(role="user", content="hi")],
+            temperature=0.7, max_tokens=100, hedge_after=hedge_after,
+        )
+        with patch("app.services.llm_hedge.get_provider", side_effect=lambda name, *a: providers[name]):
+            chunks = [c async for c in stream]
+        return stream, chunks
+
+    @pytest.mark.asyncio
+    async def test_fast_primary_is_not_hedged(self):
+        closed = []
+        providers = {"siliconflow": self._provider(0, "p", closed), "openrouter": self._provider(0, "h", closed)}
+
+        stream, chunks = await self._collect(providers, self.HEDGE, hedge_after=1)
+
+        assert not stream.hedged
+        assert stream.winner_config is self.PRIMARY
+        assert chunks[0].content == "p"
+
+    @pytest.mark.asyncio
+    async def test_slow_primary_loses_and_is_cancelled(self):
+        closed = []
+        providers = {"siliconflow": self._provider(5, "p", closed), "openrouter": self._provider(0, "h", closed)}
+
+        stream, chunks = await self._collect(providers, self.HEDGE)
+
+        assert stream.hedged
+        assert stream.winner_config is self.HEDGE
+        assert [c.content for c in chunks if c.type == "delta"] == ["h"]
+        assert "p" in closed
+
+    @pytest.mark.asyncio
+    async def test_hedge_error_falls_back_to_primary(self):
+        closed = []
+
+        async def failing_stream(**kwargs):
+            yield LLMStreamChunk(type="error", error="HTTP 500")
+
+        failing = MagicMock()
+        failing.chat_stream = failing_stream
+        providers = {"siliconflow": self._provider(0.05, "p", closed), "openrouter": failing}
+
+        stream, chunks = await self._collect(providers, self.HEDGE)
+
+        assert stream.winner_config is self.PRIMARY
+        assert chunks[0].content == "p"
+
+
+class TestSSECoalescing:
+    """SSE delta 合并测试"""
+
+    @staticmethod
+    async def _upstream(items):
+        import asyncio
+
+        for delay, chunk in items:
+            if delay:
+                await asyncio.sleep(delay)
+            yield chunk
+
+    @staticmethod
+    def _delta(text):
+        return LLMStreamChunk(type="delta", content=text)
+
+    @pytest.mark.asyncio
+    async def test_burst_is_merged_after_first_delta(self):
+        from app.services.sse import coalesce_deltas
+
+        items = [(0, self._delta(t)) for t in ["a", "b", "c", "d"]] + [(0, LLMStreamChunk(type="done"))]
+        out = [c async for c in coalesce_deltas(self._upstream(items), window_ms=50)]
+
+        assert [(c.type, c.content) for c in out] == [("delta", "a"), ("delta", "bcd"), ("done", None)]
+
+    @pytest.mark.asyncio
+    async def test_window_expiry_flushes_without_waiting_for_upstream(self):
+        from app.services.sse import coalesce_deltas
+
+        items = [(0, self._delta("a")), (0, self._delta("b")), (0.2, self._delta("c"))]
+        out = [c.content async for c in coalesce_deltas(self._upstream(items), window_ms=10)]
+
+        assert out == ["a", "b", "c"]
+
+    @pytest.mark.asyncio
+    async def test_max_chars_forces_flush(self):
+        from app.services.sse import coalesce_deltas
+
+        items = [(0, self._delta(t)) for t in ["x", "12", "34", "5"]]
+        out = [c.content async for c in coalesce_deltas(self._upstream(items), window_ms=1000, max_chars=4)]
+
+        assert out == ["x", "1234", "5"]
+
+    def test_sse_event_encoding(self):
+        from app.services.sse import sse_event
+
+        raw = sse_event("delta", {"content": "你好"})
+        assert raw.startswith(b"data: ") and raw.endswith(b"\n\n")
+        assert json.loads(raw[6:]) == {"type": "delta", "content": "你好"}
+
+
+class TestTokenCounter:
+    """消息 token 计数测试"""
+
+    def test_char_estimate_handles_mixed_scripts(self):
+        from app.services.token_counter import estimate_tokens_by_chars
+
+        assert estimate_tokens_by_chars("读书毁了我") == 5
+        assert estimate_tokens_by_chars("abcdefgh") == 2
+        assert estimate_tokens_by_chars("王强 wrote books") == 2 + 3
+
+    def test_uses_model_tokenizer_when_available(self):
+        from app.services import token_counter
+
+        tokenizer = MagicMock()
+        tokenizer.encode.return_value.ids = [1, 2, 3]
+        with patch.dict(token_counter._tokenizers, {"deepseek-ai/DeepSeek-V3.2": tokenizer}):
+            assert token_counter.count_tokens("你好", "Pro/deepseek-ai/DeepSeek-V3.2") == 3
+
+    def test_falls_back_when_tokenizer_unavailable(self):
+        from app.services import token_counter
+
+        with patch.dict(token_counter._tokenizers, {"org/missing": None}), \
+             patch.object(token_counter, "_get_tiktoken", return_value=None):
+            assert token_counter.count_tokens("读书", "org/missing") == 2
+        assert token_counter.count_tokens("") == 0
+
+
+class TestModelConfigRegistry:
+    """模型配置注册表测试"""
+
+    @pytest.mark.asyncio
+    async def test_config_cached_until_version_changes(self):
+        from app.services.model_registry import ModelConfigRegistry
+
+        registry = ModelConfigRegistry()
+        registry._redis = MagicMock()
+        registry._redis.get.return_value = "1"
+        config = {"provider": "siliconflow", "model_id": "m", "api_key": "k"}
+
+        with patch("app.services.model_registry.MODEL_CONFIG_CHECK_INTERVAL", 0), \
+             patch("app.services.model_registry._load_default_model_config",
+                   new_callable=AsyncMock, return_value=config) as mock_load:
+            assert await registry.get_default() == config
+            assert await registry.get_default() == config
+            assert mock_load.call_count == 1
+
+            registry._redis.get.return_value = "2"
+            with patch("app.services.llm_provider.clear_provider_cache") as mock_clear:
+                await registry.get_default()
+            assert mock_load.call_count == 2
+            mock_clear.assert_called_once()
+
+    @pytest.mark.asyncio
+    async def test_config_reloaded_after_max_age(self):
+        from app.services.model_registry import ModelConfigRegistry
+
+        registry = ModelConfigRegistry()
+        registry._redis = MagicMock()
+        registry._redis.get.return_value = "1"
+        config = {"provider": "siliconflow", "model_id": "m", "api_key": "k"}
+
+        with patch("app.services.model_registry._load_default_model_config",
+                   new_callable=AsyncMock, return_value=config) as mock_load:
+            await registry.get_default()
+            with patch("app.services.model_registry.MODEL_CONFIG_MAX_AGE", 0):
+                await registry.get_default()
+            assert mock_load.call_count == 2
+
 
 # ============================================================================
 # AI API Tests
@@ -182,6 +849,161 @@ class TestAIConversationsAPI:
                 assert exc_info.value.detail == "insufficient_credits"
 
 
+# ============================================================================
+# QA Retrieval Tests
+# ============================================================================
+
+
+class TestQARetrieval:
+    """QA 并发检索测试"""
+
+    def test_merge_search_results_dedup_primary_first(self):
+        from app.ai import merge_search_results
+
+        primary = [{"chunk_id": "a"}, {"chunk_id": "b"}]
+        secondary = [{"chunk_id": "b"}, {"chunk_id": "c"}, {"chunk_id": "d"}]
+        merged = merge_search_results(primary, secondary, top_k=3)
+
+        assert [c["chunk_id"] for c in merged] == ["a", "b", "c"]
+
+    @pytest.mark.asyncio
+    async def test_speculative_search_runs_during_rewrite(self):
+        """原始问题的向量搜索不等待查询重写"""
+        import asyncio
+        from app.ai import retrieve_qa_context
+
+        speculative_started = asyncio.Event()
+
+        async def fake_rewrite(current_query, history, model_config, conversation_id=None):
+            # 若检索是串行的，这里会一直等待直到超时
+            await asyncio.wait_for(speculative_started.wait(), timeout=1)
+            return "王强还写过什么书"
+
+        async def fake_search(query, content_sha256_list, top_k, **kwargs):
+            if query == "他还写过什么书":
+                speculative_started.set()
+                return [{"chunk_id": "raw", "book_id": "b1", "content": "原始结果"}]
+            return [{"chunk_id": "rw", "book_id": "b1", "content": "重写结果"}]
+
+        book = {"id": "b1", "title": "书", "author": "作者", "content_sha256": "sha"}
+        history = [ChatMessage(role="user", content="王强是谁"), ChatMessage(role="assistant", content="作家")]
+
+        with patch("app.ai.rewrite_query_with_context", side_effect=fake_rewrite), \
+             patch("app.ai.search_book_chunks", side_effect=fake_search), \
+             patch("app.ai.search_user_notes", AsyncMock(return_value=[])), \
+             patch("app.ai.load_book_contexts", AsyncMock(return_value=[book])):
+            ctx = await retrieve_qa_context("他还写过什么书", history, ["b1"], "user-1", {})
+
+        assert ctx["search_query"] == "王强还写过什么书"
+        assert [c["preview"] for c in ctx["citations"]] == ["重写结果", "原始结果"]
+        assert {"book_info", "rewrite", "search_speculative", "search_rewritten", "total"} <= set(ctx["timings"])
+
+    @pytest.mark.parametrize("query,expected", [
+        ("他还写过什么书", True),
+        ("为啥？", True),
+        ("那第二个观点呢", True),
+        ("What did she do next?", True),
+        ("这本书的主要观点是什么", False),
+        ("苏格拉底如何看待死亡", False),
+        ("Summarize the main argument of chapter one", False),
+        ("其中哪个论证最有说服力", True),
+        ("该作者还写过哪些小说", True),
+        ("这个观点应该怎么理解", True),
+        ("他们后来怎样了", True),
+        # 含 该/此/其/他 的普通词，不是指代
+        ("初学者应该先读康德的哪本著作", False),
+        ("为什么说存在先于本质因此人是自由的", False),
+        ("除了柏拉图以外其他古希腊哲学家怎么看灵魂", False),
+        ("尤其在战争年代知识分子如何自处", False),
+        ("古典吉他的历史起源是什么", False),
+    ])
+    def test_needs_query_rewrite(self, query, expected):
+        from app.ai import needs_query_rewrite
+
+        history = [ChatMessage(role="user", content="王强是谁"), ChatMessage(role="assistant", content="作家")]
+        assert needs_query_rewrite(query, history) is expected
+        assert needs_query_rewrite(query, []) is False
+
+    def test_rewrite_cache_key_identifies_turn_by_content(self):
+        """history 长度相同（被截断）时，不同轮次的缓存 key 不同"""
+        from app.ai import _rewrite_cache_key
+
+        turn_a = [ChatMessage(role="user", content="王强是谁"), ChatMessage(role="assistant", content="作家")]
+        turn_b = [ChatMessage(role="user", content="李白是谁"), ChatMessage(role="assistant", content="诗人")]
+        assert _rewrite_cache_key("c1", turn_a, "他还写过什么") != _rewrite_cache_key("c1", turn_b, "他还写过什么")
+        assert _rewrite_cache_key("c1", turn_a, "他还写过什么") == _rewrite_cache_key("c1", list(turn_a), "他还写过什么")
+
+    @pytest.mark.asyncio
+    async def test_rewrite_cached_per_turn(self):
+        """同一对话同一轮次的重写只调用一次 LLM"""
+        from app.ai import rewrite_query_with_context
+
+        store = {}
+        fake_redis = MagicMock()
+        fake_redis.get.side_effect = store.get
+        fake_redis.setex.side_effect = lambda k, ttl, v: store.__setitem__(k, v)
+
+        async def fake_stream(**kwargs):
+            yield MagicMock(type="delta", content="王强还写过什么书")
+            yield MagicMock(type="done", content=None)
+
+        provider = MagicMock()
+        provider.chat_stream = MagicMock(side_effect=lambda **kw: fake_stream(**kw))
+        history = [ChatMessage(role="user", content="王强是谁"), ChatMessage(role="assistant", content="作家")]
+        config = {"provider": "siliconflow", "api_key": "k", "endpoint": None, "model_id": "m"}
+
+        with patch("app.ai.redis_client", fake_redis), patch("app.ai.get_provider", return_value=provider):
+            first = await rewrite_query_with_context("他还写过什么书", history, config, conversation_id="c1")
+            second = await rewrite_query_with_context("他还写过什么书", history, config, conversation_id="c1")
+
+        assert first == second == "王强还写过什么书"
+        assert provider.chat_stream.call_count == 1
+
+
+    @pytest.mark.asyncio
+    async def test_load_book_contexts_single_query_and_cache(self):
+        """批量书籍信息：一次 ANY(:ids) 查询，第二次命中缓存"""
+        from app.services import book_context
+
+        store = {}
+        fake_redis = MagicMock()
+        fake_redis.hmget.side_effect = lambda key, fields: [store.get(f) for f in fields]
+        fake_pipe = MagicMock()
+        fake_pipe.hset.side_effect = lambda key, mapping: store.update(mapping)
+        fake_redis.pipeline.return_value = fake_pipe
+
+        with patch.object(book_context, "_get_redis", return_value=fake_redis), \
+             patch.object(book_context, "engine") as mock_engine:
+            mock_conn = AsyncMock()
+            mock_result = MagicMock()
+            mock_result.fetchall.return_value = [
+                ("b2", "书二", None, "sha2", 3),
+                ("b1", "书一", "作者一", "sha1", 1),
+            ]
+            mock_conn.execute.return_value = mock_result
+            mock_engine.begin.return_value.__aenter__.return_value = mock_conn
+
+            first = await book_context.load_book_contexts(["b1", "b2", "missing"], "user-1")
+            second = await book_context.load_book_contexts(["b1", "b2"], "user-1")
+
+        assert mock_conn.execute.call_count == 1
+        assert mock_conn.execute.call_args.args[1]["ids"] == ["b1", "b2", "missing"]
+        assert [b["id"] for b in first] == ["b1", "b2"]
+        assert first[1]["author"] == "未知作者"
+        assert second == first
+
+    @pytest.mark.asyncio
+    async def test_powersync_book_update_invalidates_context_cache(self):
+        """PowerSync 修改书名后清除书籍上下文缓存"""
+        from app import powersync
+
+        conn = AsyncMock()
+        with patch("app.services.book_context.invalidate_book_context_cache") as invalidate:
+            await powersync._handle_books_update(conn, "b1", {"title": "新书名"}, "user-1", MagicMock())
+
+        invalidate.assert_called_once_with("user-1")
+
+
 # ============================================================================
 # Admin AI API Tests
 # ============================================================================
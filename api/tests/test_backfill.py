@@ -0,0 +1,129 @@
+"""
+书籍批量补处理编排测试
+
+测试覆盖:
+- 队列水位线与 gpu_high 让路（含公平调度子队列积压）
+- 剩余时间估算
+- 分批投递与游标推进
+- 补处理任务以最低优先级投递
+"""
+
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+
+from app.services import backfill
+
+
+def _job(**overrides):
+    job = {
+        "id": "vector-missing",
+        "kind": "vector",
+        "scope": "missing",
+        "status": "running",
+        "cursor_created_at": None,
+        "cursor_id": None,
+        "total": 100,
+        "enqueued": 40,
+        "rate_started_at": datetime.now(timezone.utc) - timedelta(minutes=10),
+        "rate_base": 0,
+    }
+    job.update(overrides)
+    return job
+
+
+def _mock_engine(conn):
+    @asynccontextmanager
+    async def _ctx():
+        yield conn
+
+    engine = MagicMock()
+    engine.connect = _ctx
+    engine.begin = _ctx
+    return engine
+
+
+class TestBackfillThrottle:
+    """水位线与让路测试"""
+
+    def test_vector_yields_to_gpu_high(self):
+        depths = {"gpu_high": 1, "gpu_low": 0}
+        with patch.object(backfill, "queue_depth", side_effect=depths.get), \
+             patch.object(backfill, "pending_count", return_value=0):
+            assert backfill.available_slots("vector") == 0
+
+    def test_vector_fills_up_to_watermark(self):
+        depths = {"gpu_high": 0, "gpu_low": 1}
+        with patch.object(backfill, "queue_depth", side_effect=depths.get), \
+             patch.object(backfill, "pending_count", return_value=0):
+            assert backfill.available_slots("vector") == backfill.VECTOR_WATERMARK - 1
+
+    def test_fair_queue_backlog_counts_against_watermark(self):
+        pending = {"gpu_high": 1, "gpu_low": 0}
+        with patch.object(backfill, "queue_depth", return_value=0), \
+             patch.object(backfill, "pending_count", side_effect=pending.get):
+            assert backfill.available_slots("vector") == 0
+            assert backfill.available_slots("ocr") == backfill.OCR_WATERMARK - 1
+
+    def test_eta_from_rate_since_resume(self):
+        job = backfill._with_eta(_job())
+        assert job["remaining"] == 60
+        assert job["rate_per_min"] == pytest.approx(4.0, rel=0.01)
+        assert job["eta_seconds"] == pytest.approx(900, rel=0.01)
+        assert backfill._with_eta(_job(status="paused"))["eta_seconds"] is None
+
+    def test_unsupported_scope_rejected(self):
+        with pytest.raises(ValueError):
+            backfill._where("ocr", "all")
+
+
+class TestBackfillStep:
+    """分批投递与游标推进测试"""
+
+    @pytest.mark.asyncio
+    async def test_waits_when_queue_full(self):
+        conn = AsyncMock()
+        with patch.object(backfill, "engine", _mock_engine(conn)), \
+             patch.object(backfill, "_load_job", AsyncMock(return_value=_job())), \
+             patch.object(backfill, "available_slots", return_value=0), \
+             patch.object(backfill, "_dispatch") as dispatch:
+            assert await backfill.run_backfill_step("vector-missing") == "running"
+        dispatch.assert_not_called()
+        conn.execute.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_dispatches_batch_and_advances_cursor(self):
+        conn = AsyncMock()
+        created = datetime(2026, 10, 19, tzinfo=timezone.utc)
+        books = [
+            {"id": "b1", "user_id": "u1", "created_at": created},
+            {"id": "b2", "user_id": "u1", "created_at": created},
+        ]
+        with patch.object(backfill, "engine", _mock_engine(conn)), \
+             patch.object(backfill, "_load_job", AsyncMock(return_value=_job())), \
+             patch.object(backfill, "available_slots", return_value=2), \
+             patch.object(backfill, "_next_books", AsyncMock(return_value=books)) as next_books, \
+             patch.object(backfill, "_dispatch") as dispatch:
+            assert await backfill.run_backfill_step("vector-missing") == "running"
+
+        assert next_books.await_args.args[2] == 2
+        assert dispatch.call_count == 2
+        params = conn.execute.await_args.args[1]
+        assert params["book_id"] == "b2" and params["n"] == 2
+
+    @pytest.mark.asyncio
+    async def test_paused_job_does_nothing(self):
+        with patch.object(backfill, "engine", _mock_engine(AsyncMock())), \
+             patch.object(backfill, "_load_job", AsyncMock(return_value=_job(status="paused"))), \
+             patch.object(backfill, "available_slots") as slots:
+            assert await backfill.run_backfill_step("vector-missing") == "paused"
+        slots.assert_not_called()
+
+    def test_dispatch_uses_lowest_broker_priority(self):
+        # kombu Redis 传输先消费优先级 0，补处理必须用最大档位，排在用户任务（3 / 7）之后
+        with patch.object(backfill, "submit_task") as submit:
+            backfill._dispatch("ocr", {"id": "b1", "user_id": "u1"})
+        assert submit.call_args.kwargs["priority"] == 9
+        assert submit.call_args.args == ("tasks.process_book_ocr", ["b1", "u1"], backfill.BACKFILL_TENANT)
@@ -0,0 +1,108 @@
+"""
+GPU 队列公平调度测试
+
+测试覆盖:
+- 加权轮询：大批量用户不阻塞其他用户
+- 水位线：Celery 队列积压达到上限时停止转发
+- 关闭 / Redis 不可用时直接投递
+- Celery 队列长度统计（含优先级子队列）
+- 入队 / 选取在 fakeredis 中执行生产 Lua 脚本
+"""
+
+import json
+from unittest.mock import MagicMock, patch
+
+import fakeredis
+import pytest
+
+from app.services import fair_queue
+
+
+@pytest.fixture
+def fake_redis():
+    """带 Lua 支持的 fakeredis：_ENQUEUE_SCRIPT / _PICK_SCRIPT 按生产脚本执行"""
+    redis = fakeredis.FakeRedis(decode_responses=True)
+    with patch.object(fair_queue, "_get_redis", return_value=redis), \
+         patch.object(fair_queue, "_scripts", None), \
+         patch.object(fair_queue, "FAIR_QUEUE_ENABLED", True):
+        yield redis
+
+
+def _submit_without_pump(user, n, weight=1):
+    with patch.object(fair_queue, "pump"):
+        for i in range(n):
+            fair_queue.submit_task("tasks.process_book_ocr", [f"{user}-{i}", user], user, weight=weight)
+
+
+def _drain(celery):
+    """Celery 队列始终空闲时依次转发，返回转发的用户顺序"""
+    order = []
+    celery.send_task.side_effect = lambda name, args, priority=None: order.append(args[1])
+    with patch.object(fair_queue, "queue_depth", return_value=0):
+        fair_queue.pump("gpu_high")
+    return order
+
+
+class TestFairQueue:
+    """加权轮询与水位线测试"""
+
+    def test_bulk_import_does_not_block_other_users(self, fake_redis):
+        celery = MagicMock()
+        with patch("app.celery_app.celery_app", celery):
+            _submit_without_pump("bulk", 5)
+            _submit_without_pump("alice", 1)
+            _submit_without_pump("bob", 1)
+            order = _drain(celery)
+
+        assert order[:3] == ["bulk", "alice", "bob"]
+        assert order.count("bulk") == 5
+
+    def test_weight_gives_more_turns_per_round(self, fake_redis):
+        celery = MagicMock()
+        with patch("app.celery_app.celery_app", celery):
+            _submit_without_pump("pro", 4, weight=2)
+            _submit_without_pump("free", 4)
+            order = _drain(celery)
+
+        assert order[:6] == ["pro", "pro", "free", "pro", "pro", "free"]
+
+    def test_stops_at_watermark(self, fake_redis):
+        celery = MagicMock()
+        with patch("app.celery_app.celery_app", celery):
+            _submit_without_pump("alice", 3)
+            with patch.object(fair_queue, "queue_depth", side_effect=[0, fair_queue.FAIR_QUEUE_WATERMARK]):
+                assert fair_queue.pump("gpu_high") == 1
+
+        assert celery.send_task.call_count == 1
+        stats = fair_queue.fair_queue_stats("gpu_high")
+        assert stats[0]["tenant"] == "alice" and stats[0]["pending"] == 2
+
+    def test_non_gpu_tasks_bypass_fair_queue(self, fake_redis):
+        celery = MagicMock()
+        with patch("app.celery_app.celery_app", celery):
+            fair_queue.submit_task("tasks.deep_analyze_book", ["b1", "alice"], "alice")
+
+        celery.send_task.assert_called_once_with("tasks.deep_analyze_book", args=["b1", "alice"], priority=None)
+        assert fake_redis.llen("fair:cpu_default:ring") == 0
+
+    def test_redis_error_sends_directly(self):
+        celery = MagicMock()
+        with patch("app.celery_app.celery_app", celery), \
+             patch.object(fair_queue, "FAIR_QUEUE_ENABLED", True), \
+             patch.object(fair_queue, "_get_scripts", side_effect=ConnectionError("down")):
+            fair_queue.submit_task("tasks.index_book_vectors", ["b1"], "alice")
+
+        celery.send_task.assert_called_once_with("tasks.index_book_vectors", args=["b1"], priority=None)
+
+    def test_queue_depth_counts_priority_sub_queues(self):
+        redis = MagicMock()
+        redis.pipeline.return_value.execute.return_value = [2, 0, 1, 0]
+        with patch.object(fair_queue, "_get_redis", return_value=redis):
+            assert fair_queue.queue_depth("gpu_low") == 3
+        keys = [c.args[0] for c in redis.pipeline.return_value.llen.call_args_list]
+        assert keys[0] == "gpu_low" and keys[1] == "gpu_low\x06\x163"
+
+    def test_item_records_enqueue_time(self, fake_redis):
+        _submit_without_pump("alice", 1)
+        item = json.loads(fake_redis.lindex("fair:gpu_high:user:alice", 0))
+        assert item["task"] == "tasks.process_book_ocr" and item["enqueued_at"] > 0
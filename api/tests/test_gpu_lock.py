@@ -0,0 +1,144 @@
+"""
+GPU 锁（优先级仲裁）测试
+
+测试覆盖:
+- 等待释放通知后获取、超时退出队列
+- 更高优先级等待者到达时让出 GPU、租约丢失后重新获取
+- Redis 不可用时不加锁执行
+- OCR 在 GPU 模式下按页段处理并在段间让出
+"""
+
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from app.services import gpu_lock
+from app.services.gpu_lock import GPULock, GPULockAcquisitionError
+
+
+@pytest.fixture
+def scripts():
+    acquire, release, renew = MagicMock(), MagicMock(return_value=""), MagicMock(return_value=1)
+    redis = MagicMock()
+    with patch.object(gpu_lock, "_get_scripts", return_value=(acquire, release, renew)), \
+         patch.object(gpu_lock, "_get_redis", return_value=redis), \
+         patch.object(gpu_lock, "GPU_LOCK_ENABLED", True):
+        yield acquire, release, redis
+
+
+def _score(priority):
+    return gpu_lock.GPU_PRIORITIES[priority] * gpu_lock._RANK_SPAN + 1_800_000_000_000
+
+
+class TestGPULock:
+    """获取 / 释放 / 让出测试"""
+
+    def test_waits_for_wake_notification(self, scripts):
+        acquire, release, redis = scripts
+        acquire.side_effect = [0, 1]
+
+        lock = GPULock(priority="interactive", name="query")
+        assert lock.acquire() and lock.held
+        token = acquire.call_args.kwargs["args"][0]
+        redis.blpop.assert_called_once()
+        assert redis.blpop.call_args.args[0] == [gpu_lock.GPU_WAKE_PREFIX + token]
+        # 两次尝试使用同一排队分值（保持到达顺序）
+        assert acquire.call_args_list[0].kwargs["args"][1] == acquire.call_args_list[1].kwargs["args"][1]
+
+        assert lock.release() and not lock.held
+        assert release.call_args.kwargs["args"][0] == token
+
+    def test_blocking_timeout_leaves_queue(self, scripts):
+        acquire, _, redis = scripts
+        acquire.return_value = 0
+
+        with pytest.raises(GPULockAcquisitionError):
+            GPULock(blocking_timeout=0).acquire()
+        redis.pipeline.return_value.zrem.assert_any_call(gpu_lock.GPU_WAITERS_KEY, acquire.call_args.kwargs["args"][0])
+
+    def test_yields_only_to_higher_priority(self, scripts):
+        acquire, release, redis = scripts
+        acquire.return_value = 1
+        lock = GPULock(priority="normal", name="ocr")
+        lock.acquire()
+
+        redis.zrange.return_value = [("w1", float(_score("background")))]
+        assert not lock.yield_if_needed()
+
+        redis.zrange.return_value = [("w2", float(_score("interactive")))]
+        assert lock.yield_if_needed()
+        release.assert_called_once()
+        assert acquire.call_count == 2 and lock.held
+        lock.release()
+
+    def test_lost_lease_reacquires_at_safe_point(self, scripts):
+        acquire, release, redis = scripts
+        acquire.return_value = 1
+        redis.zrange.return_value = []
+        lock = GPULock(priority="background", name="index")
+        lock.acquire()
+        first = lock._lock_id
+
+        lock.lost = True
+        assert lock.yield_if_needed()
+        # 锁已被他人接手：不走释放脚本（不能替新持有者唤醒等待者），重新排队获取
+        release.assert_not_called()
+        assert acquire.call_count == 2 and lock.held and not lock.lost
+        assert lock._lock_id != first
+        lock.release()
+
+    def test_redis_error_runs_without_lock(self):
+        with patch.object(gpu_lock, "_get_scripts", side_effect=ConnectionError("down")), \
+             patch.object(gpu_lock, "_get_redis", return_value=MagicMock()), \
+             patch.object(gpu_lock, "GPU_LOCK_ENABLED", True):
+            with gpu_lock.gpu_lock(priority="background") as lock:
+                assert not lock.held
+
+    def test_unknown_priority_rejected(self):
+        with pytest.raises(ValueError):
+            GPULock(priority="urgent")
+
+
+def _pdf(pages):
+    import fitz
+
+    doc = fitz.open()
+    for i in range(pages):
+        doc.new_page().insert_text((72, 72), f"page {i + 1}")
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+class TestOCRSegments:
+    """OCR 页段与让出测试"""
+
+    def test_cpu_mode_processes_whole_pdf(self):
+        from app.tasks import ocr_tasks
+
+        with patch.object(ocr_tasks, "OCR_PADDLE_USE_GPU", False), \
+             patch("app.services.ocrmypdf_paddleocr_service.ocr_pdf_bytes", return_value=b"pdf") as ocr, \
+             patch("app.services.gpu_lock.gpu_lock") as lock:
+            assert ocr_tasks._ocr_layered_pdf(_pdf(3)) == b"pdf"
+        ocr.assert_called_once()
+        lock.assert_not_called()
+
+    def test_gpu_mode_yields_between_segments(self):
+        import fitz
+        from app.tasks import ocr_tasks
+
+        lock = MagicMock()
+        gpu_section = MagicMock()
+        gpu_section.return_value.__enter__.return_value = lock
+        with patch.object(ocr_tasks, "OCR_PADDLE_USE_GPU", True), \
+             patch.object(ocr_tasks, "OCR_YIELD_PAGES", 2), \
+             patch("app.services.ocrmypdf_paddleocr_service.ocr_pdf_bytes", side_effect=lambda pdf_data, **kw: pdf_data) as ocr, \
+             patch("app.services.gpu_lock.gpu_lock", gpu_section):
+            result = ocr_tasks._ocr_layered_pdf(_pdf(5))
+
+        assert ocr.call_count == 3
+        assert lock.yield_if_needed.call_count == 2
+        assert gpu_section.call_args.kwargs["priority"] == "normal"
+        with fitz.open(stream=result, filetype="pdf") as doc:
+            assert len(doc) == 5
+            assert "page 5" in doc[4].get_text()
@@ -0,0 +1,685 @@
+"""
+RAG 检索层测试
+
+测试覆盖:
+- Embedding 推理后端选择（torch / onnx / auto）
+- 小语料精确搜索 / HNSW 路径选择
+- 书籍块数缓存
+- 章节序号解析与章节查询
+- 按书籍分组多样化检索
+- 本地 Cross-Encoder 重排序
+- 笔记向量批量索引（删除墓碑）与按用户路由
+- 书籍向量索引零停机重建（读/写别名）
+- 书籍向量索引维护（segment 合并 / refresh 调整）
+"""
+
+import pytest
+from unittest.mock import AsyncMock, MagicMock, patch
+
+from app.services import llama_rag
+
+
+def _hit(score: float, book_id: str = "b1") -> dict:
+    return {
+        "_score": score,
+        "_source": {"text": "正文", "metadata": {"book_id": book_id, "chunk_index": 0}},
+    }
+
+
+def _count_response(counts: dict) -> dict:
+    return {
+        "aggregations": {
+            "per_book": {"buckets": [{"key": k, "doc_count": v} for k, v in counts.items()]}
+        }
+    }
+
+
+@pytest.fixture(autouse=True)
+def clear_chunk_count_cache():
+    llama_rag.invalidate_chunk_count_cache()
+    yield
+    llama_rag.invalidate_chunk_count_cache()
+
+
+def _mock_client(search_side_effect):
+    client = MagicMock()
+    client.search = AsyncMock(side_effect=search_side_effect)
+    client.close = AsyncMock()
+    return client
+
+
+# ============================================================================
+# opensearch_knn_search 路径选择
+# ============================================================================
+
+
+class TestEmbeddingBackendSelection:
+    """Embedding 推理后端选择测试"""
+
+    @pytest.fixture
+    def cpu_host(self, monkeypatch):
+        monkeypatch.setenv("EMBEDDING_USE_GPU", "false")
+        torch = MagicMock()
+        huggingface = MagicMock()
+        with patch.object(llama_rag, "_embed_model", None), \
+             patch.object(llama_rag, "_embed_device", None), \
+             patch.dict("sys.modules", {
+                 "torch": torch,
+                 "llama_index.embeddings.huggingface": huggingface,
+             }):
+            yield huggingface.HuggingFaceEmbedding
+
+    def _load(self, backend, onnx_model):
+        with patch.object(llama_rag, "EMBEDDING_BACKEND", backend), \
+             patch("app.services.onnx_embedding.create_onnx_embedding", return_value=onnx_model) as create:
+            return llama_rag.get_embed_model(), create
+
+    def test_torch_backend_never_loads_onnx(self, cpu_host):
+        model, create = self._load("torch", MagicMock())
+        create.assert_not_called()
+        assert model is cpu_host.return_value
+
+    @pytest.mark.parametrize("backend", ["onnx", "auto"])
+    def test_onnx_used_on_cpu(self, cpu_host, backend):
+        onnx_model = MagicMock()
+        model, create = self._load(backend, onnx_model)
+        assert model is onnx_model
+        assert llama_rag._embed_device == "cpu"
+        cpu_host.assert_not_called()
+
+    def test_falls_back_to_torch_when_onnx_unavailable(self, cpu_host):
+        model, create = self._load("onnx", None)
+        create.assert_called_once()
+        assert model is cpu_host.return_value
+
+
+class TestKnnSearchPathSelection:
+    """小语料精确搜索测试"""
+
+    @pytest.mark.asyncio
+    async def test_small_corpus_uses_exact_script_score(self):
+        client = _mock_client([
+            _count_response({"sha-a": 1200}),
+            {"hits": {"hits": [_hit(1.8)]}},
+        ])
+        with patch("opensearchpy.AsyncOpenSearch", return_value=client):
+            results = await llama_rag.opensearch_knn_search([0.1] * 4, ["sha-a"], top_k=5, min_score=0.3)
+
+        body = client.search.call_args_list[1].kwargs["body"]
+        assert "script_score" in body["query"]
+        # knn_score 返回 1 + cos，换算为与 Lucene knn 一致的 (1 + cos) / 2
+        assert results[0]["score"] == pytest.approx(0.9)
+
+    @pytest.mark.asyncio
+    async def test_large_corpus_uses_hnsw(self):
+        client = _mock_client([
+            _count_response({"sha-a": llama_rag.EXACT_SEARCH_MAX_CHUNKS + 1}),
+            {"hits": {"hits": [_hit(0.8)]}},
+        ])
+        with patch("opensearchpy.AsyncOpenSearch", return_value=client):
+            results = await llama_rag.opensearch_knn_search([0.1] * 4, ["sha-a"], top_k=5, min_score=0.3)
+
+        body = client.search.call_args_list[1].kwargs["body"]
+        assert "knn" in body["query"]
+        assert results[0]["score"] == pytest.approx(0.8)
+
+    @pytest.mark.asyncio
+    async def test_unfiltered_search_skips_count_lookup(self):
+        client = _mock_client([{"hits": {"hits": []}}])
+        with patch("opensearchpy.AsyncOpenSearch", return_value=client):
+            await llama_rag.opensearch_knn_search([0.1] * 4, [], top_k=5)
+
+        assert client.search.call_count == 1
+        assert "knn" in client.search.call_args.kwargs["body"]["query"]
+
+    @pytest.mark.asyncio
+    async def test_exact_failure_falls_back_to_hnsw(self):
+        client = _mock_client([
+            _count_response({"sha-a": 100}),
+            Exception("script not supported"),
+            {"hits": {"hits": [_hit(0.7)]}},
+        ])
+        with patch("opensearchpy.AsyncOpenSearch", return_value=client):
+            results = await llama_rag.opensearch_knn_search([0.1] * 4, ["sha-a"], top_k=5, min_score=0.3)
+
+        assert "knn" in client.search.call_args_list[2].kwargs["body"]["query"]
+        assert results[0]["score"] == pytest.approx(0.7)
+
+
+class TestChunkCountCache:
+    """书籍块数缓存测试"""
+
+    @pytest.mark.asyncio
+    async def test_counts_are_cached(self):
+        client = _mock_client([_count_response({"sha-a": 10, "sha-b": 20})])
+        first = await llama_rag.get_chunk_counts(client, ["sha-a", "sha-b"])
+        second = await llama_rag.get_chunk_counts(client, ["sha-a", "sha-b"])
+
+        assert first == second == {"sha-a": 10, "sha-b": 20}
+        assert client.search.call_count == 1
+
+    @pytest.mark.asyncio
+    async def test_zero_counts_not_cached(self):
+        client = _mock_client([_count_response({}), _count_response({"sha-a": 5})])
+        assert await llama_rag.get_chunk_counts(client, ["sha-a"]) == {"sha-a": 0}
+        assert await llama_rag.get_chunk_counts(client, ["sha-a"]) == {"sha-a": 5}
+
+
+# ============================================================================
+# 章节序号解析 / 章节查询
+# ============================================================================
+
+
+class TestChapterOrdinal:
+    """章节序号解析与章节查询测试"""
+
+    @pytest.mark.parametrize("text,expected", [
+        ("三", 3), ("十", 10), ("十二", 12), ("二十", 20), ("二十五", 25),
+        ("一百零一", 101), ("两百", 200), ("一二三", 123), ("42", 42), ("abc", None),
+    ])
+    def test_parse_chinese_numeral(self, text, expected):
+        assert llama_rag.parse_chinese_numeral(text) == expected
+
+    @pytest.mark.parametrize("query,expected", [
+        ("这本书第三章讲了什么", 3),
+        ("第3章的标题", 3),
+        ("第三十六章", 36),
+        ("第 一百零一 回", 101),
+        ("What happens in Chapter 7?", 7),
+        ("第１２章", 12),
+        ("这本书讲了什么", None),
+    ])
+    def test_extract_chapter_number(self, query, expected):
+        assert llama_rag.extract_chapter_number(query) == expected
+
+    @pytest.mark.asyncio
+    async def test_search_by_chapter_uses_ordinal_term(self):
+        client = _mock_client([{"hits": {"hits": [_hit(1.0)]}}])
+        with patch("opensearchpy.AsyncOpenSearch", return_value=client):
+            results = await llama_rag.search_by_chapter(3, ["sha-a"], top_k=5)
+
+        assert len(results) == 1
+        assert client.search.call_count == 1
+        filters = client.search.call_args.kwargs["body"]["query"]["bool"]["filter"]
+        assert {"term": {"metadata.chapter_ordinal": 3}} in filters
+
+    @pytest.mark.asyncio
+    async def test_ordinal_miss_on_reindexed_books_skips_wildcard(self):
+        client = _mock_client([
+            {"hits": {"hits": []}},
+            _count_response({"sha-a": 120, "sha-b": 80}),
+        ])
+        with patch("opensearchpy.AsyncOpenSearch", return_value=client):
+            results = await llama_rag.search_by_chapter(99, ["sha-a", "sha-b"], top_k=5)
+
+        assert results == []
+        assert client.search.call_count == 2
+        exists_filters = client.search.call_args.kwargs["body"]["query"]["bool"]["filter"]
+        assert {"exists": {"field": "metadata.chapter_ordinal"}} in exists_filters
+
+    @pytest.mark.asyncio
+    async def test_wildcard_fallback_limited_to_legacy_books(self):
+        section_hit = {"_source": {"metadata": {"section_index": 4, "chapter_title": "第三章 启程"}}}
+        client = _mock_client([
+            {"hits": {"hits": []}},
+            _count_response({"sha-new": 120}),
+            {"hits": {"hits": [section_hit]}},
+            {"hits": {"hits": [_hit(1.0)]}},
+        ])
+        with patch("opensearchpy.AsyncOpenSearch", return_value=client):
+            results = await llama_rag.search_by_chapter(3, ["sha-new", "sha-old"], top_k=5)
+
+        assert len(results) == 1
+        wildcard_body = client.search.call_args_list[2].kwargs["body"]
+        assert wildcard_body["query"]["bool"]["filter"] == [{"terms": {"metadata.content_sha256": ["sha-old"]}}]
+
+
+# ============================================================================
+# 按书籍分组多样化检索
+# ============================================================================
+
+
+def _group(sha: str, hits: list) -> dict:
+    return {"_score": hits[0]["_score"], "inner_hits": {"per_book": {"hits": {"hits": hits}}}}
+
+
+class TestPerBookDiversification:
+    """按书籍配额检索测试"""
+
+    @pytest.mark.asyncio
+    async def test_knn_collapses_by_book(self):
+        client = _mock_client([
+            _count_response({"sha-a": 100, "sha-b": 100}),
+            {"hits": {"hits": [
+                _group("sha-a", [_hit(1.8, "a"), _hit(1.6, "a")]),
+                _group("sha-b", [_hit(1.7, "b")]),
+            ]}},
+        ])
+        with patch("opensearchpy.AsyncOpenSearch", return_value=client):
+            results = await llama_rag.opensearch_knn_search(
+                [0.1] * 4, ["sha-a", "sha-b"], top_k=10, min_score=0.3, per_book_limit=2
+            )
+
+        body = client.search.call_args_list[1].kwargs["body"]
+        assert body["collapse"]["field"] == "metadata.content_sha256"
+        assert body["collapse"]["inner_hits"]["size"] == 2
+        assert [r["book_id"] for r in results] == ["a", "b", "a"]
+
+    @pytest.mark.asyncio
+    async def test_hnsw_queries_each_book_separately(self):
+        # 大书架走 HNSW：sha-a 的块全局分数都更高，单个 knn 查询的前 k 个会被它占满
+        client = _mock_client([_count_response({"sha-a": 30000, "sha-b": 500, "sha-c": 500})])
+        client.msearch = AsyncMock(return_value={"responses": [
+            {"hits": {"hits": [_hit(1.9, "a"), _hit(1.8, "a")]}},
+            {"hits": {"hits": [_hit(1.2, "b")]}},
+            {"error": {"type": "timeout"}},
+        ]})
+        with patch("opensearchpy.AsyncOpenSearch", return_value=client):
+            results = await llama_rag.opensearch_knn_search(
+                [0.1] * 4, ["sha-a", "sha-b", "sha-c"], top_k=6, min_score=0.3, per_book_limit=2
+            )
+
+        assert client.search.call_count == 1  # 只有块数统计
+        searches = client.msearch.call_args.kwargs["body"]
+        queries = searches[1::2]
+        assert len(queries) == 3
+        for sha, query in zip(["sha-a", "sha-b", "sha-c"], queries):
+            knn = query["query"]["knn"]["embedding"]
+            assert knn["k"] == 2 and query["size"] == 2
+            assert knn["filter"]["bool"]["filter"] == [{"term": {"metadata.content_sha256": sha}}]
+        assert [r["book_id"] for r in results] == ["a", "a", "b"]
+
+    def test_apply_per_book_limit(self):
+        docs = [{"book_id": "a"}, {"book_id": "a"}, {"book_id": "b"}, {"book_id": "a"}]
+        assert [d["book_id"] for d in llama_rag._apply_per_book_limit(docs, 2)] == ["a", "a", "b"]
+        assert llama_rag._apply_per_book_limit(docs, None) == docs
+
+    def test_apply_per_book_limit_shares_quota_across_copies(self):
+        # 同一内容以不同 book_id 重复索引时共用一个配额（与 collapse 的分组键一致）
+        docs = [
+            {"book_id": "a1", "content_sha256": "sha-a"},
+            {"book_id": "a2", "content_sha256": "sha-a"},
+            {"book_id": "a1", "content_sha256": "sha-a"},
+            {"book_id": "b", "content_sha256": "sha-b"},
+        ]
+        limited = llama_rag._apply_per_book_limit(docs, 2)
+        assert [d["book_id"] for d in limited] == ["a1", "a2", "b"]
+
+
+# ============================================================================
+# 本地 Cross-Encoder 重排序
+# ============================================================================
+
+
+class TestLocalRerankClient:
+    """集群内 Reranker 微批与缓存测试"""
+
+    @pytest.fixture
+    def client(self):
+        from app.services.local_reranker import LocalRerankClient
+        client = LocalRerankClient()
+        client._redis = MagicMock()
+        client._redis.mget.side_effect = lambda keys: [None] * len(keys)
+        return client
+
+    @pytest.mark.asyncio
+    async def test_concurrent_requests_share_one_task(self, client):
+        import asyncio
+
+        task = MagicMock()
+        task.get.return_value = [[0.1, 0.9], [0.5]]
+        with patch("app.celery_app.celery_app.send_task", return_value=task) as send_task:
+            first, second = await asyncio.gather(
+                client.rerank("q1", ["a", "b"], chunk_ids=["c1", "c2"], top_n=2),
+                client.rerank("q2", ["c"], chunk_ids=["c3"]),
+            )
+
+        assert send_task.call_count == 1
+        groups = send_task.call_args.kwargs["args"][0]
+        assert [g["query"] for g in groups] == ["q1", "q2"]
+        assert [r.index for r in first] == [1, 0]
+        assert second[0].relevance_score == pytest.approx(0.5)
+
+    @pytest.mark.asyncio
+    async def test_cached_scores_skip_worker(self, client):
+        client._redis.mget.side_effect = lambda keys: ["0.2", "0.8"]
+        with patch("app.celery_app.celery_app.send_task") as send_task:
+            results = await client.rerank("q", ["a", "b"], chunk_ids=["c1", "c2"])
+
+        send_task.assert_not_called()
+        assert [r.index for r in results] == [1, 0]
+
+
+# ============================================================================
+# 笔记向量批量索引
+# ============================================================================
+
+
+def _note(note_id: str, content: str) -> dict:
+    return {"note_id": note_id, "user_id": "u1", "book_id": "b1", "content": content}
+
+
+class TestBulkNoteIndexing:
+    """笔记向量批量索引测试"""
+
+    @pytest.mark.asyncio
+    async def test_one_embedding_pass_and_one_bulk_write(self):
+        embed_model = MagicMock()
+        embed_model.get_text_embedding_batch.side_effect = lambda texts: [[0.1] * 4 for _ in texts]
+        client = MagicMock()
+        client.bulk = AsyncMock(return_value={"items": [{"index": {}}, {"index": {}}]})
+        client.close = AsyncMock()
+
+        redis_client = MagicMock()
+        redis_client.mget.side_effect = lambda keys: [None] * len(keys)
+
+        with patch.object(llama_rag, "_redis", redis_client), \
+             patch.object(llama_rag, "ensure_user_notes_index", AsyncMock()), \
+             patch.object(llama_rag, "get_embed_model", return_value=embed_model), \
+             patch("opensearchpy.AsyncOpenSearch", return_value=client):
+            indexed = await llama_rag.bulk_index_user_notes([
+                _note("n1", "旧内容"), _note("n2", "笔记二"), _note("n1", "新内容"), _note("n3", "  "),
+            ])
+
+        assert indexed == 2
+        embed_model.get_text_embedding_batch.assert_called_once_with(["新内容", "笔记二"])
+        body = client.bulk.call_args.kwargs["body"]
+        assert [line["index"]["_id"] for line in body[::2]] == ["n1", "n2"]
+        assert client.bulk.call_args.kwargs["refresh"] is False
+        assert {line["index"]["routing"] for line in body[::2]} == {"u1"}
+
+    @pytest.mark.asyncio
+    async def test_deleted_notes_are_not_reindexed(self):
+        embed_model = MagicMock()
+        embed_model.get_text_embedding_batch.side_effect = lambda texts: [[0.1] * 4 for _ in texts]
+        client = MagicMock()
+        client.bulk = AsyncMock(return_value={"items": [{"index": {}}]})
+        client.close = AsyncMock()
+        redis_client = MagicMock()
+        tombstones = {llama_rag.NOTES_VECTOR_DELETED_PREFIX + "n1"}
+        redis_client.mget.side_effect = lambda keys: ["1" if k in tombstones else None for k in keys]
+
+        with patch.object(llama_rag, "_redis", redis_client), \
+             patch.object(llama_rag, "ensure_user_notes_index", AsyncMock()), \
+             patch.object(llama_rag, "get_embed_model", return_value=embed_model), \
+             patch("opensearchpy.AsyncOpenSearch", return_value=client):
+            indexed = await llama_rag.bulk_index_user_notes([_note("n1", "已删除"), _note("n2", "笔记二")])
+
+        assert indexed == 1
+        embed_model.get_text_embedding_batch.assert_called_once_with(["笔记二"])
+
+    @pytest.mark.asyncio
+    async def test_note_deleted_during_embedding_is_removed_after_write(self):
+        redis_client = MagicMock()
+        tombstones = set()
+
+        def _embed(texts):
+            # 向量化期间笔记被删除
+            tombstones.add(llama_rag.NOTES_VECTOR_DELETED_PREFIX + "n1")
+            return [[0.1] * 4 for _ in texts]
+
+        embed_model = MagicMock()
+        embed_model.get_text_embedding_batch.side_effect = _embed
+        redis_client.mget.side_effect = lambda keys: ["1" if k in tombstones else None for k in keys]
+        client = MagicMock()
+        client.bulk = AsyncMock(return_value={"items": [{"index": {}}]})
+        client.close = AsyncMock()
+
+        with patch.object(llama_rag, "_redis", redis_client), \
+             patch.object(llama_rag, "ensure_user_notes_index", AsyncMock()), \
+             patch.object(llama_rag, "get_embed_model", return_value=embed_model), \
+             patch.object(llama_rag, "delete_user_note_index", AsyncMock()) as delete, \
+             patch("opensearchpy.AsyncOpenSearch", return_value=client):
+            await llama_rag.bulk_index_user_notes([_note("n1", "内容")])
+
+        delete.assert_awaited_once_with("n1", "u1")
+
+    @pytest.mark.asyncio
+    async def test_write_blocked_index_raises_for_retry(self):
+        embed_model = MagicMock()
+        embed_model.get_text_embedding_batch.side_effect = lambda texts: [[0.1] * 4 for _ in texts]
+        client = MagicMock()
+        client.bulk = AsyncMock(return_value={"items": [
+            {"index": {"error": {"type": "cluster_block_exception", "reason": "index [athena_user_notes] blocked"}}},
+        ]})
+        client.close = AsyncMock()
+        redis_client = MagicMock()
+        redis_client.mget.side_effect = lambda keys: [None] * len(keys)
+
+        with patch.object(llama_rag, "_redis", redis_client), \
+             patch.object(llama_rag, "ensure_user_notes_index", AsyncMock()), \
+             patch.object(llama_rag, "get_embed_model", return_value=embed_model), \
+             patch("opensearchpy.AsyncOpenSearch", return_value=client):
+            with pytest.raises(RuntimeError):
+                await llama_rag.bulk_index_user_notes([_note("n1", "内容")])
+
+    def test_queue_schedules_single_flush_per_window(self):
+        redis_client = MagicMock()
+        pipe = redis_client.pipeline.return_value
+        pipe.execute.side_effect = [[1, True], [2, None]]
+        celery_app = MagicMock()
+
+        with patch.object(llama_rag, "_redis", redis_client), \
+             patch("app.celery_app.celery_app", celery_app):
+            assert llama_rag.queue_user_note_vector(_note("n1", "a"))
+            assert llama_rag.queue_user_note_vector(_note("n2", "b"))
+
+        assert pipe.rpush.call_count == 2
+        celery_app.send_task.assert_called_once()
+        assert celery_app.send_task.call_args.args[0] == "tasks.flush_user_note_vectors"
+
+    @pytest.mark.asyncio
+    async def test_drain_requeues_batch_on_failure(self):
+        redis_client = MagicMock()
+        raw = ['{"note_id": "n1"}', '{"note_id": "n2"}']
+        redis_client.pipeline.return_value.execute.return_value = [raw, True]
+
+        with patch.object(llama_rag, "_redis", redis_client), \
+             patch.object(llama_rag, "bulk_index_user_notes", AsyncMock(side_effect=RuntimeError("down"))):
+            with pytest.raises(RuntimeError):
+                await llama_rag.drain_user_note_vectors()
+
+        # 放回队列头部并保持原顺序，排在之后到达的新内容之前
+        redis_client.lpush.assert_called_once_with(llama_rag.NOTES_VECTOR_PENDING_KEY, *reversed(raw))
+
+
+class TestUserNotesRouting:
+    """笔记索引按 user_id 路由测试"""
+
+    @pytest.mark.asyncio
+    async def test_search_is_routed_to_user_shard(self):
+        client = _mock_client([{"hits": {"hits": []}}, {"hits": {"hits": []}}])
+
+        with patch.object(llama_rag, "get_local_embedding", AsyncMock(return_value=[0.1] * 4)), \
+             patch("opensearchpy.AsyncOpenSearch", return_value=client):
+            await llama_rag.search_user_notes("问题", user_id="u1")
+
+        for call in client.search.call_args_list:
+            assert call.kwargs["routing"] == "u1"
+            # 路由只决定访问的分片，user_id 过滤仍必须保留
+            assert "{'term': {'metadata.user_id': 'u1'}}" in str(call.kwargs["body"])
+
+    def test_new_index_requires_routing(self):
+        body = llama_rag.user_notes_index_body()
+        assert body["mappings"]["_routing"] == {"required": True}
+        assert body["settings"]["index"]["number_of_shards"] == llama_rag.USER_NOTES_INDEX_SHARDS
+
+    @pytest.mark.asyncio
+    async def test_delete_without_user_id_falls_back_to_query(self):
+        client = MagicMock()
+        client.delete = AsyncMock()
+        client.delete_by_query = AsyncMock()
+        client.close = AsyncMock()
+
+        with patch("opensearchpy.AsyncOpenSearch", return_value=client):
+            await llama_rag.delete_user_note_index("n1", user_id="u1")
+            await llama_rag.delete_user_note_index("n2")
+
+        assert client.delete.call_args.kwargs["routing"] == "u1"
+        assert client.delete_by_query.call_args.kwargs["body"] == {"query": {"term": {"metadata.note_id": "n2"}}}
+
+
+# ============================================================================
+# 书籍向量索引零停机重建
+# ============================================================================
+
+
+def _alias_client(aliases: dict, physical: set = frozenset()):
+    """aliases: 别名 -> 物理索引列表"""
+    from opensearchpy.exceptions import NotFoundError
+
+    async def get_alias(name):
+        if name not in aliases:
+            raise NotFoundError(404, "alias_missing", {})
+        return {index: {"aliases": {name: {}}} for index in aliases[name]}
+
+    client = MagicMock()
+    client.indices.get_alias = AsyncMock(side_effect=get_alias)
+    client.indices.exists = AsyncMock(side_effect=lambda index: index in physical)
+    client.indices.create = AsyncMock()
+    client.indices.update_aliases = AsyncMock()
+    client.indices.put_settings = AsyncMock()
+    client.indices.refresh = AsyncMock()
+    client.indices.delete = AsyncMock()
+    client.close = AsyncMock()
+    return client
+
+
+class TestBookChunksRebuild:
+    """读/写别名与原子切换测试"""
+
+    @pytest.mark.asyncio
+    async def test_begin_moves_only_write_alias(self):
+        client = _alias_client({
+            llama_rag.BOOK_CHUNKS_INDEX: ["chunks_v1"],
+            llama_rag.BOOK_CHUNKS_WRITE_ALIAS: ["chunks_v1"],
+        })
+
+        with patch.object(llama_rag, "ensure_book_chunks_index", AsyncMock()), \
+             patch("opensearchpy.AsyncOpenSearch", return_value=client):
+            result = await llama_rag.begin_book_chunks_rebuild()
+
+        assert result["started"]
+        settings = client.indices.create.call_args.kwargs["body"]["settings"]["index"]
+        assert settings["refresh_interval"] == "-1"
+        actions = client.indices.update_aliases.call_args.kwargs["body"]["actions"]
+        assert {"remove": {"index": "chunks_v1", "alias": llama_rag.BOOK_CHUNKS_WRITE_ALIAS}} in actions
+        assert all(a.get("add", {}).get("alias") != llama_rag.BOOK_CHUNKS_INDEX for a in actions)
+
+    @pytest.mark.asyncio
+    async def test_finish_swaps_read_alias_atomically(self):
+        client = _alias_client({
+            llama_rag.BOOK_CHUNKS_INDEX: ["chunks_v1"],
+            llama_rag.BOOK_CHUNKS_WRITE_ALIAS: ["chunks_v2"],
+        })
+
+        with patch("opensearchpy.AsyncOpenSearch", return_value=client):
+            result = await llama_rag.finish_book_chunks_rebuild()
+
+        assert result["swapped"]
+        client.indices.update_aliases.assert_awaited_once()
+        actions = client.indices.update_aliases.call_args.kwargs["body"]["actions"]
+        assert actions == [
+            {"remove": {"index": "chunks_v1", "alias": llama_rag.BOOK_CHUNKS_INDEX}},
+            {"add": {"index": "chunks_v2", "alias": llama_rag.BOOK_CHUNKS_INDEX}},
+        ]
+        client.indices.delete.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_finish_replaces_legacy_physical_index(self):
+        client = _alias_client(
+            {llama_rag.BOOK_CHUNKS_WRITE_ALIAS: ["chunks_v2"]},
+            physical={llama_rag.BOOK_CHUNKS_INDEX},
+        )
+
+        with patch("opensearchpy.AsyncOpenSearch", return_value=client):
+            await llama_rag.finish_book_chunks_rebuild(delete_old=True)
+
+        actions = client.indices.update_aliases.call_args.kwargs["body"]["actions"]
+        assert actions[0] == {"remove_index": {"index": llama_rag.BOOK_CHUNKS_INDEX}}
+        client.indices.delete.assert_not_called()
+
+
+# ============================================================================
+# 书籍向量索引维护
+# ============================================================================
+
+
+class TestIndexMaintenance:
+    """segment 合并与 refresh 调整决策测试"""
+
+    @staticmethod
+    def _stats(segments=4, deleted_ratio=0.0):
+        return {"index": "chunks_v1", "segments": segments, "deleted_ratio": deleted_ratio, "write_ops_total": 0}
+
+    def test_quiet_hours_wrap_midnight(self):
+        from app.services.index_maintenance import in_quiet_hours
+
+        assert in_quiet_hours(3, "2-6")
+        assert not in_quiet_hours(6, "2-6")
+        assert in_quiet_hours(23, "23-5") and in_quiet_hours(1, "23-5")
+        assert not in_quiet_hours(12, "23-5")
+        assert in_quiet_hours(12, "")
+
+    def test_busy_writes_raise_refresh_interval_and_skip_merge(self):
+        from app.services import index_maintenance as im
+
+        actions = im.plan_maintenance(self._stats(segments=50, deleted_ratio=0.5), im.BUSY_WRITES_PER_MIN, None, 3)
+        assert actions == [("refresh", im.BUSY_REFRESH_INTERVAL)]
+
+    def test_quiet_restores_refresh_and_expunges_deletes(self):
+        from app.services import index_maintenance as im
+
+        actions = im.plan_maintenance(self._stats(segments=50, deleted_ratio=0.5), 0, im.BUSY_REFRESH_INTERVAL, 3)
+        assert actions == [("refresh", None), ("expunge_deletes",)]
+
+    def test_merges_segments_only_in_quiet_hours(self):
+        from app.services import index_maintenance as im
+
+        stats = self._stats(segments=im.MAINT_MAX_SEGMENTS + 10)
+        assert im.plan_maintenance(stats, 0, None, 3) == [("merge", im.MAINT_MAX_SEGMENTS)]
+        assert im.plan_maintenance(stats, 0, None, 12) == []
+        # 首轮没有写入速率基线
+        assert im.plan_maintenance(stats, None, None, 3) == []
+
+    @pytest.mark.asyncio
+    async def test_skips_while_rebuilding(self):
+        from app.services import index_maintenance as im
+
+        client = _alias_client({
+            llama_rag.BOOK_CHUNKS_INDEX: ["chunks_v1"],
+            llama_rag.BOOK_CHUNKS_WRITE_ALIAS: ["chunks_v2"],
+        })
+        client.indices.forcemerge = AsyncMock()
+        redis = MagicMock()
+        redis.set.return_value = True
+
+        with patch.object(im, "_get_redis", return_value=redis), \
+             patch("opensearchpy.AsyncOpenSearch", return_value=client):
+            result = await im.maintain_book_chunks_index()
+
+        assert result == {"skipped": "rebuilding"}
+        client.indices.forcemerge.assert_not_called()
+        client.indices.put_settings.assert_not_called()
+        redis.delete.assert_called_once_with(im.MAINT_LOCK_KEY)
+
+    @pytest.mark.asyncio
+    async def test_collects_segment_and_hnsw_stats(self):
+        from app.services.index_maintenance import collect_book_chunks_stats
+
+        client = MagicMock()
+        client.indices.stats = AsyncMock(return_value={"_all": {"primaries": {
+            "docs": {"count": 900, "deleted": 100},
+            "segments": {"count": 37, "memory_in_bytes": 1024},
+            "indexing": {"index_total": 500, "delete_total": 50},
+        }}})
+        client.transport.perform_request = AsyncMock(return_value={"nodes": {
+            "n1": {"graph_memory_usage": 2048, "knn_query_requests": 7, "cache_capacity_reached": False},
+        }})
+
+        stats = await collect_book_chunks_stats(client, "chunks_v1")
+
+        assert stats["segments"] == 37
+        assert stats["deleted_ratio"] == 0.1
+        assert stats["write_ops_total"] == 550
+        assert stats["hnsw"]["graph_memory_usage_kb"] == 2048
@@ -0,0 +1,221 @@
+"""
+书籍处理任务去重（singleflight）测试
+
+测试覆盖:
+- 申领角色（leader / attached / done / bypassed）
+- 完成时扇出等待者
+- 向量任务：等待者与执行者共享 vector_indexed_at
+- 向量任务：执行者出错时重新投递等待者
+- OCR 任务：执行者失败时只标记自身 failed，重新投递等待者
+"""
+
+import asyncio
+import json
+from contextlib import asynccontextmanager
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+
+from app.services.task_singleflight import TaskSingleflight
+
+
+class _FakeScripts:
+    """按 Lua 脚本语义模拟 Redis 中的租约 / 等待者 / 结果"""
+
+    def __init__(self):
+        self.store = {}
+
+    def claim(self, keys, args):
+        lease, waiters, done = keys
+        member, token, _ttl = args
+        if done in self.store:
+            return ["done", self.store[done]]
+        if lease not in self.store:
+            self.store[lease] = token
+            return ["leader", ""]
+        self.store.setdefault(waiters, set()).add(member)
+        return ["attached", ""]
+
+    def finish(self, keys, args):
+        lease, waiters, done = keys
+        token, payload, _ttl = args
+        members = sorted(self.store.pop(waiters, set()))
+        if self.store.get(lease) == token:
+            del self.store[lease]
+        if payload:
+            self.store[done] = payload
+        return members
+
+
+@pytest.fixture
+def singleflight():
+    fake = _FakeScripts()
+    sf = TaskSingleflight()
+    sf._claim, sf._finish = fake.claim, fake.finish
+    sf.fake = fake
+    return sf
+
+
+class TestTaskSingleflight:
+    """申领与扇出测试"""
+
+    def test_second_claim_attaches_and_is_fanned_out(self, singleflight):
+        leader = singleflight.claim("ocr", "sha", "v1", "b1:u1", 60)
+        follower = singleflight.claim("ocr", "sha", "v1", "b2:u2", 60)
+
+        assert leader.role == "leader" and leader.is_leader
+        assert follower.role == "attached" and not follower.is_leader
+        assert singleflight.complete(leader, {"layered_key": "k"}) == ["b2:u2"]
+        # 租约已释放，等待者集合已清空
+        assert leader.keys[0] not in singleflight.fake.store
+        assert leader.keys[1] not in singleflight.fake.store
+
+    def test_recent_result_is_reused(self, singleflight):
+        leader = singleflight.claim("vector", "sha", "v1", "b1", 60)
+        singleflight.complete(leader, {"chunks_indexed": 12})
+
+        late = singleflight.claim("vector", "sha", "v1", "b3", 60)
+        assert late.role == "done"
+        assert late.result == {"chunks_indexed": 12}
+
+    def test_failure_releases_lease_without_result(self, singleflight):
+        leader = singleflight.claim("ocr", "sha", "v1", "b1:u1", 60)
+        singleflight.claim("ocr", "sha", "v1", "b2:u2", 60)
+
+        assert singleflight.fail(leader) == ["b2:u2"]
+        assert singleflight.claim("ocr", "sha", "v1", "b4:u4", 60).role == "leader"
+
+    def test_version_separates_flights(self, singleflight):
+        singleflight.claim("vector", "sha", "model:index_a", "b1", 60)
+        assert singleflight.claim("vector", "sha", "model:index_b", "b2", 60).role == "leader"
+
+    def test_missing_sha_bypasses(self, singleflight):
+        flight = singleflight.claim("ocr", None, "v1", "b1:u1", 60)
+        assert flight.role == "bypassed" and flight.is_leader
+        assert singleflight.complete(flight, {}) == []
+
+    def test_redis_error_fails_open(self):
+        sf = TaskSingleflight()
+        sf._claim = MagicMock(side_effect=ConnectionError("down"))
+        sf._finish = MagicMock()
+        assert sf.claim("ocr", "sha", "v1", "b1:u1", 60).role == "bypassed"
+
+
+def _task_engine(conn):
+    @asynccontextmanager
+    async def _begin():
+        yield conn
+
+    engine = MagicMock()
+    engine.begin = _begin
+    engine.dispose = AsyncMock()
+    return engine
+
+
+def _book_row(book_id="b1"):
+    result = MagicMock()
+    result.fetchone.return_value = (book_id, "u1", "书名", "作者", "k.epub", "epub", True, None, None, "sha")
+    return result
+
+
+class TestVectorTaskSingleflight:
+    """向量任务去重测试"""
+
+    @pytest.mark.asyncio
+    async def test_attached_book_skips_indexing(self, singleflight):
+        from app.tasks import index_tasks
+
+        singleflight.claim("vector", "sha", "v1", "other", 60)
+        conn = AsyncMock()
+        conn.execute = AsyncMock(return_value=_book_row())
+
+        with patch.object(index_tasks, "_create_task_engine", return_value=_task_engine(conn)), \
+             patch.object(index_tasks, "get_task_singleflight", return_value=singleflight), \
+             patch.object(index_tasks, "_vector_task_version", AsyncMock(return_value="v1")), \
+             patch.object(index_tasks, "_index_claimed_book", AsyncMock()) as index:
+            result = await index_tasks._index_book_async("b1")
+
+        assert result["status"] == "attached"
+        index.assert_not_awaited()
+
+    @pytest.mark.asyncio
+    async def test_leader_marks_waiting_books_indexed(self, singleflight):
+        from app.tasks import index_tasks
+
+        conn = AsyncMock()
+        conn.execute = AsyncMock(return_value=_book_row())
+        success = {"status": "success", "book_id": "b1", "title": "书名", "chunks_indexed": 5}
+
+        async def _index(*args):
+            # 执行期间另一本同内容的书到达
+            assert singleflight.claim("vector", "sha", "v1", "b2", 60).role == "attached"
+            return success
+
+        with patch.object(index_tasks, "_create_task_engine", return_value=_task_engine(conn)), \
+             patch.object(index_tasks, "get_task_singleflight", return_value=singleflight), \
+             patch.object(index_tasks, "_vector_task_version", AsyncMock(return_value="v1")), \
+             patch.object(index_tasks, "_index_claimed_book", AsyncMock(side_effect=_index)):
+            result = await index_tasks._index_book_async("b1")
+
+        assert result == success
+        params = conn.execute.await_args.args[1]
+        assert params["ids"] == ["b1", "b2"]
+        done_key = singleflight._keys("vector", "sha", "v1")[2]
+        assert json.loads(singleflight.fake.store[done_key]) == {"chunks_indexed": 5}
+
+    @pytest.mark.asyncio
+    async def test_leader_error_resubmits_waiting_books(self, singleflight):
+        from app.tasks import index_tasks
+
+        waiter_rows = MagicMock()
+        waiter_rows.fetchall.return_value = [("b2", "u2")]
+        conn = AsyncMock()
+        conn.execute = AsyncMock(side_effect=[_book_row(), waiter_rows])
+        error = {"status": "error", "message": "Download failed: timeout"}
+
+        async def _index(*args):
+            assert singleflight.claim("vector", "sha", "v1", "b2", 60).role == "attached"
+            return error
+
+        with patch.object(index_tasks, "_create_task_engine", return_value=_task_engine(conn)), \
+             patch.object(index_tasks, "get_task_singleflight", return_value=singleflight), \
+             patch.object(index_tasks, "_vector_task_version", AsyncMock(return_value="v1")), \
+             patch.object(index_tasks, "_index_claimed_book", AsyncMock(side_effect=_index)), \
+             patch("app.services.fair_queue.submit_task") as submit:
+            result = await index_tasks._index_book_async("b1")
+
+        assert result == error
+        submit.assert_called_once_with("tasks.index_book_vectors", ["b2"], "u2")
+        assert singleflight.claim("vector", "sha", "v1", "b2", 60).role == "leader"
+
+
+class TestOCRTaskSingleflight:
+    """OCR 任务去重测试"""
+
+    def test_leader_failure_resubmits_waiting_books(self, singleflight):
+        from app.tasks import ocr_tasks
+
+        book = MagicMock()
+        book.fetchone.return_value = ("users/u1/k.pdf", "书名", "sha")
+        conn = AsyncMock()
+        conn.execute = AsyncMock(return_value=book)
+
+        def _download(bucket, key):
+            # 执行者下载期间另一本同内容的书到达；下载失败只与执行者自己的文件有关
+            assert singleflight.claim("ocr", "sha", ocr_tasks.OCR_TASK_VERSION, "b2:u2", 60).role == "attached"
+            return None
+
+        previous_loop = asyncio.get_event_loop_policy().get_event_loop()
+        with patch.object(ocr_tasks, "_create_task_engine", return_value=_task_engine(conn)), \
+             patch("app.services.task_singleflight.get_task_singleflight", return_value=singleflight), \
+             patch.object(ocr_tasks, "read_full", side_effect=_download), \
+             patch.object(ocr_tasks, "_set_ocr_status", AsyncMock()) as set_status, \
+             patch("app.services.fair_queue.submit_task") as submit:
+            ocr_tasks.process_book_ocr("b1", "u1")
+        # 任务在自建的事件循环中运行：关闭它并恢复原事件循环
+        asyncio.get_event_loop_policy().get_event_loop().close()
+        asyncio.set_event_loop(previous_loop)
+
+        assert [c.args[1:] for c in set_status.await_args_list] == [("b1", "u1", "failed")]
+        submit.assert_called_once_with("tasks.process_book_ocr", ["b2", "u2"], "u2")
+        assert singleflight.claim("ocr", "sha", ocr_tasks.OCR_TASK_VERSION, "b2:u2", 60).role == "leader"